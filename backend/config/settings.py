@@ -4,7 +4,8 @@ Django settings for CRM project.
 
 from pathlib import Path
 from datetime import timedelta
-from decouple import config
+from corsheaders.defaults import default_headers
+from decouple import Csv, config
 
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -78,6 +79,13 @@ if REDIS_URL:
             'CONFIG': {'hosts': [REDIS_URL]},
         }
     }
+    # Cache compartilhado entre os processos (ex.: versão da lista de números bloqueados)
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': REDIS_URL,
+        }
+    }
 else:
     CHANNEL_LAYERS = {
         'default': {
@@ -85,6 +93,13 @@ else:
         }
     }
 
+# WebSocket multiplexado (ws/atendimento/): intervalo do heartbeat (s) e eventos
+# pendentes por conexão antes de descartar prévias de um client lento
+WS_HEARTBEAT_SEGUNDOS = config('WS_HEARTBEAT_SEGUNDOS', default=25, cast=int)
+WS_FILA_MAX = config('WS_FILA_MAX', default=200, cast=int)
+# Eventos aguardando a thread de envio ao Redis (services.difusao); cheia, descarta
+WS_DIFUSAO_FILA_MAX = config('WS_DIFUSAO_FILA_MAX', default=1000, cast=int)
+
 
 # Database
 DB_ENGINE = config('DB_ENGINE', default='django.db.backends.mysql')
@@ -141,6 +156,9 @@ CORS_ALLOWED_ORIGINS = config(
     default='http://localhost:8080,http://localhost:5173'
 ).split(',')
 CORS_ALLOW_CREDENTIALS = True
+# Delta do chat: o cliente manda If-None-Match e lê o ETag da resposta
+CORS_ALLOW_HEADERS = (*default_headers, 'if-none-match')
+CORS_EXPOSE_HEADERS = ['ETag']
 
 # REST Framework Configuration
 REST_FRAMEWORK = {
@@ -195,11 +213,47 @@ SPECTACULAR_SETTINGS = {
 EVOLUTION_API_KEY = config('EVOLUTION_API_KEY', default='')
 EVOLUTION_INSTANCE_ID = config('EVOLUTION_INSTANCE_ID', default='')
 EVOLUTION_API_URL = config('EVOLUTION_API_URL', default='https://evo.matutec.com.br')
+# Cliente HTTP (services.evolution_http): timeouts em segundos, tentativas em
+# 429/5xx, conexões keep-alive por processo e teto de requisições simultâneas
+# por instância (o limite efetivo se adapta às respostas da API)
+EVOLUTION_HTTP_CONNECT_TIMEOUT = config('EVOLUTION_HTTP_CONNECT_TIMEOUT', default=5, cast=float)
+EVOLUTION_HTTP_READ_TIMEOUT = config('EVOLUTION_HTTP_READ_TIMEOUT', default=30, cast=float)
+EVOLUTION_HTTP_TENTATIVAS = config('EVOLUTION_HTTP_TENTATIVAS', default=3, cast=int)
+EVOLUTION_HTTP_POOL = config('EVOLUTION_HTTP_POOL', default=20, cast=int)
+EVOLUTION_CONCORRENCIA_MAX = config('EVOLUTION_CONCORRENCIA_MAX', default=16, cast=int)
+
+# Downloads de mídia (services.media_fetcher): tipos baixados assim que chegam (os demais só
+# quando abertos no chat), teto de tamanho, downloads simultâneos (total e por instância),
+# horas que uma mídia que falhou de vez fica sem nova tentativa (0 = para sempre) e quantas
+# mídias pendentes a abertura de um chat agenda
+MIDIA_PREFETCH = config('MIDIA_PREFETCH', default='audio,image', cast=Csv())
+MIDIA_TAMANHO_MAX_MB = config('MIDIA_TAMANHO_MAX_MB', default=16, cast=int)
+MIDIA_DOWNLOADS_MAX = config('MIDIA_DOWNLOADS_MAX', default=4, cast=int)
+MIDIA_DOWNLOADS_POR_INSTANCIA = config('MIDIA_DOWNLOADS_POR_INSTANCIA', default=2, cast=int)
+MIDIA_FALHA_HORAS = config('MIDIA_FALHA_HORAS', default=24, cast=int)
+MIDIA_PENDENTES_POR_CHAT = config('MIDIA_PENDENTES_POR_CHAT', default=10, cast=int)
+# Validade (s) das URLs assinadas de streaming das mídias (media_store.url_midia)
+MIDIA_URL_TTL = config('MIDIA_URL_TTL', default=3600, cast=int)
 
 # Webhook security: token secreto para validar requisições do webhook WhatsApp
 # Deve ser igual ao "apikey" configurado na Evolution API
 WEBHOOK_SECRET = config('WEBHOOK_SECRET', default='')
 
+# Modo assíncrono do webhook: a view só grava o payload bruto em WebhookEvento e
+# responde 200; o worker `python manage.py process_webhook_inbox` processa a fila.
+WHATSAPP_WEBHOOK_ASYNC = config('WHATSAPP_WEBHOOK_ASYNC', default=False, cast=bool)
+# Tentativas antes de mover o evento para o estado FALHOU (dead-letter)
+WEBHOOK_INBOX_MAX_TENTATIVAS = config('WEBHOOK_INBOX_MAX_TENTATIVAS', default=5, cast=int)
+
+# Tarefas em segundo plano (model Tarefa). Com True a aplicação só grava as tarefas e
+# `python manage.py run_workers` as executa; com False rodam num pool local após o commit.
+TAREFAS_WORKER = config('TAREFAS_WORKER', default=False, cast=bool)
+# Threads do run_workers e do pool local (limite de tarefas simultâneas)
+TAREFAS_THREADS = config('TAREFAS_THREADS', default=4, cast=int)
+TAREFAS_THREADS_LOCAIS = config('TAREFAS_THREADS_LOCAIS', default=4, cast=int)
+# Dias que tarefas concluídas/falhas ficam no banco (limpeza periódica)
+TAREFAS_RETENCAO_DIAS = config('TAREFAS_RETENCAO_DIAS', default=7, cast=int)
+
 # Whisper Audio Transcription Settings
 # Modelos disponíveis: tiny, base, small, medium, large-v2, large-v3
 # Quanto maior o modelo, melhor a qualidade mas mais lento e usa mais memória
@@ -208,3 +262,18 @@ WHISPER_MODEL_SIZE = config('WHISPER_MODEL_SIZE', default='base')
 WHISPER_DEVICE = config('WHISPER_DEVICE', default='cpu')
 # Tipo de computação: 'int8' (cpu), 'float16' (gpu), 'int8_float16' (gpu híbrido)
 WHISPER_COMPUTE_TYPE = config('WHISPER_COMPUTE_TYPE', default='int8')
+# Threads de CPU do modelo (0 = padrão do faster-whisper)
+WHISPER_CPU_THREADS = config('WHISPER_CPU_THREADS', default=0, cast=int)
+# Seleção adaptativa por duração: "duracao_max_s:modelo:beam" por faixa, em ordem crescente;
+# duração 0 = sem limite (ex.: "45:tiny:1,300:base:5,0:small:5"). Vazio = só WHISPER_MODEL_SIZE
+WHISPER_NIVEIS = config('WHISPER_NIVEIS', default='')
+# Com esta quantidade de pedidos na fila cada áudio desce um nível e usa beam 1 (0 desativa)
+WHISPER_FILA_REBAIXAR = config('WHISPER_FILA_REBAIXAR', default=10, cast=int)
+# Modelos mantidos carregados ao mesmo tempo (LRU) e teto de memória estimada em MB (0 = sem teto)
+WHISPER_MODELOS_CARREGADOS = config('WHISPER_MODELOS_CARREGADOS', default=2, cast=int)
+WHISPER_MEMORIA_MAX_MB = config('WHISPER_MEMORIA_MAX_MB', default=1500, cast=int)
+# Daemon de transcrição: com True os áudios vão para a fila TranscricaoAudio e são
+# transcritos por `python manage.py whisper_worker` (modelo carregado uma só vez)
+WHISPER_WORKER = config('WHISPER_WORKER', default=False, cast=bool)
+# Tempo máximo (s) que o "transcrever" do chat espera o daemon antes de responder "na fila"
+WHISPER_ESPERA_INTERATIVA = config('WHISPER_ESPERA_INTERATIVA', default=60, cast=int)
@@ -6,7 +6,7 @@ from django.contrib.auth.admin import UserAdmin as BaseUserAdmin
 from .models import (
     Canal, User, Conta, Contato, TipoContato, Funil, EstagioFunil, FunilEstagio, Oportunidade, Atividade,
     DiagnosticoPilar, DiagnosticoPergunta, DiagnosticoResposta, DiagnosticoResultado,
-    Plano, PlanoAdicional, Log, NumeroBloqueado
+    Plano, PlanoAdicional, Log, NumeroBloqueado, WebhookEvento
 )
 
 
@@ -143,6 +143,24 @@ class NumeroBloqueadoAdmin(admin.ModelAdmin):
     readonly_fields = ['data_criacao']
 
 
+@admin.register(WebhookEvento)
+class WebhookEventoAdmin(admin.ModelAdmin):
+    list_display = ['id', 'instancia', 'evento', 'status', 'tentativas', 'data_recebimento', 'data_processamento']
+    list_filter = ['status', 'instancia']
+    search_fields = ['instancia', 'evento', 'ultimo_erro']
+    readonly_fields = ['data_recebimento', 'data_processamento']
+    actions = ['reenfileirar']
+
+    @admin.action(description='Reenfileirar eventos selecionados')
+    def reenfileirar(self, request, queryset):
+        from django.utils import timezone
+        queryset.update(
+            status=WebhookEvento.STATUS_PENDENTE,
+            tentativas=0,
+            proxima_tentativa=timezone.now(),
+        )
+
+
 @admin.register(Log)
 class LogAdmin(admin.ModelAdmin):
     list_display = ['timestamp', 'usuario', 'acao', 'modelo', 'objeto_id', 'objeto_repr', 'ip_address']
@@ -7,14 +7,33 @@ Cada canal (Canal model) tem sua própria sala WebSocket:
 
 Ao receber uma nova WhatsappMessage pelo webhook, o signal
 notifica o grupo do canal correspondente via channel_layer.group_send().
+
+O chat aberto assina a conversa pela mesma conexão e passa a receber as
+mensagens completas dela (services.chat_ao_vivo):
+  Client → {"acao": "assinar", "numero": "..."} / {"acao": "cancelar", "numero": "..."}
+  Grupo:   "atendimento_conversa_{canal_id}_{numero_chave}"
+
+AtendimentoMultiplexConsumer (ws/atendimento/) atende todos os canais em uma
+única conexão por navegador: os grupos de canal e de conversa são assinados
+e cancelados por mensagens na própria conexão, com heartbeat e fila de envio
+que coalesce/descarta as prévias quando o client não acompanha.
 """
 
+import asyncio
+import itertools
 import json
 import logging
+import time
+from collections import OrderedDict
+
+from django.conf import settings
 
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
 
+from crm.services.chat_ao_vivo import grupo as grupo_conversa
+from crm.services.phone import canonical_phone
+
 logger = logging.getLogger(__name__)
 
 
@@ -36,6 +55,7 @@ class AtendimentoConsumer(AsyncWebsocketConsumer):
 
         self.canal_id = canal_id
         self.group_name = f'atendimento_canal_{canal_id}'
+        self.assinaturas = {}  # numero_chave -> número como o client assinou
 
         await self.channel_layer.group_add(self.group_name, self.channel_name)
         await self.accept()
@@ -44,29 +64,257 @@ class AtendimentoConsumer(AsyncWebsocketConsumer):
     async def disconnect(self, close_code):
         if hasattr(self, 'group_name'):
             await self.channel_layer.group_discard(self.group_name, self.channel_name)
+            for chave in self.assinaturas:
+                await self.channel_layer.group_discard(grupo_conversa(self.canal_id, chave), self.channel_name)
             logger.info(f'[WS] Desconectou do canal {self.canal_id} (code={close_code})')
 
+    # Assinatura das conversas abertas no chat
+    async def receive(self, text_data=None, bytes_data=None):
+        try:
+            dados = json.loads(text_data or '{}')
+        except ValueError:
+            return
+        if not isinstance(dados, dict):
+            return
+
+        numero = str(dados.get('numero') or '')
+        chave = canonical_phone(numero)
+        if not chave:
+            return
+
+        if dados.get('acao') == 'assinar':
+            if chave not in self.assinaturas:
+                await self.channel_layer.group_add(grupo_conversa(self.canal_id, chave), self.channel_name)
+            self.assinaturas[chave] = numero
+            await self.enviar({'tipo': 'conversa_assinada', 'numero': numero})
+        elif dados.get('acao') == 'cancelar' and chave in self.assinaturas:
+            del self.assinaturas[chave]
+            await self.channel_layer.group_discard(grupo_conversa(self.canal_id, chave), self.channel_name)
+
+    async def enviar(self, dados, coalescer=None):
+        """
+        Envia o evento ao client. coalescer: chave das prévias que podem ser
+        substituídas pela mais recente (usada pelo AtendimentoMultiplexConsumer).
+        """
+        await self.send(text_data=json.dumps(dados))
+
     # Mensagem enviada pelo grupo (via signal/webhook) → encaminha para o client
     async def nova_mensagem(self, event):
-        await self.send(text_data=json.dumps({
-            'tipo': 'nova_mensagem',
-            'conversa': event['conversa'],
-        }))
+        conversa = event['conversa']
+        await self.enviar(
+            {'tipo': 'nova_mensagem', 'conversa': conversa},
+            coalescer=('nova_mensagem', conversa.get('canal_id'), conversa.get('numero')),
+        )
 
-    # Notificação de contagem de não lidas atualizada
+    # Notificação de contagem de não lidas atualizada (services.nao_lidas):
+    # conversa, oportunidade e totais do canal
     async def unread_update(self, event):
-        await self.send(text_data=json.dumps({
-            'tipo': 'unread_update',
-            'numero': event['numero'],
-            'canal_id': event['canal_id'],
-            'nao_lidas': event['nao_lidas'],
-        }))
+        dados = {k: v for k, v in event.items() if k != 'type'}
+        await self.enviar(
+            {'tipo': 'unread_update', **dados},
+            coalescer=('unread_update', dados.get('canal_id'), dados.get('numero')),
+        )
+
+    # Transcrição progressiva de um áudio (services.transcricao): texto acumulado
+    # a cada segmento e, por último, concluida=True com o texto gravado
+    async def transcricao_parcial(self, event):
+        dados = {k: v for k, v in event.items() if k != 'type'}
+        await self.enviar(
+            {'tipo': 'transcricao_parcial', **dados},
+            coalescer=('transcricao_parcial', dados.get('mensagem_id')),
+        )
+
+    def numero_assinado(self, event):
+        return self.assinaturas.get(event['numero_chave'])
+
+    # Mensagens criadas/alteradas de uma conversa assinada (services.chat_ao_vivo),
+    # no formato do WhatsappMessageSlimSerializer
+    async def conversa_mensagens(self, event):
+        numero = self.numero_assinado(event)
+        if numero is None:
+            return
+        await self.enviar({
+            'tipo': 'conversa_mensagens',
+            'canal_id': event.get('canal_id'),
+            'numero': numero,
+            'mensagens': event['mensagens'],
+        })
 
     @database_sync_to_async
     def can_access_canal(self, user, canal_id):
-        from crm.models import Canal
-        # Admin pode acessar qualquer canal
-        if user.perfil == 'ADMIN' or user.is_superuser:
-            return Canal.objects.filter(id=canal_id).exists()
-        # Demais usuários só acessam o próprio canal
-        return str(getattr(user.canal, 'id', None)) == str(canal_id)
+        return pode_acessar_canal(user, canal_id)
+
+
+def pode_acessar_canal(user, canal_id):
+    from crm.models import Canal
+    # Admin pode acessar qualquer canal
+    if user.perfil == 'ADMIN' or user.is_superuser:
+        return Canal.objects.filter(id=canal_id).exists()
+    # Demais usuários só acessam o próprio canal
+    return str(getattr(user.canal, 'id', None)) == str(canal_id)
+
+
+def canais_do_usuario(user):
+    """Ids dos canais que o usuário pode acompanhar (Admin: todos)."""
+    from crm.models import Canal
+    if user.perfil == 'ADMIN' or user.is_superuser:
+        return list(Canal.objects.values_list('id', flat=True))
+    return [user.canal_id] if user.canal_id else []
+
+
+class AtendimentoMultiplexConsumer(AtendimentoConsumer):
+    """
+    Uma conexão para todos os canais do usuário (URL: ws/atendimento/).
+
+    Client → {"acao": "assinar_canal", "canal_id": 3} / {"acao": "cancelar_canal", "canal_id": 3}
+             {"acao": "assinar", "numero": "...", "canal_id": 3} / {"acao": "cancelar", ...}
+               (sem canal_id: a conversa em todos os canais do usuário)
+             {"acao": "pong"}
+    Server → os mesmos eventos do AtendimentoConsumer, mais
+             {"tipo": "canal_assinado", "canal_id": 3}, {"tipo": "conversa_assinada", "numero": "..."},
+             {"tipo": "erro", "erro": "sem_permissao", "canal_id": 3},
+             {"tipo": "heartbeat"} a cada WS_HEARTBEAT_SEGUNDOS e
+             {"tipo": "ressincronizar"} quando eventos foram descartados.
+
+    Os eventos passam por uma fila escrita por uma única task: se o client
+    não acompanha (o send fica esperando), prévias da mesma conversa
+    (nova_mensagem, unread_update, transcricao_parcial) ainda na fila são
+    substituídas pela mais recente e, acima de WS_FILA_MAX, os eventos novos
+    são descartados; quando a fila esvazia o client recebe `ressincronizar`
+    e recarrega o que estiver aberto. Sem nenhuma mensagem do client por dois
+    heartbeats, a conexão é fechada (code 4008).
+    """
+
+    async def connect(self):
+        user = self.scope.get('user')
+        if not user or not user.is_authenticated:
+            await self.close(code=4001)
+            return
+
+        self.user = user
+        self.canais = set()
+        self.assinaturas = {}  # (canal_id, numero_chave) -> número como o client assinou
+        self.preparar_fila()
+
+        await self.accept()
+        self.tarefas = [
+            asyncio.ensure_future(self._escrever_fila()),
+            asyncio.ensure_future(self._heartbeat()),
+        ]
+        logger.info(f'[WS] {user.username} conectou (multiplex)')
+
+    async def disconnect(self, close_code):
+        for tarefa in getattr(self, 'tarefas', []):
+            tarefa.cancel()
+        for canal_id in getattr(self, 'canais', ()):
+            await self.channel_layer.group_discard(f'atendimento_canal_{canal_id}', self.channel_name)
+        for canal_id, chave in getattr(self, 'assinaturas', {}):
+            await self.channel_layer.group_discard(grupo_conversa(canal_id, chave), self.channel_name)
+
+    async def receive(self, text_data=None, bytes_data=None):
+        self.ultimo_contato = time.monotonic()
+        try:
+            dados = json.loads(text_data or '{}')
+        except ValueError:
+            return
+        if not isinstance(dados, dict):
+            return
+
+        acao = dados.get('acao')
+        try:
+            canal_id = int(dados['canal_id']) if dados.get('canal_id') not in (None, '') else None
+        except (TypeError, ValueError):
+            return
+
+        if acao in ('assinar_canal', 'cancelar_canal') and canal_id is not None:
+            await self._canal(acao == 'assinar_canal', canal_id)
+        elif acao in ('assinar', 'cancelar'):
+            await self._conversa(acao == 'assinar', str(dados.get('numero') or ''), canal_id)
+
+    async def _canal(self, assinar, canal_id):
+        grupo = f'atendimento_canal_{canal_id}'
+        if not assinar:
+            if canal_id in self.canais:
+                self.canais.discard(canal_id)
+                await self.channel_layer.group_discard(grupo, self.channel_name)
+            return
+        if canal_id not in self.canais:
+            if not await database_sync_to_async(pode_acessar_canal)(self.user, canal_id):
+                await self._controle({'tipo': 'erro', 'erro': 'sem_permissao', 'canal_id': canal_id})
+                return
+            self.canais.add(canal_id)
+            await self.channel_layer.group_add(grupo, self.channel_name)
+        await self._controle({'tipo': 'canal_assinado', 'canal_id': canal_id})
+
+    async def _conversa(self, assinar, numero, canal_id):
+        chave = canonical_phone(numero)
+        if not chave:
+            return
+
+        if not assinar:
+            for canal_chave in [k for k in self.assinaturas if k[1] == chave and canal_id in (None, k[0])]:
+                del self.assinaturas[canal_chave]
+                await self.channel_layer.group_discard(grupo_conversa(*canal_chave), self.channel_name)
+            return
+
+        if canal_id is None:
+            canais = await database_sync_to_async(canais_do_usuario)(self.user)
+        elif await database_sync_to_async(pode_acessar_canal)(self.user, canal_id):
+            canais = [canal_id]
+        else:
+            await self._controle({'tipo': 'erro', 'erro': 'sem_permissao', 'canal_id': canal_id})
+            return
+
+        for cid in canais:
+            if (cid, chave) not in self.assinaturas:
+                await self.channel_layer.group_add(grupo_conversa(cid, chave), self.channel_name)
+            self.assinaturas[(cid, chave)] = numero
+        await self._controle({'tipo': 'conversa_assinada', 'numero': numero})
+
+    def numero_assinado(self, event):
+        return self.assinaturas.get((int(event.get('canal_id') or 0), event['numero_chave']))
+
+    # ──────────────────────────────
+    # Fila de envio (backpressure) e heartbeat
+    # ──────────────────────────────
+
+    def preparar_fila(self):
+        self.fila = OrderedDict()  # coalescer (ou sequência) -> evento
+        self.sequencia = itertools.count()
+        self.descartou = False
+        self.tem_eventos = asyncio.Event()
+        self.ultimo_contato = time.monotonic()
+
+    async def enviar(self, dados, coalescer=None):
+        if coalescer is not None and coalescer in self.fila:
+            self.fila[coalescer] = dados
+        elif len(self.fila) >= getattr(settings, 'WS_FILA_MAX', 200):
+            self.descartou = True
+        else:
+            self.fila[coalescer if coalescer is not None else next(self.sequencia)] = dados
+        self.tem_eventos.set()
+
+    async def _escrever_fila(self):
+        while True:
+            await self.tem_eventos.wait()
+            self.tem_eventos.clear()
+            while self.fila:
+                _, dados = self.fila.popitem(last=False)
+                await self.send(text_data=json.dumps(dados))
+            if self.descartou:
+                self.descartou = False
+                await self.send(text_data=json.dumps({'tipo': 'ressincronizar'}))
+
+    async def _heartbeat(self):
+        intervalo = getattr(settings, 'WS_HEARTBEAT_SEGUNDOS', 25)
+        while True:
+            await asyncio.sleep(intervalo)
+            if time.monotonic() - self.ultimo_contato > 2 * intervalo:
+                logger.info(f'[WS] {self.user.username} sem resposta ao heartbeat: fechando')
+                await self.close(code=4008)
+                return
+            await self._controle({'tipo': 'heartbeat'})
+
+    async def _controle(self, dados):
+        """Respostas de controle não entram na fila: passam na frente das prévias acumuladas."""
+        await self.send(text_data=json.dumps(dados))
@@ -0,0 +1,71 @@
+"""
+Move as mídias em base64 das mensagens WhatsApp (media_base64) para o store
+endereçado por conteúdo (services.media_store).
+
+Uso:
+    python manage.py migrar_midias_whatsapp                  # todas as mensagens
+    python manage.py migrar_midias_whatsapp --lote 100 --limite 5000
+
+Processa em blocos por id, carregando apenas o base64 do bloco atual; cada
+bloco é gravado com um bulk_update. Pode ser interrompido e executado de novo:
+só mensagens que ainda têm media_base64 são lidas.
+"""
+import logging
+
+from django.core.management.base import BaseCommand
+
+from crm.models import WhatsappMessage
+from crm.services import media_store
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Move media_base64 das mensagens WhatsApp para o store de mídias (MEDIA_ROOT/whatsapp)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--lote', type=int, default=200, help='Mensagens lidas por bloco')
+        parser.add_argument('--limite', type=int, default=0, help='Para após N mensagens (0 = todas)')
+
+    def handle(self, *args, **options):
+        lote_tamanho = options['lote']
+        limite = options['limite']
+
+        migradas = invalidas = 0
+        ultimo_id = 0
+        while True:
+            lote = list(
+                WhatsappMessage.objects
+                .filter(id__gt=ultimo_id, media_base64__isnull=False)
+                .order_by('id')
+                .only('id', 'tipo_mensagem', 'media_base64', 'media_hash')[:lote_tamanho]
+            )
+            if not lote:
+                break
+            ultimo_id = lote[-1].id
+
+            alteradas = []
+            for msg in lote:
+                if msg.media_hash:
+                    # Já está no store: só descarta o base64
+                    msg.media_base64 = None
+                    alteradas.append(msg)
+                    continue
+                try:
+                    media_store.anexar(msg, msg.media_base64, media_store.MIMETYPE_PADRAO.get(msg.tipo_mensagem, ''))
+                    alteradas.append(msg)
+                except media_store.MidiaInvalida as e:
+                    invalidas += 1
+                    logger.warning(f'[MigrarMidias] msg={msg.id} base64 inválido, mantido: {e}')
+
+            if alteradas:
+                WhatsappMessage.objects.bulk_update(alteradas, media_store.CAMPOS_MIDIA)
+            migradas += len(alteradas)
+            self.stdout.write(f'{migradas} mensagem(ns) migrada(s) até id={ultimo_id}')
+
+            if limite and migradas >= limite:
+                break
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Concluído: {migradas} migrada(s), {invalidas} com base64 inválido'
+        ))
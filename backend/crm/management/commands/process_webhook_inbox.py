@@ -0,0 +1,161 @@
+"""
+Worker que drena a caixa de entrada do webhook WhatsApp (WebhookEvento).
+
+Uso:
+    python manage.py process_webhook_inbox                 # loop contínuo
+    python manage.py process_webhook_inbox --once          # processa o pendente e sai
+    python manage.py process_webhook_inbox --instancia canal_recife
+
+Os eventos são processados em ordem de chegada por instância: se um evento
+falha e aguarda nova tentativa, os eventos seguintes da mesma instância
+esperam por ele. Após WEBHOOK_INBOX_MAX_TENTATIVAS falhas o evento vai para
+o estado FALHOU (dead-letter) e a fila da instância segue.
+
+Vários workers podem rodar ao mesmo tempo: cada evento é reservado com
+SELECT ... FOR UPDATE SKIP LOCKED numa transação que dura o processamento
+(se o worker morrer, o lock cai e o evento volta para a fila) e só é
+processado se não houver evento anterior pendente da mesma instância.
+"""
+import time
+import logging
+import traceback
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections, transaction
+from django.db.models import Min, Q
+from django.utils import timezone
+
+from crm.models import WebhookEvento
+from crm.services.tarefas import backoff
+from crm.services.whatsapp_webhook import processar_payload
+
+logger = logging.getLogger(__name__)
+
+# Intervalo mínimo entre as limpezas de eventos processados no loop contínuo
+LIMPEZA_INTERVALO_SEGUNDOS = 5 * 60
+
+
+class Command(BaseCommand):
+    help = 'Processa os eventos do webhook WhatsApp gravados em WebhookEvento'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Processa os eventos pendentes e encerra')
+        parser.add_argument('--batch-size', type=int, default=100, help='Eventos lidos por ciclo')
+        parser.add_argument('--sleep', type=float, default=1.0, help='Pausa (s) quando a fila está vazia')
+        parser.add_argument('--instancia', help='Processa apenas eventos desta instância')
+        parser.add_argument(
+            '--limpar-dias', type=int, default=7,
+            help='Remove eventos PROCESSADOS há mais de N dias (0 desativa)'
+        )
+
+    def handle(self, *args, **options):
+        self.max_tentativas = getattr(settings, 'WEBHOOK_INBOX_MAX_TENTATIVAS', 5)
+        instancia = options.get('instancia')
+
+        total = 0
+        ultima_limpeza = time.monotonic()
+        while True:
+            close_old_connections()
+            processados = self.drenar(options['batch_size'], instancia)
+            total += processados
+
+            if processados == 0:
+                if options['once']:
+                    break
+                if time.monotonic() - ultima_limpeza >= LIMPEZA_INTERVALO_SEGUNDOS:
+                    self.limpar_processados(options['limpar_dias'])
+                    ultima_limpeza = time.monotonic()
+                time.sleep(options['sleep'])
+
+        self.limpar_processados(options['limpar_dias'])
+        self.stdout.write(self.style.SUCCESS(f'{total} evento(s) processado(s)'))
+
+    def drenar(self, batch_size, instancia=None):
+        """Processa um lote de eventos prontos. Retorna quantos foram tentados."""
+        agora = timezone.now()
+        pendentes = WebhookEvento.objects.filter(status=WebhookEvento.STATUS_PENDENTE)
+        if instancia:
+            pendentes = pendentes.filter(instancia=instancia)
+
+        # Instâncias com um evento aguardando nova tentativa ficam travadas a partir dele
+        bloqueios = dict(
+            pendentes.filter(proxima_tentativa__gt=agora)
+            .values('instancia')
+            .annotate(primeiro=Min('id'))
+            .values_list('instancia', 'primeiro')
+        )
+        prontos = pendentes.filter(proxima_tentativa__lte=agora)
+        for inst, primeiro_id in bloqueios.items():
+            prontos = prontos.exclude(Q(instancia=inst) & Q(id__gt=primeiro_id))
+
+        processados = 0
+        for evento_id, inst in prontos.order_by('id').values_list('id', 'instancia')[:batch_size]:
+            limite = bloqueios.get(inst)
+            if limite is not None and evento_id > limite:
+                continue
+            resultado = self.processar_reservado(evento_id)
+            if resultado is not None:
+                processados += 1
+            if not resultado:
+                # Falhou ou está com outro worker: os seguintes da instância esperam
+                bloqueios[inst] = evento_id
+
+        return processados
+
+    def processar_reservado(self, evento_id):
+        """
+        Reserva e processa o evento na mesma transação. None se outro worker o
+        reservou (ou já processou) ou se há evento anterior pendente da instância.
+        """
+        with transaction.atomic():
+            evento = (
+                WebhookEvento.objects.select_for_update(skip_locked=True)
+                .filter(id=evento_id, status=WebhookEvento.STATUS_PENDENTE, proxima_tentativa__lte=timezone.now())
+                .first()
+            )
+            if evento is None:
+                return None
+            # Os anteriores em aberto (inclusive os reservados por outro worker) seguem PENDENTE
+            if WebhookEvento.objects.filter(
+                instancia=evento.instancia, id__lt=evento.id, status=WebhookEvento.STATUS_PENDENTE
+            ).exists():
+                return None
+            return self.processar_evento(evento)
+
+    def processar_evento(self, evento):
+        """Processa um evento; em caso de erro agenda retry ou move para dead-letter."""
+        evento.tentativas += 1
+        try:
+            with transaction.atomic():
+                processar_payload(evento.payload, raise_errors=True)
+        except Exception as e:
+            evento.ultimo_erro = f"{e}\n{traceback.format_exc()}"[:5000]
+            if evento.tentativas >= self.max_tentativas:
+                evento.status = WebhookEvento.STATUS_FALHOU
+                logger.error(f"[WebhookInbox] Evento #{evento.id} movido para dead-letter: {e}")
+            else:
+                atraso = backoff(evento.tentativas)
+                evento.proxima_tentativa = timezone.now() + timedelta(seconds=atraso)
+                logger.warning(
+                    f"[WebhookInbox] Evento #{evento.id} falhou "
+                    f"(tentativa {evento.tentativas}/{self.max_tentativas}), nova tentativa em {atraso}s: {e}"
+                )
+            evento.save(update_fields=['tentativas', 'ultimo_erro', 'status', 'proxima_tentativa'])
+            return False
+
+        evento.status = WebhookEvento.STATUS_PROCESSADO
+        evento.data_processamento = timezone.now()
+        evento.ultimo_erro = None
+        evento.save(update_fields=['tentativas', 'ultimo_erro', 'status', 'data_processamento'])
+        return True
+
+    def limpar_processados(self, dias):
+        if not dias:
+            return
+        limite = timezone.now() - timedelta(days=dias)
+        WebhookEvento.objects.filter(
+            status=WebhookEvento.STATUS_PROCESSADO,
+            data_processamento__lt=limite,
+        ).delete()
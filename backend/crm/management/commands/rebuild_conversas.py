@@ -0,0 +1,32 @@
+"""
+Reconstrói a tabela Conversa (inbox de atendimento) a partir das mensagens.
+
+Uso:
+    python manage.py rebuild_conversas                 # todas as instâncias
+    python manage.py rebuild_conversas --instancia canal_recife
+
+A tabela é preenchida na implantação (0070_popular_conversas) e mantida
+incrementalmente depois disso (services.conversas); use o comando para
+reparo. Sem --instancia, também recalcula os contadores de não lidas de
+Oportunidade/Canal (services.nao_lidas).
+"""
+from django.core.management.base import BaseCommand
+
+from crm.services.conversas import reconstruir_conversas
+from crm.services.nao_lidas import reconstruir_contadores
+
+
+class Command(BaseCommand):
+    help = 'Reconstrói o resumo de conversas do WhatsApp (Conversa) a partir de WhatsappMessage'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--instancia', help='Reconstrói apenas as conversas desta instância')
+
+    def handle(self, *args, **options):
+        instancia = options.get('instancia')
+        total = reconstruir_conversas(instancia=instancia)
+        self.stdout.write(self.style.SUCCESS(f'{total} conversa(s) reconstruída(s)'))
+
+        if not instancia:
+            reconstruir_contadores()
+            self.stdout.write(self.style.SUCCESS('Contadores de não lidas recalculados'))
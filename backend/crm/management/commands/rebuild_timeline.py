@@ -0,0 +1,33 @@
+"""
+Regenera a tabela TimelineEvento (Timeline materializada) a partir de
+Atividade, WhatsappMessage e Log.
+
+Uso:
+    python manage.py rebuild_timeline                          # tabela inteira
+    python manage.py rebuild_timeline --model conta --id 42    # uma entidade
+
+A tabela é preenchida na implantação (0071_popular_timeline) e mantida
+incrementalmente depois disso (services.timeline); use o comando para reparo.
+"""
+from django.core.management.base import BaseCommand, CommandError
+
+from crm.services import timeline
+
+
+class Command(BaseCommand):
+    help = 'Regenera a Timeline materializada (TimelineEvento) a partir dos dados existentes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--model', choices=sorted(timeline.ESCOPOS), help='Reconstrói apenas uma entidade')
+        parser.add_argument('--id', type=int, help='Id da entidade (com --model)')
+
+    def handle(self, *args, **options):
+        model, entidade_id = options.get('model'), options.get('id')
+        if bool(model) != bool(entidade_id):
+            raise CommandError('Use --model e --id juntos')
+
+        if model:
+            total = timeline.reconstruir_entidade(model, entidade_id)
+        else:
+            total = timeline.reconstruir()
+        self.stdout.write(self.style.SUCCESS(f'{total} evento(s) da timeline gravado(s)'))
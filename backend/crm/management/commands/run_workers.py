@@ -0,0 +1,109 @@
+"""
+Executa as tarefas em segundo plano gravadas em Tarefa (services.tarefas).
+
+Uso:
+    python manage.py run_workers                 # loop contínuo, TAREFAS_THREADS threads
+    python manage.py run_workers --threads 8
+    python manage.py run_workers --once          # executa as tarefas prontas e sai
+
+Cada thread reserva a próxima tarefa pronta (prioridade, executar_em) com um
+UPDATE condicional, então vários processos run_workers podem rodar juntos.
+A thread principal também trabalha e, a cada minuto, agenda as tarefas
+periódicas e devolve à fila as que ficaram EXECUTANDO por mais de --timeout
+minutos (worker derrubado no meio).
+
+Ative TAREFAS_WORKER=True para que a aplicação deixe de executar as tarefas
+no próprio processo e só as grave para este comando.
+"""
+import threading
+import time
+import logging
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections, connection
+
+from crm.services import tarefas
+
+logger = logging.getLogger(__name__)
+
+INTERVALO_MANUTENCAO_SEGUNDOS = 60
+
+
+class Command(BaseCommand):
+    help = 'Executa as tarefas em segundo plano (Tarefa) com N threads'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--threads', type=int, default=None,
+            help='Threads de execução (padrão: TAREFAS_THREADS)'
+        )
+        parser.add_argument('--once', action='store_true', help='Executa as tarefas prontas e encerra')
+        parser.add_argument('--sleep', type=float, default=1.0, help='Pausa (s) quando não há tarefa pronta')
+        parser.add_argument(
+            '--timeout', type=int, default=30,
+            help='Minutos após os quais uma tarefa EXECUTANDO volta para a fila'
+        )
+
+    def handle(self, *args, **options):
+        n_threads = max(1, options['threads'] or getattr(settings, 'TAREFAS_THREADS', 4))
+        registro = tarefas.carregar_registro()
+        self.stdout.write(f'{len(registro)} tarefa(s) registrada(s): {", ".join(sorted(registro))}')
+
+        self.parar = threading.Event()
+        self.executadas = 0
+        self.lock = threading.Lock()
+
+        # A thread principal é o worker 0 (e faz a manutenção); as demais são extras
+        extras = [
+            threading.Thread(target=self.trabalhar, args=(options,), name=f'run_workers-{i}', daemon=True)
+            for i in range(1, n_threads)
+        ]
+        for t in extras:
+            t.start()
+
+        try:
+            self.trabalhar(options, manutencao=True)
+            for t in extras:
+                t.join()
+        except KeyboardInterrupt:
+            self.stdout.write('Encerrando: aguardando as tarefas em execução...')
+            self.parar.set()
+            for t in extras:
+                t.join()
+
+        self.stdout.write(self.style.SUCCESS(f'{self.executadas} tarefa(s) executada(s)'))
+
+    def manutencao(self, timeout):
+        try:
+            liberadas = tarefas.liberar_travadas(timeout)
+            if liberadas:
+                logger.warning(f'[RunWorkers] {liberadas} tarefa(s) travada(s) devolvida(s) à fila')
+            tarefas.garantir_periodicas()
+        except Exception as e:
+            logger.error(f'[RunWorkers] Erro na manutenção da fila: {e}')
+
+    def trabalhar(self, options, manutencao=False):
+        ultima_manutencao = None
+        try:
+            while not self.parar.is_set():
+                close_old_connections()
+                if manutencao and (
+                    ultima_manutencao is None
+                    or time.monotonic() - ultima_manutencao >= INTERVALO_MANUTENCAO_SEGUNDOS
+                ):
+                    self.manutencao(options['timeout'])
+                    ultima_manutencao = time.monotonic()
+
+                t = tarefas.proxima()
+                if t is None:
+                    if options['once']:
+                        return
+                    self.parar.wait(options['sleep'])
+                    continue
+                tarefas.executar(t)
+                with self.lock:
+                    self.executadas += 1
+        finally:
+            if not manutencao:
+                connection.close()
@@ -0,0 +1,216 @@
+"""
+Transcreve em massa os áudios do WhatsApp que ficaram sem transcrição
+(ex.: depois de uma queda da Evolution API).
+
+Uso:
+    python manage.py transcribe_backlog
+    python manage.py transcribe_backlog --processos 4 --downloads 8 --lote 50
+    python manage.py transcribe_backlog --reiniciar      # ignora o checkpoint
+
+Percorre as mensagens por id (keyset), em lotes. Para cada lote:
+- baixa da Evolution, em paralelo (--downloads), as mídias que ainda não
+  estão no store;
+- transcreve num pool de processos (--processos, padrão: todos os núcleos),
+  cada um com o próprio modelo Whisper e cpu_threads = núcleos / processos;
+- grava os textos com um bulk_update e avança o checkpoint (último id do lote).
+
+Interrompido, continua do checkpoint na próxima execução. Ao final informa o
+throughput em segundos de áudio por segundo de relógio.
+"""
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.utils import timezone
+
+from crm.models import WhatsappMessage
+from crm.services import media_store
+from crm.services.evolution_api import EvolutionService
+from crm.services.transcricao import TEXTOS_NAO_TRANSCRITOS, texto_transcrito
+
+logger = logging.getLogger(__name__)
+
+
+def _iniciar_processo(cpu_threads):
+    """Inicializa o Django e o modelo em cada processo do pool (contexto spawn)."""
+    import django
+    django.setup()
+
+    from crm.services.audio_transcription import get_whisper_model
+    get_whisper_model(cpu_threads=cpu_threads)
+
+
+def _transcrever(item):
+    """(msg_id, caminho, audio_hash) -> (msg_id, resultado ou None, erro)"""
+    from crm.services.audio_transcription import transcribe_audio
+
+    msg_id, caminho, audio_hash = item
+    try:
+        return msg_id, transcribe_audio(caminho, remover_arquivo=False, audio_hash=audio_hash), None
+    except Exception as e:
+        return msg_id, None, str(e)
+
+
+class Command(BaseCommand):
+    help = 'Transcreve em lotes, com downloads e processos em paralelo, os áudios ainda não transcritos'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--lote', type=int, default=50, help='Mensagens por lote')
+        parser.add_argument(
+            '--processos', type=int, default=os.cpu_count() or 1,
+            help='Processos de transcrição (1 = no próprio processo)'
+        )
+        parser.add_argument('--downloads', type=int, default=4, help='Downloads simultâneos da Evolution')
+        parser.add_argument('--limite', type=int, default=0, help='Para após N mensagens (0 = todas)')
+        parser.add_argument(
+            '--checkpoint', default=os.path.join(settings.BASE_DIR, '.transcribe_backlog'),
+            help='Arquivo com o último id processado'
+        )
+        parser.add_argument('--reiniciar', action='store_true', help='Ignora o checkpoint e começa do início')
+
+    def handle(self, *args, **options):
+        checkpoint = options['checkpoint']
+        ultimo_id = 0 if options['reiniciar'] else self.ler_checkpoint(checkpoint)
+        if ultimo_id:
+            self.stdout.write(f'Retomando após id={ultimo_id}')
+
+        processos = max(1, options['processos'])
+        cpu_threads = max(1, (os.cpu_count() or 1) // processos)
+        pool = None
+        if processos > 1:
+            # Processos novos (spawn) não herdam conexões de banco nem o estado do Django
+            connections.close_all()
+            pool = ProcessPoolExecutor(
+                max_workers=processos,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_iniciar_processo,
+                initargs=(cpu_threads,),
+            )
+
+        self.servicos = {}
+        inicio = time.monotonic()
+        transcritas = falhas = 0
+        segundos_audio = 0.0
+        try:
+            while True:
+                lote = list(
+                    WhatsappMessage.objects
+                    .filter(id__gt=ultimo_id, tipo_mensagem='audio', texto__in=TEXTOS_NAO_TRANSCRITOS)
+                    .defer('media_base64')
+                    .order_by('id')[:options['lote']]
+                )
+                if not lote:
+                    break
+
+                prontas, sem_midia = self.garantir_midias(lote, options['downloads'])
+                falhas += sem_midia
+
+                itens = [
+                    (msg.id, media_store.caminho(msg.media_hash), msg.media_hash)
+                    for msg in prontas
+                ]
+                if pool is not None:
+                    resultados = list(pool.map(_transcrever, itens))
+                else:
+                    resultados = [_transcrever(item) for item in itens]
+
+                por_id = {msg.id: msg for msg in prontas}
+                alteradas = []
+                for msg_id, resultado, erro in resultados:
+                    msg = por_id[msg_id]
+                    if resultado and resultado.get('text'):
+                        msg.texto = texto_transcrito(resultado)
+                        segundos_audio += resultado.get('duration') or 0
+                        transcritas += 1
+                    else:
+                        falhas += 1
+                        logger.warning(f'[TranscribeBacklog] msg={msg_id} sem transcrição: {erro or "vazia"}')
+                    alteradas.append(msg)
+
+                if alteradas:
+                    # bulk_update não aplica auto_now: o delta do chat depende de data_atualizacao
+                    agora = timezone.now()
+                    for msg in alteradas:
+                        msg.data_atualizacao = agora
+                    WhatsappMessage.objects.bulk_update(
+                        alteradas, ['texto', 'data_atualizacao', *media_store.CAMPOS_MIDIA]
+                    )
+
+                ultimo_id = lote[-1].id
+                self.gravar_checkpoint(checkpoint, ultimo_id)
+                self.stdout.write(f'{transcritas} transcrita(s), {falhas} falha(s) até id={ultimo_id}')
+
+                if options['limite'] and transcritas + falhas >= options['limite']:
+                    break
+        finally:
+            if pool is not None:
+                pool.shutdown(cancel_futures=True)
+
+        decorrido = time.monotonic() - inicio
+        throughput = segundos_audio / decorrido if decorrido else 0
+        self.stdout.write(self.style.SUCCESS(
+            f'Concluído: {transcritas} transcrita(s), {falhas} falha(s), '
+            f'{segundos_audio:.0f}s de áudio em {decorrido:.0f}s ({throughput:.2f} s de áudio/s)'
+        ))
+
+    def garantir_midias(self, lote, downloads):
+        """
+        Deixa no store a mídia de cada mensagem do lote (migra base64 legado e
+        baixa o que falta em paralelo). Retorna (mensagens prontas, quantas falharam).
+        """
+        faltando = []
+        for msg in lote:
+            if not msg.media_hash and msg.media_base64:
+                try:
+                    media_store.anexar(msg, msg.media_base64, media_store.MIMETYPE_PADRAO['audio'])
+                except media_store.MidiaInvalida:
+                    pass
+            if not msg.media_hash:
+                faltando.append(msg)
+
+        if faltando:
+            # Só HTTP e arquivo nas threads; o banco fica com a thread principal
+            for msg in faltando:
+                self.servico(msg.instancia)
+            with ThreadPoolExecutor(max_workers=max(1, downloads)) as executor:
+                list(executor.map(self.baixar_midia, faltando))
+
+        prontas = [msg for msg in lote if msg.media_hash]
+        return prontas, len(lote) - len(prontas)
+
+    def servico(self, instancia):
+        if instancia not in self.servicos:
+            self.servicos[instancia] = EvolutionService(instance_name=instancia, instance_token=None)
+        return self.servicos[instancia]
+
+    def baixar_midia(self, msg):
+        remoto = (msg.numero_remetente if not msg.de_mim else msg.numero_destinatario) or ''
+        key = {
+            'id': msg.id_mensagem,
+            'remoteJid': f"{remoto.split('@')[0]}@s.whatsapp.net",
+            'fromMe': msg.de_mim,
+        }
+        try:
+            resultado = self.servico(msg.instancia).get_media_base64(key)
+            if resultado and resultado.get('base64'):
+                media_store.anexar(msg, resultado['base64'], resultado.get('mimetype') or media_store.MIMETYPE_PADRAO['audio'])
+        except Exception as e:
+            logger.warning(f'[TranscribeBacklog] msg={msg.id} falha ao baixar mídia: {e}')
+
+    def ler_checkpoint(self, caminho):
+        try:
+            with open(caminho) as f:
+                return int(f.read().strip() or 0)
+        except (OSError, ValueError):
+            return 0
+
+    def gravar_checkpoint(self, caminho, ultimo_id):
+        temporario = f'{caminho}.tmp'
+        with open(temporario, 'w') as f:
+            f.write(str(ultimo_id))
+        os.replace(temporario, caminho)
@@ -0,0 +1,155 @@
+"""
+Daemon de transcrição de áudios do WhatsApp (fila TranscricaoAudio).
+
+Uso:
+    python manage.py whisper_worker                 # loop contínuo
+    python manage.py whisper_worker --threads 4     # threads de CPU do modelo
+    python manage.py whisper_worker --once          # processa o pendente e sai
+
+Carrega o modelo faster-whisper uma única vez na inicialização e atende os
+pedidos por prioridade (interativos do chat antes dos áudios do webhook),
+gravando o resultado em WhatsappMessage.texto. Ative com WHISPER_WORKER=True
+para que o webhook e o chat enfileirem em vez de transcrever no processo web.
+
+Rode um único worker: o modelo ocupa centenas de MB e já usa várias threads.
+"""
+import time
+import logging
+import traceback
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections
+from django.utils import timezone
+
+from crm.models import TranscricaoAudio
+from crm.services import media_store
+from crm.services.audio_transcription import get_whisper_model, transcribe_audio
+from crm.services.transcricao import aplicar_resultado, notificador
+
+logger = logging.getLogger(__name__)
+
+MAX_TENTATIVAS = 3
+
+
+class TranscricaoVazia(Exception):
+    """Áudio sem fala reconhecível: não adianta tentar de novo."""
+
+
+class Command(BaseCommand):
+    help = 'Transcreve os áudios da fila TranscricaoAudio com um modelo Whisper carregado uma única vez'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--threads', type=int, default=None,
+            help='Threads de CPU do modelo (padrão: WHISPER_CPU_THREADS)'
+        )
+        parser.add_argument('--once', action='store_true', help='Processa os pedidos pendentes e encerra')
+        parser.add_argument('--sleep', type=float, default=1.0, help='Pausa (s) quando a fila está vazia')
+        parser.add_argument(
+            '--limpar-dias', type=int, default=7,
+            help='Remove pedidos concluídos há mais de N dias (0 desativa)'
+        )
+
+    def handle(self, *args, **options):
+        threads = options['threads']
+        if threads is None:
+            threads = getattr(settings, 'WHISPER_CPU_THREADS', 0)
+        if get_whisper_model(cpu_threads=threads) is None:
+            raise CommandError('Não foi possível carregar o modelo Whisper (faster-whisper instalado?)')
+
+        # Pedidos que ficaram em PROCESSANDO numa execução interrompida voltam para a fila
+        TranscricaoAudio.objects.filter(status=TranscricaoAudio.STATUS_PROCESSANDO).update(
+            status=TranscricaoAudio.STATUS_PENDENTE
+        )
+
+        total = 0
+        while True:
+            close_old_connections()
+            pedido = self.proximo()
+            if pedido is None:
+                if options['once']:
+                    break
+                self.limpar_concluidos(options['limpar_dias'])
+                time.sleep(options['sleep'])
+                continue
+            self.processar(pedido)
+            total += 1
+
+        self.stdout.write(self.style.SUCCESS(f'{total} transcrição(ões) processada(s)'))
+
+    def proximo(self):
+        """Reserva o pedido pendente de maior prioridade (menor valor, depois o mais antigo)."""
+        while True:
+            pedido = (
+                TranscricaoAudio.objects
+                .filter(status=TranscricaoAudio.STATUS_PENDENTE)
+                .order_by('prioridade', 'id')
+                .first()
+            )
+            if pedido is None:
+                return None
+            reservado = TranscricaoAudio.objects.filter(
+                id=pedido.id, status=TranscricaoAudio.STATUS_PENDENTE
+            ).update(status=TranscricaoAudio.STATUS_PROCESSANDO)
+            if reservado:
+                pedido.status = TranscricaoAudio.STATUS_PROCESSANDO
+                return pedido
+
+    def processar(self, pedido):
+        pedido.tentativas += 1
+        notificar = None
+        try:
+            mensagem = pedido.mensagem
+            # Pedido do chat: transmite os segmentos pelo WebSocket enquanto transcreve
+            if pedido.prioridade == TranscricaoAudio.PRIORIDADE_INTERATIVA:
+                notificar = notificador(mensagem)
+            if not mensagem.media_hash:
+                media_store.migrar_legado(mensagem)
+            if not mensagem.media_hash:
+                raise ValueError('mensagem sem áudio no store de mídias')
+
+            inicio = time.monotonic()
+            # O arquivo do store é nomeado pelo sha256: serve de chave do cache de transcrições
+            resultado = transcribe_audio(
+                media_store.caminho(mensagem.media_hash), remover_arquivo=False, audio_hash=mensagem.media_hash,
+                ao_segmento=(lambda segmento, acumulado: notificar(acumulado)) if notificar else None,
+            )
+            if not (resultado and resultado.get('text')):
+                raise TranscricaoVazia('transcrição vazia')
+            aplicar_resultado(mensagem, resultado)
+        except Exception as e:
+            pedido.ultimo_erro = f"{e}\n{traceback.format_exc()}"[:5000]
+            # Falhas inesperadas voltam para a fila; áudio sem fala não
+            if pedido.tentativas >= MAX_TENTATIVAS or isinstance(e, TranscricaoVazia):
+                pedido.status = TranscricaoAudio.STATUS_FALHOU
+                if notificar:
+                    notificar(None, concluida=True, erro='transcription_empty')
+            else:
+                pedido.status = TranscricaoAudio.STATUS_PENDENTE
+            logger.warning(f"[WhisperWorker] Pedido #{pedido.id} (msg={pedido.mensagem_id}) falhou: {e}")
+            pedido.save(update_fields=['tentativas', 'ultimo_erro', 'status'])
+            return
+
+        pedido.status = TranscricaoAudio.STATUS_CONCLUIDA
+        pedido.texto = resultado['text']
+        pedido.duracao = resultado.get('duration')
+        pedido.data_processamento = timezone.now()
+        pedido.ultimo_erro = None
+        pedido.save(update_fields=['tentativas', 'status', 'texto', 'duracao', 'data_processamento', 'ultimo_erro'])
+        if notificar:
+            notificar(mensagem.texto, concluida=True, duracao=pedido.duracao)
+        logger.info(
+            f"[WhisperWorker] Pedido #{pedido.id} (msg={pedido.mensagem_id}, prioridade={pedido.prioridade}) "
+            f"transcrito em {time.monotonic() - inicio:.1f}s"
+        )
+
+    def limpar_concluidos(self, dias):
+        if not dias:
+            return
+        limite = timezone.now() - timedelta(days=dias)
+        TranscricaoAudio.objects.filter(
+            status__in=[TranscricaoAudio.STATUS_CONCLUIDA, TranscricaoAudio.STATUS_FALHOU],
+            data_criacao__lt=limite,
+        ).delete()
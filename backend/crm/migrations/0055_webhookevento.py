@@ -0,0 +1,35 @@
+# Generated by Django 5.2.12 on 2026-10-18 08:34
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('crm', '0054_agendatreinamento_modalidade'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WebhookEvento',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('instancia', models.CharField(help_text='Instância Evolution que enviou o evento', max_length=100)),
+                ('evento', models.CharField(blank=True, default='', max_length=100)),
+                ('payload', models.JSONField(help_text='Payload bruto recebido da Evolution API')),
+                ('status', models.CharField(choices=[('PENDENTE', 'Pendente'), ('PROCESSADO', 'Processado'), ('FALHOU', 'Falhou (dead-letter)')], default='PENDENTE', max_length=20)),
+                ('tentativas', models.PositiveIntegerField(default=0)),
+                ('ultimo_erro', models.TextField(blank=True, null=True)),
+                ('proxima_tentativa', models.DateTimeField(default=django.utils.timezone.now)),
+                ('data_recebimento', models.DateTimeField(auto_now_add=True)),
+                ('data_processamento', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'verbose_name': 'Evento de Webhook',
+                'verbose_name_plural': 'Eventos de Webhook',
+                'ordering': ['id'],
+                'indexes': [models.Index(fields=['status', 'proxima_tentativa'], name='crm_webhook_status_9494dd_idx'), models.Index(fields=['instancia', 'status'], name='crm_webhook_instanc_20d162_idx')],
+            },
+        ),
+    ]
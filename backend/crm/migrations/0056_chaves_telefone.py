@@ -0,0 +1,37 @@
+# Generated by Django 5.2.12 on 2026-10-18 08:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('crm', '0055_webhookevento'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='contato',
+            name='celular_chave',
+            field=models.CharField(blank=True, db_index=True, default='', editable=False, max_length=20),
+        ),
+        migrations.AddField(
+            model_name='contato',
+            name='telefone_chave',
+            field=models.CharField(blank=True, db_index=True, default='', editable=False, max_length=20),
+        ),
+        migrations.AddField(
+            model_name='contatotelefone',
+            name='numero_chave',
+            field=models.CharField(blank=True, db_index=True, default='', editable=False, max_length=20),
+        ),
+        migrations.AddField(
+            model_name='whatsappmessage',
+            name='numero_chave',
+            field=models.CharField(blank=True, default='', editable=False, help_text='Chave canônica do número da outra parte (remetente se recebida, destinatário se enviada)', max_length=20),
+        ),
+        migrations.AddIndex(
+            model_name='whatsappmessage',
+            index=models.Index(fields=['numero_chave', 'timestamp'], name='crm_whatsap_numero__1f3d81_idx'),
+        ),
+    ]
@@ -0,0 +1,90 @@
+"""
+Data migration: preenche as chaves canônicas de telefone (services.phone)
+em Contato, ContatoTelefone e WhatsappMessage já existentes.
+Processa em blocos por id para não carregar as tabelas inteiras na memória.
+
+A normalização é uma cópia congelada de services.phone.canonical_phone: a
+migração continua fazendo o mesmo mesmo que o serviço mude ou saia do lugar.
+"""
+import re
+
+from django.db import migrations
+
+BLOCO = 2000
+TAMANHO_CHAVE = 20
+
+
+def canonical_phone(numero):
+    if not numero:
+        return ''
+
+    digits = re.sub(r'\D', '', str(numero).split('@')[0])
+    if len(digits) < 8:
+        return ''
+
+    if digits.startswith('55') and len(digits) in (12, 13):
+        digits = digits[2:]
+    elif len(digits) not in (10, 11):
+        if len(digits) == 9 and digits.startswith('9'):
+            return digits[1:]
+        return digits[:TAMANHO_CHAVE]
+
+    if len(digits) == 11 and digits[2] == '9':
+        digits = digits[:2] + digits[3:]
+
+    return '55' + digits
+
+
+def _preencher(model, dependencias, campos, calcular):
+    ultimo_id = 0
+    while True:
+        lote = list(
+            model.objects.filter(id__gt=ultimo_id)
+            .order_by('id')
+            .only('id', *dependencias)[:BLOCO]
+        )
+        if not lote:
+            break
+        for obj in lote:
+            calcular(obj)
+        model.objects.bulk_update(lote, campos)
+        ultimo_id = lote[-1].id
+
+
+def _contato(obj):
+    obj.telefone_chave = canonical_phone(obj.telefone)
+    obj.celular_chave = canonical_phone(obj.celular)
+
+
+def _contato_telefone(obj):
+    obj.numero_chave = canonical_phone(obj.numero)
+
+
+def _mensagem(obj):
+    obj.numero_chave = canonical_phone(obj.numero_destinatario if obj.de_mim else obj.numero_remetente)
+
+
+def popular_chaves(apps, schema_editor):
+    _preencher(
+        apps.get_model('crm', 'Contato'),
+        ['telefone', 'celular'], ['telefone_chave', 'celular_chave'], _contato
+    )
+    _preencher(
+        apps.get_model('crm', 'ContatoTelefone'),
+        ['numero'], ['numero_chave'], _contato_telefone
+    )
+    _preencher(
+        apps.get_model('crm', 'WhatsappMessage'),
+        ['de_mim', 'numero_remetente', 'numero_destinatario'], ['numero_chave'], _mensagem
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('crm', '0056_chaves_telefone'),
+    ]
+
+    operations = [
+        migrations.RunPython(popular_chaves, migrations.RunPython.noop),
+    ]
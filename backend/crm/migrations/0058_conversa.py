@@ -0,0 +1,41 @@
+# Generated by Django 5.2.12 on 2026-10-18 08:42
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('crm', '0057_popular_chaves_telefone'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Conversa',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('instancia', models.CharField(max_length=100)),
+                ('numero_chave', models.CharField(help_text='Chave canônica do número remoto (services.phone)', max_length=20)),
+                ('numero', models.CharField(help_text='Número remoto como recebido da Evolution API', max_length=50)),
+                ('funil_tipo', models.CharField(blank=True, max_length=20, null=True)),
+                ('ultima_mensagem', models.CharField(blank=True, default='', help_text='Prévia da última mensagem', max_length=255)),
+                ('ultima_mensagem_tipo', models.CharField(default='text', max_length=50)),
+                ('ultima_mensagem_de_mim', models.BooleanField(default=False)),
+                ('ultima_mensagem_timestamp', models.DateTimeField(blank=True, null=True)),
+                ('ultima_recebida_timestamp', models.DateTimeField(blank=True, help_text='Última mensagem recebida do contato (ordena o inbox)', null=True)),
+                ('nao_lidas', models.PositiveIntegerField(default=0)),
+                ('data_criacao', models.DateTimeField(auto_now_add=True)),
+                ('data_atualizacao', models.DateTimeField(auto_now=True)),
+                ('contato', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='conversas_whatsapp', to='crm.contato')),
+                ('oportunidade', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='conversas_whatsapp', to='crm.oportunidade')),
+            ],
+            options={
+                'verbose_name': 'Conversa WhatsApp',
+                'verbose_name_plural': 'Conversas WhatsApp',
+                'ordering': ['-ultima_recebida_timestamp', '-id'],
+                'indexes': [models.Index(fields=['instancia', 'ultima_recebida_timestamp'], name='crm_convers_instanc_0beb49_idx'), models.Index(fields=['ultima_recebida_timestamp'], name='crm_convers_ultima__061ccd_idx'), models.Index(fields=['numero_chave'], name='crm_convers_numero__17e948_idx')],
+                'constraints': [models.UniqueConstraint(fields=('instancia', 'numero_chave'), name='conversa_unica_por_instancia')],
+            },
+        ),
+    ]
@@ -0,0 +1,69 @@
+# Generated by Django 5.2.12 on 2026-10-18 08:46
+
+from django.db import migrations, models
+from django.db.models import Count, Q
+
+
+def popular_contadores(apps, schema_editor):
+    """Preenche os contadores de não lidas a partir das mensagens existentes."""
+    Canal = apps.get_model('crm', 'Canal')
+    Oportunidade = apps.get_model('crm', 'Oportunidade')
+    WhatsappMessage = apps.get_model('crm', 'WhatsappMessage')
+    nao_lidas = WhatsappMessage.objects.filter(lida=False, de_mim=False)
+
+    por_opp = (
+        nao_lidas.filter(oportunidade__isnull=False)
+        .values('oportunidade_id')
+        .annotate(total=Count('id'))
+        .order_by()
+    )
+    for linha in por_opp:
+        Oportunidade.objects.filter(id=linha['oportunidade_id']).update(whatsapp_nao_lidas=linha['total'])
+
+    por_instancia = {
+        linha['instancia']: linha
+        for linha in nao_lidas.values('instancia').annotate(
+            total=Count('id'),
+            novas=Count('id', filter=Q(oportunidade__isnull=True)),
+        ).order_by()
+    }
+    for canal in Canal.objects.exclude(evolution_instance_name__isnull=True).exclude(evolution_instance_name=''):
+        linha = por_instancia.get(canal.evolution_instance_name)
+        if linha:
+            Canal.objects.filter(id=canal.id).update(
+                whatsapp_nao_lidas=linha['total'], whatsapp_nao_lidas_novas=linha['novas']
+            )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('crm', '0058_conversa'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='canal',
+            name='whatsapp_nao_lidas',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='canal',
+            name='whatsapp_nao_lidas_novas',
+            field=models.PositiveIntegerField(default=0, editable=False, help_text='Não lidas ainda sem oportunidade vinculada'),
+        ),
+        migrations.AddField(
+            model_name='oportunidade',
+            name='whatsapp_nao_lidas',
+            field=models.PositiveIntegerField(db_index=True, default=0, editable=False),
+        ),
+        migrations.AddIndex(
+            model_name='whatsappmessage',
+            index=models.Index(fields=['oportunidade', 'lida', 'de_mim'], name='crm_whatsap_oportun_566ed5_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='whatsappmessage',
+            index=models.Index(fields=['instancia', 'lida', 'de_mim'], name='crm_whatsap_instanc_01debe_idx'),
+        ),
+        migrations.RunPython(popular_contadores, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.2.12 on 2026-10-18 08:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('crm', '0059_contadores_nao_lidas'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='whatsappmessage',
+            name='media_hash',
+            field=models.CharField(blank=True, db_index=True, default='', help_text='SHA-256 do arquivo', max_length=64),
+        ),
+        migrations.AddField(
+            model_name='whatsappmessage',
+            name='media_mimetype',
+            field=models.CharField(blank=True, default='', max_length=100),
+        ),
+        migrations.AddField(
+            model_name='whatsappmessage',
+            name='media_tamanho',
+            field=models.PositiveIntegerField(blank=True, help_text='Tamanho em bytes', null=True),
+        ),
+        migrations.AlterField(
+            model_name='whatsappmessage',
+            name='media_base64',
+            field=models.TextField(blank=True, help_text='Legado: base64 da mídia. Novas mídias vão para o store (media_hash); migrar com migrar_midias_whatsapp', null=True),
+        ),
+    ]
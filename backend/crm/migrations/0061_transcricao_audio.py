@@ -0,0 +1,35 @@
+# Generated by Django 5.2.12 on 2026-10-18 08:55
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('crm', '0060_midia_store'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TranscricaoAudio',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('prioridade', models.PositiveSmallIntegerField(default=10)),
+                ('status', models.CharField(choices=[('PENDENTE', 'Pendente'), ('PROCESSANDO', 'Processando'), ('CONCLUIDA', 'Concluída'), ('FALHOU', 'Falhou')], default='PENDENTE', max_length=20)),
+                ('tentativas', models.PositiveIntegerField(default=0)),
+                ('texto', models.TextField(blank=True, help_text='Texto transcrito', null=True)),
+                ('duracao', models.FloatField(blank=True, help_text='Duração do áudio em segundos', null=True)),
+                ('ultimo_erro', models.TextField(blank=True, null=True)),
+                ('data_criacao', models.DateTimeField(auto_now_add=True)),
+                ('data_processamento', models.DateTimeField(blank=True, null=True)),
+                ('mensagem', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='transcricoes', to='crm.whatsappmessage')),
+            ],
+            options={
+                'verbose_name': 'Transcrição de Áudio',
+                'verbose_name_plural': 'Transcrições de Áudio',
+                'ordering': ['prioridade', 'id'],
+                'indexes': [models.Index(fields=['status', 'prioridade', 'id'], name='crm_transcr_status_54edfd_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.2.12 on 2026-10-18 08:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('crm', '0061_transcricao_audio'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TranscricaoCache',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('audio_hash', models.CharField(help_text='SHA-256 dos bytes do áudio', max_length=64)),
+                ('modelo', models.CharField(help_text='WHISPER_MODEL_SIZE usado', max_length=50)),
+                ('idioma', models.CharField(max_length=10)),
+                ('texto', models.TextField()),
+                ('segmentos', models.JSONField(blank=True, default=list)),
+                ('duracao', models.FloatField(blank=True, null=True)),
+                ('idioma_detectado', models.CharField(blank=True, default='', max_length=10)),
+                ('data_criacao', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'verbose_name': 'Cache de Transcrição',
+                'verbose_name_plural': 'Cache de Transcrições',
+                'constraints': [models.UniqueConstraint(fields=('audio_hash', 'modelo', 'idioma'), name='transcricao_cache_unica')],
+            },
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.12 on 2026-10-18 09:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('crm', '0063_tarefas'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='whatsappmessage',
+            name='media_erro',
+            field=models.CharField(blank=True, default='', max_length=255),
+        ),
+        migrations.AddField(
+            model_name='whatsappmessage',
+            name='media_falha_em',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='whatsappmessage',
+            name='media_tamanho',
+            field=models.PositiveIntegerField(blank=True, help_text='Tamanho em bytes (antes do download, o informado pelo webhook)', null=True),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 5.2.12 on 2026-10-18 10:02
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('crm', '0064_midia_cache_negativo'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='whatsappmessage',
+            name='data_atualizacao',
+            field=models.DateTimeField(auto_now=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+        migrations.AddIndex(
+            model_name='whatsappmessage',
+            index=models.Index(fields=['numero_chave', 'data_atualizacao'], name='crm_whatsap_numero__c4e153_idx'),
+        ),
+    ]
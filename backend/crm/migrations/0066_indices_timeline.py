@@ -0,0 +1,34 @@
+# Generated by Django 5.2.12 on 2026-10-18 09:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('crm', '0065_mensagem_data_atualizacao'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='atividade',
+            name='crm_ativida_content_48da7d_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='log',
+            name='crm_log_modelo_bfb605_idx',
+        ),
+        migrations.AddIndex(
+            model_name='atividade',
+            index=models.Index(fields=['content_type', 'object_id', 'data_criacao'], name='crm_ativida_content_e0360f_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='log',
+            index=models.Index(fields=['modelo', 'objeto_id', 'timestamp'], name='crm_log_modelo_5af0f4_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='whatsappmessage',
+            index=models.Index(fields=['oportunidade', 'timestamp'], name='crm_whatsap_oportun_3ed465_idx'),
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 5.2.12 on 2026-10-18 09:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('crm', '0066_indices_timeline'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conta',
+            name='telefone_principal_chave',
+            field=models.CharField(blank=True, db_index=True, default='', editable=False, max_length=20),
+        ),
+        migrations.CreateModel(
+            name='TimelineEvento',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('escopo', models.CharField(choices=[('oportunidade', 'Oportunidade'), ('conta', 'Conta'), ('contato', 'Contato')], max_length=20)),
+                ('entidade_id', models.PositiveBigIntegerField()),
+                ('fonte', models.CharField(choices=[('atividade', 'Atividade'), ('whatsapp', 'WhatsApp'), ('log', 'Log')], max_length=20)),
+                ('item_id', models.PositiveBigIntegerField()),
+                ('momento', models.DateTimeField(help_text='data_criacao da Atividade ou timestamp da mensagem/log')),
+            ],
+            options={
+                'verbose_name': 'Evento da Timeline',
+                'verbose_name_plural': 'Eventos da Timeline',
+                'ordering': ['-momento', '-fonte', '-item_id'],
+                'indexes': [models.Index(fields=['escopo', 'entidade_id', 'momento', 'fonte', 'item_id'], name='crm_timelin_escopo_0f94f7_idx')],
+                'constraints': [models.UniqueConstraint(fields=('fonte', 'item_id', 'escopo', 'entidade_id'), name='timeline_evento_unico')],
+            },
+        ),
+    ]
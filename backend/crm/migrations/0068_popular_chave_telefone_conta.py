@@ -0,0 +1,62 @@
+"""
+Data migration: preenche a chave canônica do telefone principal (services.phone)
+das Contas já existentes, em blocos por id.
+
+A normalização é uma cópia congelada de services.phone.canonical_phone (a
+mesma da 0057_popular_chaves_telefone).
+"""
+import re
+
+from django.db import migrations
+
+BLOCO = 2000
+TAMANHO_CHAVE = 20
+
+
+def canonical_phone(numero):
+    if not numero:
+        return ''
+
+    digits = re.sub(r'\D', '', str(numero).split('@')[0])
+    if len(digits) < 8:
+        return ''
+
+    if digits.startswith('55') and len(digits) in (12, 13):
+        digits = digits[2:]
+    elif len(digits) not in (10, 11):
+        if len(digits) == 9 and digits.startswith('9'):
+            return digits[1:]
+        return digits[:TAMANHO_CHAVE]
+
+    if len(digits) == 11 and digits[2] == '9':
+        digits = digits[:2] + digits[3:]
+
+    return '55' + digits
+
+
+def popular_chaves(apps, schema_editor):
+    Conta = apps.get_model('crm', 'Conta')
+    ultimo_id = 0
+    while True:
+        lote = list(
+            Conta.objects.filter(id__gt=ultimo_id)
+            .order_by('id')
+            .only('id', 'telefone_principal')[:BLOCO]
+        )
+        if not lote:
+            break
+        for conta in lote:
+            conta.telefone_principal_chave = canonical_phone(conta.telefone_principal)
+        Conta.objects.bulk_update(lote, ['telefone_principal_chave'])
+        ultimo_id = lote[-1].id
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('crm', '0067_timeline_evento'),
+    ]
+
+    operations = [
+        migrations.RunPython(popular_chaves, migrations.RunPython.noop),
+    ]
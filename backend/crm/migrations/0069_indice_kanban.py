@@ -0,0 +1,21 @@
+# Generated by Django 5.2.12 on 2026-10-18 09:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('crm', '0068_popular_chave_telefone_conta'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='oportunidade',
+            name='crm_oportun_funil_i_ee1205_idx',
+        ),
+        migrations.AddIndex(
+            model_name='oportunidade',
+            index=models.Index(fields=['funil', 'estagio', 'data_criacao'], name='crm_oportun_funil_i_62b2a7_idx'),
+        ),
+    ]
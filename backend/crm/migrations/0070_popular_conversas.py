@@ -0,0 +1,105 @@
+"""
+Data migration: preenche Conversa (criada vazia na 0058_conversa) a partir do
+histórico de WhatsappMessage, para que o inbox de atendimento — que lê apenas
+Conversa — não fique vazio após a implantação.
+
+Cópia congelada de services.conversas.reconstruir_conversas (e dos helpers
+texto_preview, resolver_contato_id e resolver_oportunidade_do_contato) sobre
+os modelos históricos. Conversas já existentes (gravadas pelos signals ou por
+rebuild_conversas) são recalculadas do mesmo jeito, então rodar de novo não
+altera o resultado.
+"""
+from django.db import migrations
+from django.db.models import Count, Max, Q
+
+
+def texto_preview(texto, tipo):
+    if tipo == 'audio':
+        return '🎤 Áudio'
+    if tipo == 'image':
+        return '📷 Imagem'
+    if tipo == 'document':
+        return '📄 Documento'
+    return (texto or '')[:80]
+
+
+def numero_remoto(mensagem):
+    return mensagem.numero_destinatario if mensagem.de_mim else mensagem.numero_remetente
+
+
+def popular_conversas(apps, schema_editor):
+    Contato = apps.get_model('crm', 'Contato')
+    Conversa = apps.get_model('crm', 'Conversa')
+    Oportunidade = apps.get_model('crm', 'Oportunidade')
+    WhatsappMessage = apps.get_model('crm', 'WhatsappMessage')
+
+    mensagens = WhatsappMessage.objects.exclude(numero_chave='')
+    grupos = (
+        mensagens
+        .values('instancia', 'numero_chave')
+        .annotate(
+            ultima_timestamp=Max('timestamp'),
+            ultima_recebida_timestamp=Max('timestamp', filter=Q(de_mim=False)),
+            nao_lidas=Count('id', filter=Q(de_mim=False, lida=False)),
+        )
+        .order_by()
+    )
+
+    for grupo in list(grupos):
+        inst, chave = grupo['instancia'], grupo['numero_chave']
+        msgs_conversa = mensagens.filter(instancia=inst, numero_chave=chave)
+        ultima = msgs_conversa.order_by('-timestamp', '-id').first()
+        ultima_recebida = msgs_conversa.filter(de_mim=False).order_by('-timestamp', '-id').first()
+        ultima_vinculada = (
+            msgs_conversa.filter(oportunidade__isnull=False)
+            .order_by('-timestamp', '-id')
+            .values_list('oportunidade_id', flat=True)
+            .first()
+        )
+
+        contato_id = (
+            Contato.objects
+            .filter(Q(celular_chave=chave) | Q(telefone_chave=chave))
+            .values_list('id', flat=True)
+            .first()
+        )
+        if ultima_vinculada:
+            opp = Oportunidade.objects.filter(id=ultima_vinculada).values('id', 'funil__tipo').first()
+        elif contato_id:
+            opp = (
+                Oportunidade.objects
+                .filter(Q(conta__contatos__id=contato_id) | Q(contato_principal_id=contato_id))
+                .order_by('-data_criacao')
+                .values('id', 'funil__tipo')
+                .first()
+            )
+        else:
+            opp = None
+
+        Conversa.objects.update_or_create(
+            instancia=inst,
+            numero_chave=chave,
+            defaults={
+                'numero': numero_remoto(ultima_recebida or ultima),
+                'contato_id': contato_id,
+                'oportunidade_id': opp['id'] if opp else None,
+                'funil_tipo': opp['funil__tipo'] if opp else None,
+                'ultima_mensagem': texto_preview(ultima.texto, ultima.tipo_mensagem),
+                'ultima_mensagem_tipo': ultima.tipo_mensagem,
+                'ultima_mensagem_de_mim': ultima.de_mim,
+                'ultima_mensagem_timestamp': grupo['ultima_timestamp'],
+                'ultima_recebida_timestamp': grupo['ultima_recebida_timestamp'],
+                'nao_lidas': grupo['nao_lidas'],
+            },
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('crm', '0069_indice_kanban'),
+    ]
+
+    operations = [
+        migrations.RunPython(popular_conversas, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,146 @@
+"""
+Data migration: preenche TimelineEvento (criada vazia na 0067_timeline_evento)
+a partir de Atividade, WhatsappMessage e Log, em blocos por id. Sem isso a
+Timeline — que lê apenas TimelineEvento — mostraria só os itens gravados após
+a implantação.
+
+Cópia congelada de services.timeline.reconstruir (e de _escopos/_gravar)
+sobre os modelos históricos.
+"""
+from django.db import migrations
+from django.db.models import Q
+
+LOTE = 1000
+OPORTUNIDADE, CONTA, CONTATO = 'oportunidade', 'conta', 'contato'
+ESCOPOS = (OPORTUNIDADE, CONTA, CONTATO)
+
+
+def popular_timeline(apps, schema_editor):
+    Atividade = apps.get_model('crm', 'Atividade')
+    Conta = apps.get_model('crm', 'Conta')
+    Contato = apps.get_model('crm', 'Contato')
+    ContatoTelefone = apps.get_model('crm', 'ContatoTelefone')
+    Log = apps.get_model('crm', 'Log')
+    Oportunidade = apps.get_model('crm', 'Oportunidade')
+    TimelineEvento = apps.get_model('crm', 'TimelineEvento')
+    WhatsappMessage = apps.get_model('crm', 'WhatsappMessage')
+    ContentType = apps.get_model('contenttypes', 'ContentType')
+
+    tipos = dict(
+        ContentType.objects.filter(app_label='crm', model__in=ESCOPOS).values_list('id', 'model')
+    )
+
+    def escopos_das_refs(refs):
+        por_tipo = {}
+        for tipo, valor in refs:
+            por_tipo.setdefault(tipo, set()).add(valor)
+        escopos = {ref: set() for ref in refs}
+
+        def add(tipo, valor, escopo, entidade_id):
+            if entidade_id:
+                escopos[(tipo, valor)].add((escopo, entidade_id))
+
+        opp_ids = por_tipo.get(OPORTUNIDADE)
+        if opp_ids:
+            for opp_id, conta_id, contato_id in Oportunidade.objects.filter(id__in=opp_ids).values_list(
+                'id', 'conta_id', 'contato_principal_id'
+            ):
+                add(OPORTUNIDADE, opp_id, OPORTUNIDADE, opp_id)
+                add(OPORTUNIDADE, opp_id, CONTA, conta_id)
+                add(OPORTUNIDADE, opp_id, CONTATO, contato_id)
+            for opp_id, contato_id in Oportunidade.contatos.through.objects.filter(
+                oportunidade_id__in=opp_ids
+            ).values_list('oportunidade_id', 'contato_id'):
+                add(OPORTUNIDADE, opp_id, CONTATO, contato_id)
+            for opp_id, conta_id in Oportunidade.empresas.through.objects.filter(
+                oportunidade_id__in=opp_ids
+            ).values_list('oportunidade_id', 'conta_id'):
+                add(OPORTUNIDADE, opp_id, CONTA, conta_id)
+
+        conta_ids = por_tipo.get(CONTA)
+        if conta_ids:
+            for conta_id in Conta.objects.filter(id__in=conta_ids).values_list('id', flat=True):
+                add(CONTA, conta_id, CONTA, conta_id)
+            for conta_id, contato_id in Contato.objects.filter(conta_id__in=conta_ids).values_list('conta_id', 'id'):
+                add(CONTA, conta_id, CONTATO, contato_id)
+
+        for contato_id in por_tipo.get(CONTATO, ()):
+            add(CONTATO, contato_id, CONTATO, contato_id)
+
+        chaves = por_tipo.get('numero')
+        if chaves:
+            for contato_id, telefone, celular in Contato.objects.filter(
+                Q(telefone_chave__in=chaves) | Q(celular_chave__in=chaves)
+            ).values_list('id', 'telefone_chave', 'celular_chave'):
+                for chave in {telefone, celular} & chaves:
+                    add('numero', chave, CONTATO, contato_id)
+            for chave, contato_id in ContatoTelefone.objects.filter(numero_chave__in=chaves).values_list(
+                'numero_chave', 'contato_id'
+            ):
+                add('numero', chave, CONTATO, contato_id)
+            for chave, conta_id in Conta.objects.filter(telefone_principal_chave__in=chaves).values_list(
+                'telefone_principal_chave', 'id'
+            ):
+                add('numero', chave, CONTA, conta_id)
+
+        return escopos
+
+    def gravar(itens):
+        """itens: (fonte, item_id, momento, refs)."""
+        itens = [item for item in itens if item[3]]
+        if not itens:
+            return
+        escopos = escopos_das_refs({ref for *_, refs in itens for ref in refs})
+        TimelineEvento.objects.bulk_create(
+            [
+                TimelineEvento(escopo=escopo, entidade_id=entidade_id, fonte=fonte, item_id=item_id, momento=momento)
+                for fonte, item_id, momento, refs in itens
+                for escopo, entidade_id in set().union(*(escopos[ref] for ref in refs))
+            ],
+            ignore_conflicts=True,
+            batch_size=LOTE,
+        )
+
+    def refs_atividade(atividade):
+        modelo = tipos.get(atividade.content_type_id)
+        return [(modelo, atividade.object_id)] if modelo else []
+
+    def refs_log(log):
+        modelo = (log.modelo or '').lower()
+        return [(modelo, log.objeto_id)] if modelo in ESCOPOS and log.objeto_id else []
+
+    def refs_mensagem(mensagem):
+        refs = []
+        if mensagem.oportunidade_id:
+            refs.append((OPORTUNIDADE, mensagem.oportunidade_id))
+        if mensagem.numero_chave:
+            refs.append(('numero', mensagem.numero_chave))
+        return refs
+
+    fontes = [
+        ('atividade', Atividade.objects.only('id', 'data_criacao', 'content_type_id', 'object_id'),
+         'data_criacao', refs_atividade),
+        ('whatsapp', WhatsappMessage.objects.only('id', 'timestamp', 'oportunidade_id', 'numero_chave'),
+         'timestamp', refs_mensagem),
+        ('log', Log.objects.only('id', 'timestamp', 'modelo', 'objeto_id'), 'timestamp', refs_log),
+    ]
+    for fonte, queryset, campo, refs in fontes:
+        ultimo_id = 0
+        while True:
+            lote = list(queryset.filter(id__gt=ultimo_id).order_by('id')[:LOTE])
+            if not lote:
+                break
+            gravar((fonte, item.id, getattr(item, campo), refs(item)) for item in lote)
+            ultimo_id = lote[-1].id
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('crm', '0070_popular_conversas'),
+    ]
+
+    operations = [
+        migrations.RunPython(popular_timeline, migrations.RunPython.noop),
+    ]
@@ -5,8 +5,26 @@ from django.contrib.auth.models import AbstractUser
 from django.contrib.contenttypes.fields import GenericForeignKey, GenericRelation
 from django.contrib.contenttypes.models import ContentType
 from django.db import models
+from django.utils import timezone
 from django.core.validators import EmailValidator
 
+from .services.phone import canonical_phone
+
+
+def _incluir_chaves_update_fields(kwargs, campos_chave):
+    """
+    Quando save() recebe update_fields com um campo de telefone, inclui também
+    a chave canônica correspondente. campos_chave: {campo_telefone: campo_chave}
+    """
+    update_fields = kwargs.get('update_fields')
+    if update_fields is None:
+        return
+    update_fields = set(update_fields)
+    for campo, chave in campos_chave.items():
+        if campo in update_fields:
+            update_fields.add(chave)
+    kwargs['update_fields'] = update_fields
+
 
 class Canal(models.Model):
     """Representa um Canal de Vendas"""
@@ -92,6 +110,12 @@ class Canal(models.Model):
         help_text="Se ativo, encaminha mensagens WhatsApp recebidas nas oportunidades deste canal para o responsável"
     )
 
+    # Contadores mantidos por services.nao_lidas (mensagens recebidas e não lidas da instância)
+    whatsapp_nao_lidas = models.PositiveIntegerField(default=0, editable=False)
+    whatsapp_nao_lidas_novas = models.PositiveIntegerField(
+        default=0, editable=False, help_text="Não lidas ainda sem oportunidade vinculada"
+    )
+
     class Meta:
         verbose_name = 'Canal'
         verbose_name_plural = 'Canais'
@@ -189,6 +213,7 @@ class Conta(models.Model):
     marca = models.CharField(max_length=100, null=True, blank=True)
     cnpj = models.CharField(max_length=20, null=True, blank=True, unique=True)
     telefone_principal = models.CharField(max_length=20, null=True, blank=True)
+    telefone_principal_chave = models.CharField(max_length=20, blank=True, default='', db_index=True, editable=False)
     email = models.EmailField(null=True, blank=True)
     website = models.URLField(null=True, blank=True)
     setor = models.CharField(max_length=100, null=True, blank=True)
@@ -245,6 +270,11 @@ class Conta(models.Model):
     def __str__(self):
         return self.nome_empresa
 
+    def save(self, *args, **kwargs):
+        self.telefone_principal_chave = canonical_phone(self.telefone_principal)
+        _incluir_chaves_update_fields(kwargs, {'telefone_principal': 'telefone_principal_chave'})
+        super().save(*args, **kwargs)
+
 
 class ContaMarca(models.Model):
     """Marcas adicionais vinculadas a uma Conta"""
@@ -305,6 +335,9 @@ class Contato(models.Model):
     email = models.EmailField(null=True, blank=True, validators=[EmailValidator()])
     telefone = models.CharField(max_length=20, null=True, blank=True)
     celular = models.CharField(max_length=20, null=True, blank=True)
+    # Chaves canônicas (services.phone.canonical_phone) para busca exata indexada
+    telefone_chave = models.CharField(max_length=20, blank=True, default='', db_index=True, editable=False)
+    celular_chave = models.CharField(max_length=20, blank=True, default='', db_index=True, editable=False)
     cargo = models.CharField(max_length=100, null=True, blank=True)
     departamento = models.CharField(max_length=100, null=True, blank=True)
     chave_pix = models.CharField(max_length=255, null=True, blank=True)
@@ -388,6 +421,12 @@ class Contato(models.Model):
         conta_nome = self.conta.nome_empresa if self.conta else "Sem Empresa"
         return f"{self.nome} ({conta_nome})"
 
+    def save(self, *args, **kwargs):
+        self.telefone_chave = canonical_phone(self.telefone)
+        self.celular_chave = canonical_phone(self.celular)
+        _incluir_chaves_update_fields(kwargs, {'telefone': 'telefone_chave', 'celular': 'celular_chave'})
+        super().save(*args, **kwargs)
+
 
 class ContatoTelefone(models.Model):
     """Múltiplos telefones para um contato"""
@@ -405,6 +444,7 @@ class ContatoTelefone(models.Model):
         related_name='telefones'
     )
     numero = models.CharField(max_length=20)
+    numero_chave = models.CharField(max_length=20, blank=True, default='', db_index=True, editable=False)
     tipo = models.CharField(max_length=20, choices=TIPO_CHOICES, default='CELULAR')
     principal = models.BooleanField(default=False)
     
@@ -416,6 +456,11 @@ class ContatoTelefone(models.Model):
     def __str__(self):
         return f"{self.numero} ({self.get_tipo_display()})"
 
+    def save(self, *args, **kwargs):
+        self.numero_chave = canonical_phone(self.numero)
+        _incluir_chaves_update_fields(kwargs, {'numero': 'numero_chave'})
+        super().save(*args, **kwargs)
+
 
 class ContatoEmail(models.Model):
     """Múltiplos emails para um contato"""
@@ -782,6 +827,9 @@ class Oportunidade(models.Model):
     descricao = models.TextField(null=True, blank=True)
     motivo_perda = models.TextField(null=True, blank=True)
     data_fechamento_real = models.DateField(null=True, blank=True)
+
+    # Contador mantido por services.nao_lidas (mensagens WhatsApp recebidas e não lidas)
+    whatsapp_nao_lidas = models.PositiveIntegerField(default=0, editable=False, db_index=True)
     
     data_criacao = models.DateTimeField(auto_now_add=True)
     data_atualizacao = models.DateTimeField(auto_now=True)
@@ -803,7 +851,8 @@ class Oportunidade(models.Model):
         indexes = [
             models.Index(fields=['proprietario', 'estagio']),
             models.Index(fields=['conta']),
-            models.Index(fields=['funil', 'estagio']),
+            # Kanban: GROUP BY por estágio e cards de cada coluna por data_criacao
+            models.Index(fields=['funil', 'estagio', 'data_criacao']),
         ]
 
     def __str__(self):
@@ -898,7 +947,8 @@ class Atividade(models.Model):
         ordering = ['-data_criacao']
         indexes = [
             models.Index(fields=['proprietario', 'status']),
-            models.Index(fields=['content_type', 'object_id']),
+            # Timeline: filtro pela entidade e ordem por data_criacao no mesmo índice
+            models.Index(fields=['content_type', 'object_id', 'data_criacao']),
         ]
 
     def __str__(self):
@@ -990,16 +1040,35 @@ class WhatsappMessage(models.Model):
     de_mim = models.BooleanField(default=False, help_text="True se enviada pelo CRM, False se recebida")
     numero_remetente = models.CharField(max_length=50)
     numero_destinatario = models.CharField(max_length=50)
+    numero_chave = models.CharField(
+        max_length=20, blank=True, default='', editable=False,
+        help_text="Chave canônica do número da outra parte (remetente se recebida, destinatário se enviada)"
+    )
     
     texto = models.TextField(null=True, blank=True)
     tipo_mensagem = models.CharField(max_length=50, default='text', help_text="text, image, video, document, audio, etc")
     url_media = models.URLField(max_length=1000, null=True, blank=True)
-    media_base64 = models.TextField(null=True, blank=True, help_text="Base64 da mídia para exibição direta")
+    media_base64 = models.TextField(
+        null=True, blank=True,
+        help_text="Legado: base64 da mídia. Novas mídias vão para o store (media_hash); migrar com migrar_midias_whatsapp"
+    )
+    # Mídia no store endereçado por conteúdo (services.media_store)
+    media_hash = models.CharField(max_length=64, blank=True, default='', db_index=True, help_text="SHA-256 do arquivo")
+    media_mimetype = models.CharField(max_length=100, blank=True, default='')
+    media_tamanho = models.PositiveIntegerField(
+        null=True, blank=True, help_text="Tamanho em bytes (antes do download, o informado pelo webhook)"
+    )
+    # Cache negativo do services.media_fetcher: download que falhou de vez não é refeito tão cedo
+    media_falha_em = models.DateTimeField(null=True, blank=True)
+    media_erro = models.CharField(max_length=255, blank=True, default='')
     reacoes = models.JSONField(default=list, blank=True, help_text="Reações [{emoji, de_mim, numero}]")
 
     lida = models.BooleanField(default=False, help_text="True se a mensagem já foi visualizada no CRM")
     timestamp = models.DateTimeField()
     data_criacao = models.DateTimeField(auto_now_add=True)
+    # Delta do chat (?since=): save() atualiza sozinho; update() de queryset não aciona o
+    # auto_now e precisa gravar data_atualizacao=timezone.now() ele mesmo
+    data_atualizacao = models.DateTimeField(auto_now=True)
 
     class Meta:
         verbose_name = 'Mensagem WhatsApp'
@@ -1009,12 +1078,30 @@ class WhatsappMessage(models.Model):
             models.Index(fields=['numero_remetente']),
             models.Index(fields=['numero_destinatario']),
             models.Index(fields=['timestamp']),
+            models.Index(fields=['numero_chave', 'timestamp']),
+            models.Index(fields=['oportunidade', 'lida', 'de_mim']),
+            models.Index(fields=['instancia', 'lida', 'de_mim']),
+            models.Index(fields=['numero_chave', 'data_atualizacao']),
+            models.Index(fields=['oportunidade', 'timestamp']),
         ]
 
     def __str__(self):
         direcao = "->" if self.de_mim else "<-"
         return f"{self.numero_remetente} {direcao} {self.numero_destinatario}: {self.texto[:30]}..."
 
+    @property
+    def numero_remoto(self):
+        return self.numero_destinatario if self.de_mim else self.numero_remetente
+
+    def save(self, *args, **kwargs):
+        self.numero_chave = canonical_phone(self.numero_remoto)
+        _incluir_chaves_update_fields(kwargs, {
+            'numero_remetente': 'numero_chave', 'numero_destinatario': 'numero_chave', 'de_mim': 'numero_chave'
+        })
+        if kwargs.get('update_fields') is not None:
+            kwargs['update_fields'] = set(kwargs['update_fields']) | {'data_atualizacao'}
+        super().save(*args, **kwargs)
+
 
 class NumeroBloqueado(models.Model):
     """Números bloqueados que não devem aparecer no inbox/chat do WhatsApp"""
@@ -1030,6 +1117,244 @@ class NumeroBloqueado(models.Model):
     def __str__(self):
         return f"{self.numero} — {self.motivo or 'Sem motivo'}"
 
+    @classmethod
+    def chaves(cls):
+        """Chaves canônicas (services.phone) de todos os números bloqueados."""
+        return {c for c in map(canonical_phone, cls.objects.values_list('numero', flat=True)) if c}
+
+
+class Conversa(models.Model):
+    """
+    Resumo de uma conversa do WhatsApp por (instância, número remoto).
+    Mantido incrementalmente pelo services.conversas a cada mensagem gravada
+    ou marcada como lida; alimenta o inbox de atendimento.
+    """
+    instancia = models.CharField(max_length=100)
+    numero_chave = models.CharField(max_length=20, help_text="Chave canônica do número remoto (services.phone)")
+    numero = models.CharField(max_length=50, help_text="Número remoto como recebido da Evolution API")
+
+    contato = models.ForeignKey(
+        Contato, on_delete=models.SET_NULL, null=True, blank=True, related_name='conversas_whatsapp'
+    )
+    oportunidade = models.ForeignKey(
+        Oportunidade, on_delete=models.SET_NULL, null=True, blank=True, related_name='conversas_whatsapp'
+    )
+    funil_tipo = models.CharField(max_length=20, null=True, blank=True)
+
+    ultima_mensagem = models.CharField(max_length=255, blank=True, default='', help_text="Prévia da última mensagem")
+    ultima_mensagem_tipo = models.CharField(max_length=50, default='text')
+    ultima_mensagem_de_mim = models.BooleanField(default=False)
+    ultima_mensagem_timestamp = models.DateTimeField(null=True, blank=True)
+    ultima_recebida_timestamp = models.DateTimeField(
+        null=True, blank=True, help_text="Última mensagem recebida do contato (ordena o inbox)"
+    )
+    nao_lidas = models.PositiveIntegerField(default=0)
+
+    data_criacao = models.DateTimeField(auto_now_add=True)
+    data_atualizacao = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = 'Conversa WhatsApp'
+        verbose_name_plural = 'Conversas WhatsApp'
+        ordering = ['-ultima_recebida_timestamp', '-id']
+        constraints = [
+            models.UniqueConstraint(fields=['instancia', 'numero_chave'], name='conversa_unica_por_instancia'),
+        ]
+        indexes = [
+            models.Index(fields=['instancia', 'ultima_recebida_timestamp']),
+            models.Index(fields=['ultima_recebida_timestamp']),
+            models.Index(fields=['numero_chave']),
+        ]
+
+    def __str__(self):
+        return f"{self.instancia} ↔ {self.numero} ({self.nao_lidas} não lidas)"
+
+
+class TimelineEvento(models.Model):
+    """
+    Item da Timeline (Atividade, mensagem do WhatsApp ou Log) materializado
+    por escopo: uma linha para cada oportunidade, conta e contato em cuja
+    Timeline o item aparece. Gravado pelo services.timeline a cada item novo;
+    a Timeline de uma entidade é um range scan em (escopo, entidade_id, momento).
+    """
+    ESCOPO_OPORTUNIDADE = 'oportunidade'
+    ESCOPO_CONTA = 'conta'
+    ESCOPO_CONTATO = 'contato'
+
+    ESCOPO_CHOICES = [
+        (ESCOPO_OPORTUNIDADE, 'Oportunidade'),
+        (ESCOPO_CONTA, 'Conta'),
+        (ESCOPO_CONTATO, 'Contato'),
+    ]
+
+    FONTE_CHOICES = [
+        ('atividade', 'Atividade'),
+        ('whatsapp', 'WhatsApp'),
+        ('log', 'Log'),
+    ]
+
+    escopo = models.CharField(max_length=20, choices=ESCOPO_CHOICES)
+    entidade_id = models.PositiveBigIntegerField()
+    fonte = models.CharField(max_length=20, choices=FONTE_CHOICES)
+    item_id = models.PositiveBigIntegerField()
+    momento = models.DateTimeField(help_text="data_criacao da Atividade ou timestamp da mensagem/log")
+
+    class Meta:
+        verbose_name = 'Evento da Timeline'
+        verbose_name_plural = 'Eventos da Timeline'
+        ordering = ['-momento', '-fonte', '-item_id']
+        constraints = [
+            # Também serve a remoção por item (fonte, item_id)
+            models.UniqueConstraint(
+                fields=['fonte', 'item_id', 'escopo', 'entidade_id'], name='timeline_evento_unico'
+            ),
+        ]
+        indexes = [
+            models.Index(fields=['escopo', 'entidade_id', 'momento', 'fonte', 'item_id']),
+        ]
+
+    def __str__(self):
+        return f"{self.escopo} #{self.entidade_id}: {self.fonte} #{self.item_id}"
+
+
+class WebhookEvento(models.Model):
+    """Caixa de entrada durável dos payloads do webhook WhatsApp (drenada pelo worker)"""
+    STATUS_PENDENTE = 'PENDENTE'
+    STATUS_PROCESSADO = 'PROCESSADO'
+    STATUS_FALHOU = 'FALHOU'
+
+    STATUS_CHOICES = [
+        (STATUS_PENDENTE, 'Pendente'),
+        (STATUS_PROCESSADO, 'Processado'),
+        (STATUS_FALHOU, 'Falhou (dead-letter)'),
+    ]
+
+    instancia = models.CharField(max_length=100, help_text="Instância Evolution que enviou o evento")
+    evento = models.CharField(max_length=100, blank=True, default='')
+    payload = models.JSONField(help_text="Payload bruto recebido da Evolution API")
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=STATUS_PENDENTE)
+    tentativas = models.PositiveIntegerField(default=0)
+    ultimo_erro = models.TextField(null=True, blank=True)
+    proxima_tentativa = models.DateTimeField(default=timezone.now)
+    data_recebimento = models.DateTimeField(auto_now_add=True)
+    data_processamento = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        verbose_name = 'Evento de Webhook'
+        verbose_name_plural = 'Eventos de Webhook'
+        ordering = ['id']
+        indexes = [
+            models.Index(fields=['status', 'proxima_tentativa']),
+            models.Index(fields=['instancia', 'status']),
+        ]
+
+    def __str__(self):
+        return f"#{self.id} {self.instancia} {self.evento} ({self.status})"
+
+
+class Tarefa(models.Model):
+    """Tarefa em segundo plano (services.tarefas), executada por `manage.py run_workers`"""
+    STATUS_PENDENTE = 'PENDENTE'
+    STATUS_EXECUTANDO = 'EXECUTANDO'
+    STATUS_CONCLUIDA = 'CONCLUIDA'
+    STATUS_FALHOU = 'FALHOU'
+
+    STATUS_CHOICES = [
+        (STATUS_PENDENTE, 'Pendente'),
+        (STATUS_EXECUTANDO, 'Executando'),
+        (STATUS_CONCLUIDA, 'Concluída'),
+        (STATUS_FALHOU, 'Falhou (dead-letter)'),
+    ]
+    STATUS_ABERTOS = [STATUS_PENDENTE, STATUS_EXECUTANDO]
+
+    nome = models.CharField(max_length=100, help_text="Nome registrado com @tarefa")
+    parametros = models.JSONField(default=dict, blank=True)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=STATUS_PENDENTE)
+    # Menor valor é executado primeiro
+    prioridade = models.SmallIntegerField(default=10)
+    tentativas = models.PositiveIntegerField(default=0)
+    max_tentativas = models.PositiveIntegerField(default=5)
+    executar_em = models.DateTimeField(default=timezone.now)
+    ultimo_erro = models.TextField(null=True, blank=True)
+    data_criacao = models.DateTimeField(auto_now_add=True)
+    data_inicio = models.DateTimeField(null=True, blank=True)
+    data_conclusao = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        verbose_name = 'Tarefa'
+        verbose_name_plural = 'Tarefas'
+        ordering = ['prioridade', 'executar_em', 'id']
+        indexes = [
+            models.Index(fields=['status', 'executar_em', 'prioridade']),
+            models.Index(fields=['nome', 'status']),
+        ]
+
+    def __str__(self):
+        return f"#{self.id} {self.nome} ({self.status})"
+
+
+class TranscricaoAudio(models.Model):
+    """Fila de transcrição de áudios (drenada pelo daemon whisper_worker)"""
+    STATUS_PENDENTE = 'PENDENTE'
+    STATUS_PROCESSANDO = 'PROCESSANDO'
+    STATUS_CONCLUIDA = 'CONCLUIDA'
+    STATUS_FALHOU = 'FALHOU'
+
+    STATUS_CHOICES = [
+        (STATUS_PENDENTE, 'Pendente'),
+        (STATUS_PROCESSANDO, 'Processando'),
+        (STATUS_CONCLUIDA, 'Concluída'),
+        (STATUS_FALHOU, 'Falhou'),
+    ]
+    STATUS_ABERTOS = [STATUS_PENDENTE, STATUS_PROCESSANDO]
+
+    # Menor valor é atendido primeiro
+    PRIORIDADE_INTERATIVA = 0
+    PRIORIDADE_SEGUNDO_PLANO = 10
+
+    mensagem = models.ForeignKey(WhatsappMessage, on_delete=models.CASCADE, related_name='transcricoes')
+    prioridade = models.PositiveSmallIntegerField(default=PRIORIDADE_SEGUNDO_PLANO)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=STATUS_PENDENTE)
+    tentativas = models.PositiveIntegerField(default=0)
+    texto = models.TextField(null=True, blank=True, help_text="Texto transcrito")
+    duracao = models.FloatField(null=True, blank=True, help_text="Duração do áudio em segundos")
+    ultimo_erro = models.TextField(null=True, blank=True)
+    data_criacao = models.DateTimeField(auto_now_add=True)
+    data_processamento = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        verbose_name = 'Transcrição de Áudio'
+        verbose_name_plural = 'Transcrições de Áudio'
+        ordering = ['prioridade', 'id']
+        indexes = [
+            models.Index(fields=['status', 'prioridade', 'id']),
+        ]
+
+    def __str__(self):
+        return f"#{self.id} msg={self.mensagem_id} ({self.status})"
+
+
+class TranscricaoCache(models.Model):
+    """Resultado do Whisper por conteúdo do áudio (sha256 dos bytes), modelo e idioma"""
+    audio_hash = models.CharField(max_length=64, help_text="SHA-256 dos bytes do áudio")
+    modelo = models.CharField(max_length=50, help_text="WHISPER_MODEL_SIZE usado")
+    idioma = models.CharField(max_length=10)
+    texto = models.TextField()
+    segmentos = models.JSONField(default=list, blank=True)
+    duracao = models.FloatField(null=True, blank=True)
+    idioma_detectado = models.CharField(max_length=10, blank=True, default='')
+    data_criacao = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name = 'Cache de Transcrição'
+        verbose_name_plural = 'Cache de Transcrições'
+        constraints = [
+            models.UniqueConstraint(fields=['audio_hash', 'modelo', 'idioma'], name='transcricao_cache_unica'),
+        ]
+
+    def __str__(self):
+        return f"{self.audio_hash[:12]} ({self.modelo}/{self.idioma})"
+
 
 class Log(models.Model):
     """Sistema de logs de auditoria para rastrear todas as ações no sistema"""
@@ -1099,7 +1424,7 @@ class Log(models.Model):
         ordering = ['-timestamp']
         indexes = [
             models.Index(fields=['usuario', 'timestamp']),
-            models.Index(fields=['modelo', 'objeto_id']),
+            models.Index(fields=['modelo', 'objeto_id', 'timestamp']),
             models.Index(fields=['acao', 'timestamp']),
         ]
 
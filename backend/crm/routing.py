@@ -7,4 +7,6 @@ from crm import consumers
 
 websocket_urlpatterns = [
     re_path(r'^ws/atendimento/(?P<canal_id>\d+)/$', consumers.AtendimentoConsumer.as_asgi()),
+    # Uma conexão para todos os canais (assinaturas por mensagem)
+    re_path(r'^ws/atendimento/$', consumers.AtendimentoMultiplexConsumer.as_asgi()),
 ]
@@ -4,6 +4,8 @@ Serializers para a API do CRM
 import re
 from rest_framework import serializers
 from django.db import transaction
+from django.db.models import Count, OuterRef, Prefetch, Subquery
+from django.db.models.functions import Coalesce
 from django.contrib.auth.password_validation import validate_password
 from django.contrib.auth.models import Group, Permission
 from .models import (
@@ -13,6 +15,7 @@ from .models import (
     Plano, PlanoAdicional, OportunidadeAdicional, OportunidadeAnexo, WhatsappMessage, Log,
     ModuloTreinamento, OnboardingCliente, SessaoTreinamento, AgendaTreinamento
 )
+from .services import media_store
 
 
 def normalize_phone_brazil(phone: str) -> str:
@@ -328,6 +331,28 @@ class ContaMarcaSerializer(serializers.ModelSerializer):
         fields = ['id', 'nome']
 
 
+def _contagem(queryset, campo):
+    """Subconsulta COUNT(*) das linhas de queryset com campo = pk da linha externa (0 se nenhuma)."""
+    return Coalesce(
+        Subquery(
+            queryset.filter(**{campo: OuterRef('pk')}).order_by()
+            .values(campo).annotate(n=Count('*')).values('n')
+        ),
+        0,
+    )
+
+
+def _prefetch_tags(lookup='tags'):
+    from .models import Tag
+    return Prefetch(lookup, queryset=TagSerializer.preparar_queryset(Tag.objects.all()))
+
+
+def _telefone_principal(contato):
+    """ContatoTelefone principal (senão o primeiro): a ordenação do modelo já põe o principal na frente."""
+    telefones = list(contato.telefones.all())
+    return telefones[0] if telefones else None
+
+
 class TagSerializer(serializers.ModelSerializer):
     """Serializer para Tags"""
     uso_oportunidades = serializers.SerializerMethodField()
@@ -340,17 +365,30 @@ class TagSerializer(serializers.ModelSerializer):
         model = Tag
         fields = ['id', 'nome', 'cor', 'uso_oportunidades', 'uso_contatos', 'uso_contas', 'total_uso']
 
+    @staticmethod
+    def preparar_queryset(queryset):
+        """Anota os contadores de uso (uma subconsulta por relação) em vez de três COUNTs por tag."""
+        return queryset.annotate(
+            _uso_oportunidades=_contagem(Oportunidade.tags.through.objects, 'tag_id'),
+            _uso_contatos=_contagem(Contato.tags.through.objects, 'tag_id'),
+            _uso_contas=_contagem(Conta.tags.through.objects, 'tag_id'),
+        )
+
+    def _uso(self, obj, relacao):
+        anotado = getattr(obj, f'_uso_{relacao}', None)
+        return anotado if anotado is not None else getattr(obj, relacao).count()
+
     def get_uso_oportunidades(self, obj):
-        return obj.oportunidades.count()
+        return self._uso(obj, 'oportunidades')
 
     def get_uso_contatos(self, obj):
-        return obj.contatos.count()
+        return self._uso(obj, 'contatos')
 
     def get_uso_contas(self, obj):
-        return obj.contas.count()
+        return self._uso(obj, 'contas')
 
     def get_total_uso(self, obj):
-        return obj.oportunidades.count() + obj.contatos.count() + obj.contas.count()
+        return self.get_uso_oportunidades(obj) + self.get_uso_contatos(obj) + self.get_uso_contas(obj)
 
 
 class ContaSerializer(serializers.ModelSerializer):
@@ -377,12 +415,37 @@ class ContaSerializer(serializers.ModelSerializer):
         ]
         read_only_fields = ['data_criacao', 'data_atualizacao', 'proprietario', 'diagnosticos', 'marcas_adicionais']
     
+    @staticmethod
+    def preparar_queryset(queryset):
+        """
+        Tudo o que o serializer lê em número constante de consultas: FKs por
+        JOIN, relações por Prefetch e os totais por subconsulta.
+        """
+        return queryset.select_related('canal', 'proprietario').annotate(
+            _total_contatos=_contagem(Contato.objects, 'conta_id'),
+            # Oportunidades com a conta como principal + vinculadas por empresas (sem repetir)
+            _total_oportunidades=(
+                _contagem(Oportunidade.objects, 'conta_id')
+                + _contagem(
+                    Oportunidade.empresas.through.objects.exclude(oportunidade__conta_id=OuterRef('pk')),
+                    'conta_id',
+                )
+            ),
+        ).prefetch_related(
+            Prefetch('diagnosticos', queryset=DiagnosticoResultado.objects.select_related('conta', 'oportunidade')),
+            'marcas_adicionais',
+            _prefetch_tags(),
+        )
+
     def get_total_contatos(self, obj):
-        return obj.contatos.count()
+        anotado = getattr(obj, '_total_contatos', None)
+        return anotado if anotado is not None else obj.contatos.count()
     
     def get_total_oportunidades(self, obj):
         from django.db.models import Q
-        from .models import Oportunidade
+        anotado = getattr(obj, '_total_oportunidades', None)
+        if anotado is not None:
+            return anotado
         return Oportunidade.objects.filter(Q(conta=obj) | Q(empresas=obj)).distinct().count()
     
     def _salvar_marcas_adicionais(self, conta, marcas_data):
@@ -570,10 +633,30 @@ class ContatoSerializer(serializers.ModelSerializer):
             return obj.foto.url
         return None
     
+    @staticmethod
+    def preparar_queryset(queryset):
+        """
+        Tudo o que o serializer lê em número constante de consultas: FKs por
+        JOIN e relações (inclusive as oportunidades) por Prefetch.
+        """
+        from .models import ContatoAnexo
+        oportunidades = Oportunidade.objects.select_related('estagio')
+        return queryset.select_related(
+            'conta', 'tipo_contato', 'canal', 'proprietario', 'criado_por', 'atualizado_por'
+        ).prefetch_related(
+            Prefetch('redes_sociais', queryset=ContatoRedeSocial.objects.select_related('tipo')),
+            'telefones',
+            'emails',
+            _prefetch_tags(),
+            Prefetch('anexos', queryset=ContatoAnexo.objects.select_related('uploaded_por')),
+            Prefetch('oportunidades', queryset=oportunidades),
+            Prefetch('oportunidades_principais_contato', queryset=oportunidades),
+        )
+
     def get_telefone_formatado(self, obj):
         phone = obj.telefone
         if not phone:
-            tel = obj.telefones.filter(principal=True).first() or obj.telefones.first()
+            tel = _telefone_principal(obj)
             if tel:
                 phone = tel.numero
         return format_phone_display(phone) if phone else ''
@@ -581,7 +664,7 @@ class ContatoSerializer(serializers.ModelSerializer):
     def get_celular_formatado(self, obj):
         phone = obj.celular
         if not phone:
-            tel = obj.telefones.filter(principal=True).first() or obj.telefones.first()
+            tel = _telefone_principal(obj)
             if tel:
                 phone = tel.numero
         return format_phone_display(phone) if phone else ''
@@ -589,8 +672,15 @@ class ContatoSerializer(serializers.ModelSerializer):
     def get_oportunidades(self, obj):
         """Retorna as oportunidades vinculadas a este contato"""
         from django.db.models import Q
-        from .models import Oportunidade
-        opps = Oportunidade.objects.filter(Q(contato_principal=obj) | Q(contatos=obj)).distinct()
+        cache = getattr(obj, '_prefetched_objects_cache', {})
+        if 'oportunidades' in cache and 'oportunidades_principais_contato' in cache:
+            # Vindas do preparar_queryset: une as duas listas sem consultar o banco
+            unicas = {o.id: o for o in [*obj.oportunidades_principais_contato.all(), *obj.oportunidades.all()]}
+            opps = sorted(unicas.values(), key=lambda o: o.data_criacao, reverse=True)
+        else:
+            opps = Oportunidade.objects.filter(
+                Q(contato_principal=obj) | Q(contatos=obj)
+            ).select_related('estagio').distinct()
         return [{
             'id': opp.id,
             'nome': opp.nome,
@@ -1028,7 +1118,6 @@ class OportunidadeSerializer(serializers.ModelSerializer):
     funil_tipo = serializers.SerializerMethodField()
     contato_telefone = serializers.SerializerMethodField()
     contato_celular = serializers.SerializerMethodField()
-    whatsapp_nao_lidas = serializers.SerializerMethodField()
     adicionais_detalhes = OportunidadeAdicionalSerializer(source='oportunidadeadicional_set', many=True, read_only=True)
     anexos = OportunidadeAnexoSerializer(many=True, read_only=True)
     diagnosticos = DiagnosticoResultadoSerializer(many=True, read_only=True)
@@ -1068,12 +1157,52 @@ class OportunidadeSerializer(serializers.ModelSerializer):
             'estagio': {'required': False, 'allow_null': True},
         }
     
+    @staticmethod
+    def preparar_queryset(queryset):
+        """
+        Tudo o que o serializer lê em número constante de consultas por
+        página: FKs por JOIN, relações e serializers aninhados por Prefetch
+        (já preparados) e a próxima atividade por um Prefetch que traz só ela.
+        Descarta os select/prefetch_related anteriores do queryset, que
+        trariam as mesmas relações sem as anotações.
+        """
+        from django.contrib.contenttypes.models import ContentType
+        from django.utils import timezone
+
+        pendentes = Atividade.objects.filter(status='PENDENTE', data_vencimento__gte=timezone.now())
+        # A atividade é a primeira pendente da sua própria oportunidade (object_id)
+        primeira = pendentes.filter(
+            content_type=ContentType.objects.get_for_model(Oportunidade),
+            object_id=OuterRef('object_id'),
+        ).order_by('data_vencimento', 'id').values('id')[:1]
+        contatos = ContatoSerializer.preparar_queryset(Contato.objects.all())
+        contas = ContaSerializer.preparar_queryset(Conta.objects.all())
+        return queryset.select_related(None).prefetch_related(None).select_related(
+            'funil', 'estagio', 'proprietario', 'plano', 'indicador_comissao', 'origem', 'canal'
+        ).prefetch_related(
+            Prefetch(
+                'atividades', queryset=pendentes.filter(id=Subquery(primeira)), to_attr='_proxima_atividade'
+            ),
+            Prefetch('conta', queryset=contas),
+            Prefetch('contato_principal', queryset=contatos),
+            Prefetch('empresas', queryset=contas),
+            Prefetch('contatos', queryset=contatos),
+            Prefetch('oportunidadeadicional_set', queryset=OportunidadeAdicional.objects.select_related('adicional')),
+            Prefetch('anexos', queryset=OportunidadeAnexo.objects.select_related('uploaded_por')),
+            Prefetch('diagnosticos', queryset=DiagnosticoResultado.objects.select_related('conta', 'oportunidade')),
+            _prefetch_tags(),
+        )
+
     def get_proxima_atividade(self, obj):
         from django.utils import timezone
-        next_activity = obj.atividades.filter(
-            status='PENDENTE', 
-            data_vencimento__gte=timezone.now()
-        ).order_by('data_vencimento').first()
+        if hasattr(obj, '_proxima_atividade'):
+            # Vinda do preparar_queryset: lista com no máximo a próxima atividade
+            next_activity = next(iter(obj._proxima_atividade), None)
+        else:
+            next_activity = obj.atividades.filter(
+                status='PENDENTE', 
+                data_vencimento__gte=timezone.now()
+            ).order_by('data_vencimento').first()
         
         if next_activity:
             return {
@@ -1083,12 +1212,10 @@ class OportunidadeSerializer(serializers.ModelSerializer):
             }
         return None
     
-    def get_whatsapp_nao_lidas(self, obj):
-        return obj.mensagens_whatsapp.filter(lida=False, de_mim=False).count()
-    
     def get_conta_nome(self, obj):
-        if obj.empresas.exists():
-            return ", ".join([e.nome_empresa for e in obj.empresas.all()])
+        empresas = list(obj.empresas.all())
+        if empresas:
+            return ", ".join([e.nome_empresa for e in empresas])
         return obj.conta.nome_empresa if obj.conta else None
 
     def get_estagio_nome(self, obj):
@@ -1101,8 +1228,9 @@ class OportunidadeSerializer(serializers.ModelSerializer):
         return obj.estagio.tipo if obj.estagio else "ABERTO"
 
     def get_contato_nome(self, obj):
-        if obj.contatos.exists():
-            return ", ".join([c.nome for c in obj.contatos.all()])
+        contatos = list(obj.contatos.all())
+        if contatos:
+            return ", ".join([c.nome for c in contatos])
         return obj.contato_principal.nome if obj.contato_principal else None
 
     def get_contato_telefone(self, obj):
@@ -1110,7 +1238,7 @@ class OportunidadeSerializer(serializers.ModelSerializer):
         c = obj.contato_principal
         phone = c.celular or c.telefone
         if not phone:
-            tel = c.telefones.filter(principal=True).first() or c.telefones.first()
+            tel = _telefone_principal(c)
             if tel:
                 phone = tel.numero
         return format_phone_display(phone) if phone else None
@@ -1120,7 +1248,7 @@ class OportunidadeSerializer(serializers.ModelSerializer):
         c = obj.contato_principal
         phone = c.celular or c.telefone
         if not phone:
-            tel = c.telefones.filter(principal=True).first() or c.telefones.first()
+            tel = _telefone_principal(c)
             if tel:
                 phone = tel.numero
         return format_phone_display(phone) if phone else None
@@ -1241,7 +1369,6 @@ class OportunidadeKanbanSerializer(serializers.ModelSerializer):
     proprietario_nome = serializers.CharField(source='proprietario.get_full_name', read_only=True)
     estagio_id = serializers.IntegerField(source='estagio.id', read_only=True)
     contato_telefone = serializers.SerializerMethodField()
-    whatsapp_nao_lidas = serializers.SerializerMethodField()
     adicionais_detalhes = OportunidadeAdicionalSerializer(source='oportunidadeadicional_set', many=True, read_only=True)
     tags_detail = TagSerializer(source='tags', many=True, read_only=True)
 
@@ -1254,17 +1381,32 @@ class OportunidadeKanbanSerializer(serializers.ModelSerializer):
             'whatsapp_nao_lidas', 'adicionais_detalhes', 'tags_detail', 'data_atualizacao'
         ]
 
+    @staticmethod
+    def preparar_queryset(queryset):
+        """
+        Cards em número constante de consultas: FKs por JOIN, nomes de
+        empresas/contatos, adicionais e tags por Prefetch. O total de não
+        lidas já é a coluna whatsapp_nao_lidas.
+        """
+        return queryset.select_related(None).prefetch_related(None).select_related(
+            'conta', 'contato_principal', 'proprietario', 'estagio'
+        ).prefetch_related(
+            Prefetch('empresas', queryset=Conta.objects.only('id', 'nome_empresa')),
+            Prefetch('contatos', queryset=Contato.objects.only('id', 'nome')),
+            Prefetch('oportunidadeadicional_set', queryset=OportunidadeAdicional.objects.select_related('adicional')),
+            _prefetch_tags(),
+        )
+
     def get_conta_nome(self, obj):
-        if obj.empresas.exists():
-            return ", ".join([e.nome_empresa for e in obj.empresas.all()])
+        empresas = list(obj.empresas.all())
+        if empresas:
+            return ", ".join([e.nome_empresa for e in empresas])
         return obj.conta.nome_empresa if obj.conta else "N/A"
 
-    def get_whatsapp_nao_lidas(self, obj):
-        return obj.mensagens_whatsapp.filter(lida=False, de_mim=False).count()
-
     def get_contato_nome(self, obj):
-        if obj.contatos.exists():
-            return ", ".join([c.nome for c in obj.contatos.all()])
+        contatos = list(obj.contatos.all())
+        if contatos:
+            return ", ".join([c.nome for c in contatos])
         return obj.contato_principal.nome if obj.contato_principal else None
 
     def get_contato_telefone(self, obj):
@@ -1307,6 +1449,11 @@ class LeadConversaoSerializer(serializers.Serializer):
 
 class WhatsappMessageSerializer(serializers.ModelSerializer):
     contato = serializers.SerializerMethodField()
+    media_src = serializers.SerializerMethodField()
+
+    def get_media_src(self, obj):
+        """URL de streaming da mídia (services.media_store); o base64 não trafega no JSON."""
+        return media_store.url_midia(obj, self.context.get('request'))
 
     def get_contato(self, obj):
         """Retorna o número do contato (o que não é a instância/de_mim)"""
@@ -1318,21 +1465,19 @@ class WhatsappMessageSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = WhatsappMessage
-        fields = '__all__'
+        exclude = ['media_base64']
 
 
 class WhatsappMessageSlimSerializer(WhatsappMessageSerializer):
-    """Serializer leve para listagem — exclui media_base64 para evitar respostas enormes."""
-
-    class Meta(WhatsappMessageSerializer.Meta):
-        exclude = ['media_base64']
-        fields = None
+    """Serializer para listagem do chat (mesmos campos; a mídia vem por media_src)."""
 
 
 class LogSerializer(serializers.ModelSerializer):
     """Serializer para logs de auditoria"""
     usuario_nome = serializers.CharField(source='usuario.get_full_name', read_only=True)
     acao_display = serializers.CharField(source='get_acao_display', read_only=True)
+    # IPAddressField do DRF 3.14 quebra com o Django 5 (ip_address_validators); o log é só leitura
+    ip_address = serializers.CharField(read_only=True, allow_null=True)
 
     class Meta:
         model = Log
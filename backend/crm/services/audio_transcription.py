@@ -1,33 +1,97 @@
 """
 Serviço de Transcrição de Áudio usando Faster-Whisper
+
+Os resultados ficam em TranscricaoCache, indexados pelo SHA-256 dos bytes do
+áudio + modelo + idioma: o mesmo áudio (encaminhado, transcrito de novo pelo
+chat ou reprocessado) é resolvido por uma consulta, sem carregar o modelo.
+
+Modelo e beam size são escolhidos por áudio (WHISPER_NIVEIS): notas curtas
+num modelo pequeno, chamadas longas num maior; com fila acumulada
+(WHISPER_FILA_REBAIXAR) desce um nível. Resultado rebaixado não vai para o
+cache, e o cache só atende com modelo no mínimo do nível sem fila: a
+qualidade reduzida fica restrita ao pico. Os modelos carregados ficam num
+LRU limitado por quantidade e memória estimada.
+
+Áudios em base64 ou baixados por URL são decodificados direto num buffer em
+memória (o faster-whisper aceita arquivo-objeto); arquivo temporário só é
+usado se o decodificador não conseguir ler o formato a partir do buffer.
 """
+import base64
+import hashlib
+import io
 import os
 import tempfile
+import threading
 import logging
+from collections import OrderedDict
+
 import requests
 from django.conf import settings
 
 logger = logging.getLogger(__name__)
 
-# Modelo será carregado sob demanda (lazy loading)
-_whisper_model = None
+# Modelos carregados sob demanda (lazy loading), mantidos em LRU: tamanho -> WhisperModel
+_modelos = OrderedDict()
+_modelos_lock = threading.Lock()
+_cpu_threads = None
 
+# Transcrições rodando neste processo (entra na profundidade da fila)
+_em_andamento = 0
+_em_andamento_lock = threading.Lock()
+
+# Múltiplo de 4: cada bloco de base64 decodifica sozinho
+BLOCO_BASE64 = 4 * 64 * 1024
+
+# Do menor para o maior: rebaixar sob fila = um passo para a esquerda
+ORDEM_MODELOS = ['tiny', 'base', 'small', 'medium', 'large-v2', 'large-v3']
+# Memória aproximada de cada modelo em CPU/int8 (MB), para o teto do LRU
+MEMORIA_MODELOS_MB = {'tiny': 75, 'base': 145, 'small': 480, 'medium': 1500, 'large-v2': 3100, 'large-v3': 3100}
+# Voz opus do WhatsApp fica perto de 16 kbit/s: estimativa quando o contêiner não informa a duração
+BYTES_POR_SEGUNDO_ESTIMADO = 2000
+
+
+def _liberar_excedentes():
+    """Descarta os modelos menos usados acima de WHISPER_MODELOS_CARREGADOS / WHISPER_MEMORIA_MAX_MB."""
+    maximo = max(1, getattr(settings, 'WHISPER_MODELOS_CARREGADOS', 2))
+    memoria_max = getattr(settings, 'WHISPER_MEMORIA_MAX_MB', 0)
+    while len(_modelos) > 1:
+        memoria = sum(MEMORIA_MODELOS_MB.get(t, 500) for t in _modelos)
+        if len(_modelos) <= maximo and (not memoria_max or memoria <= memoria_max):
+            break
+        tamanho, _ = _modelos.popitem(last=False)
+        logger.info(f"[Whisper] Modelo '{tamanho}' descarregado (LRU)")
+
+
+def get_whisper_model(cpu_threads=None, model_size=None):
+    """
+    Carrega o modelo Whisper sob demanda e o mantém no LRU do processo.
+    O daemon whisper_worker chama na inicialização para pré-carregar (e fixar
+    cpu_threads dos modelos carregados depois).
+    """
+    global _cpu_threads
+
+    if cpu_threads is not None:
+        _cpu_threads = cpu_threads
+    model_size = model_size or getattr(settings, 'WHISPER_MODEL_SIZE', 'base')
+
+    with _modelos_lock:
+        model = _modelos.get(model_size)
+        if model is not None:
+            _modelos.move_to_end(model_size)
+            return model
 
-def get_whisper_model():
-    """Carrega o modelo Whisper sob demanda (singleton)"""
-    global _whisper_model
-    
-    if _whisper_model is None:
         try:
             from faster_whisper import WhisperModel
             
             # Configuração do modelo via settings ou padrão
-            model_size = getattr(settings, 'WHISPER_MODEL_SIZE', 'base')
             device = getattr(settings, 'WHISPER_DEVICE', 'cpu')
             compute_type = getattr(settings, 'WHISPER_COMPUTE_TYPE', 'int8')
+            threads = _cpu_threads if _cpu_threads is not None else getattr(settings, 'WHISPER_CPU_THREADS', 0)
             
-            logger.info(f"[Whisper] Carregando modelo '{model_size}' no dispositivo '{device}'...")
-            _whisper_model = WhisperModel(model_size, device=device, compute_type=compute_type)
+            logger.info(f"[Whisper] Carregando modelo '{model_size}' no dispositivo '{device}' (cpu_threads={threads})...")
+            model = WhisperModel(
+                model_size, device=device, compute_type=compute_type, cpu_threads=threads
+            )
             logger.info(f"[Whisper] Modelo carregado com sucesso!")
             
         except ImportError:
@@ -36,28 +100,168 @@ def get_whisper_model():
         except Exception as e:
             logger.error(f"[Whisper] Erro ao carregar modelo: {str(e)}")
             return None
-    
-    return _whisper_model
+
+        _modelos[model_size] = model
+        _liberar_excedentes()
+        return model
+
+
+def niveis():
+    """
+    Faixas de WHISPER_NIVEIS ("duracao_max:modelo:beam,..."; duração 0 = sem
+    limite) como [(duracao_max, modelo, beam)]. Sem configuração, um único
+    nível com WHISPER_MODEL_SIZE e beam 5.
+    """
+    faixas = []
+    for item in (getattr(settings, 'WHISPER_NIVEIS', '') or '').split(','):
+        partes = item.strip().split(':')
+        if len(partes) != 3:
+            continue
+        try:
+            faixas.append((float(partes[0]), partes[1].strip(), int(partes[2])))
+        except ValueError:
+            logger.warning(f"[Whisper] Faixa inválida em WHISPER_NIVEIS: {item!r}")
+    if not faixas:
+        return [(0, getattr(settings, 'WHISPER_MODEL_SIZE', 'base'), 5)]
+    return faixas
+
+
+def duracao_audio(fonte, tamanho=None):
+    """Duração (s) lida do contêiner pelo PyAV, ou estimada pelo tamanho; None se nada der."""
+    try:
+        import av
+        with av.open(fonte) as container:
+            if container.duration:
+                return container.duration / av.time_base
+    except Exception:
+        pass
+    finally:
+        if hasattr(fonte, 'seek'):
+            fonte.seek(0)
+    if tamanho is None and isinstance(fonte, str) and os.path.exists(fonte):
+        tamanho = os.path.getsize(fonte)
+    elif tamanho is None and hasattr(fonte, 'getbuffer'):
+        tamanho = fonte.getbuffer().nbytes
+    return tamanho / BYTES_POR_SEGUNDO_ESTIMADO if tamanho else None
+
+
+def profundidade_fila():
+    """Transcrições em andamento neste processo + pedidos pendentes do whisper_worker."""
+    profundidade = _em_andamento
+    if getattr(settings, 'WHISPER_WORKER', False):
+        from crm.models import TranscricaoAudio
+        profundidade += TranscricaoAudio.objects.filter(status=TranscricaoAudio.STATUS_PENDENTE).count()
+    return profundidade
+
+
+def escolher_nivel(duracao, fila):
+    """
+    (modelo, beam_size) para um áudio: a faixa pela duração e, com
+    WHISPER_FILA_REBAIXAR ou mais pedidos na fila, um nível abaixo e beam 1.
+    """
+    faixas = niveis()
+    indice = len(faixas) - 1
+    if duracao is not None:
+        for i, (limite, _, _) in enumerate(faixas):
+            if not limite or duracao <= limite:
+                indice = i
+                break
+    _, modelo, beam = faixas[indice]
+
+    rebaixar = getattr(settings, 'WHISPER_FILA_REBAIXAR', 0)
+    if rebaixar and fila >= rebaixar:
+        # Sem WHISPER_NIVEIS (faixa única) só o beam cai: o modelo fixo foi escolha explícita
+        if indice > 0:
+            modelo = faixas[indice - 1][1]
+        elif modelo in ORDEM_MODELOS and ORDEM_MODELOS.index(modelo) > 0 and len(faixas) > 1:
+            modelo = ORDEM_MODELOS[ORDEM_MODELOS.index(modelo) - 1]
+        beam = 1
+    return modelo, beam
+
+
+def hash_audio(audio_path: str) -> str:
+    """SHA-256 do arquivo de áudio (mesmo valor de media_hash no store de mídias)."""
+    h = hashlib.sha256()
+    with open(audio_path, 'rb') as f:
+        for bloco in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(bloco)
+    return h.hexdigest()
+
+
+def _posicao_modelo(modelo):
+    return ORDEM_MODELOS.index(modelo) if modelo in ORDEM_MODELOS else -1
+
+
+def _atende_nivel(modelo, duracao):
+    """Se `modelo` é no mínimo o que escolher_nivel daria a este áudio com a fila vazia."""
+    alvo, _ = escolher_nivel(duracao, fila=0)
+    if modelo == alvo:
+        return True
+    return _posicao_modelo(alvo) >= 0 and _posicao_modelo(modelo) >= _posicao_modelo(alvo)
+
+
+def buscar_cache(audio_hash: str, language: str = 'pt') -> dict:
+    """
+    Transcrição já feita deste áudio, ou None. Com seleção adaptativa o mesmo
+    áudio pode ter sido transcrito por modelos diferentes: vale o maior, desde
+    que atenda o nível atual do áudio (WHISPER_NIVEIS / WHISPER_MODEL_SIZE
+    elevados invalidam os resultados de modelos menores).
+    """
+    from crm.models import TranscricaoCache
+
+    itens = [
+        item for item in TranscricaoCache.objects.filter(audio_hash=audio_hash, idioma=language)
+        if _atende_nivel(item.modelo, item.duracao)
+    ]
+    if not itens:
+        return None
+    item = max(itens, key=lambda i: _posicao_modelo(i.modelo))
+    logger.info(f"[Whisper] Transcrição em cache para {audio_hash[:12]}")
+    return {
+        'text': item.texto,
+        'segments': item.segmentos,
+        'language': item.idioma_detectado or language,
+        'duration': item.duracao,
+        'model': item.modelo,
+        'rebaixado': False,
+    }
+
+
+def gravar_cache(audio_hash: str, language: str, resultado: dict):
+    """
+    Guarda a transcrição (só resultados com texto: vazio pode ser falha
+    passageira). Resultados rebaixados pela fila não entram: seriam servidos
+    no lugar da transcrição completa depois que a fila esvaziasse.
+    """
+    from crm.models import TranscricaoCache
+
+    if not (resultado and resultado.get('text')) or resultado.get('rebaixado'):
+        return
+    try:
+        TranscricaoCache.objects.get_or_create(
+            audio_hash=audio_hash, idioma=language,
+            modelo=resultado.get('model') or getattr(settings, 'WHISPER_MODEL_SIZE', 'base'),
+            defaults={
+                'texto': resultado['text'],
+                'segmentos': resultado.get('segments') or [],
+                'duracao': resultado.get('duration'),
+                'idioma_detectado': (resultado.get('language') or '')[:10],
+            },
+        )
+    except Exception as e:
+        logger.warning(f"[Whisper] Falha ao gravar cache de transcrição: {e}")
 
 
 def download_audio(url: str, headers: dict = None) -> str:
     """
     Baixa um arquivo de áudio de uma URL e retorna o caminho do arquivo temporário.
+    (transcribe_from_url não usa mais: transcreve em memória)
     """
     try:
         response = requests.get(url, headers=headers, timeout=30)
         response.raise_for_status()
         
-        # Determina a extensão do arquivo
-        content_type = response.headers.get('content-type', '')
-        if 'ogg' in content_type or 'opus' in content_type:
-            ext = '.ogg'
-        elif 'mpeg' in content_type or 'mp3' in content_type:
-            ext = '.mp3'
-        elif 'wav' in content_type:
-            ext = '.wav'
-        else:
-            ext = '.ogg'  # Padrão do WhatsApp
+        ext = _extensao(response.headers.get('content-type', ''))
         
         # Cria arquivo temporário
         with tempfile.NamedTemporaryFile(delete=False, suffix=ext) as tmp_file:
@@ -69,71 +273,207 @@ def download_audio(url: str, headers: dict = None) -> str:
         return None
 
 
-def transcribe_audio(audio_path: str, language: str = 'pt') -> dict:
+def _extensao(mimetype: str) -> str:
+    if 'opus' in mimetype or 'ogg' in mimetype:
+        return '.ogg'
+    if 'mp3' in mimetype or 'mpeg' in mimetype:
+        return '.mp3'
+    if 'wav' in mimetype:
+        return '.wav'
+    if 'webm' in mimetype:
+        return '.webm'
+    if 'mp4' in mimetype or 'm4a' in mimetype:
+        return '.m4a'
+    return '.ogg'  # Padrão do WhatsApp
+
+
+def _erros_decodificacao():
+    """Exceções do PyAV (decodificador do faster-whisper) que justificam tentar via arquivo."""
+    try:
+        import av
+        return (av.error.FFmpegError,)
+    except (ImportError, AttributeError):
+        return (Exception,)
+
+
+def decodificar_base64(base64_data: str):
+    """
+    Decodifica base64 puro ou data URI em blocos para um BytesIO, calculando o
+    sha256 junto (sem montar um bytes intermediário do áudio inteiro).
+
+    Returns:
+        (buffer posicionado no início, sha256, tamanho em bytes)
+    """
+    inicio = base64_data.index(',') + 1 if base64_data.startswith('data:') else 0
+    if any(c in base64_data for c in '\r\n '):
+        # Quebras de linha desalinhariam os blocos: caso raro, normaliza antes
+        base64_data = ''.join(base64_data[inicio:].split())
+        inicio = 0
+
+    buffer = io.BytesIO()
+    h = hashlib.sha256()
+    for pos in range(inicio, len(base64_data), BLOCO_BASE64):
+        bloco = base64.b64decode(base64_data[pos:pos + BLOCO_BASE64])
+        h.update(bloco)
+        buffer.write(bloco)
+    tamanho = buffer.tell()
+    buffer.seek(0)
+    return buffer, h.hexdigest(), tamanho
+
+
+def _executar_modelo(model, fonte, language: str, ao_segmento=None, beam_size: int = 5) -> dict:
+    """
+    Roda o Whisper sobre um caminho ou arquivo-objeto e monta o resultado.
+    ao_segmento(segmento, texto_acumulado) é chamado a cada segmento decodificado.
+    """
+    segments, info = model.transcribe(
+        fonte,
+        language=language,
+        beam_size=beam_size,
+        vad_filter=True,  # Remove silêncios
+        vad_parameters=dict(min_silence_duration_ms=500)
+    )
+    
+    # Converte o gerador para lista e extrai o texto
+    segments_list = []
+    full_text = []
+    
+    for segment in segments:
+        segments_list.append({
+            'start': segment.start,
+            'end': segment.end,
+            'text': segment.text.strip()
+        })
+        full_text.append(segment.text.strip())
+        if ao_segmento is not None:
+            ao_segmento(segments_list[-1], ' '.join(full_text))
+    
+    transcription = ' '.join(full_text)
+    
+    logger.info(f"[Whisper] Transcrição concluída: {len(transcription)} caracteres")
+    
+    return {
+        'text': transcription,
+        'segments': segments_list,
+        'language': info.language,
+        'duration': info.duration
+    }
+
+
+def _rodar_whisper(fonte, language: str, ao_segmento=None) -> dict:
+    """
+    Escolhe modelo e beam pela duração do áudio e pela fila (escolher_nivel),
+    carrega o modelo pelo LRU e transcreve. None se o modelo não carregar.
+    """
+    global _em_andamento
+
+    duracao = duracao_audio(fonte)
+    model_size, beam_size = escolher_nivel(duracao, profundidade_fila())
+    rebaixado = (model_size, beam_size) != escolher_nivel(duracao, fila=0)
+    model = get_whisper_model(model_size=model_size)
+    if model is None:
+        return None
+
+    logger.info(f"[Whisper] Nível escolhido: modelo={model_size} beam={beam_size} (duração≈{duracao or 0:.0f}s)")
+    with _em_andamento_lock:
+        _em_andamento += 1
+    try:
+        resultado = _executar_modelo(model, fonte, language, ao_segmento, beam_size=beam_size)
+    finally:
+        with _em_andamento_lock:
+            _em_andamento -= 1
+    resultado['model'] = model_size
+    resultado['rebaixado'] = rebaixado
+    return resultado
+
+
+def transcribe_audio(audio_path: str, language: str = 'pt', remover_arquivo: bool = True,
+                     audio_hash: str = None, ao_segmento=None) -> dict:
     """
-    Transcreve um arquivo de áudio usando Faster-Whisper.
+    Transcreve um arquivo de áudio usando Faster-Whisper (consultando antes o
+    cache de transcrições).
     
     Args:
         audio_path: Caminho para o arquivo de áudio
         language: Código do idioma (pt para português)
+        remover_arquivo: Remove o arquivo temporário ao final (False para
+            arquivos do store de mídias)
+        audio_hash: SHA-256 do conteúdo, se já conhecido (evita reler o arquivo)
+        ao_segmento: callback por segmento (transcrição progressiva); não é
+            chamado quando o resultado vem do cache
     
     Returns:
         dict com 'text' (transcrição completa), 'segments' (lista de segmentos com timestamps)
         ou None se falhar
     """
-    model = get_whisper_model()
-    if model is None:
-        return None
-    
     try:
+        if audio_hash is None:
+            audio_hash = hash_audio(audio_path)
+        resultado = buscar_cache(audio_hash, language)
+        if resultado is not None:
+            return resultado
+
         logger.info(f"[Whisper] Transcrevendo áudio: {audio_path}")
-        
-        segments, info = model.transcribe(
-            audio_path,
-            language=language,
-            beam_size=5,
-            vad_filter=True,  # Remove silêncios
-            vad_parameters=dict(min_silence_duration_ms=500)
-        )
-        
-        # Converte o gerador para lista e extrai o texto
-        segments_list = []
-        full_text = []
-        
-        for segment in segments:
-            segments_list.append({
-                'start': segment.start,
-                'end': segment.end,
-                'text': segment.text.strip()
-            })
-            full_text.append(segment.text.strip())
-        
-        transcription = ' '.join(full_text)
-        
-        logger.info(f"[Whisper] Transcrição concluída: {len(transcription)} caracteres")
-        
-        return {
-            'text': transcription,
-            'segments': segments_list,
-            'language': info.language,
-            'duration': info.duration
-        }
+        resultado = _rodar_whisper(audio_path, language, ao_segmento)
+        if resultado is None:
+            return None
+        gravar_cache(audio_hash, language, resultado)
+        return resultado
         
     except Exception as e:
         logger.error(f"[Whisper] Erro na transcrição: {str(e)}")
         return None
     finally:
         # Limpa o arquivo temporário se existir
-        if audio_path and os.path.exists(audio_path) and audio_path.startswith(tempfile.gettempdir()):
+        if (remover_arquivo and audio_path and os.path.exists(audio_path)
+                and audio_path.startswith(tempfile.gettempdir())):
             try:
                 os.remove(audio_path)
             except:
                 pass
 
 
+def transcribe_buffer(buffer, language: str = 'pt', audio_hash: str = None, ext: str = '.ogg',
+                      ao_segmento=None) -> dict:
+    """
+    Transcreve áudio a partir de um arquivo-objeto em memória (BytesIO).
+
+    Se o decodificador não conseguir ler o formato do buffer, grava um
+    arquivo temporário com a extensão `ext` e tenta por caminho.
+
+    Returns:
+        dict com 'text' e 'segments' ou None se falhar
+    """
+    try:
+        if audio_hash is None:
+            audio_hash = hashlib.sha256(buffer.getbuffer()).hexdigest()
+        resultado = buscar_cache(audio_hash, language)
+        if resultado is not None:
+            return resultado
+
+        try:
+            buffer.seek(0)
+            resultado = _rodar_whisper(buffer, language, ao_segmento)
+        except _erros_decodificacao() as e:
+            logger.warning(f"[Whisper] Formato não lido da memória ({e}); usando arquivo temporário")
+            with tempfile.NamedTemporaryFile(delete=False, suffix=ext) as tmp_file:
+                tmp_file.write(buffer.getbuffer())
+                audio_path = tmp_file.name
+            return transcribe_audio(audio_path, language, audio_hash=audio_hash, ao_segmento=ao_segmento)
+
+        if resultado is None:
+            return None
+        gravar_cache(audio_hash, language, resultado)
+        return resultado
+
+    except Exception as e:
+        logger.error(f"[Whisper] Erro na transcrição em memória: {str(e)}")
+        return None
+
+
 def transcribe_from_url(url: str, headers: dict = None, language: str = 'pt') -> dict:
     """
-    Baixa e transcreve áudio de uma URL.
+    Baixa e transcreve áudio de uma URL (em memória).
     
     Args:
         url: URL do arquivo de áudio
@@ -143,59 +483,38 @@ def transcribe_from_url(url: str, headers: dict = None, language: str = 'pt') ->
     Returns:
         dict com 'text' e 'segments' ou None se falhar
     """
-    audio_path = download_audio(url, headers)
-    if audio_path is None:
+    try:
+        response = requests.get(url, headers=headers, timeout=30)
+        response.raise_for_status()
+    except Exception as e:
+        logger.error(f"[Whisper] Erro ao baixar áudio: {str(e)}")
         return None
-    
-    return transcribe_audio(audio_path, language)
 
+    ext = _extensao(response.headers.get('content-type', ''))
+    return transcribe_buffer(io.BytesIO(response.content), language, ext=ext)
 
-def transcribe_from_base64(base64_data: str, mimetype: str = '', language: str = 'pt') -> dict:
+
+def transcribe_from_base64(base64_data: str, mimetype: str = '', language: str = 'pt', ao_segmento=None) -> dict:
     """
-    Transcreve áudio a partir de dados Base64 (formato da Evolution API).
+    Transcreve áudio a partir de dados Base64 (formato da Evolution API),
+    decodificando em memória.
     
     Args:
         base64_data: String Base64 do áudio
         mimetype: Tipo MIME do áudio (ex: audio/ogg; codecs=opus)
         language: Código do idioma
+        ao_segmento: callback por segmento (ver transcribe_audio)
     
     Returns:
         dict com 'text' e 'segments' ou None se falhar
     """
-    import base64
-    
     try:
-        # Determina a extensão do arquivo baseado no mimetype
-        if 'opus' in mimetype or 'ogg' in mimetype:
-            ext = '.ogg'
-        elif 'mp3' in mimetype or 'mpeg' in mimetype:
-            ext = '.mp3'
-        elif 'wav' in mimetype:
-            ext = '.wav'
-        elif 'webm' in mimetype:
-            ext = '.webm'
-        elif 'mp4' in mimetype or 'm4a' in mimetype:
-            ext = '.m4a'
-        else:
-            ext = '.ogg'  # Padrão do WhatsApp
-        
-        # Remove prefixo data:audio/... se existir
-        if base64_data.startswith('data:'):
-            base64_data = base64_data.split(',', 1)[-1]
-        
-        # Decodifica o Base64
-        audio_bytes = base64.b64decode(base64_data)
-        
-        # Salva em arquivo temporário
-        with tempfile.NamedTemporaryFile(delete=False, suffix=ext) as tmp_file:
-            tmp_file.write(audio_bytes)
-            audio_path = tmp_file.name
-        
-        logger.info(f"[Whisper] Áudio Base64 salvo: {audio_path} ({len(audio_bytes)} bytes)")
-        
-        # Transcreve
-        return transcribe_audio(audio_path, language)
-        
+        buffer, audio_hash, tamanho = decodificar_base64(base64_data)
     except Exception as e:
         logger.error(f"[Whisper] Erro ao processar áudio Base64: {str(e)}")
         return None
+
+    logger.info(f"[Whisper] Áudio Base64 decodificado em memória ({tamanho} bytes)")
+    return transcribe_buffer(
+        buffer, language, audio_hash=audio_hash, ext=_extensao(mimetype), ao_segmento=ao_segmento
+    )
@@ -0,0 +1,47 @@
+"""
+Cache em processo das chaves canônicas dos números bloqueados.
+
+O chat e o inbox excluem os bloqueados a cada listagem. Em vez de ler
+NumeroBloqueado do banco a cada requisição, cada processo guarda o conjunto
+de chaves junto com a versão lida do cache do Django; os signals de
+save/delete de NumeroBloqueado trocam a versão e os processos recarregam na
+próxima consulta. Sem REDIS_URL o cache do Django é local ao processo, então
+o conjunto também expira após TTL_SEGUNDOS.
+"""
+import threading
+import time
+import uuid
+
+from django.core.cache import cache
+
+CHAVE_VERSAO = 'crm:bloqueados:versao'
+TTL_SEGUNDOS = 60
+
+_lock = threading.Lock()
+_local = {'versao': None, 'chaves': frozenset(), 'carregado_em': 0.0}
+
+
+def versao():
+    return cache.get_or_set(CHAVE_VERSAO, uuid.uuid4().hex, timeout=None)
+
+
+def invalidar():
+    """Chamado ao salvar/remover um NumeroBloqueado."""
+    cache.set(CHAVE_VERSAO, uuid.uuid4().hex, timeout=None)
+    with _lock:
+        _local['versao'] = None
+
+
+def chaves():
+    """Chaves canônicas (services.phone) dos números bloqueados, do cache do processo."""
+    from ..models import NumeroBloqueado
+
+    atual = versao()
+    with _lock:
+        if _local['versao'] == atual and time.monotonic() - _local['carregado_em'] < TTL_SEGUNDOS:
+            return _local['chaves']
+
+    carregadas = frozenset(NumeroBloqueado.chaves())
+    with _lock:
+        _local.update(versao=atual, chaves=carregadas, carregado_em=time.monotonic())
+    return carregadas
@@ -0,0 +1,62 @@
+"""
+Push das mensagens da conversa aberta no chat pelo WebSocket.
+
+O chat assina a conversa na conexão do AtendimentoConsumer
+({"acao": "assinar", "numero": ...}) e entra no grupo
+"atendimento_conversa_{canal_id}_{numero_chave}". Toda mensagem criada ou
+alterada (recebida, eco das enviadas, reação, mídia baixada, transcrição,
+leitura) é enviada ao grupo com o payload do WhatsappMessageSlimSerializer,
+um evento `conversa_mensagens` por conversa, então o chat não precisa de
+polling enquanto a conexão estiver aberta.
+
+Pontos de chamada: signals (post_save de WhatsappMessage),
+whatsapp_webhook.processar_lote (bulk_create), media_fetcher.marcar_falha e
+WhatsappViewSet.marcar_lidas.
+"""
+import logging
+from functools import partial
+
+from django.db import transaction
+
+from . import difusao
+
+logger = logging.getLogger(__name__)
+
+# Teto de mensagens por publicação de caminhos em lote (marcar_lidas)
+MAX_MENSAGENS = 200
+
+
+def grupo(canal_id, numero_chave):
+    return f'atendimento_conversa_{canal_id}_{numero_chave}'
+
+
+def publicar(mensagens):
+    """
+    Envia as mensagens (WhatsappMessage) aos grupos das suas conversas após o
+    commit, serializadas no estado em que a transação as deixou.
+    """
+    mensagens = [m for m in mensagens if m.id and m.instancia and m.numero_chave]
+    if mensagens:
+        transaction.on_commit(partial(_publicar, mensagens))
+
+
+def _publicar(mensagens):
+    from ..serializers import WhatsappMessageSlimSerializer
+
+    try:
+        canais = difusao.canais_das_instancias({m.instancia for m in mensagens})
+        por_conversa = {}
+        for m in mensagens:
+            canal_id = canais.get(m.instancia)
+            if canal_id:
+                por_conversa.setdefault((canal_id, m.numero_chave), []).append(m)
+
+        for (canal_id, chave), lista in por_conversa.items():
+            difusao.despachar(grupo(canal_id, chave), {
+                'type': 'conversa_mensagens',
+                'canal_id': canal_id,
+                'numero_chave': chave,
+                'mensagens': [dict(m) for m in WhatsappMessageSlimSerializer(lista, many=True).data],
+            })
+    except Exception as e:
+        logger.error(f'[WS] Erro ao publicar mensagens no chat: {e}')
@@ -0,0 +1,214 @@
+"""
+Manutenção incremental da tabela Conversa (inbox de atendimento).
+
+Cada mensagem gravada atualiza o resumo da sua conversa (prévia, horário,
+não lidas, contato, oportunidade e tipo de funil) na mesma transação, de modo
+que o inbox seja uma única consulta sobre Conversa em vez de agrupar o
+histórico de WhatsappMessage a cada carregamento.
+
+Pontos de atualização:
+- signals: post_save de WhatsappMessage (mensagem nova / vínculo com oportunidade),
+  post_save de Contato e de Oportunidade (nome e tipo de funil);
+- whatsapp_webhook.processar_lote: mensagens inseridas via bulk_create;
+- WhatsappViewSet.marcar_lidas: recálculo de não lidas.
+
+`manage.py rebuild_conversas` reconstrói a tabela a partir das mensagens.
+"""
+from django.db import transaction
+from django.db.models import Count, Max, Q
+
+from ..models import Contato, Conversa, Oportunidade, WhatsappMessage
+
+
+def texto_preview(texto, tipo):
+    """Prévia exibida na lista de conversas."""
+    if tipo == 'audio':
+        return '🎤 Áudio'
+    if tipo == 'image':
+        return '📷 Imagem'
+    if tipo == 'document':
+        return '📄 Documento'
+    return (texto or '')[:80]
+
+
+def resolver_contato_id(chave):
+    """Contato cujo telefone ou celular tem a chave canônica informada."""
+    if not chave:
+        return None
+    return (
+        Contato.objects
+        .filter(Q(celular_chave=chave) | Q(telefone_chave=chave))
+        .values_list('id', flat=True)
+        .first()
+    )
+
+
+def resolver_oportunidade_do_contato(contato_id):
+    """Oportunidade mais recente do contato (principal ou via empresa): (id, funil_tipo)."""
+    opp = (
+        Oportunidade.objects
+        .filter(Q(conta__contatos__id=contato_id) | Q(contato_principal_id=contato_id))
+        .order_by('-data_criacao')
+        .values('id', 'funil__tipo')
+        .first()
+    )
+    return (opp['id'], opp['funil__tipo']) if opp else (None, None)
+
+
+def _funil_tipo(oportunidade_id):
+    return (
+        Oportunidade.objects
+        .filter(id=oportunidade_id)
+        .values_list('funil__tipo', flat=True)
+        .first()
+    )
+
+
+def registrar_mensagem(mensagem):
+    registrar_mensagens([mensagem])
+
+
+def registrar_mensagens(mensagens):
+    """Aplica mensagens recém-gravadas às respectivas conversas (uma atualização por conversa)."""
+    grupos = {}
+    for m in mensagens:
+        if m.numero_chave:
+            grupos.setdefault((m.instancia, m.numero_chave), []).append(m)
+
+    if not grupos:
+        return
+
+    with transaction.atomic():
+        for (instancia, chave), msgs in grupos.items():
+            _aplicar(instancia, chave, msgs)
+
+
+def _aplicar(instancia, chave, mensagens):
+    ultima = max(mensagens, key=lambda m: m.timestamp)
+    conversa, _ = Conversa.objects.select_for_update().get_or_create(
+        instancia=instancia,
+        numero_chave=chave,
+        defaults={'numero': ultima.numero_remoto},
+    )
+
+    if conversa.ultima_mensagem_timestamp is None or ultima.timestamp >= conversa.ultima_mensagem_timestamp:
+        conversa.ultima_mensagem = texto_preview(ultima.texto, ultima.tipo_mensagem)
+        conversa.ultima_mensagem_tipo = ultima.tipo_mensagem
+        conversa.ultima_mensagem_de_mim = ultima.de_mim
+        conversa.ultima_mensagem_timestamp = ultima.timestamp
+        if ultima.oportunidade_id and ultima.oportunidade_id != conversa.oportunidade_id:
+            conversa.oportunidade_id = ultima.oportunidade_id
+            conversa.funil_tipo = _funil_tipo(ultima.oportunidade_id)
+
+    recebidas = [m for m in mensagens if not m.de_mim]
+    if recebidas:
+        ultima_recebida = max(recebidas, key=lambda m: m.timestamp)
+        if (conversa.ultima_recebida_timestamp is None
+                or ultima_recebida.timestamp >= conversa.ultima_recebida_timestamp):
+            conversa.ultima_recebida_timestamp = ultima_recebida.timestamp
+            conversa.numero = ultima_recebida.numero_remetente
+        conversa.nao_lidas += sum(1 for m in recebidas if not m.lida)
+
+    if not conversa.contato_id:
+        conversa.contato_id = resolver_contato_id(chave)
+
+    if not conversa.oportunidade_id and conversa.contato_id:
+        conversa.oportunidade_id, conversa.funil_tipo = resolver_oportunidade_do_contato(conversa.contato_id)
+
+    conversa.save()
+
+
+def atualizar_oportunidade(mensagem):
+    """
+    Propaga para a conversa o vínculo mensagem → oportunidade feito após a
+    inserção (identify_and_link_message). Vale se a conversa ainda não tem
+    oportunidade ou se a mensagem é a mais recente.
+    """
+    if not (mensagem.oportunidade_id and mensagem.numero_chave):
+        return
+
+    qs = (
+        Conversa.objects
+        .filter(instancia=mensagem.instancia, numero_chave=mensagem.numero_chave)
+        .filter(Q(oportunidade__isnull=True) | Q(ultima_mensagem_timestamp__lte=mensagem.timestamp))
+        .exclude(oportunidade_id=mensagem.oportunidade_id)
+    )
+    if qs.exists():
+        qs.update(
+            oportunidade_id=mensagem.oportunidade_id,
+            funil_tipo=_funil_tipo(mensagem.oportunidade_id),
+        )
+
+
+def recalcular_nao_lidas(pares):
+    """Recalcula nao_lidas das conversas [(instancia, numero_chave), ...] a partir das mensagens."""
+    with transaction.atomic():
+        for instancia, chave in set(pares):
+            if not chave:
+                continue
+            total = WhatsappMessage.objects.filter(
+                instancia=instancia, numero_chave=chave, de_mim=False, lida=False
+            ).count()
+            Conversa.objects.filter(instancia=instancia, numero_chave=chave).update(nao_lidas=total)
+
+
+def reconstruir_conversas(instancia=None):
+    """
+    Reconstrói as conversas a partir do histórico de mensagens.
+    Usado na implantação da tabela e para reparo. Retorna o total de conversas.
+    """
+    mensagens = WhatsappMessage.objects.exclude(numero_chave='')
+    if instancia:
+        mensagens = mensagens.filter(instancia=instancia)
+
+    grupos = (
+        mensagens
+        .values('instancia', 'numero_chave')
+        .annotate(
+            ultima_timestamp=Max('timestamp'),
+            ultima_recebida_timestamp=Max('timestamp', filter=Q(de_mim=False)),
+            nao_lidas=Count('id', filter=Q(de_mim=False, lida=False)),
+        )
+        .order_by()
+    )
+
+    total = 0
+    for grupo in list(grupos):
+        inst, chave = grupo['instancia'], grupo['numero_chave']
+        msgs_conversa = mensagens.filter(instancia=inst, numero_chave=chave)
+        ultima = msgs_conversa.order_by('-timestamp', '-id').first()
+        ultima_recebida = msgs_conversa.filter(de_mim=False).order_by('-timestamp', '-id').first()
+        ultima_vinculada = (
+            msgs_conversa.filter(oportunidade__isnull=False)
+            .order_by('-timestamp', '-id')
+            .values_list('oportunidade_id', flat=True)
+            .first()
+        )
+
+        contato_id = resolver_contato_id(chave)
+        if ultima_vinculada:
+            oportunidade_id, funil_tipo = ultima_vinculada, _funil_tipo(ultima_vinculada)
+        elif contato_id:
+            oportunidade_id, funil_tipo = resolver_oportunidade_do_contato(contato_id)
+        else:
+            oportunidade_id, funil_tipo = None, None
+
+        Conversa.objects.update_or_create(
+            instancia=inst,
+            numero_chave=chave,
+            defaults={
+                'numero': (ultima_recebida or ultima).numero_remoto,
+                'contato_id': contato_id,
+                'oportunidade_id': oportunidade_id,
+                'funil_tipo': funil_tipo,
+                'ultima_mensagem': texto_preview(ultima.texto, ultima.tipo_mensagem),
+                'ultima_mensagem_tipo': ultima.tipo_mensagem,
+                'ultima_mensagem_de_mim': ultima.de_mim,
+                'ultima_mensagem_timestamp': grupo['ultima_timestamp'],
+                'ultima_recebida_timestamp': grupo['ultima_recebida_timestamp'],
+                'nao_lidas': grupo['nao_lidas'],
+            },
+        )
+        total += 1
+
+    return total
@@ -0,0 +1,207 @@
+"""
+Envio dos eventos WebSocket (channel layer) fora do caminho da requisição.
+
+- despachar(grupo, evento): group_send sem bloquear quem chama. Os pontos de
+  chamada montam o evento em transaction.on_commit, então nada é enviado de
+  uma transação que ainda pode ser desfeita.
+- Com a RedisChannelLayer os eventos vão para uma fila atendida por uma
+  thread com event loop próprio (conexões ao Redis reaproveitadas), então
+  latência ou queda do Redis não atrasam o webhook. A fila é limitada
+  (WS_DIFUSAO_FILA_MAX): cheia, o evento é descartado com log. Com a
+  InMemoryChannelLayer (sem REDIS_URL) o envio é feito na hora: não há rede
+  e a camada não é thread-safe.
+- Caches em processo para montar os eventos sem consultar o banco a cada
+  mensagem: instância → canal, nome do contato por chave canônica e funil
+  da oportunidade. Os signals de Canal, Contato e Oportunidade limpam o
+  cache deste processo; nos demais as entradas expiram por TTL.
+"""
+import asyncio
+import logging
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+
+from channels.layers import InMemoryChannelLayer, get_channel_layer
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+CANAIS_TTL_SEGUNDOS = 60
+# Instância desconhecida recarrega o mapa, no máximo uma vez a cada N segundos
+CANAIS_RECARGA_MINIMA_SEGUNDOS = 5
+NOMES_TTL_SEGUNDOS = 300
+NOMES_MAX = 4096
+ENVIO_TIMEOUT_SEGUNDOS = 5
+
+_SEM_VALOR = object()
+
+
+class Lru:
+    """Cache LRU com TTL, seguro entre threads."""
+
+    def __init__(self, maximo, ttl):
+        self.maximo = maximo
+        self.ttl = ttl
+        self._itens = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, chave):
+        with self._lock:
+            item = self._itens.get(chave)
+            if item is None or item[1] < time.monotonic():
+                return _SEM_VALOR
+            self._itens.move_to_end(chave)
+            return item[0]
+
+    def set(self, chave, valor):
+        with self._lock:
+            self._itens[chave] = (valor, time.monotonic() + self.ttl)
+            self._itens.move_to_end(chave)
+            while len(self._itens) > self.maximo:
+                self._itens.popitem(last=False)
+
+    def limpar(self, chave=_SEM_VALOR):
+        with self._lock:
+            if chave is _SEM_VALOR:
+                self._itens.clear()
+            else:
+                self._itens.pop(chave, None)
+
+
+_canais_lock = threading.Lock()
+_canais = {'mapa': None, 'carregado_em': 0.0}
+_nomes = Lru(NOMES_MAX, NOMES_TTL_SEGUNDOS)
+_funis = Lru(NOMES_MAX, NOMES_TTL_SEGUNDOS)
+
+_fila = {'fila': None, 'pid': None}
+_fila_lock = threading.Lock()
+
+
+# ──────────────────────────────
+# Caches
+# ──────────────────────────────
+
+def _carregar_canais():
+    from ..models import Canal
+
+    mapa = dict(
+        Canal.objects.exclude(evolution_instance_name__isnull=True)
+        .exclude(evolution_instance_name='')
+        .values_list('evolution_instance_name', 'id')
+    )
+    with _canais_lock:
+        _canais.update(mapa=mapa, carregado_em=time.monotonic())
+    return mapa
+
+
+def canais_das_instancias(instancias):
+    """{instancia: canal_id} das instâncias que têm Canal."""
+    instancias = {i for i in instancias if i}
+    with _canais_lock:
+        mapa, idade = _canais['mapa'], time.monotonic() - _canais['carregado_em']
+    if mapa is None or idade > CANAIS_TTL_SEGUNDOS or (
+        not instancias <= mapa.keys() and idade > CANAIS_RECARGA_MINIMA_SEGUNDOS
+    ):
+        mapa = _carregar_canais()
+    return {i: mapa[i] for i in instancias if i in mapa}
+
+
+def canal_da_instancia(instancia):
+    return canais_das_instancias([instancia]).get(instancia)
+
+
+def limpar_canais():
+    with _canais_lock:
+        _canais['mapa'] = None
+
+
+def nome_contato(numero_chave):
+    """Nome do Contato com o celular/telefone de mesma chave canônica, ou None."""
+    from django.db.models import Q
+
+    from ..models import Contato
+
+    if not numero_chave:
+        return None
+    nome = _nomes.get(numero_chave)
+    if nome is _SEM_VALOR:
+        nome = (
+            Contato.objects.filter(Q(celular_chave=numero_chave) | Q(telefone_chave=numero_chave))
+            .values_list('nome', flat=True).first()
+        )
+        _nomes.set(numero_chave, nome)
+    return nome
+
+
+def limpar_contatos():
+    _nomes.limpar()
+
+
+def funil_tipo(oportunidade_id):
+    from ..models import Oportunidade
+
+    if not oportunidade_id:
+        return None
+    tipo = _funis.get(oportunidade_id)
+    if tipo is _SEM_VALOR:
+        tipo = Oportunidade.objects.filter(id=oportunidade_id).values_list('funil__tipo', flat=True).first()
+        _funis.set(oportunidade_id, tipo)
+    return tipo
+
+
+def limpar_funil(oportunidade_id):
+    _funis.limpar(oportunidade_id)
+
+
+# ──────────────────────────────
+# Envio
+# ──────────────────────────────
+
+def despachar(grupo, evento):
+    """group_send sem bloquear: vai para a fila da thread de envio (ou na hora, em memória)."""
+    channel_layer = get_channel_layer()
+    if channel_layer is None:
+        return
+    if isinstance(channel_layer, InMemoryChannelLayer):
+        _enviar_agora(channel_layer, grupo, evento)
+        return
+    try:
+        _fila_envio().put_nowait((grupo, evento))
+    except queue.Full:
+        logger.warning(f"[WS] Fila de envio cheia: evento {evento.get('type')} para {grupo} descartado")
+
+
+def _enviar_agora(channel_layer, grupo, evento):
+    from asgiref.sync import async_to_sync
+
+    try:
+        async_to_sync(channel_layer.group_send)(grupo, evento)
+    except Exception as e:
+        logger.error(f'[WS] Erro ao enviar evento para {grupo}: {e}')
+
+
+def _fila_envio():
+    # Criada no primeiro envio de cada processo (a thread não sobrevive a um fork)
+    with _fila_lock:
+        if _fila['fila'] is None or _fila['pid'] != os.getpid():
+            fila = queue.Queue(maxsize=max(1, getattr(settings, 'WS_DIFUSAO_FILA_MAX', 1000)))
+            threading.Thread(target=_trabalhar, args=(fila,), name='ws-difusao', daemon=True).start()
+            _fila.update(fila=fila, pid=os.getpid())
+        return _fila['fila']
+
+
+def _trabalhar(fila):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    while True:
+        grupo, evento = fila.get()
+        try:
+            loop.run_until_complete(
+                asyncio.wait_for(get_channel_layer().group_send(grupo, evento), ENVIO_TIMEOUT_SEGUNDOS)
+            )
+        except Exception as e:
+            logger.error(f'[WS] Erro ao enviar evento para {grupo}: {e}')
+        finally:
+            fila.task_done()
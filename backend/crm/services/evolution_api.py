@@ -1,13 +1,28 @@
 import requests
 import json
 import logging
+import threading
+import time
 from django.conf import settings
 from datetime import datetime
 from ..models import WhatsappMessage, Oportunidade, Canal
+from .evolution_http import requisitar
+from .phone import canonical_phone
 from django.db.models import Q
 
 logger = logging.getLogger(__name__)
 
+# Cache (por processo) do Canal padrão; invalidado pelo signal de Canal
+CANAL_PADRAO_TTL_SEGUNDOS = 60
+_canal_padrao = {'expira': 0.0, 'canal': None}
+_canal_padrao_lock = threading.Lock()
+
+
+def limpar_cache_canal():
+    with _canal_padrao_lock:
+        _canal_padrao['expira'] = 0.0
+        _canal_padrao['canal'] = None
+
 class EvolutionService:
     """
     Serviço para interagir com a Evolution API.
@@ -22,15 +37,24 @@ class EvolutionService:
         """
         Retorna o primeiro Canal com Evolution configurado no banco.
         Usado como fallback quando nenhuma instância é especificada.
+        Cacheado por CANAL_PADRAO_TTL_SEGUNDOS para não consultar o banco a
+        cada EvolutionService().
         """
+        with _canal_padrao_lock:
+            if time.monotonic() < _canal_padrao['expira']:
+                return _canal_padrao['canal']
         try:
-            return Canal.objects.filter(
+            canal = Canal.objects.filter(
                 evolution_instance_name__isnull=False
             ).exclude(
                 evolution_instance_name=''
             ).first()
         except Exception:
             return None
+        with _canal_padrao_lock:
+            _canal_padrao['canal'] = canal
+            _canal_padrao['expira'] = time.monotonic() + CANAL_PADRAO_TTL_SEGUNDOS
+        return canal
 
     @classmethod
     def for_canal(cls, canal):
@@ -84,6 +108,11 @@ class EvolutionService:
             'Content-Type': 'application/json'
         }
 
+    def _requisitar(self, metodo, url, **kwargs):
+        """Requisição pela sessão compartilhada (pool, timeouts, retentativas, limite por instância)."""
+        kwargs.setdefault('headers', self.headers)
+        return requisitar(metodo, url, instancia=self.instance, **kwargs)
+
     def create_instance(self, instance_name, webhook_url=None):
         """
         Cria uma nova instância no Evolution API usando a Global API Key.
@@ -122,7 +151,7 @@ class EvolutionService:
             logger.info(f"[Evolution] URL: {url}")
             logger.info(f"[Evolution] API Key (primeiros 8 chars): {self.global_api_key[:8]}...")
             # Usa Global API Key para criar
-            response = requests.post(url, json=payload, headers=self._get_global_headers(), timeout=30)
+            response = self._requisitar('post', url, json=payload, headers=self._get_global_headers(), idempotente=False)
             logger.info(f"[Evolution] Response status: {response.status_code}")
             response.raise_for_status()
             data = response.json()
@@ -173,7 +202,7 @@ class EvolutionService:
         url = f"{self.base_url}/instance/delete/{self.instance}"
         
         try:
-            response = requests.delete(url, headers=self._get_global_headers(), timeout=10)
+            response = self._requisitar('delete', url, headers=self._get_global_headers(), timeout=10)
             response.raise_for_status()
             return {
                 'success': True,
@@ -211,7 +240,7 @@ class EvolutionService:
         url = f"{self.base_url}/instance/connectionState/{self.instance}"
 
         try:
-            response = requests.get(url, headers=self.headers, timeout=10)
+            response = self._requisitar('get', url, timeout=10)
 
             # Instância não existe na Evolution API
             if response.status_code == 404:
@@ -248,7 +277,7 @@ class EvolutionService:
         url = f"{self.base_url}/instance/connect/{self.instance}"
         
         try:
-            response = requests.get(url, headers=self.headers, timeout=30)
+            response = self._requisitar('get', url)
             response.raise_for_status()
             data = response.json()
             
@@ -286,7 +315,7 @@ class EvolutionService:
         url = f"{self.base_url}/instance/logout/{self.instance}"
         
         try:
-            response = requests.delete(url, headers=self.headers, timeout=10)
+            response = self._requisitar('delete', url, timeout=10)
             response.raise_for_status()
             return {
                 'success': True,
@@ -304,7 +333,7 @@ class EvolutionService:
         url = f"{self.base_url}/instance/restart/{self.instance}"
         
         try:
-            response = requests.put(url, headers=self.headers, timeout=10)
+            response = self._requisitar('put', url, timeout=10)
             response.raise_for_status()
             return {
                 'success': True,
@@ -322,7 +351,7 @@ class EvolutionService:
         url = f"{self.base_url}/instance/fetchInstances"
         
         try:
-            response = requests.get(url, headers=self.headers, timeout=10)
+            response = self._requisitar('get', url, timeout=10)
             response.raise_for_status()
             data = response.json()
             
@@ -363,7 +392,7 @@ class EvolutionService:
         }
 
         try:
-            response = requests.post(url, json=payload, headers=self.headers)
+            response = self._requisitar('post', url, json=payload, idempotente=False)
             response.raise_for_status()
             data = response.json()
             
@@ -399,7 +428,7 @@ class EvolutionService:
         }
 
         try:
-            response = requests.post(url, json=payload, headers=self.headers)
+            response = self._requisitar('post', url, json=payload, timeout=60, idempotente=False)
             response.raise_for_status()
             data = response.json()
             
@@ -433,7 +462,7 @@ class EvolutionService:
         }
 
         try:
-            response = requests.post(url, json=payload, headers=self.headers)
+            response = self._requisitar('post', url, json=payload)
             response.raise_for_status()
             return response.json()
         except Exception as e:
@@ -470,7 +499,7 @@ class EvolutionService:
 
         try:
             logger.info(f"[Evolution] Baixando mídia: id={key.get('id', '')[:20]} jid={remote_jid} fromMe={key.get('fromMe')}")
-            response = requests.post(url, json=payload, headers=self.headers, timeout=60)
+            response = self._requisitar('post', url, json=payload, timeout=60)
 
             if not response.ok:
                 logger.error(f"[Evolution] HTTP {response.status_code} ao baixar mídia: {response.text[:300]}")
@@ -501,94 +530,61 @@ class EvolutionService:
             logger.error(f"[Evolution] Erro inesperado ao baixar mídia: {str(e)}")
             return None
 
+    @staticmethod
+    def _escolher_oportunidade(queryset):
+        """A oportunidade aberta mais recente; se não houver, a mais recente encerrada."""
+        opp_aberta = queryset.exclude(
+            estagio__tipo__in=['GANHO', 'PERDIDO']
+        ).order_by('-data_atualizacao').first()
+        return opp_aberta or queryset.order_by('-data_atualizacao').first()
+
     @staticmethod
     def identify_and_link_message(message_obj):
         """Tenta identificar Lead ou Oportunidade pelo número da mensagem e vincula"""
-        # Pega o número remoto (remetente ou destinatário que não seja a instância)
-        remote_number = message_obj.numero_remetente if not message_obj.de_mim else message_obj.numero_destinatario
-        
-        if not remote_number:
+        # Chave canônica do número remoto (preenchida no save da mensagem)
+        chave = message_obj.numero_chave or canonical_phone(message_obj.numero_remoto)
+        if not chave:
             return
 
-        # Limpa o número: remove '@s.whatsapp.net' e caracteres não numéricos
-        clean_num = str(remote_number).split('@')[0]
-        clean_num = ''.join(filter(str.isdigit, clean_num))
-        
-        if not clean_num or len(clean_num) < 8:
-            return
-        
-        # Gera TODAS as variações possíveis do número
-        variations = set()
-        
-        # Número original
-        variations.add(clean_num)
-        
-        # Remove DDI 55 se existir
-        base_num = clean_num[2:] if clean_num.startswith('55') else clean_num
-        variations.add(base_num)
-        
-        # Adiciona DDI 55 se não tiver
-        if not clean_num.startswith('55'):
-            variations.add('55' + clean_num)
-        
-        # Gera variações com/sem o 9º dígito para cada variação base
-        for num in list(variations):
-            # Formato: DDD (2) + 9 (1) + número (8) = 11 dígitos (sem DDI)
-            # Formato: 55 + DDD (2) + 9 (1) + número (8) = 13 dígitos (com DDI)
-            
-            if num.startswith('55'):
-                ddd = num[2:4]  # Pega DDD
-                rest = num[4:]  # Resto do número
-                
-                if len(rest) == 9 and rest.startswith('9'):
-                    # Tem 9, gera sem
-                    variations.add('55' + ddd + rest[1:])
-                    variations.add(ddd + rest[1:])
-                elif len(rest) == 8:
-                    # Não tem 9, gera com
-                    variations.add('55' + ddd + '9' + rest)
-                    variations.add(ddd + '9' + rest)
-            else:
-                if len(num) >= 10:
-                    ddd = num[0:2]
-                    rest = num[2:]
-                    
-                    if len(rest) == 9 and rest.startswith('9'):
-                        # Tem 9, gera sem
-                        variations.add(ddd + rest[1:])
-                        variations.add('55' + ddd + rest[1:])
-                    elif len(rest) == 8:
-                        # Não tem 9, gera com
-                        variations.add(ddd + '9' + rest)
-                        variations.add('55' + ddd + '9' + rest)
-        
-        # Adiciona os últimos 8 dígitos como fallback (mais agressivo)
-        if len(clean_num) >= 8:
-            variations.add(clean_num[-8:])
-        
-        # logger.debug(f"[Evolution] Variações geradas para {remote_number}: {variations}")
-        
-        # Tenta Oportunidade (via contatos vinculados)
-        q_opp = Q()
-        for v in variations:
-            if len(v) >= 8:
-                q_opp |= Q(contatos__telefone__icontains=v) | \
-                         Q(contatos__celular__icontains=v)
-            
-        # Refinando: busca por todas as oportunidades do número
-        queryset = Oportunidade.objects.filter(q_opp).distinct()
-        
-        if queryset.exists():
-            # Tenta pegar uma que não esteja encerrada (GANHA/PERDIDA) e seja a mais recente
-            opp_aberta = queryset.exclude(
-                estagio__tipo__in=['GANHO', 'PERDIDO']
-            ).order_by('-data_atualizacao').first()
-            
-            if opp_aberta:
-                message_obj.oportunidade = opp_aberta
-            else:
-                # Se não houver aberta, pega a mais recente mesmo que encerrada
-                message_obj.oportunidade = queryset.order_by('-data_atualizacao').first()
-            
-        message_obj.save()
+        # Tenta Oportunidade (via contatos vinculados) com busca exata indexada
+        queryset = Oportunidade.objects.filter(
+            Q(contatos__telefone_chave=chave) | Q(contatos__celular_chave=chave)
+        ).distinct()
+
+        opp = EvolutionService._escolher_oportunidade(queryset)
+        if opp:
+            message_obj.oportunidade = opp
+            message_obj.save(update_fields=['oportunidade', 'data_atualizacao'])
+
+    @staticmethod
+    def identificar_oportunidades_em_lote(chaves):
+        """
+        Versão em lote de identify_and_link_message: resolve a oportunidade de várias
+        chaves canônicas de telefone com uma única consulta.
+
+        Mesma regra de escolha: a oportunidade aberta mais recente; se não houver,
+        a mais recente encerrada.
+
+        Returns:
+            dict {chave: oportunidade_id} apenas para as chaves identificadas
+        """
+        chaves = {c for c in chaves if c}
+        if not chaves:
+            return {}
+
+        linhas = Oportunidade.objects.filter(
+            Q(contatos__telefone_chave__in=chaves) | Q(contatos__celular_chave__in=chaves)
+        ).values_list(
+            'id', 'contatos__telefone_chave', 'contatos__celular_chave', 'estagio__tipo', 'data_atualizacao'
+        )
+
+        # chave -> (aberta?, data_atualizacao, id) da melhor candidata
+        melhores = {}
+        for opp_id, telefone_chave, celular_chave, estagio_tipo, atualizacao in linhas:
+            candidata = (estagio_tipo not in ('GANHO', 'PERDIDO'), atualizacao, opp_id)
+            for chave in {telefone_chave, celular_chave} & chaves:
+                if chave not in melhores or candidata > melhores[chave]:
+                    melhores[chave] = candidata
+
+        return {chave: candidata[2] for chave, candidata in melhores.items()}
 
@@ -0,0 +1,176 @@
+"""
+Transporte HTTP da Evolution API.
+
+- Uma requests.Session por URL base (por processo), com pool de conexões
+  keep-alive: envios, status, mídias e findMessages reaproveitam a conexão
+  TCP/TLS em vez de abrir uma nova a cada chamada.
+- Timeouts de conexão e leitura em todas as chamadas.
+- Retentativas limitadas com backoff exponencial (e Retry-After) em 429/5xx
+  e erros de rede. Chamadas não idempotentes (envio de mensagem, criação de
+  instância) só são repetidas quando a requisição certamente não foi
+  processada: timeout de conexão ou 429.
+- Limite adaptativo de requisições simultâneas por instância (AIMD): cresce
+  com respostas boas e cai pela metade em 429/5xx/timeouts, para não
+  sobrecarregar a instância quando o WhatsApp está lento.
+"""
+import logging
+import os
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+STATUS_RETENTAVEIS = {429, 500, 502, 503, 504}
+BACKOFF_BASE_SEGUNDOS = 0.5
+BACKOFF_MAX_SEGUNDOS = 8
+RETRY_AFTER_MAX_SEGUNDOS = 30
+
+_sessoes = {}
+_limites = {}
+_lock = threading.Lock()
+
+
+class EvolutionOcupada(requests.exceptions.ConnectionError):
+    """Nenhuma vaga no limite de concorrência da instância dentro do prazo."""
+
+
+def _config(nome, padrao):
+    return getattr(settings, nome, padrao)
+
+
+def timeout_padrao(leitura=None):
+    """(conexão, leitura) em segundos."""
+    return (
+        _config('EVOLUTION_HTTP_CONNECT_TIMEOUT', 5),
+        leitura if leitura is not None else _config('EVOLUTION_HTTP_READ_TIMEOUT', 30),
+    )
+
+
+def sessao(base_url):
+    """Session compartilhada da URL base (recriada após fork do processo)."""
+    chave = (os.getpid(), base_url)
+    with _lock:
+        s = _sessoes.get(chave)
+        if s is None:
+            s = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=4,
+                pool_maxsize=_config('EVOLUTION_HTTP_POOL', 20),
+                max_retries=0,  # retentativas tratadas em requisitar()
+            )
+            s.mount('http://', adapter)
+            s.mount('https://', adapter)
+            _sessoes[chave] = s
+        return s
+
+
+class LimiteAdaptativo:
+    """Semáforo cujo tamanho se ajusta às respostas (aumento aditivo, queda multiplicativa)."""
+
+    def __init__(self, inicial, minimo, maximo):
+        self.limite = inicial
+        self.minimo = minimo
+        self.maximo = maximo
+        self.em_uso = 0
+        self._sucessos = 0
+        self._cond = threading.Condition()
+
+    def adquirir(self, espera):
+        with self._cond:
+            if not self._cond.wait_for(lambda: self.em_uso < self.limite, timeout=espera):
+                raise EvolutionOcupada(f'limite de {self.limite} requisições simultâneas atingido')
+            self.em_uso += 1
+
+    def liberar(self, sobrecarga):
+        with self._cond:
+            self.em_uso -= 1
+            if sobrecarga:
+                self.limite = max(self.minimo, self.limite // 2)
+                self._sucessos = 0
+            else:
+                self._sucessos += 1
+                if self._sucessos >= self.limite:
+                    self.limite = min(self.maximo, self.limite + 1)
+                    self._sucessos = 0
+            self._cond.notify_all()
+
+
+def limite(instancia):
+    with _lock:
+        lim = _limites.get(instancia)
+        if lim is None:
+            maximo = _config('EVOLUTION_CONCORRENCIA_MAX', 16)
+            lim = LimiteAdaptativo(inicial=min(4, maximo), minimo=1, maximo=maximo)
+            _limites[instancia] = lim
+        return lim
+
+
+def _espera(tentativa, resposta):
+    espera = min(BACKOFF_BASE_SEGUNDOS * 2 ** (tentativa - 1), BACKOFF_MAX_SEGUNDOS)
+    espera *= random.uniform(0.5, 1.0)
+    retry_after = resposta.headers.get('Retry-After') if resposta is not None else None
+    if retry_after and retry_after.isdigit():
+        espera = max(espera, min(int(retry_after), RETRY_AFTER_MAX_SEGUNDOS))
+    return espera
+
+
+def requisitar(metodo, url, instancia='', idempotente=True, timeout=None, **kwargs):
+    """
+    Executa a requisição pela Session da URL base, com timeout, retentativas e
+    limite de concorrência da instância.
+
+    Args:
+        metodo: 'get', 'post', 'put' ou 'delete'
+        instancia: nome da instância (chave do limite de concorrência)
+        idempotente: se False, só repete em timeout de conexão ou 429
+        timeout: segundos de leitura ou (conexão, leitura); padrão das settings
+
+    Returns:
+        requests.Response (a última, se todas as tentativas falharem com status
+        retentável — o chamador decide com raise_for_status/ok)
+
+    Raises:
+        requests.exceptions.RequestException em erro de rede na última tentativa
+    """
+    if timeout is None or isinstance(timeout, (int, float)):
+        timeout = timeout_padrao(timeout)
+    partes = urlsplit(url)
+    s = sessao(f'{partes.scheme}://{partes.netloc}')
+    lim = limite(instancia or partes.netloc)
+    tentativas = max(1, _config('EVOLUTION_HTTP_TENTATIVAS', 3))
+
+    for tentativa in range(1, tentativas + 1):
+        lim.adquirir(espera=sum(timeout))
+        resposta = None
+        try:
+            resposta = s.request(metodo, url, timeout=timeout, **kwargs)
+        except requests.exceptions.ConnectTimeout:
+            # A requisição não chegou ao servidor: sempre pode repetir
+            lim.liberar(sobrecarga=True)
+            if tentativa == tentativas:
+                raise
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            lim.liberar(sobrecarga=True)
+            if tentativa == tentativas or not idempotente:
+                raise
+        else:
+            retentavel = resposta.status_code in STATUS_RETENTAVEIS
+            lim.liberar(sobrecarga=retentavel)
+            if not retentavel or tentativa == tentativas:
+                return resposta
+            if not idempotente and resposta.status_code != 429:
+                return resposta
+
+        espera = _espera(tentativa, resposta)
+        logger.warning(
+            f"[Evolution] {metodo.upper()} {partes.path} "
+            f"{'HTTP ' + str(resposta.status_code) if resposta is not None else 'erro de rede'}; "
+            f"tentativa {tentativa}/{tentativas}, nova tentativa em {espera:.1f}s"
+        )
+        time.sleep(espera)
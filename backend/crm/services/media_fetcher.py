@@ -0,0 +1,299 @@
+"""
+Busca das mídias do WhatsApp na Evolution (getBase64FromMediaMessage).
+
+Ponto único de download: a tarefa agendada pelo webhook, a abertura do chat
+(process_pending_media), o media_processor e os downloads sob demanda do chat
+(get_audio, transcribe_audio, load_media) passam por aqui.
+
+- Política por tipo (MIDIA_PREFETCH): os tipos listados são baixados assim
+  que a mensagem chega (EAGER); os demais (vídeo, documento) só quando alguém
+  abre a mídia (LAZY).
+- Teto de tamanho (MIDIA_TAMANHO_MAX_MB): vale para o tamanho informado pelo
+  webhook (fileLength) e para o conteúdo devolvido.
+- Dedupe: no máximo uma tarefa de download em aberto por mensagem e, neste
+  processo, um download em andamento por id_mensagem (quem chega depois
+  espera o primeiro e reaproveita o arquivo).
+- Concorrência: teto global (MIDIA_DOWNLOADS_MAX) e por instância
+  (MIDIA_DOWNLOADS_POR_INSTANCIA) de downloads simultâneos neste processo.
+- Cache negativo: a mídia que falhou de vez (tentativas esgotadas ou grande
+  demais) grava media_falha_em e não é agendada de novo por MIDIA_FALHA_HORAS.
+"""
+import logging
+import threading
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+
+from ..models import Tarefa, WhatsappMessage
+from . import chat_ao_vivo, media_store, tarefas, transcricao
+from .evolution_api import EvolutionService
+from .media_store import MidiaIndisponivel
+
+logger = logging.getLogger(__name__)
+
+TAREFA = 'whatsapp.processar_midia'
+
+EAGER = 'eager'
+LAZY = 'lazy'
+TIPOS_MIDIA = ('audio', 'image', 'video', 'document')
+
+# Downloads pedidos ao abrir o chat passam na frente dos do webhook
+PRIORIDADE_CHAT = 5
+
+# Tempo máximo (s) esperando uma vaga de download ou o download de outra thread
+ESPERA_SEGUNDOS = 60
+
+_lock = threading.Lock()
+_em_andamento = {}  # id_mensagem -> threading.Event
+_vagas_global = None
+_vagas_instancia = {}
+
+
+class MidiaGrandeDemais(Exception):
+    """Mídia acima de MIDIA_TAMANHO_MAX_MB: não é baixada."""
+
+
+def politica(tipo):
+    """EAGER, LAZY ou None se o tipo de mensagem não tem mídia."""
+    if tipo not in TIPOS_MIDIA:
+        return None
+    return EAGER if tipo in tipos_antecipados() else LAZY
+
+
+def tipos_antecipados():
+    return [t for t in getattr(settings, 'MIDIA_PREFETCH', ('audio', 'image')) if t in TIPOS_MIDIA]
+
+
+def grande_demais(tamanho):
+    limite_mb = getattr(settings, 'MIDIA_TAMANHO_MAX_MB', 16)
+    return bool(limite_mb and tamanho and tamanho > limite_mb * 1024 * 1024)
+
+
+def _corte_falhas():
+    """Falhas registradas antes deste instante já expiraram (None: nunca expiram)."""
+    horas = getattr(settings, 'MIDIA_FALHA_HORAS', 24)
+    return timezone.now() - timedelta(hours=horas) if horas else None
+
+
+def em_cache_negativo(msg):
+    if not msg.media_falha_em:
+        return False
+    corte = _corte_falhas()
+    return corte is None or msg.media_falha_em >= corte
+
+
+def precisa_baixar(msg):
+    return (
+        politica(msg.tipo_mensagem) is not None
+        and not media_store.tem_midia(msg)
+        and not em_cache_negativo(msg)
+    )
+
+
+def sem_midia(queryset):
+    """Filtra as mensagens EAGER ainda sem mídia e fora do cache negativo."""
+    queryset = queryset.filter(
+        tipo_mensagem__in=tipos_antecipados(), media_hash='', media_base64__isnull=True
+    )
+    corte = _corte_falhas()
+    falha_expirada = Q(media_falha_em__isnull=True)
+    if corte is not None:
+        falha_expirada |= Q(media_falha_em__lt=corte)
+    return queryset.filter(falha_expirada)
+
+
+def marcar_falha(msg, erro):
+    """Grava a mensagem no cache negativo (sem disparar os signals de save) e avisa o chat."""
+    msg.media_falha_em = timezone.now()
+    msg.media_erro = str(erro)[:255]
+    msg.data_atualizacao = msg.media_falha_em
+    WhatsappMessage.objects.filter(id=msg.id).update(
+        media_falha_em=msg.media_falha_em, media_erro=msg.media_erro, data_atualizacao=msg.data_atualizacao
+    )
+    chat_ao_vivo.publicar([msg])
+    logger.warning(f"[MediaFetcher] msg={msg.id} no cache negativo: {msg.media_erro}")
+
+
+def chave(msg):
+    """key da mensagem no formato da Evolution (o remoteJid é sempre a outra parte)."""
+    numero = (msg.numero_remoto or '').split('@')[0]
+    return {'id': msg.id_mensagem, 'remoteJid': f'{numero}@s.whatsapp.net', 'fromMe': msg.de_mim}
+
+
+def servico(msg, instance_name=None):
+    """EvolutionService do canal da oportunidade da mensagem; senão, o da instância que a recebeu."""
+    canal = msg.oportunidade.canal if msg.oportunidade_id and msg.oportunidade else None
+    if canal and canal.evolution_instance_name:
+        return EvolutionService(
+            instance_name=canal.evolution_instance_name,
+            instance_token=canal.evolution_token
+        )
+    return EvolutionService(instance_name=instance_name or msg.instancia or None, instance_token=None)
+
+
+# ──────────────────────────────
+# Agendamento (tarefa whatsapp.processar_midia)
+# ──────────────────────────────
+
+def agendar(msg, atraso=0, prioridade=None, msg_key=None, instance_name=None, nova=False):
+    """
+    Agenda o download se a mídia ainda falta, não está no cache negativo e não
+    há tarefa em aberto para a mensagem. nova=True pula essa última consulta
+    (mensagem acabou de ser gravada).
+
+    Returns:
+        True se agendou
+    """
+    if not precisa_baixar(msg):
+        return False
+    if grande_demais(msg.media_tamanho):
+        marcar_falha(msg, MidiaGrandeDemais(f'{msg.media_tamanho} bytes'))
+        return False
+    if not nova and Tarefa.objects.filter(
+        nome=TAREFA, status__in=Tarefa.STATUS_ABERTOS, parametros__msg_id=msg.id
+    ).exists():
+        return False
+
+    tarefas.agendar(
+        TAREFA, atraso=atraso, prioridade=prioridade,
+        msg_id=msg.id, msg_key=msg_key or chave(msg),
+        instance_name=instance_name or msg.instancia, media_type=msg.tipo_mensagem,
+    )
+    return True
+
+
+def antecipar(msg, **kwargs):
+    """Mensagem recém-chegada: agenda o download só se o tipo for EAGER."""
+    if politica(msg.tipo_mensagem) != EAGER:
+        return False
+    return agendar(msg, **kwargs)
+
+
+def _falhou(msg_id, **kwargs):
+    msg = WhatsappMessage.objects.filter(id=msg_id).first()
+    if msg is not None and not media_store.tem_midia(msg):
+        marcar_falha(msg, 'Evolution não devolveu a mídia após todas as tentativas')
+
+
+@tarefas.tarefa(TAREFA, max_tentativas=4, ao_falhar=_falhou)
+def processar(msg_id, msg_key=None, instance_name=None, media_type=None):
+    """Baixa a mídia da mensagem para o store (e transcreve, se áudio)."""
+    msg = WhatsappMessage.objects.select_related('oportunidade__canal').filter(id=msg_id).first()
+    if msg is None or not precisa_baixar(msg):
+        return
+
+    try:
+        base64_data, mimetype = baixar(msg, msg_key=msg_key, instance_name=instance_name)
+    except MidiaGrandeDemais:
+        return
+
+    # Transcreve o áudio (ou enfileira para o whisper_worker)
+    if msg.tipo_mensagem == 'audio' and base64_data:
+        transcricao.transcrever(msg, base64_data, mimetype)
+
+
+# ──────────────────────────────
+# Download
+# ──────────────────────────────
+
+def _vagas(instancia):
+    global _vagas_global
+    with _lock:
+        if _vagas_global is None:
+            _vagas_global = threading.BoundedSemaphore(max(1, getattr(settings, 'MIDIA_DOWNLOADS_MAX', 4)))
+        if instancia not in _vagas_instancia:
+            _vagas_instancia[instancia] = threading.BoundedSemaphore(
+                max(1, getattr(settings, 'MIDIA_DOWNLOADS_POR_INSTANCIA', 2))
+            )
+        return _vagas_global, _vagas_instancia[instancia]
+
+
+@contextmanager
+def _vaga(instancia):
+    """Ocupa uma vaga global e uma da instância; MidiaIndisponivel se não liberarem a tempo."""
+    global_, da_instancia = _vagas(instancia)
+    if not global_.acquire(timeout=ESPERA_SEGUNDOS):
+        raise MidiaIndisponivel('limite global de downloads simultâneos atingido')
+    try:
+        if not da_instancia.acquire(timeout=ESPERA_SEGUNDOS):
+            raise MidiaIndisponivel(f'limite de downloads simultâneos da instância {instancia} atingido')
+        try:
+            yield
+        finally:
+            da_instancia.release()
+    finally:
+        global_.release()
+
+
+def baixar(msg, msg_key=None, instance_name=None):
+    """
+    Baixa a mídia da mensagem para o store e salva a mensagem. Não consulta o
+    cache negativo: é usado também quando alguém abre a mídia no chat.
+
+    Returns:
+        (base64, mimetype) do conteúdo baixado, ou (None, '') se a mensagem já
+        tinha a mídia (ex.: outra thread terminou o mesmo download)
+
+    Raises:
+        MidiaIndisponivel: a Evolution não devolveu a mídia ou não houve vaga
+            a tempo (vale tentar de novo)
+        MidiaGrandeDemais: acima de MIDIA_TAMANHO_MAX_MB (vai para o cache negativo)
+    """
+    if media_store.tem_midia(msg):
+        return None, ''
+    if grande_demais(msg.media_tamanho):
+        erro = MidiaGrandeDemais(f'{msg.media_tamanho} bytes')
+        marcar_falha(msg, erro)
+        raise erro
+
+    with _lock:
+        evento = _em_andamento.get(msg.id_mensagem)
+        primeiro = evento is None
+        if primeiro:
+            evento = _em_andamento[msg.id_mensagem] = threading.Event()
+
+    if not primeiro:
+        # Mesma mídia já sendo baixada neste processo: espera e reaproveita
+        evento.wait(ESPERA_SEGUNDOS)
+        msg.refresh_from_db(fields=media_store.CAMPOS_MIDIA)
+        if media_store.tem_midia(msg):
+            return None, ''
+        raise MidiaIndisponivel(f'download concorrente da mídia da mensagem {msg.id} não concluiu')
+
+    try:
+        return _baixar(msg, msg_key, instance_name)
+    finally:
+        with _lock:
+            _em_andamento.pop(msg.id_mensagem, None)
+        evento.set()
+
+
+def _baixar(msg, msg_key, instance_name):
+    service = servico(msg, instance_name)
+    with _vaga(service.instance):
+        media_result = service.get_media_base64(msg_key or chave(msg))
+    if not (media_result and media_result.get('base64')):
+        raise MidiaIndisponivel(f'mídia da mensagem {msg.id} ainda não disponível')
+
+    base64_data = media_result['base64']
+    # base64 ocupa 4/3 do conteúdo
+    if grande_demais(len(base64_data) * 3 // 4):
+        erro = MidiaGrandeDemais(f'~{len(base64_data) * 3 // 4} bytes')
+        marcar_falha(msg, erro)
+        raise erro
+
+    padrao = media_store.MIMETYPE_PADRAO.get(msg.tipo_mensagem, '')
+    mimetype = media_result.get('mimetype') or padrao
+    if msg.tipo_mensagem == 'audio' and not mimetype.startswith('audio'):
+        mimetype = padrao
+
+    campos = media_store.anexar(msg, base64_data, mimetype)
+    if msg.media_falha_em:
+        msg.media_falha_em, msg.media_erro = None, ''
+        campos += ['media_falha_em', 'media_erro']
+    msg.save(update_fields=campos)
+    logger.info(f"[MediaFetcher] msg={msg.id} ({msg.tipo_mensagem}) baixada: {msg.media_tamanho} bytes")
+    return base64_data, mimetype
@@ -0,0 +1,181 @@
+"""
+Armazenamento de mídias do WhatsApp endereçado por conteúdo.
+
+A mídia (imagem/áudio) é decodificada uma única vez e gravada em
+MEDIA_ROOT/whatsapp/<aa>/<bb>/<sha256>; a linha de WhatsappMessage guarda
+apenas media_hash, media_mimetype e media_tamanho. Mídias iguais (ex.:
+encaminhadas) ocupam um único arquivo.
+
+A reprodução usa a URL assinada de `url_midia` (views_midia.midia_whatsapp),
+que faz streaming com suporte a Range e cache. A assinatura tem timestamp e
+expira após MIDIA_URL_TTL segundos. Mensagens antigas ainda com
+media_base64 são migradas por `manage.py migrar_midias_whatsapp` ou no
+primeiro acesso à mídia.
+"""
+import base64
+import binascii
+import hashlib
+import logging
+import os
+import re
+import tempfile
+
+from django.conf import settings
+from django.core import signing
+from django.urls import reverse
+
+logger = logging.getLogger(__name__)
+
+SALT_URL = 'crm.whatsapp.midia'
+HASH_RE = re.compile(r'^[0-9a-f]{64}$')
+CAMPOS_MIDIA = ['media_hash', 'media_mimetype', 'media_tamanho', 'media_base64']
+MIMETYPE_PADRAO = {'audio': 'audio/ogg; codecs=opus', 'image': 'image/jpeg'}
+
+
+class MidiaInvalida(ValueError):
+    """Conteúdo base64 que não pôde ser decodificado."""
+
+
+class MidiaIndisponivel(Exception):
+    """A Evolution ainda não devolveu a mídia (a tarefa que baixa tenta de novo com backoff)."""
+
+
+def diretorio_base():
+    return os.path.join(settings.MEDIA_ROOT, 'whatsapp')
+
+
+def caminho(media_hash):
+    """Caminho do arquivo de um hash (valida o formato para não sair do diretório)."""
+    if not HASH_RE.match(media_hash or ''):
+        raise ValueError(f'Hash de mídia inválido: {media_hash!r}')
+    return os.path.join(diretorio_base(), media_hash[:2], media_hash[2:4], media_hash)
+
+
+def decodificar(valor, mimetype=''):
+    """
+    Decodifica base64 puro ou data URI.
+
+    Returns:
+        (bytes, mimetype) — o mimetype do data URI prevalece sobre o informado
+    """
+    valor = (valor or '').strip()
+    if valor.startswith('data:'):
+        cabecalho, _, valor = valor.partition(',')
+        tipo = cabecalho[5:].replace(';base64', '')
+        if tipo:
+            mimetype = tipo
+    try:
+        conteudo = base64.b64decode(valor, validate=False)
+    except (binascii.Error, ValueError) as e:
+        raise MidiaInvalida(str(e)) from e
+    if not conteudo:
+        raise MidiaInvalida('conteúdo vazio')
+    return conteudo, mimetype
+
+
+def gravar(conteudo):
+    """
+    Grava os bytes no store (se ainda não existirem).
+
+    Returns:
+        (sha256, tamanho)
+    """
+    media_hash = hashlib.sha256(conteudo).hexdigest()
+    destino = caminho(media_hash)
+    if not os.path.exists(destino):
+        pasta = os.path.dirname(destino)
+        os.makedirs(pasta, exist_ok=True)
+        # Escrita atômica: outro processo nunca lê um arquivo pela metade
+        fd, temporario = tempfile.mkstemp(dir=pasta, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(conteudo)
+            os.replace(temporario, destino)
+        except Exception:
+            if os.path.exists(temporario):
+                os.remove(temporario)
+            raise
+    return media_hash, len(conteudo)
+
+
+def anexar(mensagem, valor_base64, mimetype=''):
+    """
+    Grava a mídia (base64 ou data URI) e preenche os campos da mensagem,
+    sem salvá-la. Limpa media_base64 legado.
+
+    Returns:
+        lista de campos para save(update_fields=...)
+    """
+    conteudo, mimetype = decodificar(valor_base64, mimetype)
+    mensagem.media_hash, mensagem.media_tamanho = gravar(conteudo)
+    mensagem.media_mimetype = (mimetype or '')[:100]
+    mensagem.media_base64 = None
+    return list(CAMPOS_MIDIA)
+
+
+def tem_midia(mensagem):
+    return bool(mensagem.media_hash or mensagem.media_base64)
+
+
+def ler_base64(mensagem):
+    """
+    Base64 puro e mimetype da mídia da mensagem (store ou campo legado), para
+    quem precisa do conteúdo em memória (ex.: transcrição). (None, '') se não houver.
+    """
+    if mensagem.media_hash:
+        try:
+            with open(caminho(mensagem.media_hash), 'rb') as f:
+                return base64.b64encode(f.read()).decode('ascii'), mensagem.media_mimetype
+        except OSError as e:
+            logger.warning(f'[MediaStore] Arquivo ausente para msg={mensagem.id}: {e}')
+            return None, ''
+    if mensagem.media_base64:
+        valor = mensagem.media_base64
+        if valor.startswith('data:'):
+            cabecalho, _, valor = valor.partition(',')
+            return valor, cabecalho[5:].replace(';base64', '')
+        return valor, ''
+    return None, ''
+
+
+def migrar_legado(mensagem):
+    """Move media_base64 para o store e salva a mensagem. Retorna True se migrou."""
+    if mensagem.media_hash or not mensagem.media_base64:
+        return False
+    padrao = MIMETYPE_PADRAO.get(mensagem.tipo_mensagem, '')
+    campos = anexar(mensagem, mensagem.media_base64, padrao)
+    mensagem.save(update_fields=campos)
+    return True
+
+
+def url_midia(mensagem, request=None):
+    """
+    URL assinada de streaming da mídia da mensagem, ou None.
+
+    A assinatura leva o instante da emissão e vale por MIDIA_URL_TTL
+    segundos: cada serialização da mensagem gera uma URL nova. Mensagens já
+    no store assinam o hash da mídia; as legadas assinam o id e são migradas
+    no primeiro acesso. Aceita `midia_legada` anotado no queryset para não
+    precisar carregar media_base64.
+    """
+    if mensagem.media_hash:
+        token = mensagem.media_hash
+    else:
+        legada = getattr(mensagem, 'midia_legada', None)
+        if legada is None and 'media_base64' not in mensagem.get_deferred_fields():
+            legada = bool(mensagem.media_base64)
+        if not legada:
+            return None
+        token = f'm{mensagem.id}'
+
+    url = reverse('whatsapp-midia', kwargs={'assinatura': signing.TimestampSigner(salt=SALT_URL).sign(token)})
+    return request.build_absolute_uri(url) if request else url
+
+
+def resolver_assinatura(assinatura):
+    """Valor assinado da URL: hash da mídia ou 'm<id>' de mensagem legada (None se inválida ou expirada)."""
+    try:
+        return signing.TimestampSigner(salt=SALT_URL).unsign(assinatura, max_age=settings.MIDIA_URL_TTL)
+    except (signing.BadSignature, ValueError):
+        # ValueError: assinatura válida no formato antigo (sem timestamp)
+        return None
@@ -0,0 +1,147 @@
+"""
+Contadores de mensagens WhatsApp recebidas e não lidas.
+
+- Oportunidade.whatsapp_nao_lidas: mensagens vinculadas à oportunidade
+- Canal.whatsapp_nao_lidas: mensagens da instância do canal
+- Canal.whatsapp_nao_lidas_novas: idem, ainda sem oportunidade vinculada
+
+Os contadores afetados são recalculados com COUNTs indexados (em vez de
+incrementados), então não divergem se algum caminho gravar mensagens sem
+passar por aqui: um agregado para as oportunidades e um para os canais, e
+um UPDATE (Case/When) para as oportunidades que mudaram. O recálculo roda após o commit da transação que gravou,
+vinculou ou marcou as mensagens como lidas, e cada mudança é enviada ao grupo
+WebSocket do canal pelo handler `unread_update` do AtendimentoConsumer.
+
+Pontos de chamada: signals (post_save de WhatsappMessage),
+whatsapp_webhook.processar_lote e WhatsappViewSet.marcar_lidas.
+"""
+import logging
+from functools import partial
+
+from django.db import transaction
+from django.db.models import Case, Count, PositiveIntegerField, Q, Value, When
+
+from ..models import Canal, Conversa, Oportunidade, WhatsappMessage
+
+logger = logging.getLogger(__name__)
+
+
+def agendar(afetadas):
+    """
+    Agenda o recálculo para depois do commit.
+
+    Args:
+        afetadas: iterável de (instancia, numero_chave, oportunidade_id) das
+            mensagens gravadas, vinculadas ou marcadas como lidas
+    """
+    afetadas = set(afetadas)
+    if afetadas:
+        transaction.on_commit(partial(recalcular, afetadas))
+
+
+def recalcular(afetadas):
+    """Recalcula os contadores das oportunidades/canais afetados e notifica o WebSocket."""
+    try:
+        _recalcular(afetadas)
+    except Exception as e:
+        logger.error(f'[NaoLidas] Erro ao recalcular contadores: {e}')
+
+
+def _recalcular(afetadas):
+    opp_ids = {opp_id for _, _, opp_id in afetadas if opp_id}
+    instancias = {inst for inst, _, _ in afetadas if inst}
+    nao_lidas = WhatsappMessage.objects.filter(lida=False, de_mim=False)
+
+    contagem_opp = {}
+    if opp_ids:
+        contagem_opp = dict(
+            nao_lidas.filter(oportunidade_id__in=opp_ids)
+            .values('oportunidade_id')
+            .annotate(total=Count('id'))
+            .values_list('oportunidade_id', 'total')
+        )
+    contagem_opp = {opp_id: contagem_opp.get(opp_id, 0) for opp_id in opp_ids}
+    if contagem_opp:
+        # Um UPDATE para todas as oportunidades, tocando só as que mudaram
+        mudaram = Q()
+        for opp_id, total in contagem_opp.items():
+            mudaram |= Q(id=opp_id) & ~Q(whatsapp_nao_lidas=total)
+        Oportunidade.objects.filter(mudaram).update(whatsapp_nao_lidas=Case(
+            *[When(id=opp_id, then=Value(total)) for opp_id, total in contagem_opp.items()],
+            output_field=PositiveIntegerField(),
+        ))
+
+    contagem_canais = _contagem_canais(nao_lidas.filter(instancia__in=instancias))
+    canais = {}
+    for canal in Canal.objects.filter(evolution_instance_name__in=instancias):
+        inst = canal.evolution_instance_name
+        total, novas = contagem_canais.get(inst, (0, 0))
+        if (total, novas) != (canal.whatsapp_nao_lidas, canal.whatsapp_nao_lidas_novas):
+            Canal.objects.filter(id=canal.id).update(whatsapp_nao_lidas=total, whatsapp_nao_lidas_novas=novas)
+        canais[inst] = (canal.id, total, novas)
+
+    if canais:
+        _notificar(afetadas, canais, contagem_opp)
+
+
+def _contagem_canais(nao_lidas):
+    """{instancia: (total, novas)} com um único agregado sobre as mensagens não lidas."""
+    return {
+        linha['instancia']: (linha['total'], linha['novas'])
+        for linha in nao_lidas.values('instancia').annotate(
+            total=Count('id'), novas=Count('id', filter=Q(oportunidade__isnull=True))
+        )
+    }
+
+
+def _notificar(afetadas, canais, contagem_opp):
+    """Envia um `unread_update` por conversa afetada ao grupo do canal (services.difusao)."""
+    from . import difusao
+
+    q_conversas = Q()
+    for inst, chave, _ in afetadas:
+        if inst in canais and chave:
+            q_conversas |= Q(instancia=inst, numero_chave=chave)
+    if not q_conversas:
+        return
+
+    conversas = {
+        (c['instancia'], c['numero_chave']): c
+        for c in Conversa.objects.filter(q_conversas).values('instancia', 'numero_chave', 'numero', 'nao_lidas')
+    }
+
+    for inst, chave, opp_id in afetadas:
+        conversa = conversas.get((inst, chave))
+        if inst not in canais or not conversa:
+            continue
+        canal_id, canal_total, canal_novas = canais[inst]
+        difusao.despachar(f'atendimento_canal_{canal_id}', {
+            'type': 'unread_update',
+            'numero': conversa['numero'],
+            'canal_id': canal_id,
+            'nao_lidas': conversa['nao_lidas'],
+            'oportunidade_id': opp_id,
+            'oportunidade_nao_lidas': contagem_opp.get(opp_id) if opp_id else None,
+            'canal_nao_lidas': canal_total,
+            'canal_nao_lidas_novas': canal_novas,
+        })
+
+
+def reconstruir_contadores():
+    """Recalcula todos os contadores a partir das mensagens (reparo)."""
+    nao_lidas = WhatsappMessage.objects.filter(lida=False, de_mim=False)
+    por_opp = dict(
+        nao_lidas.filter(oportunidade__isnull=False)
+        .values('oportunidade_id')
+        .annotate(total=Count('id'))
+        .values_list('oportunidade_id', 'total')
+    )
+    with transaction.atomic():
+        Oportunidade.objects.filter(whatsapp_nao_lidas__gt=0).exclude(id__in=por_opp).update(whatsapp_nao_lidas=0)
+        for opp_id, total in por_opp.items():
+            Oportunidade.objects.filter(id=opp_id).update(whatsapp_nao_lidas=total)
+
+        contagem_canais = _contagem_canais(nao_lidas)
+        for canal in Canal.objects.all():
+            total, novas = contagem_canais.get(canal.evolution_instance_name, (0, 0))
+            Canal.objects.filter(id=canal.id).update(whatsapp_nao_lidas=total, whatsapp_nao_lidas_novas=novas)
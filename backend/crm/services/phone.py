@@ -0,0 +1,42 @@
+"""
+Chave canônica de telefone para buscas exatas (indexadas).
+
+Todas as variações de um mesmo número brasileiro geram a mesma chave:
+
+    (81) 9 9921-6560, 81999216560, 5581999216560,
+    558199216560, 5581999216560@s.whatsapp.net  ->  558199216560
+
+Regras:
+- remove sufixo JID (@s.whatsapp.net / @g.us) e tudo que não é dígito;
+- números brasileiros (10/11 dígitos, ou 12/13 com DDI 55) recebem o DDI 55;
+- o 9º dígito de celulares é "dobrado" (removido), já que o WhatsApp
+  entrega o mesmo contato com ou sem ele;
+- demais números (internacionais, grupos) ficam apenas com os dígitos.
+"""
+import re
+
+TAMANHO_CHAVE = 20
+
+
+def canonical_phone(numero):
+    """Retorna a chave canônica do número, ou '' se inválido (< 8 dígitos)."""
+    if not numero:
+        return ''
+
+    digits = re.sub(r'\D', '', str(numero).split('@')[0])
+    if len(digits) < 8:
+        return ''
+
+    if digits.startswith('55') and len(digits) in (12, 13):
+        digits = digits[2:]
+    elif len(digits) not in (10, 11):
+        # Sem DDD ou internacional: só dobra o 9º dígito de celular local
+        if len(digits) == 9 and digits.startswith('9'):
+            return digits[1:]
+        return digits[:TAMANHO_CHAVE]
+
+    # digits = DDD + número (10 ou 11 dígitos)
+    if len(digits) == 11 and digits[2] == '9':
+        digits = digits[:2] + digits[3:]
+
+    return '55' + digits
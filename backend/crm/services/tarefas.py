@@ -0,0 +1,269 @@
+"""
+Tarefas em segundo plano persistidas no banco (model Tarefa).
+
+    from crm.services import tarefas
+
+    @tarefas.tarefa('whatsapp.processar_midia', max_tentativas=4)
+    def processar_midia_async(msg_id, ...):
+        ...
+
+    tarefas.agendar('whatsapp.processar_midia', atraso=3, msg_id=msg.id, ...)
+
+- `python manage.py run_workers` executa as tarefas com N threads, por
+  prioridade e executar_em, com retentativas e backoff exponencial; também
+  agenda as tarefas periódicas (@tarefa(..., periodica=segundos)).
+- Com TAREFAS_WORKER=False (padrão) a tarefa é gravada do mesmo jeito, mas
+  executada neste processo, após o commit, por um pool limitado
+  (TAREFAS_THREADS_LOCAIS). Se o processo reiniciar antes, a linha continua
+  PENDENTE e o run_workers a executa depois. Periódicas só rodam no run_workers.
+
+Os parâmetros são gravados em JSON: passe ids, não objetos.
+"""
+import importlib
+import logging
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections, connection, transaction
+from django.utils import timezone
+
+from ..models import Tarefa
+
+logger = logging.getLogger(__name__)
+
+# Módulos que registram tarefas (importados pelo worker antes de executar)
+MODULOS = [
+    'crm.services.tarefas',
+    'crm.services.whatsapp_webhook',
+    'crm.services.media_processor',
+    'crm.services.media_fetcher',
+    'crm.services.transcricao',
+]
+
+# Backoff exponencial entre tentativas: 10s, 20s, 40s... limitado a 15 min
+# (também usado pelo worker do webhook, process_webhook_inbox)
+BACKOFF_BASE_SEGUNDOS = 5
+BACKOFF_MAX_SEGUNDOS = 15 * 60
+
+PRIORIDADE_PADRAO = 10
+
+_registro = {}
+_pool_local = None
+_pool_lock = threading.Lock()
+
+
+class Definicao:
+    def __init__(self, nome, funcao, max_tentativas, prioridade, periodica, ao_falhar=None):
+        self.nome = nome
+        self.funcao = funcao
+        self.max_tentativas = max_tentativas
+        self.prioridade = prioridade
+        self.periodica = periodica
+        self.ao_falhar = ao_falhar
+
+
+def tarefa(nome, max_tentativas=5, prioridade=PRIORIDADE_PADRAO, periodica=None, ao_falhar=None):
+    """
+    Registra a função como tarefa. periodica: intervalo em segundos entre
+    execuções; ao_falhar: chamada com os mesmos parâmetros quando a tarefa
+    esgota as tentativas (dead-letter).
+    """
+    def decorador(funcao):
+        _registro[nome] = Definicao(nome, funcao, max_tentativas, prioridade, periodica, ao_falhar)
+        return funcao
+    return decorador
+
+
+def carregar_registro():
+    for modulo in MODULOS:
+        importlib.import_module(modulo)
+    return _registro
+
+
+def definicao(nome):
+    if nome not in _registro:
+        carregar_registro()
+    return _registro.get(nome)
+
+
+def backoff(tentativas):
+    """Segundos até a próxima tentativa depois de `tentativas` falhas."""
+    return min(BACKOFF_BASE_SEGUNDOS * (2 ** tentativas), BACKOFF_MAX_SEGUNDOS)
+
+
+def worker_ativo():
+    return getattr(settings, 'TAREFAS_WORKER', False)
+
+
+def agendar(nome, atraso=0, prioridade=None, **parametros):
+    """
+    Grava a tarefa para execução em `atraso` segundos. Dentro de uma transação,
+    só fica visível (e só roda) após o commit.
+    """
+    d = definicao(nome)
+    if d is None:
+        raise ValueError(f'Tarefa não registrada: {nome}')
+
+    t = Tarefa.objects.create(
+        nome=nome,
+        parametros=parametros,
+        prioridade=d.prioridade if prioridade is None else prioridade,
+        max_tentativas=d.max_tentativas,
+        executar_em=timezone.now() + timedelta(seconds=atraso),
+    )
+    if not worker_ativo():
+        transaction.on_commit(lambda: _executar_local(t.id, atraso))
+    return t
+
+
+def reservar(tarefa_id):
+    """Marca a tarefa como EXECUTANDO se ainda estiver pendente. Retorna a Tarefa ou None."""
+    reservada = Tarefa.objects.filter(id=tarefa_id, status=Tarefa.STATUS_PENDENTE).update(
+        status=Tarefa.STATUS_EXECUTANDO, data_inicio=timezone.now()
+    )
+    return Tarefa.objects.get(id=tarefa_id) if reservada else None
+
+
+def proxima():
+    """Reserva a próxima tarefa pronta (menor prioridade, depois executar_em). None se não houver."""
+    while True:
+        candidata = (
+            Tarefa.objects
+            .filter(status=Tarefa.STATUS_PENDENTE, executar_em__lte=timezone.now())
+            .order_by('prioridade', 'executar_em', 'id')
+            .values_list('id', flat=True)
+            .first()
+        )
+        if candidata is None:
+            return None
+        t = reservar(candidata)
+        if t is not None:
+            return t
+
+
+def executar(t):
+    """
+    Executa uma tarefa já reservada; em erro agenda retry com backoff ou move
+    para FALHOU. Periódicas são reagendadas ao final. Retorna True se concluiu.
+    """
+    d = definicao(t.nome)
+    t.tentativas += 1
+    try:
+        if d is None:
+            raise LookupError(f'Tarefa não registrada: {t.nome}')
+        d.funcao(**t.parametros)
+    except Exception as e:
+        t.ultimo_erro = f"{e}\n{traceback.format_exc()}"[:5000]
+        if d is None or t.tentativas >= t.max_tentativas:
+            t.status = Tarefa.STATUS_FALHOU
+            logger.error(f"[Tarefas] #{t.id} {t.nome} movida para dead-letter: {e}")
+        else:
+            atraso = backoff(t.tentativas)
+            t.status = Tarefa.STATUS_PENDENTE
+            t.executar_em = timezone.now() + timedelta(seconds=atraso)
+            logger.warning(
+                f"[Tarefas] #{t.id} {t.nome} falhou "
+                f"(tentativa {t.tentativas}/{t.max_tentativas}), nova tentativa em {atraso}s: {e}"
+            )
+        t.save(update_fields=['tentativas', 'ultimo_erro', 'status', 'executar_em'])
+        if t.status == Tarefa.STATUS_FALHOU:
+            _ao_falhar(d, t)
+            _reagendar_periodica(d)
+        return False
+
+    t.status = Tarefa.STATUS_CONCLUIDA
+    t.data_conclusao = timezone.now()
+    t.ultimo_erro = None
+    t.save(update_fields=['tentativas', 'ultimo_erro', 'status', 'data_conclusao'])
+    _reagendar_periodica(d)
+    return True
+
+
+def _ao_falhar(d, t):
+    if d is None or d.ao_falhar is None:
+        return
+    try:
+        d.ao_falhar(**t.parametros)
+    except Exception as e:
+        logger.error(f"[Tarefas] Erro no ao_falhar de #{t.id} {t.nome}: {e}")
+
+
+def _reagendar_periodica(d):
+    if d is not None and d.periodica:
+        Tarefa.objects.create(
+            nome=d.nome, prioridade=d.prioridade, max_tentativas=d.max_tentativas,
+            executar_em=timezone.now() + timedelta(seconds=d.periodica),
+        )
+
+
+def garantir_periodicas():
+    """Cria a próxima execução de cada tarefa periódica que não tenha uma em aberto."""
+    abertas = set(
+        Tarefa.objects.filter(status__in=Tarefa.STATUS_ABERTOS).values_list('nome', flat=True).distinct()
+    )
+    for d in carregar_registro().values():
+        if d.periodica and d.nome not in abertas:
+            Tarefa.objects.create(nome=d.nome, prioridade=d.prioridade, max_tentativas=d.max_tentativas)
+
+
+def liberar_travadas(minutos):
+    """Tarefas EXECUTANDO há mais de N minutos (worker morreu no meio) voltam para a fila."""
+    limite = timezone.now() - timedelta(minutes=minutos)
+    return Tarefa.objects.filter(status=Tarefa.STATUS_EXECUTANDO, data_inicio__lt=limite).update(
+        status=Tarefa.STATUS_PENDENTE
+    )
+
+
+# ──────────────────────────────
+# Execução local (TAREFAS_WORKER=False)
+# ──────────────────────────────
+
+def _pool():
+    global _pool_local
+    with _pool_lock:
+        if _pool_local is None:
+            _pool_local = ThreadPoolExecutor(
+                max_workers=max(1, getattr(settings, 'TAREFAS_THREADS_LOCAIS', 4)),
+                thread_name_prefix='tarefa',
+            )
+        return _pool_local
+
+
+def _executar_local(tarefa_id, atraso):
+    if atraso > 0:
+        timer = threading.Timer(atraso, _pool().submit, args=(_rodar_local, tarefa_id))
+        timer.daemon = True
+        timer.start()
+    else:
+        _pool().submit(_rodar_local, tarefa_id)
+
+
+def _rodar_local(tarefa_id):
+    close_old_connections()
+    try:
+        t = reservar(tarefa_id)
+        if t is None:
+            return
+        if not executar(t) and t.status == Tarefa.STATUS_PENDENTE:
+            espera = (t.executar_em - timezone.now()).total_seconds()
+            _executar_local(t.id, max(espera, 0))
+    except Exception as e:
+        logger.error(f"[Tarefas] Erro ao executar tarefa #{tarefa_id} localmente: {e}")
+    finally:
+        connection.close()
+
+
+@tarefa('tarefas.limpar', max_tentativas=1, prioridade=50, periodica=24 * 60 * 60)
+def limpar_concluidas():
+    """Remove tarefas concluídas/falhas mais antigas que TAREFAS_RETENCAO_DIAS."""
+    dias = getattr(settings, 'TAREFAS_RETENCAO_DIAS', 7)
+    if not dias:
+        return
+    limite = timezone.now() - timedelta(days=dias)
+    Tarefa.objects.filter(
+        status__in=[Tarefa.STATUS_CONCLUIDA, Tarefa.STATUS_FALHOU],
+        data_criacao__lt=limite,
+    ).delete()
@@ -0,0 +1,412 @@
+"""
+Feed da Timeline: Atividades, mensagens do WhatsApp e Logs de uma
+oportunidade, conta ou contato em ordem cronológica decrescente, paginados
+por cursor.
+
+O feed é materializado em TimelineEvento: cada item gera uma linha por
+escopo em que aparece (a oportunidade, as contas e os contatos ligados a
+ela, o contato/conta dono do número da mensagem...), então a Timeline de
+uma entidade é um único range scan em (escopo, entidade_id, momento). O
+cursor guarda a tupla (momento, fonte, item_id) do último item da página.
+Só os itens da página são carregados e serializados.
+
+Pontos de gravação:
+- signals: post_save de Atividade, Log (os signals de auditoria) e
+  WhatsappMessage (mensagem nova / vínculo com oportunidade);
+- whatsapp_webhook.processar_lote: mensagens inseridas via bulk_create;
+- mudanças de vínculo (conta/contatos da oportunidade, conta e telefones do
+  contato, telefone da conta) reconstroem as entidades afetadas após o commit.
+
+`manage.py rebuild_timeline` regenera a tabela a partir dos dados existentes.
+"""
+import base64
+import binascii
+import json
+from functools import partial
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
+from django.db.models import BooleanField, ExpressionWrapper, Q
+from django.utils.dateparse import parse_datetime
+
+from ..models import (
+    Atividade, Conta, Contato, ContatoTelefone, Log, Oportunidade, TimelineEvento, WhatsappMessage,
+)
+
+ATIVIDADE = 'atividade'
+WHATSAPP = 'whatsapp'
+LOG = 'log'
+
+OPORTUNIDADE = TimelineEvento.ESCOPO_OPORTUNIDADE
+CONTA = TimelineEvento.ESCOPO_CONTA
+CONTATO = TimelineEvento.ESCOPO_CONTATO
+ESCOPOS = {OPORTUNIDADE: Oportunidade, CONTA: Conta, CONTATO: Contato}
+
+TAMANHO_PAGINA = 20
+LOTE = 1000
+
+
+class CursorInvalido(ValueError):
+    pass
+
+
+# ──────────────────────────────
+# Cursor
+# ──────────────────────────────
+
+def codificar_cursor(momento, fonte, item_id):
+    dados = json.dumps([momento.isoformat(), fonte, item_id], separators=(',', ':'))
+    return base64.urlsafe_b64encode(dados.encode()).decode().rstrip('=')
+
+
+def decodificar_cursor(cursor):
+    """(momento, fonte, item_id) do cursor; CursorInvalido se malformado."""
+    try:
+        bruto = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        momento, fonte, item_id = json.loads(bruto)
+        momento = parse_datetime(momento)
+        if momento is None or not isinstance(fonte, str) or not isinstance(item_id, int):
+            raise ValueError
+    except (binascii.Error, ValueError, TypeError, UnicodeDecodeError):
+        raise CursorInvalido(cursor)
+    return momento, fonte, item_id
+
+
+# ──────────────────────────────
+# Página
+# ──────────────────────────────
+
+def pagina(escopo, entidade_id, cursor=None, deslocamento=0, tamanho=TAMANHO_PAGINA):
+    """
+    Uma página da Timeline da entidade, em (momento, fonte, item_id) decrescente.
+
+    Args:
+        cursor: (momento, fonte, item_id) do último item da página anterior
+        deslocamento: itens a pular (compatibilidade com ?page=N)
+
+    Returns:
+        (linhas, tem_mais): linhas são (fonte, item_id, momento)
+    """
+    eventos = TimelineEvento.objects.filter(escopo=escopo, entidade_id=entidade_id)
+    if cursor is not None:
+        momento, fonte, item_id = cursor
+        eventos = eventos.filter(
+            Q(momento__lt=momento)
+            | Q(momento=momento, fonte__lt=fonte)
+            | Q(momento=momento, fonte=fonte, item_id__lt=item_id)
+        )
+    linhas = list(
+        eventos.order_by('-momento', '-fonte', '-item_id')
+        .values_list('fonte', 'item_id', 'momento')[deslocamento:deslocamento + tamanho + 1]
+    )
+    return linhas[:tamanho], len(linhas) > tamanho
+
+
+# ──────────────────────────────
+# Gravação incremental
+# ──────────────────────────────
+
+def _ref_atividade(atividade):
+    ct = ContentType.objects.get_for_id(atividade.content_type_id)
+    return (ct.model, atividade.object_id) if ct.app_label == 'crm' and ct.model in ESCOPOS else None
+
+
+def _ref_log(log):
+    modelo = (log.modelo or '').lower()
+    return (modelo, log.objeto_id) if modelo in ESCOPOS and log.objeto_id else None
+
+
+def _escopos(refs):
+    """
+    {ref: {(escopo, entidade_id)}} para as referências dos itens:
+    (oportunidade|conta|contato, id) da entidade dona ou ('numero', chave).
+    """
+    por_tipo = {}
+    for tipo, valor in refs:
+        por_tipo.setdefault(tipo, set()).add(valor)
+    escopos = {ref: set() for ref in refs}
+
+    def add(tipo, valor, escopo, entidade_id):
+        if entidade_id:
+            escopos[(tipo, valor)].add((escopo, entidade_id))
+
+    opp_ids = por_tipo.get(OPORTUNIDADE)
+    if opp_ids:
+        for opp_id, conta_id, contato_id in Oportunidade.objects.filter(id__in=opp_ids).values_list(
+            'id', 'conta_id', 'contato_principal_id'
+        ):
+            add(OPORTUNIDADE, opp_id, OPORTUNIDADE, opp_id)
+            add(OPORTUNIDADE, opp_id, CONTA, conta_id)
+            add(OPORTUNIDADE, opp_id, CONTATO, contato_id)
+        for opp_id, contato_id in Oportunidade.contatos.through.objects.filter(
+            oportunidade_id__in=opp_ids
+        ).values_list('oportunidade_id', 'contato_id'):
+            add(OPORTUNIDADE, opp_id, CONTATO, contato_id)
+        for opp_id, conta_id in Oportunidade.empresas.through.objects.filter(
+            oportunidade_id__in=opp_ids
+        ).values_list('oportunidade_id', 'conta_id'):
+            add(OPORTUNIDADE, opp_id, CONTA, conta_id)
+
+    conta_ids = por_tipo.get(CONTA)
+    if conta_ids:
+        for conta_id in Conta.objects.filter(id__in=conta_ids).values_list('id', flat=True):
+            add(CONTA, conta_id, CONTA, conta_id)
+        # A Timeline do contato inclui a da sua conta
+        for conta_id, contato_id in Contato.objects.filter(conta_id__in=conta_ids).values_list('conta_id', 'id'):
+            add(CONTA, conta_id, CONTATO, contato_id)
+
+    for contato_id in por_tipo.get(CONTATO, ()):
+        add(CONTATO, contato_id, CONTATO, contato_id)
+
+    chaves = por_tipo.get('numero')
+    if chaves:
+        for contato_id, telefone, celular in Contato.objects.filter(
+            Q(telefone_chave__in=chaves) | Q(celular_chave__in=chaves)
+        ).values_list('id', 'telefone_chave', 'celular_chave'):
+            for chave in {telefone, celular} & chaves:
+                add('numero', chave, CONTATO, contato_id)
+        for chave, contato_id in ContatoTelefone.objects.filter(numero_chave__in=chaves).values_list(
+            'numero_chave', 'contato_id'
+        ):
+            add('numero', chave, CONTATO, contato_id)
+        for chave, conta_id in Conta.objects.filter(telefone_principal_chave__in=chaves).values_list(
+            'telefone_principal_chave', 'id'
+        ):
+            add('numero', chave, CONTA, conta_id)
+
+    return escopos
+
+
+def _gravar(itens):
+    """itens: (fonte, item_id, momento, refs). Insere as linhas que faltam; devolve quantas montou."""
+    itens = [item for item in itens if item[3]]
+    if not itens:
+        return 0
+    escopos = _escopos({ref for *_, refs in itens for ref in refs})
+    eventos = [
+        TimelineEvento(escopo=escopo, entidade_id=entidade_id, fonte=fonte, item_id=item_id, momento=momento)
+        for fonte, item_id, momento, refs in itens
+        for escopo, entidade_id in set().union(*(escopos[ref] for ref in refs))
+    ]
+    TimelineEvento.objects.bulk_create(eventos, ignore_conflicts=True, batch_size=LOTE)
+    return len(eventos)
+
+
+def registrar_atividades(atividades):
+    return _gravar(
+        (ATIVIDADE, a.id, a.data_criacao, [ref] if ref else [])
+        for a in atividades for ref in [_ref_atividade(a)]
+    )
+
+
+def registrar_logs(logs):
+    return _gravar(
+        (LOG, log.id, log.timestamp, [ref] if ref else [])
+        for log in logs for ref in [_ref_log(log)]
+    )
+
+
+def registrar_mensagens(mensagens):
+    itens = []
+    for m in mensagens:
+        refs = []
+        if m.oportunidade_id:
+            refs.append((OPORTUNIDADE, m.oportunidade_id))
+        if m.numero_chave:
+            refs.append(('numero', m.numero_chave))
+        itens.append((WHATSAPP, m.id, m.timestamp, refs))
+    return _gravar(itens)
+
+
+def remover_item(fonte, item_id):
+    TimelineEvento.objects.filter(fonte=fonte, item_id=item_id).delete()
+
+
+def remover_entidade(escopo, entidade_id):
+    TimelineEvento.objects.filter(escopo=escopo, entidade_id=entidade_id).delete()
+
+
+# ──────────────────────────────
+# Reconstrução
+# ──────────────────────────────
+
+def consultas(escopo, entidade):
+    """
+    [(fonte, queryset, campo de data)] dos itens da Timeline da entidade,
+    pelos vínculos atuais: o inverso de _escopos.
+    """
+    if escopo == OPORTUNIDADE:
+        return [
+            (ATIVIDADE, Atividade.objects.filter(
+                content_type=ContentType.objects.get_for_model(Oportunidade), object_id=entidade.id
+            ), 'data_criacao'),
+            (WHATSAPP, WhatsappMessage.objects.filter(oportunidade=entidade), 'timestamp'),
+            (LOG, Log.objects.filter(modelo='Oportunidade', objeto_id=entidade.id), 'timestamp'),
+        ]
+
+    if escopo == CONTATO:
+        oportunidades = Q(contato_principal=entidade) | Q(contatos=entidade)
+        chaves = {entidade.telefone_chave, entidade.celular_chave}
+        chaves.update(entidade.telefones.values_list('numero_chave', flat=True))
+        donos = {CONTATO: [entidade.id], CONTA: [entidade.conta_id] if entidade.conta_id else []}
+    else:
+        oportunidades = Q(conta=entidade) | Q(empresas=entidade)
+        chaves = {entidade.telefone_principal_chave}
+        donos = {CONTA: [entidade.id]}
+    chaves.discard('')
+    donos[OPORTUNIDADE] = list(Oportunidade.objects.filter(oportunidades).values_list('id', flat=True).distinct())
+
+    filtro_atividades = Q(pk__in=[])
+    filtro_logs = Q(pk__in=[])
+    for dono, ids in donos.items():
+        if ids:
+            filtro_atividades |= Q(content_type=ContentType.objects.get_for_model(ESCOPOS[dono]), object_id__in=ids)
+            filtro_logs |= Q(modelo=ESCOPOS[dono].__name__, objeto_id__in=ids)
+
+    resultado = [
+        (ATIVIDADE, Atividade.objects.filter(filtro_atividades), 'data_criacao'),
+        (LOG, Log.objects.filter(filtro_logs), 'timestamp'),
+    ]
+    filtro_msgs = Q(pk__in=[])
+    if donos[OPORTUNIDADE]:
+        filtro_msgs |= Q(oportunidade_id__in=donos[OPORTUNIDADE])
+    if chaves:
+        filtro_msgs |= Q(numero_chave__in=chaves)
+    resultado.append((WHATSAPP, WhatsappMessage.objects.filter(filtro_msgs), 'timestamp'))
+    return resultado
+
+
+def reconstruir_entidade(escopo, entidade_id):
+    """Regrava a Timeline de uma entidade pelos vínculos atuais. Retorna o total de eventos."""
+    entidade = ESCOPOS[escopo].objects.filter(id=entidade_id).first()
+    with transaction.atomic():
+        remover_entidade(escopo, entidade_id)
+        if entidade is None:
+            return 0
+        total = 0
+        for fonte, queryset, campo in consultas(escopo, entidade):
+            lote = []
+            for item_id, momento in queryset.order_by().values_list('id', campo).iterator(chunk_size=LOTE):
+                lote.append(TimelineEvento(
+                    escopo=escopo, entidade_id=entidade_id, fonte=fonte, item_id=item_id, momento=momento
+                ))
+                if len(lote) >= LOTE:
+                    TimelineEvento.objects.bulk_create(lote, ignore_conflicts=True)
+                    total += len(lote)
+                    lote = []
+            TimelineEvento.objects.bulk_create(lote, ignore_conflicts=True)
+            total += len(lote)
+    return total
+
+
+def reconstruir_depois(escopos):
+    """Reconstrói as entidades (escopo, id) após o commit (vínculos alterados)."""
+    escopos = {(escopo, entidade_id) for escopo, entidade_id in escopos if entidade_id}
+    if escopos:
+        transaction.on_commit(partial(_reconstruir_entidades, escopos))
+
+
+def _reconstruir_entidades(escopos):
+    for escopo, entidade_id in escopos:
+        reconstruir_entidade(escopo, entidade_id)
+
+
+def reconstruir():
+    """
+    Regenera a tabela inteira a partir de Atividade, WhatsappMessage e Log,
+    em blocos por id. Usado na implantação da tabela e para reparo.
+    Retorna o total de eventos.
+    """
+    TimelineEvento.objects.all().delete()
+    fontes = [
+        (Atividade.objects.only('id', 'data_criacao', 'content_type_id', 'object_id'), registrar_atividades),
+        (WhatsappMessage.objects.only('id', 'timestamp', 'oportunidade_id', 'numero_chave'), registrar_mensagens),
+        (Log.objects.only('id', 'timestamp', 'modelo', 'objeto_id'), registrar_logs),
+    ]
+    total = 0
+    for queryset, registrar in fontes:
+        ultimo_id = 0
+        while True:
+            lote = list(queryset.filter(id__gt=ultimo_id).order_by('id')[:LOTE])
+            if not lote:
+                break
+            total += registrar(lote)
+            ultimo_id = lote[-1].id
+    return total
+
+
+# ──────────────────────────────
+# Itens
+# ──────────────────────────────
+
+def itens(linhas, request=None):
+    """Carrega e serializa só os objetos das linhas da página, na ordem delas."""
+    ids = {ATIVIDADE: [], WHATSAPP: [], LOG: []}
+    for fonte, item_id, _ in linhas:
+        ids[fonte].append(item_id)
+
+    objetos = {
+        ATIVIDADE: Atividade.objects.select_related('proprietario').in_bulk(ids[ATIVIDADE]),
+        # Mídia vai por URL (media_src): não carrega o base64 legado
+        WHATSAPP: WhatsappMessage.objects.defer('media_base64').annotate(
+            midia_legada=ExpressionWrapper(Q(media_base64__isnull=False), output_field=BooleanField())
+        ).in_bulk(ids[WHATSAPP]),
+        LOG: Log.objects.select_related('usuario').in_bulk(ids[LOG]),
+    }
+    montar = {ATIVIDADE: item_atividade, WHATSAPP: item_whatsapp, LOG: item_log}
+
+    resultado = []
+    for fonte, item_id, _ in linhas:
+        obj = objetos[fonte].get(item_id)
+        if obj is not None:
+            resultado.append(montar[fonte](obj, request))
+    return resultado
+
+
+def item_atividade(item, request=None):
+    from ..serializers import AtividadeSerializer
+
+    return {
+        'id': f"atividade_{item.id}",
+        'db_id': item.id,
+        'type': 'atividade',
+        'subtype': item.tipo,  # TAREFA, LIGACAO, NOTA, etc
+        'timestamp': item.data_criacao,
+        'author': item.proprietario.get_full_name() if item.proprietario else 'Sistema',
+        'content': item.descricao or item.titulo,
+        'title': item.titulo,
+        'status': item.status,
+        'data': AtividadeSerializer(item).data,
+    }
+
+
+def item_whatsapp(item, request=None):
+    from ..serializers import WhatsappMessageSerializer
+
+    return {
+        'id': f"whatsapp_{item.id}",
+        'db_id': item.id,
+        'type': 'whatsapp',
+        'subtype': item.tipo_mensagem,  # text, image, audio
+        'timestamp': item.timestamp,
+        'author': 'Eu' if item.de_mim else (item.numero_remetente or 'Cliente'),
+        'direction': 'outbound' if item.de_mim else 'inbound',
+        'content': item.texto or f"[{item.tipo_mensagem or 'midia'}]",
+        'status': 'read' if item.lida else 'delivered',
+        'data': WhatsappMessageSerializer(item, context={'request': request}).data,
+    }
+
+
+def item_log(item, request=None):
+    from ..serializers import LogSerializer
+
+    return {
+        'id': f"log_{item.id}",
+        'db_id': item.id,
+        'type': 'log',
+        'subtype': item.acao,
+        'timestamp': item.timestamp,
+        'author': item.usuario.get_full_name() if item.usuario else 'Sistema',
+        'content': f"{item.get_acao_display()}: {item.observacao or ''}",
+        'data': LogSerializer(item).data,
+    }
@@ -0,0 +1,209 @@
+"""
+Transcrição de áudios do WhatsApp.
+
+Com WHISPER_WORKER=True os pedidos viram TranscricaoAudio e são processados
+pelo daemon `python manage.py whisper_worker`, que carrega o modelo uma única
+vez e atende por prioridade: pedidos interativos (botão "transcrever" no chat)
+antes dos áudios recebidos pelo webhook. Assim os workers do gunicorn não
+carregam o modelo nem disputam CPU com as requisições.
+
+Com WHISPER_WORKER=False (padrão) a transcrição roda no próprio processo,
+como antes.
+
+No modo progressivo (stream=True) a requisição não espera: os segmentos são
+enviados ao grupo WebSocket do canal (AtendimentoConsumer) como eventos
+`transcricao_parcial` à medida que o Whisper os decodifica, e o texto final
+é gravado em WhatsappMessage.texto como nos demais modos.
+"""
+import logging
+import time
+
+from django.conf import settings
+
+from ..models import TranscricaoAudio
+from . import media_store, tarefas
+
+logger = logging.getLogger(__name__)
+
+INTERVALO_CONSULTA_SEGUNDOS = 0.5
+
+# Textos de áudio ainda sem transcrição (webhook, falhas antigas e sincronização)
+TEXTOS_NAO_TRANSCRITOS = ['🎤 [Áudio]', '🎤 [Áudio não transcrito]', '🎤 [Áudio - erro na transcrição]', '[audioMessage]']
+
+
+def worker_ativo():
+    return getattr(settings, 'WHISPER_WORKER', False)
+
+
+def texto_transcrito(resultado):
+    return f"🎤 [Áudio {int(resultado.get('duration') or 0)}s]: {resultado['text']}"
+
+
+def aplicar_resultado(mensagem, resultado):
+    """Grava a transcrição em WhatsappMessage.texto. Retorna True se havia texto."""
+    if not (resultado and resultado.get('text')):
+        return False
+    mensagem.texto = texto_transcrito(resultado)
+    mensagem.save(update_fields=['texto'])
+    return True
+
+
+def enfileirar(mensagem_id, interativa=False):
+    """
+    Cria (ou reaproveita) o pedido pendente de transcrição da mensagem.
+    Um pedido interativo promove o pendente já existente.
+    """
+    prioridade = TranscricaoAudio.PRIORIDADE_INTERATIVA if interativa else TranscricaoAudio.PRIORIDADE_SEGUNDO_PLANO
+    pedido = (
+        TranscricaoAudio.objects
+        .filter(mensagem_id=mensagem_id, status__in=TranscricaoAudio.STATUS_ABERTOS)
+        .order_by('id')
+        .first()
+    )
+    if pedido is None:
+        return TranscricaoAudio.objects.create(mensagem_id=mensagem_id, prioridade=prioridade)
+    if prioridade < pedido.prioridade:
+        TranscricaoAudio.objects.filter(id=pedido.id).update(prioridade=prioridade)
+        pedido.prioridade = prioridade
+    return pedido
+
+
+def enfileirar_lote(mensagem_ids):
+    """Pedidos de segundo plano para várias mensagens (ingestão em lote), sem duplicar abertos."""
+    abertos = set(
+        TranscricaoAudio.objects
+        .filter(mensagem_id__in=mensagem_ids, status__in=TranscricaoAudio.STATUS_ABERTOS)
+        .values_list('mensagem_id', flat=True)
+    )
+    TranscricaoAudio.objects.bulk_create([
+        TranscricaoAudio(mensagem_id=mid, prioridade=TranscricaoAudio.PRIORIDADE_SEGUNDO_PLANO)
+        for mid in dict.fromkeys(mensagem_ids) if mid not in abertos
+    ])
+
+
+def aguardar(pedido_id, timeout):
+    """Espera o worker concluir o pedido. Retorna o TranscricaoAudio final ou None no timeout."""
+    limite = time.monotonic() + timeout
+    while time.monotonic() < limite:
+        pedido = TranscricaoAudio.objects.filter(id=pedido_id).first()
+        if pedido is None or pedido.status not in TranscricaoAudio.STATUS_ABERTOS:
+            return pedido
+        time.sleep(INTERVALO_CONSULTA_SEGUNDOS)
+    return None
+
+
+def notificador(mensagem):
+    """
+    Função notificar(texto, concluida=False, duracao=None, erro=None) que envia
+    `transcricao_parcial` ao grupo do canal da mensagem, ou None se a
+    instância não tem canal.
+    """
+    from . import difusao
+
+    canal_id = difusao.canal_da_instancia(mensagem.instancia)
+    if canal_id is None:
+        return None
+
+    def notificar(texto, concluida=False, duracao=None, erro=None):
+        try:
+            difusao.despachar(f'atendimento_canal_{canal_id}', {
+                'type': 'transcricao_parcial',
+                'mensagem_id': mensagem.id,
+                'numero': mensagem.numero_remoto,
+                'texto': texto,
+                'concluida': concluida,
+                'duracao': duracao,
+                'erro': erro,
+            })
+        except Exception as e:
+            logger.warning(f"[Transcricao] Falha ao enviar parcial da msg {mensagem.id}: {e}")
+
+    return notificar
+
+
+def transcrever_local(mensagem, base64_data=None, mimetype='', ao_segmento=None):
+    """Transcreve no processo atual e grava o texto. Retorna o resultado ou None."""
+    from .audio_transcription import transcribe_audio, transcribe_from_base64
+
+    if base64_data is not None:
+        resultado = transcribe_from_base64(base64_data, mimetype or '', ao_segmento=ao_segmento)
+    elif mensagem.media_hash:
+        # Lê direto do store (sem recodificar em base64); o hash é a chave do cache
+        resultado = transcribe_audio(
+            media_store.caminho(mensagem.media_hash), remover_arquivo=False,
+            audio_hash=mensagem.media_hash, ao_segmento=ao_segmento,
+        )
+    else:
+        base64_data, mimetype = media_store.ler_base64(mensagem)
+        if not base64_data:
+            return None
+        resultado = transcribe_from_base64(base64_data, mimetype or '', ao_segmento=ao_segmento)
+    if not aplicar_resultado(mensagem, resultado):
+        return None
+    return resultado
+
+
+def transcrever_progressivo(mensagem, base64_data=None, mimetype='', notificar=None):
+    """
+    Transcreve enviando cada segmento pelo WebSocket e, ao final, o texto
+    gravado (concluida=True). Usado pela tarefa do modo stream.
+    """
+    if notificar is None:
+        notificar = notificador(mensagem) or (lambda *args, **kwargs: None)
+    try:
+        resultado = transcrever_local(
+            mensagem, base64_data, mimetype,
+            ao_segmento=lambda segmento, acumulado: notificar(acumulado),
+        )
+    except Exception as e:
+        logger.error(f"[Transcricao] Erro na transcrição progressiva da msg {mensagem.id}: {e}")
+        resultado = None
+    if resultado:
+        notificar(mensagem.texto, concluida=True, duracao=resultado.get('duration'))
+    else:
+        notificar(None, concluida=True, erro='transcription_empty')
+    return resultado
+
+
+@tarefas.tarefa('transcricao.progressiva', max_tentativas=1, prioridade=0)
+def transcrever_progressivo_tarefa(mensagem_id):
+    from ..models import WhatsappMessage
+
+    mensagem = WhatsappMessage.objects.filter(id=mensagem_id).first()
+    if mensagem is not None:
+        transcrever_progressivo(mensagem)
+
+
+def transcrever(mensagem, base64_data=None, mimetype='', interativa=False, stream=False):
+    """
+    Transcreve o áudio da mensagem (já gravado no store de mídias).
+
+    Com o worker ativo, enfileira o pedido; interativo espera até
+    WHISPER_ESPERA_INTERATIVA segundos. Sem worker (ou se a mídia não chegou
+    ao store, que é de onde o worker lê), transcreve aqui.
+
+    Com stream=True não espera: o texto chega por eventos `transcricao_parcial`
+    (do whisper_worker ou da tarefa transcricao.progressiva).
+
+    Returns:
+        dict com 'text' e 'duration', {'pendente': True} se ficou na fila ou
+        está sendo transmitido, ou None se a transcrição falhou/veio vazia
+    """
+    if worker_ativo() and mensagem.media_hash:
+        pedido = enfileirar(mensagem.id, interativa=interativa or stream)
+        if stream or not interativa:
+            return {'pendente': True}
+        pedido = aguardar(pedido.id, getattr(settings, 'WHISPER_ESPERA_INTERATIVA', 60))
+        if pedido is None:
+            return {'pendente': True}
+        if pedido.status != TranscricaoAudio.STATUS_CONCLUIDA or not pedido.texto:
+            return None
+        mensagem.refresh_from_db(fields=['texto'])
+        return {'text': pedido.texto, 'duration': pedido.duracao or 0}
+
+    if stream and mensagem.media_hash:
+        # A tarefa lê o áudio do store; sem ele, transcreve aqui mesmo (sem stream)
+        tarefas.agendar('transcricao.progressiva', mensagem_id=mensagem.id)
+        return {'pendente': True}
+
+    return transcrever_local(mensagem, base64_data, mimetype)
@@ -0,0 +1,487 @@
+"""
+Pipeline de ingestão dos eventos do webhook WhatsApp (Evolution API).
+
+Usado diretamente pela WhatsappWebhookView (modo síncrono) ou pelo worker
+`manage.py process_webhook_inbox`, que drena a caixa de entrada
+WebhookEvento quando WHATSAPP_WEBHOOK_ASYNC está ativo.
+"""
+import logging
+from datetime import timezone as dt_timezone
+
+from django.db import transaction
+from django.utils import timezone
+
+from ..models import Canal, WhatsappMessage
+from . import chat_ao_vivo, media_fetcher, media_store, nao_lidas, tarefas, timeline, transcricao
+from .conversas import registrar_mensagens
+from .evolution_api import EvolutionService
+from .phone import canonical_phone
+
+logger = logging.getLogger(__name__)
+
+
+def extrair_evento(data):
+    """Retorna (evento normalizado, instância) de um payload do webhook."""
+    event = (data.get('event') or '').lower().replace('_', '.')
+    instance = data.get('instance', 'unknown')
+    return event, instance
+
+
+def extrair_mensagens(data):
+    """
+    Tenta encontrar a lista de mensagens em qualquer lugar do payload.
+
+    Formatos comuns da Evolution API:
+    1. data['data']['messages']
+    2. data['messages']
+    3. data['data'] (se for uma única mensagem)
+    """
+    if 'data' in data and isinstance(data['data'], dict) and 'messages' in data['data']:
+        return data['data']['messages']
+    if 'messages' in data:
+        return data['messages']
+    if 'data' in data:
+        return [data['data']] if isinstance(data['data'], dict) else []
+    # Se não achou nos lugares comuns, procura por 'key' no root (formato de mensagem única)
+    if 'key' in data:
+        return [data]
+    return []
+
+
+def processar_payload(data, raise_errors=False):
+    """
+    Processa um payload completo do webhook.
+
+    Args:
+        data: JSON recebido da Evolution API
+        raise_errors: se True, propaga exceções por mensagem (usado pelo worker
+            para agendar nova tentativa); se False, apenas registra no log.
+
+    Returns:
+        'received' se o evento era de mensagens, 'ignored' caso contrário
+    """
+    event, instance = extrair_evento(data)
+
+    # Aceita mensagens recebidas/atribuídas e enviadas
+    if 'messages' not in event and 'message' not in event:
+        return 'received'
+
+    messages = extrair_mensagens(data)
+    if not messages:
+        return 'ignored'
+
+    # Vários itens (ex.: sincronização de histórico após reconexão) vão pelo caminho em lote
+    if len(messages) > 1:
+        try:
+            processar_lote(messages, instance)
+        except Exception as e:
+            if raise_errors:
+                raise
+            logger.error(f"[WEBHOOK] Erro ao processar lote de {len(messages)} mensagens: {str(e)}")
+        return 'received'
+
+    for msg_data in messages:
+        try:
+            processar_mensagem(msg_data, instance)
+        except Exception as e:
+            if raise_errors:
+                raise
+            logger.error(f"[WEBHOOK] Erro ao processar mensagem: {str(e)}")
+
+    return 'received'
+
+
+def processar_reacao(msg_data):
+    """Trata reações (reactionMessage) — atualiza a mensagem original."""
+    key = msg_data.get('key', {})
+    remote_jid = key.get('remoteJid', '')
+    from_me = key.get('fromMe', False)
+
+    reaction = msg_data.get('message', {})['reactionMessage']
+    original_id = reaction.get('key', {}).get('id')
+    emoji = reaction.get('text', '')
+    remote_number = remote_jid.split('@')[0] if remote_jid else ''
+    try:
+        original_msg = WhatsappMessage.objects.get(id_mensagem=original_id)
+    except WhatsappMessage.DoesNotExist:
+        return None
+
+    reacoes = list(original_msg.reacoes or [])
+    # Remove reação anterior do mesmo número
+    reacoes = [r for r in reacoes if r.get('numero') != remote_number]
+    if emoji:  # string vazia = remoção da reação
+        reacoes.append({'emoji': emoji, 'de_mim': from_me, 'numero': remote_number})
+    original_msg.reacoes = reacoes
+    original_msg.save(update_fields=['reacoes'])
+    return original_msg
+
+
+def extrair_conteudo(msg_data):
+    """
+    Extrai texto, tipo e mídia de uma mensagem do webhook.
+
+    Returns:
+        dict com text, mtype, media_url, media_base64, media_tamanho (fileLength
+        informado) e needs_async_processing (mídia sem base64 inline)
+    """
+    message_content = msg_data.get('message', {})
+    text = ""
+    media_url = None
+
+    if 'conversation' in message_content:
+        text = message_content['conversation']
+    elif 'extendedTextMessage' in message_content:
+        text = message_content['extendedTextMessage'].get('text', '')
+    elif 'buttonsResponseMessage' in message_content:
+        text = message_content['buttonsResponseMessage'].get('selectedDisplayText', '')
+
+    # Mídia
+    mtype = 'text'
+    media_base64 = None
+    media_tamanho = None
+    needs_async_processing = False
+
+    if not text:
+        for media_type in ['imageMessage', 'videoMessage', 'documentMessage', 'audioMessage']:
+            if media_type in message_content:
+                media_content = message_content[media_type]
+                text = media_content.get('caption', '')
+                mtype = media_type.replace('Message', '')
+
+                # Extrai URL da mídia para referência
+                media_url = media_content.get('url') or media_content.get('directPath')
+
+                # Captura base64 se a Evolution API enviou via Webhook Base64
+                inline_b64 = media_content.get('base64') or msg_data.get('base64')
+                if inline_b64:
+                    mimetype = media_content.get('mimetype') or media_content.get('mimeType') or ''
+                    if not inline_b64.startswith('data:'):
+                        inline_b64 = f"data:{mimetype};base64,{inline_b64}" if mimetype else inline_b64
+                    media_base64 = inline_b64
+
+                # Sem base64 inline a mídia é baixada depois (services.media_fetcher)
+                needs_async_processing = not media_base64
+                media_tamanho = _tamanho_declarado(media_content.get('fileLength'))
+
+                # Define texto temporário
+                if media_type == 'audioMessage':
+                    if not text:
+                        text = "🎤 [Áudio]"
+
+                elif media_type == 'imageMessage':
+                    if not text:
+                        text = "📷 [Imagem]"
+
+                elif media_type == 'videoMessage':
+                    if not text:
+                        text = "🎥 [Vídeo]"
+
+                elif media_type == 'documentMessage':
+                    filename = media_content.get('fileName', 'documento')
+                    if not text:
+                        text = f"📄 [{filename}]"
+
+                if not text:
+                    text = f'[{media_type}]'
+                break
+
+    return {
+        'text': text,
+        'mtype': mtype,
+        'media_url': media_url,
+        'media_base64': media_base64,
+        'media_tamanho': media_tamanho,
+        'needs_async_processing': needs_async_processing,
+    }
+
+
+def _tamanho_declarado(file_length):
+    """fileLength do WhatsApp: número, string ou Long serializado ({low, high})."""
+    if isinstance(file_length, dict):
+        file_length = (file_length.get('low') or 0) % 2 ** 32 + (file_length.get('high') or 0) * 2 ** 32
+    try:
+        return int(file_length) or None
+    except (TypeError, ValueError):
+        return None
+
+
+def montar_mensagem(msg_data, instance):
+    """
+    Monta (sem salvar) a WhatsappMessage de um item do webhook.
+
+    Returns:
+        (WhatsappMessage, needs_async_processing) ou (None, False) se o item
+        não tiver id
+    """
+    key = msg_data.get('key', {})
+    id_msg = key.get('id')
+    if not id_msg:
+        return None, False
+
+    remote_jid = key.get('remoteJid', '')
+    from_me = key.get('fromMe', False)
+
+    conteudo = extrair_conteudo(msg_data)
+    text = conteudo['text']
+    mtype = conteudo['mtype']
+
+    # Timestamp
+    ts_int = msg_data.get('messageTimestamp')
+    dt = timezone.datetime.fromtimestamp(int(ts_int), tz=dt_timezone.utc) if ts_int else timezone.now()
+
+    # Determina números
+    remote_number = remote_jid.split('@')[0] if remote_jid else ''
+
+    if from_me:
+        numero_remetente = instance
+        numero_destinatario = remote_number
+    else:
+        numero_remetente = remote_number
+        numero_destinatario = instance
+
+    msg_obj = WhatsappMessage(
+        id_mensagem=id_msg,
+        instancia=instance,
+        de_mim=from_me,
+        numero_remetente=numero_remetente,
+        numero_destinatario=numero_destinatario,
+        texto=text or '[sem texto]',
+        tipo_mensagem=mtype,
+        url_media=conteudo['media_url'],
+        timestamp=dt
+    )
+    # bulk_create não chama save(): a chave canônica é preenchida aqui
+    msg_obj.numero_chave = canonical_phone(remote_number)
+    needs_async = conteudo['needs_async_processing']
+    # Tamanho informado pelo WhatsApp: o media_fetcher não baixa o que passar do teto
+    msg_obj.media_tamanho = conteudo['media_tamanho']
+
+    # Base64 inline vai para o store de mídias; só o hash fica na mensagem
+    if conteudo['media_base64'] and mtype in ['image', 'audio']:
+        try:
+            media_store.anexar(msg_obj, conteudo['media_base64'], media_store.MIMETYPE_PADRAO.get(mtype, ''))
+        except media_store.MidiaInvalida as e:
+            logger.warning(f"[WEBHOOK] Base64 inline inválido em {id_msg}: {e}")
+            needs_async = True
+
+    return msg_obj, needs_async
+
+
+def _chave_midia(msg_data):
+    key = msg_data.get('key', {})
+    return {
+        'id': key.get('id'),
+        'remoteJid': key.get('remoteJid', ''),
+        'fromMe': key.get('fromMe', False)
+    }
+
+
+def processar_mensagem(msg_data, instance):
+    """Persiste uma mensagem do webhook e dispara vínculo, encaminhamento e mídia."""
+    key = msg_data.get('key', {})
+    id_msg = key.get('id')
+
+    if not id_msg:
+        return None
+
+    if 'reactionMessage' in msg_data.get('message', {}):
+        processar_reacao(msg_data)
+        return None  # Reação não é salva como mensagem nova
+
+    # Previne duplicatas
+    if WhatsappMessage.objects.filter(id_mensagem=id_msg).exists():
+        return None
+
+    # Oportunidade resolvida antes do INSERT: um único save (e um único post_save)
+    msg_obj, needs_async = montar_mensagem(msg_data, instance)
+    msg_obj.oportunidade_id = EvolutionService.identificar_oportunidades_em_lote(
+        [msg_obj.numero_chave]
+    ).get(msg_obj.numero_chave)
+    msg_obj.save()
+
+    # Encaminha para responsável do canal (se habilitado)
+    if not msg_obj.de_mim and msg_obj.oportunidade_id:
+        encaminhar_para_responsavel(msg_obj, msg_obj.numero_remoto, msg_obj.texto)
+
+    # Áudio que já veio inline no webhook: transcrição fica com o whisper_worker
+    if msg_obj.tipo_mensagem == 'audio' and msg_obj.media_hash and transcricao.worker_ativo():
+        transcricao.enfileirar(msg_obj.id)
+
+    # Download da mídia conforme a política do tipo (services.media_fetcher)
+    if needs_async:
+        _agendar_midia(msg_obj, _chave_midia(msg_data), instance)
+
+    return msg_obj
+
+
+def processar_lote(messages, instance, batch_size=500):
+    """
+    Ingestão em lote de vários itens do webhook (sincronização de histórico).
+
+    Em vez de exists()/create()/identify_and_link_message()/save() por mensagem:
+    - uma consulta resolve os id_mensagem já existentes;
+    - as novas entram com bulk_create(ignore_conflicts=True);
+    - as oportunidades do lote são resolvidas de uma vez
+      (EvolutionService.identificar_oportunidades_em_lote) e gravadas com um
+      UPDATE por oportunidade.
+
+    Como bulk_create não dispara post_save, o broadcast WebSocket é feito uma
+    vez por conversa (última mensagem recebida). O encaminhamento ao
+    responsável do canal não é feito para lotes, que normalmente são histórico.
+
+    Returns:
+        quantidade de mensagens novas inseridas
+    """
+    reacoes = []
+    novas = {}  # id_mensagem -> (WhatsappMessage, needs_async, msg_data)
+    for msg_data in messages:
+        if not msg_data.get('key', {}).get('id'):
+            continue
+        if 'reactionMessage' in msg_data.get('message', {}):
+            reacoes.append(msg_data)
+            continue
+        msg_obj, needs_async = montar_mensagem(msg_data, instance)
+        novas.setdefault(msg_obj.id_mensagem, (msg_obj, needs_async, msg_data))
+
+    if novas:
+        existentes = set(
+            WhatsappMessage.objects.filter(id_mensagem__in=list(novas))
+            .values_list('id_mensagem', flat=True)
+        )
+        for id_msg in existentes:
+            novas.pop(id_msg, None)
+
+    if novas:
+        with transaction.atomic():
+            WhatsappMessage.objects.bulk_create(
+                [item[0] for item in novas.values()],
+                ignore_conflicts=True,
+                batch_size=batch_size,
+            )
+            # ignore_conflicts não devolve PKs em todos os bancos: relê os ids
+            pks = dict(
+                WhatsappMessage.objects.filter(id_mensagem__in=list(novas))
+                .values_list('id_mensagem', 'id')
+            )
+            for id_msg, (msg_obj, _, _) in novas.items():
+                msg_obj.id = pks.get(id_msg)
+
+            inseridas = [item[0] for item in novas.values() if item[0].id]
+            _vincular_lote(inseridas)
+            # bulk_create não dispara post_save: atualiza conversas, Timeline e contadores aqui
+            registrar_mensagens(inseridas)
+            timeline.registrar_mensagens(inseridas)
+            nao_lidas.agendar(
+                (m.instancia, m.numero_chave, m.oportunidade_id)
+                for m in inseridas if not m.de_mim and not m.lida
+            )
+
+    # Reações depois das inserções: podem apontar para mensagens do próprio lote
+    for msg_data in reacoes:
+        processar_reacao(msg_data)
+
+    if novas:
+        _broadcast_lote([item[0] for item in novas.values() if item[0].id])
+
+        pendentes_midia = [
+            (msg_obj, _chave_midia(msg_data), instance)
+            for msg_obj, needs_async, msg_data in novas.values()
+            if needs_async and msg_obj.id
+        ]
+        if transcricao.worker_ativo():
+            audios = [
+                msg_obj.id for msg_obj, _, _ in novas.values()
+                if msg_obj.id and msg_obj.tipo_mensagem == 'audio' and msg_obj.media_hash
+            ]
+            if audios:
+                transcricao.enfileirar_lote(audios)
+
+        for args in pendentes_midia:
+            _agendar_midia(*args)
+
+    return len(novas)
+
+
+def _vincular_lote(mensagens):
+    """Vincula as mensagens às oportunidades com um UPDATE por oportunidade."""
+    mapa = EvolutionService.identificar_oportunidades_em_lote({m.numero_chave for m in mensagens})
+    if not mapa:
+        return
+
+    por_oportunidade = {}
+    for m in mensagens:
+        opp_id = mapa.get(m.numero_chave)
+        if opp_id:
+            m.oportunidade_id = opp_id
+            por_oportunidade.setdefault(opp_id, []).append(m.id)
+
+    # update() não aciona o auto_now: data_atualizacao explícita para o delta do chat
+    agora = timezone.now()
+    for opp_id, ids in por_oportunidade.items():
+        WhatsappMessage.objects.filter(id__in=ids).update(oportunidade_id=opp_id, data_atualizacao=agora)
+
+
+def _broadcast_lote(mensagens):
+    """
+    Notifica o WebSocket com a última mensagem recebida de cada conversa do
+    lote e envia o lote inteiro aos chats abertos (bulk_create não dispara signals).
+    """
+    from ..signals import _broadcast_nova_mensagem
+
+    chat_ao_vivo.publicar(mensagens)
+
+    ultimas = {}
+    for m in mensagens:
+        if m.de_mim:
+            continue
+        atual = ultimas.get(m.numero_chave)
+        if atual is None or m.timestamp > atual.timestamp:
+            ultimas[m.numero_chave] = m
+
+    for m in ultimas.values():
+        _broadcast_nova_mensagem(m)
+
+
+def _agendar_midia(msg_obj, msg_key, instance_name):
+    # A Evolution leva alguns segundos para disponibilizar a mídia
+    media_fetcher.antecipar(msg_obj, atraso=3, msg_key=msg_key, instance_name=instance_name, nova=True)
+
+
+def encaminhar_para_responsavel(msg_obj, remote_number, text):
+    """Encaminha a mensagem recebida ao responsável do canal, se habilitado."""
+    try:
+        msg_obj.refresh_from_db()
+        opp = msg_obj.oportunidade
+        if not (opp and opp.canal and opp.canal.encaminhar_whatsapp_responsavel):
+            return
+
+        canal_obj = opp.canal
+        resp = canal_obj.responsavel
+        if not (resp and resp.telefone):
+            return
+
+        resp_number = ''.join(filter(str.isdigit, resp.telefone))
+        # Evita loop: não encaminha se o remetente é o próprio responsável
+        if not resp_number or resp_number in (remote_number, f'55{remote_number}'):
+            return
+
+        conta_nome = opp.conta.nome_empresa if opp.conta else ''
+        contato_nome = opp.contato_principal.nome if opp.contato_principal else remote_number
+        header = f"📩 *{contato_nome}*"
+        if conta_nome:
+            header += f" ({conta_nome})"
+        fwd_text = f"{header}\n\n{text}"
+
+        tarefas.agendar(
+            'whatsapp.encaminhar_responsavel', canal_id=canal_obj.id, numero=resp_number, texto=fwd_text
+        )
+    except Exception as fwd_err:
+        logger.error(f"[WEBHOOK] Erro ao verificar encaminhamento: {fwd_err}")
+
+
+# Envio não é idempotente: sem retentativa no nível da tarefa (o transporte já
+# repete quando a requisição certamente não chegou)
+@tarefas.tarefa('whatsapp.encaminhar_responsavel', max_tentativas=1)
+def encaminhar_texto(canal_id, numero, texto):
+    canal = Canal.objects.get(id=canal_id)
+    EvolutionService.for_canal(canal).send_text(numero, texto)
@@ -386,65 +386,280 @@ def automatizar_pos_venda_suporte(sender, instance, created, **kwargs):
                     nova_sup.contatos.set(instance.contatos.all())
 
 
+# ──────────────────────────────────────────────────────────────────────────────
+# Inbox: manutenção incremental da tabela Conversa
+# ──────────────────────────────────────────────────────────────────────────────
+
+@receiver(post_save, sender='crm.WhatsappMessage')
+def atualizar_conversa_whatsapp(sender, instance, created, update_fields=None, **kwargs):
+    """
+    Signal: mensagem nova atualiza o resumo da conversa; vínculo posterior com
+    oportunidade (identify_and_link_message) é propagado para a conversa.
+    Em ambos os casos agenda o recálculo dos contadores de não lidas.
+    Registrado antes do broadcast para que o WebSocket já veja a conversa atualizada.
+    """
+    from .services.conversas import registrar_mensagem, atualizar_oportunidade
+    from .services import nao_lidas
+
+    if created:
+        registrar_mensagem(instance)
+    elif instance.oportunidade_id and (update_fields is None or 'oportunidade' in update_fields):
+        atualizar_oportunidade(instance)
+    else:
+        return
+
+    # Contadores de não lidas (oportunidade/canal) só mudam com mensagens recebidas
+    if not instance.de_mim and not instance.lida:
+        nao_lidas.agendar([(instance.instancia, instance.numero_chave, instance.oportunidade_id)])
+
+
+@receiver(post_save, sender=Contato)
+def vincular_conversas_ao_contato(sender, instance, **kwargs):
+    """Signal: conversas ainda sem contato passam a apontar para o contato com o mesmo número."""
+    from .models import Conversa
+
+    chaves = {instance.telefone_chave, instance.celular_chave} - {''}
+    if chaves:
+        Conversa.objects.filter(numero_chave__in=chaves, contato__isnull=True).update(contato=instance)
+
+
+@receiver(post_save, sender=Oportunidade)
+def atualizar_funil_conversas(sender, instance, **kwargs):
+    """
+    Signal: mantém o funil_tipo das conversas vinculadas (e o cacheado para
+    as prévias WebSocket) em dia com a oportunidade.
+    """
+    from .models import Conversa
+    from .services import difusao
+
+    funil_tipo = instance.funil.tipo if instance.funil_id else None
+    Conversa.objects.filter(oportunidade=instance).exclude(funil_tipo=funil_tipo).update(funil_tipo=funil_tipo)
+    difusao.limpar_funil(instance.id)
+
+
+# ──────────────────────────────────────────────────────────────────────────────
+# Timeline: gravação incremental da tabela TimelineEvento
+# ──────────────────────────────────────────────────────────────────────────────
+
+def _id_antigo(instance, campo):
+    """id do FK antes do save (capture_old_values), para os modelos auditados."""
+    antigo = getattr(instance, '_old_values', {}).get(campo)
+    return antigo.pk if antigo is not None else None
+
+
+def _mudou(instance, *campos):
+    """Algum dos campos mudou neste save (FKs comparados pelo id, sem consultar o objeto)."""
+    antigos = getattr(instance, '_old_values', {})
+    for campo in campos:
+        if campo not in antigos:
+            continue
+        field = instance._meta.get_field(campo)
+        if field.is_relation:
+            if _id_antigo(instance, campo) != getattr(instance, field.attname):
+                return True
+        elif antigos[campo] != getattr(instance, campo):
+            return True
+    return False
+
+
+@receiver(post_save, sender=Atividade)
+def registrar_timeline_atividade(sender, instance, created, **kwargs):
+    """Signal: atividade nova (ou movida para outra entidade) entra na Timeline."""
+    from .services import timeline
+
+    if not created:
+        if not _mudou(instance, 'content_type', 'object_id'):
+            return
+        timeline.remover_item(timeline.ATIVIDADE, instance.id)
+    timeline.registrar_atividades([instance])
+
+
+@receiver(post_save, sender=Log)
+def registrar_timeline_log(sender, instance, created, **kwargs):
+    """Signal: os logs de auditoria (signals acima) entram na Timeline."""
+    from .services import timeline
+
+    if created:
+        timeline.registrar_logs([instance])
+
+
+@receiver(post_save, sender='crm.WhatsappMessage')
+def registrar_timeline_mensagem(sender, instance, created, update_fields=None, **kwargs):
+    """Signal: mensagem nova ou vinculada depois a uma oportunidade entra na Timeline."""
+    from .services import timeline
+
+    if created or (instance.oportunidade_id and (update_fields is None or 'oportunidade' in update_fields)):
+        timeline.registrar_mensagens([instance])
+
+
+@receiver(post_delete, sender=Atividade)
+@receiver(post_delete, sender='crm.WhatsappMessage')
+def remover_timeline_item(sender, instance, **kwargs):
+    from .services import timeline
+
+    fonte = timeline.ATIVIDADE if sender is Atividade else timeline.WHATSAPP
+    timeline.remover_item(fonte, instance.id)
+
+
+@receiver(post_delete, sender=Oportunidade)
+@receiver(post_delete, sender=Conta)
+@receiver(post_delete, sender=Contato)
+def remover_timeline_entidade(sender, instance, **kwargs):
+    from .services import timeline
+
+    timeline.remover_entidade(sender.__name__.lower(), instance.id)
+
+
+@receiver(post_save, sender=Oportunidade)
+def reconstruir_timeline_oportunidade(sender, instance, created, **kwargs):
+    """Signal: troca da conta ou do contato principal muda as Timelines em que os itens aparecem."""
+    from .services import timeline
+
+    if created:
+        return
+    escopos = []
+    if _mudou(instance, 'conta'):
+        escopos += [(timeline.CONTA, _id_antigo(instance, 'conta')), (timeline.CONTA, instance.conta_id)]
+    if _mudou(instance, 'contato_principal'):
+        escopos += [
+            (timeline.CONTATO, _id_antigo(instance, 'contato_principal')),
+            (timeline.CONTATO, instance.contato_principal_id),
+        ]
+    timeline.reconstruir_depois(escopos)
+
+
+@receiver(post_save, sender=Contato)
+def reconstruir_timeline_contato(sender, instance, created, **kwargs):
+    """Signal: conta e telefones do contato definem quais itens aparecem na sua Timeline."""
+    from .services import timeline
+
+    if created:
+        mudou = instance.conta_id or instance.telefone_chave or instance.celular_chave
+    else:
+        mudou = _mudou(instance, 'conta', 'telefone', 'celular')
+    if mudou:
+        timeline.reconstruir_depois([(timeline.CONTATO, instance.id)])
+
+
+@receiver(post_save, sender=Conta)
+def reconstruir_timeline_conta(sender, instance, created, **kwargs):
+    """Signal: mensagens do telefone principal aparecem na Timeline da conta."""
+    from .services import timeline
+
+    if created:
+        mudou = instance.telefone_principal_chave
+    else:
+        mudou = _mudou(instance, 'telefone_principal')
+    if mudou:
+        timeline.reconstruir_depois([(timeline.CONTA, instance.id)])
+
+
+@receiver(post_save, sender='crm.ContatoTelefone')
+@receiver(post_delete, sender='crm.ContatoTelefone')
+def reconstruir_timeline_telefone_contato(sender, instance, **kwargs):
+    from .services import timeline
+
+    timeline.reconstruir_depois([(timeline.CONTATO, instance.contato_id)])
+
+
+@receiver(m2m_changed, sender=Oportunidade.contatos.through)
+@receiver(m2m_changed, sender=Oportunidade.empresas.through)
+def reconstruir_timeline_vinculos(sender, instance, action, reverse, model, pk_set, **kwargs):
+    """Signal: contatos/empresas adicionados ou removidos da oportunidade."""
+    from .services import timeline
+
+    escopo = timeline.CONTATO if sender is Oportunidade.contatos.through else timeline.CONTA
+    if reverse:
+        # instance é o Contato/Conta; pk_set são oportunidades
+        if action in ('post_add', 'post_remove', 'post_clear'):
+            timeline.reconstruir_depois([(escopo, instance.id)])
+        return
+
+    relacionados = instance.contatos if escopo == timeline.CONTATO else instance.empresas
+    if action == 'pre_clear':
+        instance._timeline_antes_clear = set(relacionados.values_list('id', flat=True))
+    elif action == 'post_clear':
+        timeline.reconstruir_depois((escopo, i) for i in getattr(instance, '_timeline_antes_clear', ()))
+    elif action in ('post_add', 'post_remove'):
+        timeline.reconstruir_depois((escopo, i) for i in pk_set or ())
+
+
+# ──────────────────────────────────────────────────────────────────────────────
+# Evolution API: cache do Canal padrão
+# ──────────────────────────────────────────────────────────────────────────────
+
+@receiver(post_save, sender='crm.Canal')
+@receiver(post_delete, sender='crm.Canal')
+def limpar_cache_canal_evolution(sender, **kwargs):
+    """
+    Signal: alteração de Canal invalida o Canal padrão cacheado pelo
+    EvolutionService e o mapa instância → canal dos eventos WebSocket.
+    """
+    from .services import difusao
+    from .services.evolution_api import limpar_cache_canal
+    limpar_cache_canal()
+    difusao.limpar_canais()
+
+
+@receiver(post_save, sender=Contato)
+@receiver(post_delete, sender=Contato)
+def limpar_cache_nomes_contato(sender, **kwargs):
+    """Signal: nomes de contato das prévias WebSocket (services.difusao) são relidos."""
+    from .services import difusao
+    difusao.limpar_contatos()
+
+
+@receiver(post_save, sender='crm.NumeroBloqueado')
+@receiver(post_delete, sender='crm.NumeroBloqueado')
+def invalidar_cache_bloqueados(sender, **kwargs):
+    """Signal: bloqueio/desbloqueio troca a versão da lista cacheada em cada processo."""
+    from .services import bloqueados
+    bloqueados.invalidar()
+
 # ──────────────────────────────────────────────────────────────────────────────
 # WebSocket: Broadcast de Nova Mensagem WhatsApp para o Canal correspondente
 # ──────────────────────────────────────────────────────────────────────────────
 
 def _broadcast_nova_mensagem(mensagem):
     """
-    Envia evento WebSocket para o grupo do canal quando uma nova mensagem chega.
-    Chamado de forma assíncrona para não bloquear o webhook.
+    Envia a prévia da nova mensagem ao grupo WebSocket do canal após o commit
+    (services.difusao): com a mensagem já vinculada e sem bloquear o webhook.
     """
+    from django.db import transaction
+
+    transaction.on_commit(lambda: _enviar_nova_mensagem(mensagem))
+
+
+def _enviar_nova_mensagem(mensagem):
     import logging
-    from asgiref.sync import async_to_sync
-    from channels.layers import get_channel_layer
-    from .models import Canal, Contato
+    from .services import difusao
 
     logger = logging.getLogger(__name__)
 
     try:
-        # Identifica o canal pela instância Evolution
-        canal = Canal.objects.filter(
-            evolution_instance_name=mensagem.instancia
-        ).first()
-
-        if not canal:
+        # Identifica o canal pela instância Evolution (mapa em cache no processo)
+        canal_id = difusao.canal_da_instancia(mensagem.instancia)
+        if not canal_id:
             logger.warning(f'[WS] Canal não encontrado para instância: {mensagem.instancia}')
             return
 
-        group_name = f'atendimento_canal_{canal.id}'
-
-        # Tenta resolver nome do contato pelo número remetente
+        # Nome do contato e funil também vêm dos caches do processo
         numero = mensagem.numero_remetente
-        contato = Contato.objects.filter(
-            celular__icontains=numero[-8:]
-        ).first()
-        nome_contato = contato.nome if contato else numero
-
-        # Monta payload para o frontend
-        funil_tipo = None
-        if mensagem.oportunidade and mensagem.oportunidade.funil:
-            funil_tipo = mensagem.oportunidade.funil.tipo
-
         payload = {
             'numero': numero,
-            'nome_contato': nome_contato,
+            'nome_contato': difusao.nome_contato(mensagem.numero_chave) or numero,
             'ultima_mensagem': (mensagem.texto or '')[:100],
             'ultima_mensagem_timestamp': mensagem.timestamp.isoformat(),
-            'funil_tipo': funil_tipo,
-            'canal_id': canal.id,
+            'funil_tipo': difusao.funil_tipo(mensagem.oportunidade_id),
+            'canal_id': canal_id,
             'oportunidade_id': mensagem.oportunidade_id,
             'de_mim': mensagem.de_mim,
         }
-
-        channel_layer = get_channel_layer()
-        async_to_sync(channel_layer.group_send)(group_name, {
+        difusao.despachar(f'atendimento_canal_{canal_id}', {
             'type': 'nova_mensagem',
             'conversa': payload,
         })
 
-        logger.info(f'[WS] Broadcast enviado para grupo {group_name}: {numero}')
-
     except Exception as e:
         logger.error(f'[WS] Erro ao broadcast de mensagem: {e}')
 
@@ -456,3 +671,13 @@ def broadcast_whatsapp_message(sender, instance, created, **kwargs):
     """
     if created and not instance.de_mim:
         _broadcast_nova_mensagem(instance)
+
+
+@receiver(post_save, sender='crm.WhatsappMessage')
+def publicar_mensagem_chat(sender, instance, **kwargs):
+    """
+    Signal: mensagem criada ou alterada (eco, reação, mídia, transcrição) vai
+    completa para quem está com a conversa aberta no chat.
+    """
+    from .services import chat_ao_vivo
+    chat_ao_vivo.publicar([instance])
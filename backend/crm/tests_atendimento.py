@@ -0,0 +1,372 @@
+import asyncio
+import importlib
+import json
+import time
+from datetime import timedelta
+from unittest import mock
+from urllib.parse import parse_qs, urlparse
+
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from channels.testing import WebsocketCommunicator
+from django.apps import apps
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.db.models.signals import post_save
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APITestCase
+
+from .consumers import AtendimentoConsumer, AtendimentoMultiplexConsumer
+from .models import Canal, Contato, Conversa, EstagioFunil, NumeroBloqueado, Oportunidade, WhatsappMessage
+from .services.conversas import reconstruir_conversas
+
+User = get_user_model()
+
+
+def _mensagem(id_msg, texto, remote_jid='5581999998888@s.whatsapp.net', from_me=False, ts=1700000000):
+    return {
+        'event': 'messages.upsert',
+        'instance': 'canal_teste',
+        'data': {
+            'key': {'id': id_msg, 'remoteJid': remote_jid, 'fromMe': from_me},
+            'message': {'conversation': texto},
+            'messageTimestamp': ts,
+        },
+    }
+
+
+@override_settings(WEBHOOK_SECRET='')
+class InboxConversasTest(APITestCase):
+    def setUp(self):
+        self.canal = Canal.objects.create(nome='Canal Teste', evolution_instance_name='canal_teste')
+        self.user = User.objects.create_user(username='admin_inbox', password='x', perfil='ADMIN')
+        self.client.force_authenticate(user=self.user)
+        Contato.objects.create(nome='Maria', celular='5581999998888', proprietario=self.user)
+
+    def _receber(self, *payloads):
+        for payload in payloads:
+            self.client.post('/api/webhooks/whatsapp/', payload, format='json')
+
+    def _com_commit(self, funcao, *args, **kwargs):
+        """Executa com os on_commit (eventos WebSocket) disparados, como em produção."""
+        with self.captureOnCommitCallbacks(execute=True):
+            return funcao(*args, **kwargs)
+
+    def test_conversa_mantida_a_cada_mensagem_e_leitura(self):
+        """Mensagens com e sem 9º dígito caem na mesma conversa; marcar_lidas zera o contador."""
+        agora = int(time.time())
+        self._receber(
+            _mensagem('A1', 'oi', ts=agora - 60),
+            _mensagem('A2', 'tudo bem?', remote_jid='558199998888@s.whatsapp.net', ts=agora - 30),
+            _mensagem('A3', 'tudo sim', from_me=True, ts=agora),
+        )
+
+        response = self.client.get('/api/atendimento/conversas/', {'canal_id': self.canal.id})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['conversas']), 1)
+        conversa = response.data['conversas'][0]
+        self.assertEqual(conversa['nao_lidas'], 2)
+        self.assertEqual(conversa['nome_contato'], 'Maria')
+        self.assertEqual(conversa['ultima_mensagem'], 'tudo sim')
+        self.assertTrue(conversa['de_mim'])
+
+        self.client.post('/api/whatsapp/marcar_lidas/', {'number': '5581999998888'}, format='json')
+        self.assertEqual(Conversa.objects.get().nao_lidas, 0)
+
+        # A reconstrução a partir das mensagens chega ao mesmo resumo
+        Conversa.objects.all().delete()
+        self.assertEqual(reconstruir_conversas(), 1)
+        conversa = Conversa.objects.get()
+        self.assertEqual(conversa.nao_lidas, 0)
+        self.assertEqual(conversa.ultima_mensagem, 'tudo sim')
+        self.assertEqual(conversa.contato.nome, 'Maria')
+
+        # A migração de implantação preenche a tabela do mesmo jeito
+        Conversa.objects.all().delete()
+        importlib.import_module('crm.migrations.0070_popular_conversas').popular_conversas(apps, None)
+        conversa = Conversa.objects.get()
+        self.assertEqual(conversa.ultima_mensagem, 'tudo sim')
+        self.assertEqual(conversa.numero_chave, '558199998888')
+        self.assertEqual(conversa.contato.nome, 'Maria')
+
+    def test_bloqueio_usa_lista_cacheada_e_invalida_ao_salvar(self):
+        agora = int(time.time())
+        self._receber(
+            _mensagem('B1', 'oi', ts=agora),
+            _mensagem('B2', 'promoção!', remote_jid='5581977776666@s.whatsapp.net', ts=agora),
+        )
+        url = '/api/atendimento/conversas/'
+
+        # Número cadastrado sem o 9º dígito: casa pela chave canônica
+        bloqueio = NumeroBloqueado.objects.create(numero='+55 81 7777-6666')
+        response = self.client.get(url, {'canal_id': self.canal.id})
+        self.assertEqual([c['numero'] for c in response.data['conversas']], ['5581999998888'])
+
+        # Lista já em cache: a listagem não consulta NumeroBloqueado de novo
+        with mock.patch.object(NumeroBloqueado, 'chaves', side_effect=AssertionError('consultou o banco')):
+            self.client.get(url, {'canal_id': self.canal.id})
+            self.client.get('/api/whatsapp/', {'number': '5581999998888'})
+
+        bloqueio.delete()
+        response = self.client.get(url, {'canal_id': self.canal.id})
+        self.assertEqual(len(response.data['conversas']), 2)
+
+    def test_historico_do_chat_paginado_por_cursor_sem_count(self):
+        inicio = timezone.now() - timedelta(days=400)
+        for i in range(5):
+            WhatsappMessage.objects.create(
+                id_mensagem=f'H{i}', instancia='canal_teste', numero_remetente='5581999998888',
+                numero_destinatario='canal_teste', texto=f'msg {i}',
+                # H3 e H4 no mesmo instante: o id desempata
+                timestamp=inicio + timedelta(days=min(i, 3)),
+            )
+
+        textos, params = [], {'number': '81999998888', 'page_size': 2}
+        with CaptureQueriesContext(connection) as queries:
+            while True:
+                response = self.client.get('/api/whatsapp/', params)
+                textos += [m['texto'] for m in response.data['results']]
+                if not response.data['next']:
+                    break
+                params['cursor'] = parse_qs(urlparse(response.data['next']).query)['cursor'][0]
+
+        self.assertEqual(textos, ['msg 4', 'msg 3', 'msg 2', 'msg 1', 'msg 0'])
+        self.assertNotIn('count', response.data)
+        self.assertFalse([q for q in queries.captured_queries if 'COUNT(' in q['sql'].upper()])
+
+        # Cliente antigo com ?limit: as N mais recentes em ordem cronológica
+        response = self.client.get('/api/whatsapp/', {'number': '81999998888', 'limit': 2})
+        self.assertEqual([m['texto'] for m in response.data], ['msg 3', 'msg 4'])
+
+        # Muitas mensagens no mesmo instante: o cursor é (timestamp, id), sem OFFSET
+        for i in range(7):
+            WhatsappMessage.objects.create(
+                id_mensagem=f'R{i}', instancia='canal_teste', numero_remetente='5581999998888',
+                numero_destinatario='canal_teste', texto=f'rajada {i}', timestamp=inicio + timedelta(days=5),
+            )
+        paginas, params = [], {'number': '81999998888', 'page_size': 3}
+        with CaptureQueriesContext(connection) as queries:
+            while True:
+                response = self.client.get('/api/whatsapp/', params)
+                paginas.append(response.data)
+                if not response.data['next']:
+                    break
+                params['cursor'] = parse_qs(urlparse(response.data['next']).query)['cursor'][0]
+        textos = [m['texto'] for pagina in paginas for m in pagina['results']]
+        self.assertEqual(textos, [f'rajada {i}' for i in range(6, -1, -1)] + ['msg 4', 'msg 3', 'msg 2', 'msg 1', 'msg 0'])
+        self.assertFalse([q for q in queries.captured_queries if 'OFFSET' in q['sql'].upper()])
+
+        # `previous` da última página volta exatamente para a anterior
+        self.assertIsNone(paginas[0]['previous'])
+        response = self.client.get(paginas[-1]['previous'])
+        self.assertEqual(response.data['results'], paginas[-2]['results'])
+
+        response = self.client.get('/api/whatsapp/', {'number': '81999998888', 'cursor': 'xx'})
+        self.assertEqual(response.status_code, 404)
+
+    def test_delta_do_chat_com_etag_e_304(self):
+        agora = int(time.time())
+        self._receber(_mensagem('D1', 'oi', ts=agora - 60), _mensagem('D2', 'tudo bem?', ts=agora))
+        antigo = timezone.now() - timedelta(hours=1)
+        WhatsappMessage.objects.update(data_atualizacao=antigo)
+        params = {'number': '5581999998888', 'since': (antigo + timedelta(minutes=1)).isoformat()}
+
+        # Nada mudou desde `since`
+        response = self.client.get('/api/whatsapp/', params)
+        self.assertEqual((response.status_code, response.data['results']), (200, []))
+        etag = response['ETag']
+        response = self.client.get('/api/whatsapp/', params, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        # Marcar como lidas (update em lote) entra no delta e troca o ETag
+        self.client.post('/api/whatsapp/marcar_lidas/', {'number': '5581999998888'}, format='json')
+        response = self.client.get('/api/whatsapp/', params, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual([(m['texto'], m['lida']) for m in response.data['results']], [('oi', True), ('tudo bem?', True)])
+
+    def test_conversa_assinada_no_websocket_recebe_mensagens_completas(self):
+        """Mensagem nova, reação e leitura chegam no formato slim a quem assinou a conversa."""
+        reacao = _mensagem('W2', '')
+        reacao['data']['message'] = {'reactionMessage': {'key': {'id': 'W1'}, 'text': '👍'}}
+
+        async def mensagens_recebidas(communicator):
+            eventos = []
+            while not await communicator.receive_nothing(timeout=0.2):
+                eventos.append(await communicator.receive_json_from())
+            return [m for e in eventos if e['tipo'] == 'conversa_mensagens' for m in e['mensagens']]
+
+        async def fluxo():
+            communicator = WebsocketCommunicator(AtendimentoConsumer.as_asgi(), f'/ws/atendimento/{self.canal.id}/')
+            communicator.scope['user'] = self.user
+            communicator.scope['url_route'] = {'kwargs': {'canal_id': str(self.canal.id)}}
+            conectado, _ = await communicator.connect()
+            self.assertTrue(conectado)
+
+            await communicator.send_json_to({'acao': 'assinar', 'numero': '81999998888'})
+            self.assertEqual(
+                await communicator.receive_json_from(), {'tipo': 'conversa_assinada', 'numero': '81999998888'}
+            )
+
+            await database_sync_to_async(self._com_commit)(self._receber, _mensagem('W1', 'oi', ts=int(time.time())))
+            recebidas = await mensagens_recebidas(communicator)
+            self.assertEqual(recebidas[-1]['id_mensagem'], 'W1')
+            self.assertIn('media_src', recebidas[-1])
+            self.assertNotIn('media_base64', recebidas[-1])
+
+            await database_sync_to_async(self._com_commit)(self._receber, reacao)
+            recebidas = await mensagens_recebidas(communicator)
+            self.assertEqual(recebidas[-1]['reacoes'][0]['emoji'], '👍')
+
+            await database_sync_to_async(self._com_commit)(
+                self.client.post, '/api/whatsapp/marcar_lidas/', {'number': '5581999998888'}, format='json'
+            )
+            recebidas = await mensagens_recebidas(communicator)
+            self.assertEqual([(m['id_mensagem'], m['lida']) for m in recebidas], [('W1', True)])
+
+            # Sem assinatura, nada além dos eventos do canal
+            await communicator.send_json_to({'acao': 'cancelar', 'numero': '5581999998888'})
+            await database_sync_to_async(self._com_commit)(self._receber, _mensagem('W3', 'ainda aí?', ts=int(time.time())))
+            self.assertEqual(await mensagens_recebidas(communicator), [])
+            await communicator.disconnect()
+
+        async_to_sync(fluxo)()
+
+    def test_websocket_multiplexado_assina_canais_e_coalesce_previas(self):
+        """Uma conexão assina canal e conversa por mensagem; client lento recebe só a prévia mais recente."""
+        async def fluxo():
+            communicator = WebsocketCommunicator(AtendimentoMultiplexConsumer.as_asgi(), '/ws/atendimento/')
+            communicator.scope['user'] = self.user
+            conectado, _ = await communicator.connect()
+            self.assertTrue(conectado)
+
+            await communicator.send_json_to({'acao': 'assinar_canal', 'canal_id': self.canal.id})
+            self.assertEqual(await communicator.receive_json_from(), {'tipo': 'canal_assinado', 'canal_id': self.canal.id})
+            await communicator.send_json_to({'acao': 'assinar_canal', 'canal_id': self.canal.id + 100})
+            self.assertEqual((await communicator.receive_json_from())['erro'], 'sem_permissao')
+            # Sem canal_id: a conversa em todos os canais do usuário
+            await communicator.send_json_to({'acao': 'assinar', 'numero': '81999998888'})
+            self.assertEqual((await communicator.receive_json_from())['tipo'], 'conversa_assinada')
+
+            await database_sync_to_async(self._com_commit)(self._receber, _mensagem('X1', 'oi', ts=int(time.time())))
+            eventos = []
+            while not await communicator.receive_nothing(timeout=0.2):
+                eventos.append(await communicator.receive_json_from())
+            tipos = {e['tipo'] for e in eventos}
+            self.assertIn('nova_mensagem', tipos)
+            self.assertIn('conversa_mensagens', tipos)
+            await communicator.disconnect()
+
+            # Fila de um client que não acompanha: prévias coalescidas, excedente descartado
+            consumer = AtendimentoMultiplexConsumer()
+            consumer.preparar_fila()
+            with override_settings(WS_FILA_MAX=2):
+                for n in (1, 2, 3):
+                    await consumer.unread_update({'type': 'unread_update', 'canal_id': 1, 'numero': 'a', 'nao_lidas': n})
+                await consumer.unread_update({'type': 'unread_update', 'canal_id': 1, 'numero': 'b', 'nao_lidas': 1})
+                await consumer.nova_mensagem({'type': 'nova_mensagem', 'conversa': {'canal_id': 1, 'numero': 'c'}})
+
+            enviados = []
+            consumer.send = mock.AsyncMock(side_effect=lambda text_data: enviados.append(json.loads(text_data)))
+            escritor = asyncio.ensure_future(consumer._escrever_fila())
+            await asyncio.sleep(0.05)
+            escritor.cancel()
+            self.assertEqual(
+                [(e['tipo'], e.get('numero'), e.get('nao_lidas')) for e in enviados],
+                [('unread_update', 'a', 3), ('unread_update', 'b', 1), ('ressincronizar', None, None)],
+            )
+
+        async_to_sync(fluxo)()
+
+    def test_previa_websocket_apos_commit_com_caches_e_envio_em_thread(self):
+        """A prévia sai só após o commit, com canal/contato em cache, e o envio ao Redis não bloqueia."""
+        from .services import difusao
+
+        with mock.patch('crm.services.difusao.despachar') as despachar:
+            with self.captureOnCommitCallbacks() as callbacks:
+                self._receber(_mensagem('P1', 'oi', ts=int(time.time())))
+            despachar.assert_not_called()
+            for callback in callbacks:
+                callback()
+        previa = next(c.args[1]['conversa'] for c in despachar.call_args_list if c.args[1]['type'] == 'nova_mensagem')
+        self.assertEqual((previa['canal_id'], previa['nome_contato']), (self.canal.id, 'Maria'))
+
+        contato = Contato.objects.get()
+        with self.assertNumQueries(0):
+            self.assertEqual(difusao.canal_da_instancia('canal_teste'), self.canal.id)
+            self.assertEqual(difusao.nome_contato(contato.celular_chave), 'Maria')
+        # O signal de Contato limpa os nomes em cache
+        contato.nome = 'Maria Silva'
+        contato.save()
+        self.assertEqual(difusao.nome_contato(contato.celular_chave), 'Maria Silva')
+
+        class CamadaLenta:
+            recebidos = []
+
+            async def group_send(self, grupo, evento):
+                await asyncio.sleep(0.2)
+                self.recebidos.append(grupo)
+
+        camada = CamadaLenta()
+        with mock.patch('crm.services.difusao.get_channel_layer', return_value=camada):
+            inicio = time.monotonic()
+            difusao.despachar('atendimento_canal_1', {'type': 'unread_update'})
+            self.assertLess(time.monotonic() - inicio, 0.1)
+            difusao._fila_envio().join()
+        self.assertEqual(camada.recebidos, ['atendimento_canal_1'])
+
+
+@override_settings(WEBHOOK_SECRET='')
+class ContadoresNaoLidasTest(APITestCase):
+    def setUp(self):
+        self.canal = Canal.objects.create(nome='Canal Teste', evolution_instance_name='canal_teste')
+        self.user = User.objects.create_user(username='admin_contadores', password='x', perfil='ADMIN')
+        self.client.force_authenticate(user=self.user)
+        contato = Contato.objects.create(nome='Maria', celular='5581999998888', proprietario=self.user)
+        estagio = EstagioFunil.objects.create(nome='Prospecção', tipo='ABERTO')
+        self.opp = Oportunidade.objects.create(nome='Negócio', estagio=estagio, proprietario=self.user)
+        self.opp.contatos.add(contato)
+
+    def test_contadores_mantidos_no_recebimento_e_na_leitura(self):
+        agora = int(time.time())
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post('/api/webhooks/whatsapp/', _mensagem('C1', 'oi', ts=agora - 60), format='json')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post('/api/webhooks/whatsapp/', _mensagem(
+                'C2', 'quem fala?', remote_jid='5511988887777@s.whatsapp.net', ts=agora
+            ), format='json')
+
+        self.opp.refresh_from_db()
+        self.canal.refresh_from_db()
+        self.assertEqual(self.opp.whatsapp_nao_lidas, 1)
+        self.assertEqual((self.canal.whatsapp_nao_lidas, self.canal.whatsapp_nao_lidas_novas), (2, 1))
+
+        response = self.client.get('/api/whatsapp/unread_counts/')
+        self.assertEqual(response.data, {'novas': 1, 'oportunidades': 1, 'total': 2})
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post('/api/whatsapp/marcar_lidas/', {'number': '5581999998888'}, format='json')
+
+        self.opp.refresh_from_db()
+        self.canal.refresh_from_db()
+        self.assertEqual(self.opp.whatsapp_nao_lidas, 0)
+        self.assertEqual((self.canal.whatsapp_nao_lidas, self.canal.whatsapp_nao_lidas_novas), (1, 1))
+
+    def test_mensagem_recebida_gravada_ja_vinculada_com_um_save(self):
+        salvas = []
+
+        def registrar(sender, instance, created, update_fields=None, **kwargs):
+            salvas.append((instance.id_mensagem, created, instance.oportunidade_id))
+
+        post_save.connect(registrar, sender=WhatsappMessage)
+        try:
+            self.client.post('/api/webhooks/whatsapp/', _mensagem('S1', 'oi'), format='json')
+            self.client.post('/api/webhooks/whatsapp/', _mensagem(
+                'S2', 'quem fala?', remote_jid='5511988887777@s.whatsapp.net'
+            ), format='json')
+        finally:
+            post_save.disconnect(registrar, sender=WhatsappMessage)
+
+        self.assertEqual(salvas, [('S1', True, self.opp.id), ('S2', True, None)])
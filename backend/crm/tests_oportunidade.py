@@ -1,7 +1,21 @@
+import importlib
+from io import StringIO
+from datetime import timedelta
+
+from django.apps import apps
+from django.contrib.contenttypes.models import ContentType
+from django.core.management import call_command
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
 from rest_framework.test import APITestCase
 from rest_framework import status
 from django.contrib.auth import get_user_model
-from .models import Canal, Funil, EstagioFunil, FunilEstagio, Conta, Oportunidade
+from .models import (
+    Canal, Funil, EstagioFunil, FunilEstagio, Conta, Oportunidade, Contato, ContatoTelefone, Tag, Atividade,
+    Log, TimelineEvento, WhatsappMessage,
+)
+from .serializers import format_phone_display
 
 User = get_user_model()
 
@@ -89,3 +103,258 @@ class OportunidadeCanalTest(APITestCase):
         self.assertEqual(oportunidade.estagio.id, self.estagio_meio.id)
         # Validar que manteve o canal automático
         self.assertEqual(oportunidade.canal.id, self.canal.id)
+
+
+class TimelineFeedTest(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='gestor_tl', password='x', perfil='ADMIN')
+        self.client.force_authenticate(user=self.user)
+        funil = Funil.objects.create(nome='Funil Timeline', tipo='VENDAS')
+        estagio = EstagioFunil.objects.create(nome='Aberto', tipo='ABERTO')
+        FunilEstagio.objects.create(funil=funil, estagio=estagio, ordem=0, is_padrao=True)
+        conta = Conta.objects.create(nome_empresa='Empresa Timeline', proprietario=self.user)
+        self.oportunidade = Oportunidade.objects.create(
+            nome='Negócio Timeline', funil=funil, estagio=estagio, conta=conta, proprietario=self.user
+        )
+        Log.objects.all().delete()
+
+        base = timezone.now() - timedelta(days=1)
+        ct = ContentType.objects.get_for_model(Oportunidade)
+        # 3 fontes intercaladas, com empates de horário entre elas
+        for i in range(15):
+            momento = base + timedelta(minutes=i)
+            atividade = Atividade.objects.create(
+                tipo='NOTA', titulo=f'Nota {i}', content_type=ct, object_id=self.oportunidade.id,
+                proprietario=self.user
+            )
+            Atividade.objects.filter(id=atividade.id).update(data_criacao=momento)
+            WhatsappMessage.objects.create(
+                id_mensagem=f'TL{i}', numero_remetente='5581999998888', texto=f'Msg {i}',
+                timestamp=momento, oportunidade=self.oportunidade, media_base64='eA==' if i == 0 else None
+            )
+            log = Log.objects.create(acao=Log.ACAO_UPDATE, modelo='Oportunidade', objeto_id=self.oportunidade.id)
+            Log.objects.filter(id=log.id).update(timestamp=momento + timedelta(seconds=30 * (i % 2)))
+
+        # Horários alterados com update(): regenera a Timeline materializada
+        call_command('rebuild_timeline', stdout=StringIO())
+
+    def test_timeline_paginada_por_cursor_sem_repetir_itens(self):
+        url = f'/api/timeline/?model=oportunidade&id={self.oportunidade.id}'
+        vistos = []
+        paginas = 0
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK, response.data)
+            self.assertLessEqual(len(response.data['results']), 20)
+            vistos.extend(response.data['results'])
+            url = response.data['next']
+            paginas += 1
+
+        self.assertEqual(paginas, 3)
+        ids = [item['id'] for item in vistos]
+        self.assertEqual(len(ids), 45)
+        self.assertEqual(len(set(ids)), 45)
+        momentos = [item['timestamp'] for item in vistos]
+        self.assertEqual(momentos, sorted(momentos, reverse=True))
+
+        # ?page=N continua funcionando e bate com o cursor
+        response = self.client.get(f'/api/timeline/?model=oportunidade&id={self.oportunidade.id}&page=2')
+        self.assertEqual([item['id'] for item in response.data['results']], ids[20:40])
+
+        response = self.client.get(f'/api/timeline/?model=oportunidade&id={self.oportunidade.id}&cursor=xx')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_log_com_ip_serializado(self):
+        log = Log.objects.create(
+            acao=Log.ACAO_UPDATE, modelo='Oportunidade', objeto_id=self.oportunidade.id, ip_address='189.6.21.4'
+        )
+
+        response = self.client.get(f'/api/logs/?objeto_id={self.oportunidade.id}&modelo=Oportunidade')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        por_id = {item['id']: item for item in response.data['results']}
+        self.assertEqual(por_id[log.id]['ip_address'], '189.6.21.4')
+
+        response = self.client.get(f'/api/timeline/?model=oportunidade&id={self.oportunidade.id}')
+        self.assertEqual(response.data['results'][0]['data']['ip_address'], '189.6.21.4')
+
+    def test_timeline_materializada_por_escopo(self):
+        conta = self.oportunidade.conta
+        contato = Contato.objects.create(
+            nome='Cliente Timeline', conta=conta, celular='(81) 99777-6655', proprietario=self.user
+        )
+        outro = Contato.objects.create(nome='Outro Contato', proprietario=self.user)
+        Atividade.objects.create(
+            tipo='NOTA', titulo='Nota da conta', content_type=ContentType.objects.get_for_model(Conta),
+            object_id=conta.id, proprietario=self.user
+        )
+        WhatsappMessage.objects.create(
+            id_mensagem='TLNUM', numero_remetente='5581997776655', texto='Oi pelo número',
+            timestamp=timezone.now()
+        )
+
+        def ids(model, entidade_id):
+            response = self.client.get(f'/api/timeline/?model={model}&id={entidade_id}')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            return {item['id'] for item in response.data['results']}
+
+        contato_ids = ids('contato', contato.id)
+        self.assertIn('whatsapp_' + str(WhatsappMessage.objects.get(id_mensagem='TLNUM').id), contato_ids)
+        self.assertTrue(any(i.startswith('atividade_') for i in contato_ids))
+        self.assertFalse(ids('contato', outro.id) & {i for i in ids('oportunidade', self.oportunidade.id)})
+
+        # Contato vinculado depois à oportunidade passa a ver a Timeline dela
+        with self.captureOnCommitCallbacks(execute=True):
+            self.oportunidade.contatos.add(outro)
+
+        def eventos(escopo, entidade_id):
+            return set(TimelineEvento.objects.filter(escopo=escopo, entidade_id=entidade_id)
+                       .values_list('fonte', 'item_id'))
+
+        self.assertLessEqual(eventos('oportunidade', self.oportunidade.id), eventos('contato', outro.id))
+
+        # A migração de implantação chega às mesmas linhas que a gravação incremental
+        campos = ('escopo', 'entidade_id', 'fonte', 'item_id', 'momento')
+        incrementais = set(TimelineEvento.objects.values_list(*campos))
+        TimelineEvento.objects.all().delete()
+        importlib.import_module('crm.migrations.0071_popular_timeline').popular_timeline(apps, None)
+        self.assertEqual(set(TimelineEvento.objects.values_list(*campos)), incrementais)
+
+        # Uma página = consultas constantes, sem depender do tamanho do histórico
+        url = f'/api/timeline/?model=oportunidade&id={self.oportunidade.id}'
+        with self.assertNumQueries(5):
+            self.client.get(url)
+
+
+class KanbanTest(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='gestor_kanban', password='x', perfil='ADMIN')
+        self.client.force_authenticate(user=self.user)
+        self.funil = Funil.objects.create(nome='Funil Kanban', tipo='VENDAS')
+        self.aberto = EstagioFunil.objects.create(nome='Aberto', tipo='ABERTO')
+        self.proposta = EstagioFunil.objects.create(nome='Proposta', tipo='ABERTO')
+        FunilEstagio.objects.create(funil=self.funil, estagio=self.aberto, ordem=0, is_padrao=True)
+        FunilEstagio.objects.create(funil=self.funil, estagio=self.proposta, ordem=1)
+
+        for i in range(25):
+            Oportunidade.objects.create(
+                nome=f'Aberta {i}', funil=self.funil, estagio=self.aberto, proprietario=self.user, valor_estimado=100
+            )
+        for i in range(3):
+            Oportunidade.objects.create(
+                nome=f'Proposta {i}', funil=self.funil, estagio=self.proposta, proprietario=self.user, valor_estimado=50
+            )
+
+    def test_kanban_totais_por_estagio_e_colunas_paginadas(self):
+        response = self.client.get(f'/api/oportunidades/kanban/?funil_id={self.funil.id}&limite=10')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        aberto, proposta = response.data
+
+        self.assertEqual((aberto['total'], aberto['valor_total']), (25, 2500))
+        self.assertEqual((proposta['total'], proposta['valor_total']), (3, 150))
+        self.assertEqual(len(aberto['oportunidades']), 10)
+        self.assertEqual(len(proposta['oportunidades']), 3)
+        self.assertIsNone(proposta['next'])
+
+        # "Carregar mais" da coluna até o fim, sem repetir cards e na ordem do quadro
+        ids = [opp['id'] for opp in aberto['oportunidades']]
+        url = aberto['next']
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            ids += [opp['id'] for opp in response.data['results']]
+            url = response.data['next']
+
+        esperado = list(
+            Oportunidade.objects.filter(estagio=self.aberto).order_by('-data_criacao', '-id').values_list('id', flat=True)
+        )
+        self.assertEqual(ids, esperado)
+
+    def _relacionar(self, oportunidades):
+        """Empresas, contatos, tag, telefone e atividade pendente em cada oportunidade."""
+        tag = Tag.objects.get_or_create(nome='Evento')[0]
+        tipo = ContentType.objects.get_for_model(Oportunidade)
+        for opp in oportunidades:
+            conta = Conta.objects.create(nome_empresa=f'Empresa {opp.id}', proprietario=self.user)
+            contato = Contato.objects.create(nome=f'Contato {opp.id}', conta=conta, proprietario=self.user)
+            ContatoTelefone.objects.create(contato=contato, numero='81999990000', principal=True)
+            opp.conta, opp.contato_principal = conta, contato
+            opp.save()
+            opp.empresas.add(conta)
+            opp.contatos.add(contato)
+            opp.tags.add(tag)
+            for dias, titulo in ((2, 'Depois'), (1, 'Retorno')):
+                Atividade.objects.create(
+                    tipo='TAREFA', titulo=f'{titulo} {opp.id}', status='PENDENTE', proprietario=self.user,
+                    data_vencimento=timezone.now() + timedelta(days=dias), content_type=tipo, object_id=opp.id
+                )
+
+    def test_consultas_constantes_por_pagina(self):
+        self._relacionar(Oportunidade.objects.all())
+        url_kanban = f'/api/oportunidades/kanban/?funil_id={self.funil.id}&limite='
+        self.client.get(url_kanban + '5')  # aquece caches (ContentType etc.)
+
+        with CaptureQueriesContext(connection) as kanban_pequeno:
+            self.client.get(url_kanban + '5')
+        with CaptureQueriesContext(connection) as lista_pequena:
+            self.client.get(f'/api/oportunidades/?estagio={self.proposta.id}')
+
+        self._relacionar([
+            Oportunidade.objects.create(
+                nome=f'Extra {i}', funil=self.funil, estagio=self.aberto, proprietario=self.user, valor_estimado=10
+            )
+            for i in range(80)
+        ])
+
+        # Uma coluna com 100 cards custa o mesmo que uma com 5
+        with self.assertNumQueries(len(kanban_pequeno)):
+            response = self.client.get(url_kanban + '100')
+        aberto = response.data[0]
+        self.assertEqual(len(aberto['oportunidades']), 100)
+        card = aberto['oportunidades'][0]
+        self.assertEqual(card['conta_nome'], f"Empresa {card['id']}")
+        self.assertEqual(card['contato_nome'], f"Contato {card['id']}")
+        self.assertEqual([t['total_uso'] for t in card['tags_detail']], [108])
+
+        # A página cheia da listagem (serializer completo) custa o mesmo que uma de 3
+        with self.assertNumQueries(len(lista_pequena)):
+            response = self.client.get(f'/api/oportunidades/?estagio={self.aberto.id}')
+        opp = response.data['results'][0]
+        self.assertEqual(len(response.data['results']), 20)
+        self.assertEqual(opp['proxima_atividade']['titulo'], f"Retorno {opp['id']}")
+        self.assertEqual(opp['contato_telefone'], format_phone_display('81999990000'))
+        self.assertEqual(opp['conta_dados']['total_oportunidades'], 1)
+
+    def test_consultas_constantes_em_tags_e_contatos_da_conta(self):
+        self._relacionar(Oportunidade.objects.filter(estagio=self.proposta)[:1])
+        tag = Tag.objects.get()
+        conta = Conta.objects.get()
+        url_contatos = f'/api/contas/{conta.id}/contatos/'
+        self.client.get('/api/tags/')  # aquece caches
+
+        with CaptureQueriesContext(connection) as tags_poucas:
+            self.client.get('/api/tags/')
+        with CaptureQueriesContext(connection) as contatos_poucos:
+            self.client.get(url_contatos)
+
+        oportunidade = Oportunidade.objects.filter(estagio=self.proposta).first()
+        for i in range(15):
+            outra = Tag.objects.create(nome=f'Tag {i}')
+            outra.oportunidades.add(oportunidade)
+            contato = Contato.objects.create(nome=f'Contato extra {i}', conta=conta, proprietario=self.user)
+            ContatoTelefone.objects.create(contato=contato, numero=f'8199999{i:04d}', principal=True)
+            contato.tags.add(tag, outra)
+            oportunidade.contatos.add(contato)
+
+        with self.assertNumQueries(len(tags_poucas)):
+            response = self.client.get('/api/tags/')
+        self.assertEqual(len(response.data['results']), 16)
+        usos = {t['nome']: (t['uso_oportunidades'], t['uso_contatos'], t['total_uso']) for t in response.data['results']}
+        self.assertEqual(usos['Evento'], (1, 15, 16))
+        self.assertEqual(usos['Tag 0'], (1, 1, 2))
+
+        with self.assertNumQueries(len(contatos_poucos)):
+            response = self.client.get(url_contatos)
+        self.assertEqual(len(response.data), 16)
+        extra = next(c for c in response.data if c['nome'] == 'Contato extra 3')
+        self.assertEqual(extra['celular_formatado'], format_phone_display('81999990003'))
+        self.assertEqual([o['id'] for o in extra['oportunidades']], [oportunidade.id])
@@ -0,0 +1,498 @@
+import base64
+import hashlib
+import shutil
+import tempfile
+from unittest import mock
+
+from django.core.management import call_command
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from rest_framework.test import APITestCase
+
+from django.contrib.auth import get_user_model
+
+from .models import (
+    Contato, EstagioFunil, Oportunidade, Tarefa, TranscricaoAudio, TranscricaoCache, WebhookEvento,
+    WhatsappMessage,
+)
+from .services import audio_transcription, evolution_http, media_store, transcricao
+from .services.phone import canonical_phone
+
+User = get_user_model()
+
+
+def _payload(id_msg='ABC123', texto='Olá, tudo bem?'):
+    return {
+        'event': 'messages.upsert',
+        'instance': 'canal_teste',
+        'data': {
+            'key': {'id': id_msg, 'remoteJid': '5581999998888@s.whatsapp.net', 'fromMe': False},
+            'message': {'conversation': texto},
+            'messageTimestamp': 1700000000,
+        },
+    }
+
+
+@override_settings(WHATSAPP_WEBHOOK_ASYNC=True, WEBHOOK_SECRET='')
+class WebhookInboxTest(APITestCase):
+
+    def test_webhook_enfileira_e_worker_processa(self):
+        """O webhook apenas grava o evento; o worker cria a mensagem."""
+        response = self.client.post('/api/webhooks/whatsapp/', _payload(), format='json')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['status'], 'queued')
+        self.assertEqual(WebhookEvento.objects.count(), 1)
+        self.assertFalse(WhatsappMessage.objects.exists())
+
+        call_command('process_webhook_inbox', '--once', stdout=mock.MagicMock())
+
+        evento = WebhookEvento.objects.get()
+        self.assertEqual(evento.status, WebhookEvento.STATUS_PROCESSADO)
+        msg = WhatsappMessage.objects.get(id_mensagem='ABC123')
+        self.assertEqual(msg.numero_remetente, '5581999998888')
+        self.assertEqual(msg.texto, 'Olá, tudo bem?')
+
+    @override_settings(WEBHOOK_INBOX_MAX_TENTATIVAS=2)
+    def test_falha_bloqueia_instancia_e_vai_para_dead_letter(self):
+        """Evento com erro segura os seguintes da instância até virar dead-letter."""
+        primeiro = WebhookEvento.objects.create(instancia='canal_teste', payload=_payload('M1'))
+        segundo = WebhookEvento.objects.create(instancia='canal_teste', payload=_payload('M2'))
+
+        with mock.patch(
+            'crm.management.commands.process_webhook_inbox.processar_payload',
+            side_effect=RuntimeError('falha simulada'),
+        ):
+            call_command('process_webhook_inbox', '--once', stdout=mock.MagicMock())
+            primeiro.refresh_from_db()
+            segundo.refresh_from_db()
+            self.assertEqual(primeiro.tentativas, 1)
+            self.assertEqual(primeiro.status, WebhookEvento.STATUS_PENDENTE)
+            self.assertEqual(segundo.tentativas, 0)
+
+            # Força o vencimento do backoff
+            WebhookEvento.objects.filter(pk=primeiro.pk).update(proxima_tentativa=timezone.now())
+            call_command('process_webhook_inbox', '--once', stdout=mock.MagicMock())
+
+        primeiro.refresh_from_db()
+        segundo.refresh_from_db()
+        self.assertEqual(primeiro.status, WebhookEvento.STATUS_FALHOU)
+        self.assertIn('falha simulada', primeiro.ultimo_erro)
+        # Com o primeiro em dead-letter, a fila da instância segue
+        self.assertEqual(segundo.tentativas, 1)
+
+        WebhookEvento.objects.filter(pk=segundo.pk).update(proxima_tentativa=timezone.now())
+        call_command('process_webhook_inbox', '--once', stdout=mock.MagicMock())
+        segundo.refresh_from_db()
+        self.assertEqual(segundo.status, WebhookEvento.STATUS_PROCESSADO)
+
+    def test_evento_so_e_reservado_depois_dos_anteriores_da_instancia(self):
+        """Um segundo worker não pega evento com anterior pendente nem evento já processado."""
+        from crm.management.commands.process_webhook_inbox import Command
+
+        primeiro = WebhookEvento.objects.create(instancia='canal_teste', payload=_payload('M1'))
+        segundo = WebhookEvento.objects.create(instancia='canal_teste', payload=_payload('M2'))
+        worker = Command()
+        worker.max_tentativas = 5
+
+        self.assertIsNone(worker.processar_reservado(segundo.id))
+        self.assertTrue(worker.processar_reservado(primeiro.id))
+        self.assertIsNone(worker.processar_reservado(primeiro.id))
+        self.assertTrue(worker.processar_reservado(segundo.id))
+
+        segundo.refresh_from_db()
+        self.assertEqual((segundo.status, segundo.tentativas), (WebhookEvento.STATUS_PROCESSADO, 1))
+        self.assertEqual(WhatsappMessage.objects.count(), 2)
+
+
+@override_settings(WEBHOOK_SECRET='')
+class WebhookLoteTest(APITestCase):
+
+    def test_lote_insere_novas_e_vincula_oportunidade(self):
+        """Payload com várias mensagens: ignora duplicadas, vincula e aplica reações do lote."""
+        user = User.objects.create_user(username='admin_teste', password='x', perfil='ADMIN')
+        estagio = EstagioFunil.objects.create(nome='Prospecção', tipo='ABERTO')
+        contato = Contato.objects.create(nome='Cliente', celular='(81) 9999-8888', proprietario=user)
+        opp = Oportunidade.objects.create(nome='Negócio', estagio=estagio, proprietario=user)
+        opp.contatos.add(contato)
+        WhatsappMessage.objects.create(
+            id_mensagem='M1', instancia='canal_teste', numero_remetente='5581999998888',
+            numero_destinatario='canal_teste', texto='antiga', timestamp=timezone.now()
+        )
+
+        itens = [_payload(f'M{i}', f'msg {i}')['data'] for i in range(1, 4)]
+        itens.append({
+            'key': {'id': 'R1', 'remoteJid': '5581999998888@s.whatsapp.net', 'fromMe': False},
+            'message': {'reactionMessage': {'key': {'id': 'M3'}, 'text': '👍'}},
+        })
+        payload = {'event': 'messages.set', 'instance': 'canal_teste', 'data': {'messages': itens}}
+
+        response = self.client.post('/api/webhooks/whatsapp/', payload, format='json')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(WhatsappMessage.objects.count(), 3)
+        self.assertEqual(WhatsappMessage.objects.get(id_mensagem='M1').texto, 'antiga')
+        self.assertEqual(
+            set(WhatsappMessage.objects.filter(oportunidade=opp).values_list('id_mensagem', flat=True)),
+            {'M2', 'M3'},
+        )
+        self.assertEqual(WhatsappMessage.objects.get(id_mensagem='M3').reacoes[0]['emoji'], '👍')
+
+
+class CanonicalPhoneTest(SimpleTestCase):
+
+    def test_variacoes_geram_mesma_chave(self):
+        variacoes = [
+            '(81) 9 9921-6560', '81999216560', '+55 81 99921-6560',
+            '5581999216560', '558199216560', '5581999216560@s.whatsapp.net',
+        ]
+        self.assertEqual({canonical_phone(v) for v in variacoes}, {'558199216560'})
+        self.assertEqual(canonical_phone('1234'), '')
+
+
+def _payload_imagem(id_msg, conteudo):
+    payload = _payload(id_msg)
+    payload['data']['message'] = {
+        'imageMessage': {'mimetype': 'image/png', 'base64': base64.b64encode(conteudo).decode()},
+    }
+    payload['data']['messageTimestamp'] = int(timezone.now().timestamp())
+    return payload
+
+
+@override_settings(WEBHOOK_SECRET='')
+class MediaStoreTest(APITestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        override = override_settings(MEDIA_ROOT=self.media_root)
+        override.enable()
+        self.addCleanup(override.disable)
+
+        user = User.objects.create_user(username='admin_midia', password='x', perfil='ADMIN')
+        self.client.force_authenticate(user=user)
+
+    def test_midia_inline_vai_para_store_com_dedupe_e_streaming(self):
+        conteudo = b'\x89PNG' + bytes(range(256)) * 4
+        self.client.post('/api/webhooks/whatsapp/', _payload_imagem('IMG1', conteudo), format='json')
+        self.client.post('/api/webhooks/whatsapp/', _payload_imagem('IMG2', conteudo), format='json')
+
+        m1, m2 = WhatsappMessage.objects.order_by('id')
+        self.assertIsNone(m1.media_base64)
+        self.assertEqual(m1.media_hash, m2.media_hash)
+        self.assertEqual((m1.media_mimetype, m1.media_tamanho), ('image/png', len(conteudo)))
+
+        response = self.client.get('/api/whatsapp/', {'number': '5581999998888'})
+        src = response.data['results'][0]['media_src']
+        self.assertNotIn('base64', src)
+
+        self.client.logout()
+        response = self.client.get(src, HTTP_RANGE='bytes=4-9')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b''.join(response.streaming_content), conteudo[4:10])
+        self.assertEqual(response['Content-Range'], f'bytes 4-9/{len(conteudo)}')
+
+        response = self.client.get(src, HTTP_IF_NONE_MATCH=f'"{m1.media_hash}"')
+        self.assertEqual(response.status_code, 304)
+
+    def test_url_da_midia_adulterada_ou_expirada_da_404(self):
+        self.client.post('/api/webhooks/whatsapp/', _payload_imagem('IMG1', b'\x89PNG-conteudo'), format='json')
+        msg = WhatsappMessage.objects.get()
+        src = media_store.url_midia(msg)
+        self.client.logout()
+
+        self.assertEqual(self.client.get(src).status_code, 200)
+        self.assertEqual(self.client.get(src[:-3] + 'xx/').status_code, 404)
+        # Hash assinado sem timestamp (formato antigo, que nunca expirava)
+        sem_validade = media_store.signing.Signer(salt=media_store.SALT_URL).sign(msg.media_hash)
+        self.assertEqual(self.client.get(f'/api/whatsapp/midia/{sem_validade}/').status_code, 404)
+
+        with override_settings(MIDIA_URL_TTL=-1):
+            self.assertEqual(self.client.get(src).status_code, 404)
+
+    def test_comando_migra_base64_legado(self):
+        conteudo = b'audio-ogg-fake'
+        msg = WhatsappMessage.objects.create(
+            id_mensagem='LEG1', instancia='canal_teste', numero_remetente='5581999998888',
+            numero_destinatario='canal_teste', texto='🎤 [Áudio]', tipo_mensagem='audio',
+            media_base64=f'data:audio/ogg;base64,{base64.b64encode(conteudo).decode()}',
+            timestamp=timezone.now(),
+        )
+
+        call_command('migrar_midias_whatsapp', stdout=mock.MagicMock())
+
+        msg.refresh_from_db()
+        self.assertIsNone(msg.media_base64)
+        self.assertEqual(msg.media_mimetype, 'audio/ogg')
+        with open(media_store.caminho(msg.media_hash), 'rb') as f:
+            self.assertEqual(f.read(), conteudo)
+
+    @override_settings(WHISPER_WORKER=True)
+    def test_whisper_worker_atende_pedido_interativo_primeiro(self):
+        mensagens = []
+        for i in range(2):
+            msg = WhatsappMessage.objects.create(
+                id_mensagem=f'AUD{i}', instancia='canal_teste', numero_remetente='5581999998888',
+                numero_destinatario='canal_teste', texto='🎤 [Áudio]', tipo_mensagem='audio',
+                timestamp=timezone.now(),
+            )
+            msg.save(update_fields=media_store.anexar(msg, base64.b64encode(f'ogg-{i}'.encode()).decode()))
+            mensagens.append(msg)
+
+        self.assertEqual(transcricao.transcrever(mensagens[0]), {'pendente': True})
+        transcricao.enfileirar(mensagens[1].id)
+        pedido = transcricao.enfileirar(mensagens[1].id, interativa=True)
+        self.assertEqual(TranscricaoAudio.objects.count(), 2)
+        self.assertEqual(pedido.prioridade, TranscricaoAudio.PRIORIDADE_INTERATIVA)
+
+        caminhos = []
+
+        def transcrever_fake(caminho, **kwargs):
+            caminhos.append(caminho)
+            return {'text': 'bom dia', 'duration': 3.2}
+
+        with mock.patch('crm.management.commands.whisper_worker.get_whisper_model', return_value=object()), \
+                mock.patch('crm.management.commands.whisper_worker.transcribe_audio', side_effect=transcrever_fake):
+            call_command('whisper_worker', '--once', stdout=mock.MagicMock())
+
+        self.assertEqual(caminhos, [media_store.caminho(m.media_hash) for m in reversed(mensagens)])
+        for msg in mensagens:
+            msg.refresh_from_db()
+            self.assertEqual(msg.texto, '🎤 [Áudio 3s]: bom dia')
+        self.assertFalse(TranscricaoAudio.objects.exclude(status=TranscricaoAudio.STATUS_CONCLUIDA).exists())
+
+    def test_transcricao_progressiva_envia_segmentos_e_grava_texto(self):
+        msg = WhatsappMessage.objects.create(
+            id_mensagem='AUDLONGO', instancia='canal_teste', numero_remetente='5581999998888',
+            numero_destinatario='canal_teste', texto='🎤 [Áudio]', tipo_mensagem='audio',
+            timestamp=timezone.now(),
+        )
+        msg.save(update_fields=media_store.anexar(msg, base64.b64encode(b'ogg-longo').decode()))
+        modelo = mock.Mock()
+        modelo.transcribe.return_value = (
+            iter([mock.Mock(start=0.0, end=4.0, text=' primeira parte'), mock.Mock(start=4.0, end=9.0, text=' segunda')]),
+            mock.Mock(language='pt', duration=9.0),
+        )
+        eventos = []
+
+        with mock.patch('crm.services.audio_transcription.get_whisper_model', return_value=modelo):
+            transcricao.transcrever_progressivo(msg, notificar=lambda texto, **kw: eventos.append((texto, kw)))
+
+        msg.refresh_from_db()
+        self.assertEqual(msg.texto, '🎤 [Áudio 9s]: primeira parte segunda')
+        self.assertEqual([texto for texto, _ in eventos], ['primeira parte', 'primeira parte segunda', msg.texto])
+        self.assertEqual(eventos[-1][1], {'concluida': True, 'duracao': 9.0})
+
+
+    def test_transcribe_backlog_baixa_transcreve_e_grava_checkpoint(self):
+        conteudos = {}
+        for i in range(3):
+            msg = WhatsappMessage.objects.create(
+                id_mensagem=f'BACK{i}', instancia='canal_teste', numero_remetente='5581999998888',
+                numero_destinatario='canal_teste', texto='🎤 [Áudio]', tipo_mensagem='audio',
+                timestamp=timezone.now(),
+            )
+            conteudos[msg.id_mensagem] = base64.b64encode(f'ogg-backlog-{i}'.encode()).decode()
+        checkpoint = f'{self.media_root}/checkpoint'
+
+        def baixar(service, key):
+            return {'base64': conteudos[key['id']], 'mimetype': 'audio/ogg'}
+
+        with mock.patch('crm.services.evolution_api.EvolutionService.get_media_base64', autospec=True, side_effect=baixar), \
+                mock.patch('crm.services.audio_transcription.transcribe_audio',
+                           return_value={'text': 'retomado', 'duration': 5.0}):
+            call_command('transcribe_backlog', '--processos', '1', '--lote', '2',
+                         '--checkpoint', checkpoint, stdout=mock.MagicMock())
+
+        self.assertEqual(set(WhatsappMessage.objects.values_list('texto', flat=True)), {'🎤 [Áudio 5s]: retomado'})
+        self.assertFalse(WhatsappMessage.objects.filter(media_hash='').exists())
+        with open(checkpoint) as f:
+            self.assertEqual(int(f.read()), WhatsappMessage.objects.order_by('id').last().id)
+
+    @override_settings(TAREFAS_WORKER=True)
+    def test_midia_pendente_vira_tarefa_com_retentativa(self):
+        payload = _payload_imagem('IMGASYNC', b'')
+        payload['data']['message'] = {'imageMessage': {'mimetype': 'image/png'}}
+        self.client.post('/api/webhooks/whatsapp/', payload, format='json')
+
+        tarefa = Tarefa.objects.get(nome='whatsapp.processar_midia')
+        self.assertEqual(tarefa.parametros['media_type'], 'image')
+        Tarefa.objects.update(executar_em=timezone.now())
+
+        conteudo = b'\x89PNG-async'
+        respostas = [None, {'base64': base64.b64encode(conteudo).decode(), 'mimetype': 'image/png'}]
+        with mock.patch('crm.services.evolution_api.EvolutionService.get_media_base64', side_effect=respostas):
+            call_command('run_workers', '--once', '--threads', '1', stdout=mock.MagicMock())
+            tarefa.refresh_from_db()
+            self.assertEqual((tarefa.status, tarefa.tentativas), (Tarefa.STATUS_PENDENTE, 1))
+            self.assertGreater(tarefa.executar_em, timezone.now())
+
+            Tarefa.objects.filter(id=tarefa.id).update(executar_em=timezone.now())
+            call_command('run_workers', '--once', '--threads', '1', stdout=mock.MagicMock())
+
+        tarefa.refresh_from_db()
+        self.assertEqual(tarefa.status, Tarefa.STATUS_CONCLUIDA)
+        msg = WhatsappMessage.objects.get(id_mensagem='IMGASYNC')
+        with open(media_store.caminho(msg.media_hash), 'rb') as f:
+            self.assertEqual(f.read(), conteudo)
+        # A limpeza periódica rodou e já tem a próxima execução agendada
+        self.assertTrue(Tarefa.objects.filter(
+            nome='tarefas.limpar', status=Tarefa.STATUS_PENDENTE, executar_em__gt=timezone.now()
+        ).exists())
+
+
+    def test_politica_por_tipo_dedupe_e_cache_negativo(self):
+        def midia(id_msg, tipo, **extra):
+            payload = _payload(id_msg)
+            payload['data']['message'] = {f'{tipo}Message': extra}
+            payload['data']['messageTimestamp'] = int(timezone.now().timestamp())
+            self.client.post('/api/webhooks/whatsapp/', payload, format='json')
+            return WhatsappMessage.objects.get(id_mensagem=id_msg)
+
+        video = midia('VID1', 'video', mimetype='video/mp4')
+        grande = midia('IMGGRANDE', 'image', fileLength={'low': 0, 'high': 1})  # 4 GiB
+        imagem = midia('IMGOK', 'image', fileLength='2048')
+
+        # Vídeo é LAZY; a imagem acima do teto vai direto para o cache negativo
+        self.assertEqual([t.parametros['msg_id'] for t in Tarefa.objects.all()], [imagem.id])
+        grande.refresh_from_db()
+        self.assertIsNotNone(grande.media_falha_em)
+
+        # Abrir o chat agenda o que falta uma única vez, mesmo se aberto de novo
+        Tarefa.objects.all().delete()
+        agendados = [
+            self.client.post(
+                '/api/whatsapp/process_pending_media/', {'number': '5581999998888'}, format='json'
+            ).data['downloads_agendados']
+            for _ in range(2)
+        ]
+        self.assertEqual(agendados, [1, 0])
+        self.assertEqual([t.parametros['msg_id'] for t in Tarefa.objects.all()], [imagem.id])
+
+        # O vídeo só é baixado quando aberto
+        resposta = {'base64': base64.b64encode(b'mp4').decode(), 'mimetype': 'video/mp4'}
+        with mock.patch(
+            'crm.services.evolution_api.EvolutionService.get_media_base64', return_value=resposta
+        ) as get_media:
+            response = self.client.post('/api/whatsapp/load_media/', {'message_id': video.id}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('/midia/', response.data['media_src'])
+        self.assertEqual(get_media.call_args.args[0]['remoteJid'], '5581999998888@s.whatsapp.net')
+
+
+def _resposta(status):
+    resposta = mock.Mock(status_code=status, headers={})
+    resposta.ok = status < 400
+    return resposta
+
+
+@override_settings(EVOLUTION_HTTP_TENTATIVAS=3)
+class EvolutionHttpTest(SimpleTestCase):
+    def setUp(self):
+        sleep = mock.patch.object(evolution_http.time, 'sleep')
+        sleep.start()
+        self.addCleanup(sleep.stop)
+
+    def test_retentativa_em_5xx_so_para_idempotentes(self):
+        with mock.patch('requests.Session.request', side_effect=[_resposta(503), _resposta(200)]) as req:
+            resposta = evolution_http.requisitar('post', 'http://evo.teste/chat/findMessages/i1', instancia='i1')
+        self.assertEqual(resposta.status_code, 200)
+        self.assertEqual(req.call_count, 2)
+        self.assertEqual(req.call_args.kwargs['timeout'], (5, 30))
+
+        # Envio não é repetido em 5xx (a mensagem pode ter saído); em 429 é
+        with mock.patch('requests.Session.request', side_effect=[_resposta(500)]) as req:
+            resposta = evolution_http.requisitar('post', 'http://evo.teste/message/sendText/i1', instancia='i1', idempotente=False)
+        self.assertEqual((resposta.status_code, req.call_count), (500, 1))
+        with mock.patch('requests.Session.request', side_effect=[_resposta(429), _resposta(201)]) as req:
+            resposta = evolution_http.requisitar('post', 'http://evo.teste/message/sendText/i1', instancia='i1', idempotente=False)
+        self.assertEqual((resposta.status_code, req.call_count), (201, 2))
+
+        self.assertIs(evolution_http.sessao('http://evo.teste'), evolution_http.sessao('http://evo.teste'))
+
+    def test_limite_adaptativo(self):
+        lim = evolution_http.LimiteAdaptativo(inicial=4, minimo=1, maximo=8)
+        lim.adquirir(espera=0)
+        lim.liberar(sobrecarga=True)
+        self.assertEqual(lim.limite, 2)
+        for _ in range(2):
+            lim.adquirir(espera=0)
+        with self.assertRaises(evolution_http.EvolutionOcupada):
+            lim.adquirir(espera=0)
+        lim.liberar(sobrecarga=False)
+        lim.liberar(sobrecarga=False)
+        self.assertEqual(lim.limite, 3)
+
+
+class TranscricaoCacheTest(TestCase):
+    def test_mesmo_audio_nao_passa_pelo_modelo_de_novo(self):
+        modelo = mock.Mock()
+        modelo.transcribe.return_value = (
+            [mock.Mock(start=0.0, end=2.0, text=' olá mundo ')],
+            mock.Mock(language='pt', duration=2.0),
+        )
+        audio = base64.b64encode(b'ogg-encaminhado').decode()
+
+        with mock.patch('crm.services.audio_transcription.get_whisper_model', return_value=modelo):
+            primeiro = audio_transcription.transcribe_from_base64(audio, 'audio/ogg')
+            segundo = audio_transcription.transcribe_from_base64(f'data:audio/ogg;base64,{audio}', 'audio/ogg')
+
+        self.assertEqual(modelo.transcribe.call_count, 1)
+        self.assertEqual(segundo, primeiro)
+        self.assertEqual(TranscricaoCache.objects.get().segmentos, [{'start': 0.0, 'end': 2.0, 'text': 'olá mundo'}])
+
+    def test_base64_decodificado_em_blocos_sem_arquivo_temporario(self):
+        conteudo = bytes(range(256)) * 2000  # maior que um bloco de decodificação
+        valor = f'data:audio/ogg;base64,{base64.b64encode(conteudo).decode()}'
+        modelo = mock.Mock()
+        modelo.transcribe.return_value = ([mock.Mock(start=0.0, end=1.0, text='oi')], mock.Mock(language='pt', duration=1.0))
+
+        with mock.patch('crm.services.audio_transcription.get_whisper_model', return_value=modelo), \
+                mock.patch('crm.services.audio_transcription.tempfile.NamedTemporaryFile') as temporario:
+            resultado = audio_transcription.transcribe_from_base64(valor, 'audio/ogg')
+
+        temporario.assert_not_called()
+        self.assertEqual(resultado['text'], 'oi')
+        fonte = modelo.transcribe.call_args.args[0]
+        self.assertEqual(fonte.getvalue(), conteudo)
+        self.assertTrue(TranscricaoCache.objects.filter(audio_hash=hashlib.sha256(conteudo).hexdigest()).exists())
+
+    @override_settings(WHISPER_NIVEIS='45:tiny:1,300:base:5,0:small:5', WHISPER_FILA_REBAIXAR=10)
+    def test_nivel_do_modelo_pela_duracao_e_pela_fila(self):
+        self.assertEqual(audio_transcription.escolher_nivel(20, fila=0), ('tiny', 1))
+        self.assertEqual(audio_transcription.escolher_nivel(120, fila=0), ('base', 5))
+        self.assertEqual(audio_transcription.escolher_nivel(900, fila=0), ('small', 5))
+        self.assertEqual(audio_transcription.escolher_nivel(None, fila=0), ('small', 5))
+        self.assertEqual(audio_transcription.escolher_nivel(900, fila=12), ('base', 1))
+
+    @override_settings(WHISPER_NIVEIS='45:tiny:1,0:base:5', WHISPER_FILA_REBAIXAR=3)
+    def test_resultado_rebaixado_nao_vai_para_o_cache(self):
+        modelo = mock.Mock()
+        modelo.transcribe.return_value = ([mock.Mock(start=0.0, end=1.0, text='oi')], mock.Mock(language='pt', duration=120.0))
+        audio = base64.b64encode(b'ogg-no-pico').decode()
+
+        def transcrever(fila):
+            with mock.patch('crm.services.audio_transcription.get_whisper_model', return_value=modelo), \
+                    mock.patch('crm.services.audio_transcription.duracao_audio', return_value=120.0), \
+                    mock.patch('crm.services.audio_transcription.profundidade_fila', return_value=fila):
+                return audio_transcription.transcribe_from_base64(audio, 'audio/ogg')
+
+        self.assertEqual(transcrever(fila=5)['model'], 'tiny')
+        self.assertFalse(TranscricaoCache.objects.exists())
+
+        # Fila vazia: transcreve no nível completo e só então guarda
+        self.assertEqual(transcrever(fila=0)['model'], 'base')
+        self.assertEqual(transcrever(fila=5)['model'], 'base')
+        self.assertEqual(modelo.transcribe.call_count, 2)
+
+        # Nível elevado depois: o resultado do modelo menor deixa de valer
+        with override_settings(WHISPER_NIVEIS='0:small:5'):
+            self.assertEqual(transcrever(fila=0)['model'], 'small')
+        self.assertEqual(modelo.transcribe.call_count, 3)
+
+    @override_settings(WHISPER_MODELOS_CARREGADOS=2, WHISPER_MEMORIA_MAX_MB=0)
+    def test_lru_de_modelos_descarta_o_menos_usado(self):
+        with mock.patch.dict('sys.modules', {'faster_whisper': mock.Mock()}), \
+                mock.patch.object(audio_transcription, '_modelos', audio_transcription.OrderedDict()) as modelos:
+            for tamanho in ('tiny', 'base', 'tiny', 'small'):
+                audio_transcription.get_whisper_model(model_size=tamanho)
+            self.assertEqual(list(modelos), ['tiny', 'small'])
@@ -14,6 +14,7 @@ from .views import (
 )
 from .views_dashboard import DashboardViewSet
 from .views_atendimento import InboxConversasView, InboxCanaisView
+from .views_midia import midia_whatsapp
 
 router = DefaultRouter()
 router.register(r'whatsapp', WhatsappViewSet, basename='whatsapp')
@@ -48,6 +49,7 @@ urlpatterns = [
     path('mapa/canal/', MapaCanalView.as_view(), name='mapa-canal'),
     path('atendimento/conversas/', InboxConversasView.as_view(), name='atendimento-conversas'),
     path('atendimento/canais/', InboxCanaisView.as_view(), name='atendimento-canais'),
+    path('whatsapp/midia/<str:assinatura>/', midia_whatsapp, name='whatsapp-midia'),
     path('', include(router.urls)),
     path('webhooks/whatsapp/', WhatsappWebhookView.as_view(), name='whatsapp-webhook'),
     path('webhook/whatsapp/', WhatsappWebhookView.as_view(), name='whatsapp-webhook-alias'),
@@ -1,6 +1,10 @@
 """
 Views da API do CRM
 """
+import base64
+import binascii
+import hashlib
+import json
 import logging
 import re
 import unicodedata
@@ -9,12 +13,14 @@ from decimal import Decimal, InvalidOperation
 from rest_framework import viewsets, status, filters, permissions
 from rest_framework.views import APIView
 from rest_framework.decorators import action
+from rest_framework.exceptions import NotFound
 from rest_framework.response import Response
-from rest_framework.pagination import PageNumberPagination
+from rest_framework.pagination import CursorPagination, PageNumberPagination
 from rest_framework.throttling import AnonRateThrottle
+from rest_framework.utils.urls import remove_query_param, replace_query_param
 from django.conf import settings
 from django.db import transaction
-from django.db.models import Q, Sum, Count, Avg, Exists, OuterRef
+from django.db.models import Q, Sum, Count, Avg, Max, Exists, OuterRef, ExpressionWrapper, BooleanField
 from django.contrib.auth.models import Permission
 from django_filters.rest_framework import DjangoFilterBackend
 
@@ -44,7 +50,7 @@ def parse_bool_param(raw_value):
 from .models import (
     Canal, User, Conta, Contato, TipoContato, TipoRedeSocial, Funil, EstagioFunil, FunilEstagio, Oportunidade, OportunidadeAnexo, Atividade, Origem,
     DiagnosticoPilar, DiagnosticoPergunta, DiagnosticoResposta, DiagnosticoResultado,
-    Plano, PlanoAdicional, WhatsappMessage, Log, NumeroBloqueado,
+    Plano, PlanoAdicional, WhatsappMessage, Log, WebhookEvento,
     ModuloTreinamento, OnboardingCliente, SessaoTreinamento, AgendaTreinamento
 )
 from .serializers import (
@@ -58,10 +64,13 @@ from .serializers import (
     OnboardingClienteSerializer, OnboardingClienteListSerializer, SessaoTreinamentoSerializer,
     AgendaTreinamentoSerializer
 )
+from .services import bloqueados, media_fetcher, media_store, timeline, transcricao
 from .services.ai_service import gerar_analise_diagnostico
 from .services.evolution_api import EvolutionService
+from .services.phone import canonical_phone
 from .permissions import HierarchyPermission, IsAdminUser
 from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from django.conf import settings
 
 
@@ -71,11 +80,117 @@ class StandardResultsSetPagination(PageNumberPagination):
     max_page_size = 1000
 
 
-class ChatMessagesPagination(PageNumberPagination):
-    """Paginação otimizada para histórico de chat."""
+class ChatMessagesPagination(CursorPagination):
+    """
+    Paginação por cursor do histórico de chat, das mensagens mais recentes para
+    as mais antigas. Não faz COUNT, e cada página ("carregar anteriores" via
+    `next`) é uma leitura por faixa no índice (numero_chave, timestamp).
+
+    O cursor é a posição (timestamp, id) da borda da página, e a página seguinte
+    filtra (timestamp, id) < posição: sem OFFSET, mesmo com muitas mensagens no
+    mesmo instante (o cursor padrão do DRF guarda timestamp + deslocamento).
+    `previous` volta para as mais recentes com o filtro inverso.
+    """
     page_size = 50
     page_size_query_param = 'page_size'
     max_page_size = 200
+    ordering = ('-timestamp', '-id')
+
+    def get_ordering(self, request, queryset, view):
+        # Ordem fixa do cursor: ?ordering= não se aplica aqui
+        return self.ordering
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.page_size = self.get_page_size(request)
+        if not self.page_size:
+            return None
+
+        self.base_url = request.build_absolute_uri()
+        self.cursor = self.decode_cursor(request)
+        if self.cursor is None:
+            recentes, posicao = False, None
+            queryset = queryset.order_by('-timestamp', '-id')
+        else:
+            recentes, timestamp, msg_id = self.cursor
+            posicao = (timestamp, msg_id)
+            if recentes:
+                queryset = queryset.filter(
+                    Q(timestamp__gt=timestamp) | Q(timestamp=timestamp, id__gt=msg_id)
+                ).order_by('timestamp', 'id')
+            else:
+                queryset = queryset.filter(
+                    Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, id__lt=msg_id)
+                ).order_by('-timestamp', '-id')
+
+        itens = list(queryset[:self.page_size + 1])
+        mais = len(itens) > self.page_size
+        self.page = itens[:self.page_size]
+        if recentes:
+            self.page.reverse()
+            self.has_next, self.has_previous = True, mais
+        else:
+            self.has_next, self.has_previous = mais, posicao is not None
+
+        # Bordas da página; página vazia fica na posição do próprio cursor
+        if self.page:
+            self.borda_recente = (self.page[0].timestamp, self.page[0].id)
+            self.borda_antiga = (self.page[-1].timestamp, self.page[-1].id)
+        else:
+            self.borda_recente = self.borda_antiga = posicao
+        return self.page
+
+    def get_next_link(self):
+        if not (self.has_next and self.borda_antiga):
+            return None
+        return self.encode_cursor((False, *self.borda_antiga))
+
+    def get_previous_link(self):
+        if not (self.has_previous and self.borda_recente):
+            return None
+        return self.encode_cursor((True, *self.borda_recente))
+
+    def encode_cursor(self, cursor):
+        recentes, timestamp, msg_id = cursor
+        dados = json.dumps([int(recentes), timestamp.isoformat(), msg_id], separators=(',', ':'))
+        valor = base64.urlsafe_b64encode(dados.encode()).decode().rstrip('=')
+        return replace_query_param(self.base_url, self.cursor_query_param, valor)
+
+    def decode_cursor(self, request):
+        """(recentes, timestamp, id) do ?cursor=, None sem cursor; 404 se malformado (como o DRF)."""
+        valor = request.query_params.get(self.cursor_query_param)
+        if not valor:
+            return None
+        try:
+            bruto = base64.urlsafe_b64decode(valor + '=' * (-len(valor) % 4))
+            recentes, timestamp, msg_id = json.loads(bruto)
+            timestamp = parse_datetime(timestamp)
+            if timestamp is None or recentes not in (0, 1) or not isinstance(msg_id, int):
+                raise ValueError
+        except (binascii.Error, ValueError, TypeError, UnicodeDecodeError):
+            raise NotFound(self.invalid_cursor_message)
+        return bool(recentes), timestamp, msg_id
+
+
+class KanbanColunaPagination(CursorPagination):
+    """
+    Cards de uma coluna do Kanban, dos mais recentes para os mais antigos. O
+    quadro traz a primeira página de cada coluna; "carregar mais" segue o
+    `next` da coluna (/oportunidades/kanban/coluna/). Não faz COUNT: os totais
+    das colunas vêm de um único GROUP BY no quadro.
+    """
+    page_size = 20
+    page_size_query_param = 'limite'
+    max_page_size = 100
+    ordering = ('-data_criacao', '-id')
+
+    def get_ordering(self, request, queryset, view):
+        return self.ordering
+
+
+# Delta do chat (?since=): volta um pouco antes do `since` do cliente para pegar gravações
+# que commitaram depois do poll anterior; acima do limite o cliente recarrega a conversa
+DELTA_SOBREPOSICAO = timedelta(seconds=5)
+DELTA_MAX_MENSAGENS = 200
 
 
 class CanalViewSet(viewsets.ModelViewSet):
@@ -594,7 +709,7 @@ class ContaViewSet(viewsets.ModelViewSet):
     def contatos(self, request, pk=None):
         """Lista contatos da conta"""
         conta = self.get_object()
-        contatos = conta.contatos.all()
+        contatos = ContatoSerializer.preparar_queryset(conta.contatos.all())
         serializer = ContatoSerializer(contatos, many=True, context={'request': request})
         return Response(serializer.data)
     
@@ -604,7 +719,9 @@ class ContaViewSet(viewsets.ModelViewSet):
         conta = self.get_object()
         from django.db.models import Q
         from .models import Oportunidade
-        oportunidades = Oportunidade.objects.filter(Q(conta=conta) | Q(empresas=conta)).distinct()
+        oportunidades = OportunidadeSerializer.preparar_queryset(
+            Oportunidade.objects.filter(Q(conta=conta) | Q(empresas=conta)).distinct()
+        )
         serializer = OportunidadeSerializer(oportunidades, many=True, context={'request': request})
         return Response(serializer.data)
 
@@ -859,7 +976,7 @@ class TagViewSet(viewsets.ModelViewSet):
 
     def get_queryset(self):
         from .models import Tag
-        return Tag.objects.all().order_by('nome')
+        return TagSerializer.preparar_queryset(Tag.objects.all()).order_by('nome')
 
     def get_permissions(self):
         # Qualquer usuário autenticado pode listar, buscar e CRIAR tags
@@ -886,31 +1003,17 @@ class ContatoViewSet(viewsets.ModelViewSet):
         # 1. Busca exata (mesma string enviada pelo front)
         contato = Contato.objects.filter(Q(telefone=telefone) | Q(celular=telefone)).first()
         
-        # 2. Busca parcial (pega registros que têm a mesma região ou dígitos na base e faz filtro Python)
+        # 2. Busca pela chave canônica (com/sem 55, com/sem 9º dígito, com/sem máscara)
+        chave = canonical_phone(telefone)
         if not contato:
-            qs = Contato.objects.filter(
-                Q(telefone__icontains=tel_digits[-8:]) | 
-                Q(celular__icontains=tel_digits[-8:])
-            )
-            for c in qs:
-                t_limpo = ''.join(filter(str.isdigit, c.telefone or ''))
-                c_limpo = ''.join(filter(str.isdigit, c.celular or ''))
-                if tel_digits[-8:] in t_limpo or tel_digits[-8:] in c_limpo:
-                    contato = c
-                    break
+            contato = Contato.objects.filter(Q(telefone_chave=chave) | Q(celular_chave=chave)).first()
 
         # 3. Busca nas tabelas secundárias
         if not contato:
-            from .models import ContatoTelefone, Contato
-            ct_qs = ContatoTelefone.objects.filter(numero=telefone)
-            ct = ct_qs.filter(contato__in=Contato.objects.all()).first()
-            if not ct:
-                ct_qs_parcial = ContatoTelefone.objects.filter(numero__icontains=tel_digits[-8:])
-                for ctt in ct_qs_parcial.filter(contato__in=Contato.objects.all()):
-                    n_limpo = ''.join(filter(str.isdigit, ctt.numero or ''))
-                    if tel_digits[-8:] in n_limpo:
-                        ct = ctt
-                        break
+            from .models import ContatoTelefone
+            ct = ContatoTelefone.objects.filter(
+                Q(numero=telefone) | Q(numero_chave=chave)
+            ).select_related('contato').first()
             if ct:
                 contato = ct.contato
 
@@ -1133,6 +1236,9 @@ class OportunidadeViewSet(viewsets.ModelViewSet):
                         proprietario=user,
                         funil__in=funis_visiveis
                     )
+        if self.action in ('list', 'retrieve'):
+            # Tudo o que o OportunidadeSerializer lê, em número constante de consultas por página
+            return OportunidadeSerializer.preparar_queryset(queryset)
         return queryset.select_related(
             'funil', 'estagio', 'conta', 'contato_principal', 'proprietario'
         ).prefetch_related(
@@ -1835,9 +1941,8 @@ class OportunidadeViewSet(viewsets.ModelViewSet):
             'rollback_summary': rollback_summary,
         })
 
-    @action(detail=False, methods=['get'])
-    def kanban(self, request):
-        """Retorna oportunidades agrupadas por estágio para visão Kanban"""
+    def _kanban_queryset(self, request):
+        """Oportunidades do quadro (funil e status filtrados) e o id do funil exibido."""
         funil_id = request.query_params.get('funil_id')
         estagio_tipo = request.query_params.get('estagio_tipo') # Novo filtro de status
         
@@ -1847,43 +1952,100 @@ class OportunidadeViewSet(viewsets.ModelViewSet):
         if estagio_tipo:
             queryset = queryset.filter(estagio__tipo=estagio_tipo)
             
-        if funil_id:
-            queryset = queryset.filter(funil_id=funil_id)
-        else:
+        if not funil_id:
             # Se não informou, tenta o primeiro funil de oportunidades do usuário
             user_funis = request.user.funis_acesso.filter(tipo=Funil.TIPO_VENDAS) if request.user.perfil != 'ADMIN' else Funil.objects.filter(tipo=Funil.TIPO_VENDAS)
-            funil = user_funis.first()
-            if funil:
-                queryset = queryset.filter(funil=funil)
-                
-        queryset = queryset.select_related('conta', 'contato_principal', 'estagio', 'proprietario')
-        serializer = OportunidadeKanbanSerializer(queryset, many=True)
-        
+            funil_id = user_funis.values_list('id', flat=True).first()
+        if funil_id:
+            queryset = queryset.filter(funil_id=funil_id)
+        return queryset, funil_id
+
+    def _kanban_coluna(self, queryset, estagio_id, request, base_url=None):
+        """
+        Página de cards de uma coluna: o cursor anda só sobre (id, data_criacao)
+        e os cards são carregados depois, de uma vez (_kanban_cards).
+        Returns: (ids da página, link da próxima página ou None)
+        """
+        paginator = KanbanColunaPagination()
+        leve = queryset.select_related(None).prefetch_related(None).only('id', 'data_criacao')
+        pagina = paginator.paginate_queryset(leve.filter(estagio_id=estagio_id), request, view=self)
+        if base_url:
+            paginator.base_url = base_url
+        return [opp.id for opp in pagina], paginator.get_next_link()
+
+    def _kanban_cards(self, ids):
+        """Cards serializados por id (as ids já passaram pelo get_queryset)."""
+        oportunidades = OportunidadeKanbanSerializer.preparar_queryset(Oportunidade.objects.filter(id__in=ids))
+        return {opp['id']: opp for opp in OportunidadeKanbanSerializer(oportunidades, many=True).data}
+
+    @action(detail=False, methods=['get'])
+    def kanban(self, request):
+        """
+        Quadro Kanban: por estágio do funil, o total de oportunidades e a soma
+        do valor estimado (um GROUP BY) e a primeira página de cards
+        (?limite=, padrão 20). Os demais cards vêm de kanban/coluna via `next`.
+        """
+        queryset, funil_selecionado_id = self._kanban_queryset(request)
+
         # Agrupa por estágios do funil selecionado via tabela de ligação (todos os tipos)
-        funil_selecionado_id = funil_id or (funil.id if 'funil' in locals() and funil else None)
         if funil_selecionado_id:
             vinculos = FunilEstagio.objects.filter(funil_id=funil_selecionado_id).select_related('estagio').order_by('ordem')
         else:
             # Fallback se não houver funil (não deveria acontecer no Kanban novo)
             vinculos = FunilEstagio.objects.all().select_related('estagio').order_by('funil', 'ordem')
-        
-        kanban_data = []
+
+        totais = {
+            linha['estagio_id']: linha
+            for linha in queryset.order_by().values('estagio_id').annotate(
+                total=Count('id'), valor_total=Sum('valor_estimado')
+            )
+        }
+
+        # Link "carregar mais" de cada coluna: kanban/coluna com os mesmos filtros
+        url_coluna = request.build_absolute_uri('coluna/')
+        for param in ('funil_id', 'estagio_tipo', 'limite'):
+            valor = funil_selecionado_id if param == 'funil_id' else request.query_params.get(param)
+            if valor:
+                url_coluna = replace_query_param(url_coluna, param, valor)
+
+        colunas = []
         for vinculo in vinculos:
-            oportunidades = [
-                opp for opp in serializer.data
-                if int(opp.get('estagio_id') or opp.get('estagio') or 0) == vinculo.estagio_id
-            ]
+            ids, proximo = self._kanban_coluna(
+                queryset, vinculo.estagio_id, request,
+                base_url=replace_query_param(url_coluna, 'estagio_id', vinculo.estagio_id)
+            )
+            colunas.append((vinculo, ids, proximo))
+        cards = self._kanban_cards([i for _, ids, _ in colunas for i in ids])
+
+        kanban_data = []
+        for vinculo, ids, proximo in colunas:
             # Montamos o objeto de estágio como o frontend espera
             estagio_data = EstagioFunilSerializer(vinculo.estagio).data
             estagio_data['ordem'] = vinculo.ordem
             estagio_data['is_padrao'] = vinculo.is_padrao
+            total = totais.get(vinculo.estagio_id, {})
 
             kanban_data.append({
                 'estagio': estagio_data,
-                'oportunidades': oportunidades
+                'oportunidades': [cards[i] for i in ids if i in cards],
+                'total': total.get('total', 0),
+                'valor_total': total.get('valor_total') or 0,
+                'next': proximo,
             })
         
         return Response(kanban_data)
+
+    @action(detail=False, methods=['get'], url_path='kanban/coluna')
+    def kanban_coluna(self, request):
+        """Próxima página de cards de uma coluna (?estagio_id=&cursor=, mesmos filtros do quadro)."""
+        estagio_id = request.query_params.get('estagio_id')
+        if not estagio_id or not estagio_id.isdigit():
+            return Response({'error': 'estagio_id é obrigatório'}, status=status.HTTP_400_BAD_REQUEST)
+
+        queryset, _ = self._kanban_queryset(request)
+        ids, proximo = self._kanban_coluna(queryset, estagio_id, request)
+        cards = self._kanban_cards(ids)
+        return Response({'results': [cards[i] for i in ids if i in cards], 'next': proximo})
     
     @action(detail=True, methods=['patch'])
     def mudar_estagio(self, request, pk=None):
@@ -2889,14 +3051,28 @@ class WhatsappViewSet(viewsets.ModelViewSet):
     pagination_class = ChatMessagesPagination
 
     def list(self, request, *args, **kwargs):
-        """Usa serializer slim (sem media_base64) para evitar payloads enormes na listagem."""
-        queryset = self.filter_queryset(self.get_queryset())
+        """Usa serializer slim; mídia legada (media_base64) não é carregada, só sinalizada."""
+        queryset = self.filter_queryset(self.get_queryset()).defer('media_base64').annotate(
+            midia_legada=ExpressionWrapper(Q(media_base64__isnull=False), output_field=BooleanField())
+        )
+        context = self.get_serializer_context()
+
+        if request.query_params.get('since') and request.query_params.get('number'):
+            return self._delta(request, queryset, context)
+
+        # Cliente antigo (?limit=N sem cursor): as N mais recentes, em ordem cronológica
+        limite = self._limite_legado()
+        if limite:
+            recentes = list(queryset.order_by('-timestamp', '-id')[:limite])
+            recentes.reverse()
+            return Response(WhatsappMessageSlimSerializer(recentes, many=True, context=context).data)
+
         page = self.paginate_queryset(queryset)
         if page is not None:
-            serializer = WhatsappMessageSlimSerializer(page, many=True)
+            serializer = WhatsappMessageSlimSerializer(page, many=True, context=context)
             return self.get_paginated_response(serializer.data)
 
-        serializer = WhatsappMessageSlimSerializer(queryset, many=True)
+        serializer = WhatsappMessageSlimSerializer(queryset, many=True, context=context)
         return Response(serializer.data)
 
     def _get_evolution_service_for_entity(self, opp_id=None, canal_id=None):
@@ -2944,76 +3120,80 @@ class WhatsappViewSet(viewsets.ModelViewSet):
         number = self.request.query_params.get('number')
         
         if number:
-            # Limpa o número para pegar apenas dígitos
-            clean_number = ''.join(filter(str.isdigit, str(number)))
-            
-            # Criamos variações do número para aumentar a chance de match
-            # Ex: com 55, sem 55, com 9o dígito, sem 9o dígito
-            variations = [clean_number]
-            
-            # Se for um número brasileiro sem 55
-            if len(clean_number) >= 10 and not clean_number.startswith('55'):
-                variations.append('55' + clean_number)
-            
-            # Se for um número brasileiro com 55
-            if clean_number.startswith('55') and len(clean_number) >= 12:
-                variations.append(clean_number[2:]) # Versão sem DDI
-                
-                # Lidar com o 9o dígito (específico do Brasil)
-                # Formato: 55 + DDD (2) + 9 + Numero (8) = 13 dígitos
-                if len(clean_number) == 13:
-                    # Versão sem o 9
-                    variations.append(clean_number[:4] + clean_number[5:])
-                # Formato: 55 + DDD (2) + Numero (8) = 12 dígitos
-                elif len(clean_number) == 12:
-                    # Versão com o 9
-                    variations.append(clean_number[:4] + '9' + clean_number[4:])
-            
-            # Remove duplicatas
-            variations = list(set(variations))
+            # Busca exata pela chave canônica (cobre com/sem 55 e com/sem 9º dígito)
+            q_filter = Q(numero_chave=canonical_phone(number))
             
-            # Busca mensagens onde qualquer uma das variações aparece em remetente ou destinatário
-            q_filter = Q()
-            for v in variations:
-                q_filter |= Q(numero_remetente__icontains=v)
-                q_filter |= Q(numero_destinatario__icontains=v)
-            
-            # Limita período para evitar carregar histórico inteiro (padrão: 90 dias)
-            dias_chat_raw = self.request.query_params.get('dias', 90)
+            queryset = self.queryset.filter(q_filter)
+
+            # Janela opcional (?dias=N); sem ela o cursor percorre o histórico página a página
             try:
-                dias_chat = int(dias_chat_raw)
+                dias_chat = int(self.request.query_params.get('dias') or 0)
             except (TypeError, ValueError):
-                dias_chat = 90
-            data_limite = timezone.now() - timedelta(days=dias_chat)
-            
-            queryset = self.queryset.filter(q_filter).filter(timestamp__gte=data_limite)
+                dias_chat = 0
+            if dias_chat > 0:
+                queryset = queryset.filter(timestamp__gte=timezone.now() - timedelta(days=dias_chat))
             
             # Exclui números bloqueados
-            bloqueados = list(NumeroBloqueado.objects.values_list('numero', flat=True))
-            if bloqueados:
-                q_block = Q()
-                for nb in bloqueados:
-                    q_block |= Q(numero_remetente__icontains=nb)
-                    q_block |= Q(numero_destinatario__icontains=nb)
-                queryset = queryset.exclude(q_block)
-            
-            # Compatibilidade: cliente antigo pode enviar "limit" sem paginação.
-            has_page = self.request.query_params.get('page') is not None
-            has_page_size = self.request.query_params.get('page_size') is not None
-            limit_raw = self.request.query_params.get('limit')
-            if limit_raw and not (has_page or has_page_size):
-                try:
-                    max_msgs = int(limit_raw)
-                except (TypeError, ValueError):
-                    max_msgs = 100
-                if max_msgs > 0:
-                    ids_recentes = queryset.order_by('-timestamp').values_list('id', flat=True)[:max_msgs]
-                    queryset = queryset.filter(id__in=ids_recentes)
+            chaves_bloqueadas = bloqueados.chaves()
+            if chaves_bloqueadas:
+                queryset = queryset.exclude(numero_chave__in=chaves_bloqueadas)
             
             return queryset.order_by('timestamp')
 
         return super().get_queryset()
 
+    def _delta(self, request, queryset, context):
+        """
+        ?since=<data_atualizacao mais recente já vista>: só as mensagens criadas
+        ou alteradas desde então (novas, reações, transcrições, lidas), lidas
+        pelo índice (numero_chave, data_atualizacao).
+
+        Responde com ETag forte do conjunto alterado e 304 quando o cliente
+        manda o mesmo If-None-Match: poll ocioso custa uma agregação vazia.
+        """
+        since = parse_datetime(request.query_params['since'])
+        if since is None:
+            return Response({'error': 'since inválido'}, status=400)
+        if timezone.is_naive(since):
+            since = timezone.make_aware(since)
+
+        alteradas = queryset.filter(data_atualizacao__gte=since - DELTA_SOBREPOSICAO)
+        resumo = alteradas.aggregate(total=Count('id'), ultima=Max('data_atualizacao'), maior_id=Max('id'))
+        assinatura = '|'.join(str(v) for v in (
+            canonical_phone(request.query_params['number']), since.isoformat(),
+            resumo['total'], resumo['ultima'] and resumo['ultima'].isoformat(), resumo['maior_id'],
+        ))
+        etag = '"%s"' % hashlib.sha1(assinatura.encode()).hexdigest()
+
+        if etag in [t.strip() for t in request.headers.get('If-None-Match', '').split(',')]:
+            response = Response(status=304)
+        elif resumo['total'] > DELTA_MAX_MENSAGENS:
+            response = Response({'results': [], 'since': None, 'recarregar': True})
+        else:
+            mensagens = alteradas.order_by('timestamp', 'id')
+            response = Response({
+                'results': WhatsappMessageSlimSerializer(mensagens, many=True, context=context).data,
+                'since': (resumo['ultima'] or since).astimezone(dt_timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%fZ'),
+                'recarregar': False,
+            })
+        response['ETag'] = etag
+        response['Cache-Control'] = 'private, no-cache'
+        return response
+
+    def _limite_legado(self):
+        """N de ?limit=N quando o cliente antigo pede sem paginação (None caso contrário)."""
+        params = self.request.query_params
+        limit_raw = params.get('limit')
+        if not (params.get('number') and limit_raw):
+            return None
+        if any(params.get(p) is not None for p in ('cursor', 'page', 'page_size')):
+            return None
+        try:
+            max_msgs = int(limit_raw)
+        except (TypeError, ValueError):
+            max_msgs = 100
+        return min(max_msgs, ChatMessagesPagination.max_page_size) if max_msgs > 0 else None
+
     # ==================== ENDPOINTS DE CONEXÃO ====================
 
     @action(detail=False, methods=['get'])
@@ -3139,7 +3319,7 @@ class WhatsappViewSet(viewsets.ModelViewSet):
                 )
             )
 
-            return Response(WhatsappMessageSerializer(msg).data)
+            return Response(WhatsappMessageSerializer(msg, context={'request': request}).data)
         except Exception as e:
             logger.exception(f"Erro ao enviar mensagem WhatsApp: {e}")
             return Response({'error': str(e)}, status=500)
@@ -3191,8 +3371,7 @@ class WhatsappViewSet(viewsets.ModelViewSet):
             if not mime_type:
                 mime_type = 'image/jpeg'
             
-            # Salva localmente com base64 completo (webhook pode ter chegado antes)
-            media_b64 = f"data:{mime_type};base64,{media}" if media_type == 'image' else None
+            # Salva localmente com a mídia enviada (webhook pode ter chegado antes)
             msg, created = WhatsappMessage.objects.get_or_create(
                 id_mensagem=msg_id,
                 defaults=dict(
@@ -3202,17 +3381,15 @@ class WhatsappViewSet(viewsets.ModelViewSet):
                     numero_destinatario=formatted_number,
                     texto=caption or f"📷 [Imagem: {file_name}]",
                     tipo_mensagem=media_type,
-                    media_base64=media_b64,
                     timestamp=timezone.now(),
                     oportunidade_id=opp_id
                 )
             )
-            # Se o webhook criou antes (sem media_base64), atualiza com o dado local
-            if not created and media_b64 and not msg.media_base64:
-                msg.media_base64 = media_b64
-                msg.save(update_fields=['media_base64'])
+            # Grava a imagem no store (também quando o webhook criou a mensagem sem mídia)
+            if media_type == 'image' and not msg.media_hash:
+                msg.save(update_fields=media_store.anexar(msg, media, mime_type))
 
-            return Response(WhatsappMessageSerializer(msg).data)
+            return Response(WhatsappMessageSerializer(msg, context={'request': request}).data)
         except Exception as e:
             logger.exception(f"Erro ao enviar mídia WhatsApp: {e}")
             return Response({'error': str(e)}, status=500)
@@ -3350,15 +3527,35 @@ class WhatsappViewSet(viewsets.ModelViewSet):
             if opp_id:
                 sub_filter |= Q(oportunidade_id=opp_id)
             if number:
-                clean_number = ''.join(filter(str.isdigit, str(number)))
-                if len(clean_number) >= 8:
-                    sub_filter |= Q(numero_remetente__icontains=clean_number)
+                chave = canonical_phone(number)
+                if chave:
+                    sub_filter |= Q(numero_chave=chave)
             
             q_filter &= sub_filter
         else:
             return Response({'error': 'Informe number, lead ou oportunidade'}, status=400)
             
-        updated = WhatsappMessage.objects.filter(q_filter).update(lida=True)
+        from .services import chat_ao_vivo, nao_lidas
+        from .services.conversas import recalcular_nao_lidas
+
+        with transaction.atomic():
+            alvo = WhatsappMessage.objects.filter(q_filter)
+            afetadas = set(
+                alvo.order_by().values_list('instancia', 'numero_chave', 'oportunidade_id').distinct()
+            )
+            # As mais recentes vão para os chats abertos da conversa (services.chat_ao_vivo)
+            ids_chat = list(
+                alvo.order_by('-timestamp', '-id').values_list('id', flat=True)[:chat_ao_vivo.MAX_MENSAGENS]
+            )
+            updated = alvo.update(lida=True, data_atualizacao=timezone.now())
+            recalcular_nao_lidas((inst, chave) for inst, chave, _ in afetadas)
+            nao_lidas.agendar(afetadas)
+        if ids_chat:
+            chat_ao_vivo.publicar(
+                WhatsappMessage.objects.filter(id__in=ids_chat).defer('media_base64').annotate(
+                    midia_legada=ExpressionWrapper(Q(media_base64__isnull=False), output_field=BooleanField())
+                )
+            )
         return Response({'status': 'success', 'updated_count': updated})
 
     @action(detail=False, methods=['get'])
@@ -3366,26 +3563,26 @@ class WhatsappViewSet(viewsets.ModelViewSet):
         """Retorna o total de mensagens não lidas para o usuário logado"""
         user = request.user
         
-        # Filtro base: mensagens recebidas e não lidas
-        unread_base = WhatsappMessage.objects.filter(lida=False, de_mim=False)
-        
+        # Lê os contadores mantidos por services.nao_lidas (sem COUNT nas mensagens)
+        opps_com_nao_lidas = Oportunidade.objects.filter(whatsapp_nao_lidas__gt=0)
+
         # Filtros de Hierarquia
         if user.perfil == 'ADMIN':
             # ADMIN vê tudo
-            outros_unread = unread_base.filter(oportunidade__isnull=True).count()
-            opps_unread = unread_base.filter(oportunidade__isnull=False).count()
+            outros_unread = Canal.objects.aggregate(total=Sum('whatsapp_nao_lidas_novas'))['total'] or 0
+            opps_unread = opps_com_nao_lidas.aggregate(total=Sum('whatsapp_nao_lidas'))['total'] or 0
         elif user.perfil == 'RESPONSAVEL':
             # RESPONSAVEL vê do seu canal
-            outros_unread = unread_base.filter(
-                oportunidade__isnull=True
-            ).count() # TODO: Filtrar outros por canal se possível via instância
-            opps_unread = unread_base.filter(
-                Q(oportunidade__canal=user.canal) | Q(oportunidade__proprietario__canal=user.canal)
-            ).count()
+            outros_unread = user.canal.whatsapp_nao_lidas_novas if user.canal else 0
+            opps_unread = opps_com_nao_lidas.filter(
+                Q(canal=user.canal) | Q(proprietario__canal=user.canal)
+            ).aggregate(total=Sum('whatsapp_nao_lidas'))['total'] or 0
         else: # VENDEDOR
             # VENDEDOR vê apenas o que é dele
             outros_unread = 0 # Vendedor geralmente não vê novos que não são dele
-            opps_unread = unread_base.filter(oportunidade__proprietario=user).count()
+            opps_unread = opps_com_nao_lidas.filter(
+                proprietario=user
+            ).aggregate(total=Sum('whatsapp_nao_lidas'))['total'] or 0
             
         return Response({
             'novas': outros_unread,
@@ -3396,140 +3593,49 @@ class WhatsappViewSet(viewsets.ModelViewSet):
     @action(detail=False, methods=['post'])
     def process_pending_media(self, request):
         """
-        Processa mídias pendentes (áudios não transcritos, imagens sem base64).
-        Chamado quando o chat é aberto para garantir que as mídias sejam processadas.
+        Processa mídias pendentes da conversa. Chamado quando o chat é aberto.
+
+        Os downloads não são feitos na requisição: as mídias EAGER que faltam
+        (das mais recentes, até MIDIA_PENDENTES_POR_CHAT) viram tarefas do
+        services.media_fetcher, com dedupe e limite de downloads simultâneos.
+        Áudios já baixados e ainda sem transcrição são transcritos aqui.
         """
         number = request.data.get('number')
         if not number:
             return Response({'error': 'number required'}, status=400)
         
-        # Remove formatação do número
-        import re
-        clean_number = re.sub(r'\D', '', str(number))
-        
-        # Gera variações do número (com e sem 9º dígito)
-        variations = set([clean_number])
-        
-        # Remove DDI se existir
-        base = clean_number[2:] if clean_number.startswith('55') else clean_number
-        variations.add(base)
-        variations.add('55' + base)
-        
-        # Variação com/sem 9º dígito
-        if len(base) == 11 and base[2] == '9':
-            # Tem 9, gera sem
-            without_9 = base[:2] + base[3:]
-            variations.add(without_9)
-            variations.add('55' + without_9)
-        elif len(base) == 10:
-            # Não tem 9, gera com
-            with_9 = base[:2] + '9' + base[2:]
-            variations.add(with_9)
-            variations.add('55' + with_9)
-        
-        # Adiciona últimos 8 dígitos
-        if len(clean_number) >= 8:
-            variations.add(clean_number[-8:])
-        
-        # Busca mensagens pendentes com todas as variações
-        from django.db.models import Q
-        
-        q_filter = Q()
-        for v in variations:
-            if len(v) >= 8:
-                q_filter |= Q(numero_remetente__icontains=v) | Q(numero_destinatario__icontains=v)
-        
-        pending_audio = WhatsappMessage.objects.filter(
-            q_filter,
+        # Busca mensagens pendentes pela chave canônica do número
+        mensagens = WhatsappMessage.objects.filter(numero_chave=canonical_phone(number))
+        limite = getattr(settings, 'MIDIA_PENDENTES_POR_CHAT', 10)
+
+        agendadas = 0
+        pendentes = media_fetcher.sem_midia(mensagens).select_related('oportunidade__canal').order_by('-timestamp')
+        for msg in pendentes[:limite]:
+            try:
+                if media_fetcher.agendar(msg, prioridade=media_fetcher.PRIORIDADE_CHAT):
+                    agendadas += 1
+            except Exception as e:
+                logger.error(f"[ProcessMedia] Erro ao agendar mídia {msg.id}: {e}")
+
+        # Áudios já no store mas sem transcrição (os que faltam baixar transcrevem na tarefa)
+        pending_audio = mensagens.filter(
             tipo_mensagem='audio',
-            texto__in=['🎤 [Áudio]', '🎤 [Áudio não transcrito]', '[audioMessage]']
-        )
-        
-        pending_images = WhatsappMessage.objects.filter(
-            q_filter,
-            tipo_mensagem='image',
-            media_base64__isnull=True
-        )
-        
+            texto__in=transcricao.TEXTOS_NAO_TRANSCRITOS
+        ).exclude(media_hash='', media_base64__isnull=True)
+
         processed_audio = 0
-        processed_images = 0
-        
-        # Processa áudios
-        if pending_audio.exists():
-            from .services.evolution_api import EvolutionService
-            from .services.audio_transcription import transcribe_from_base64
-            
-            for msg in pending_audio[:5]:  # Limita para não demorar muito
-                try:
-                    # Obtém a instância Evolution do canal da mensagem
-                    service, canal, instance_name = self._get_evolution_service_for_entity(msg.oportunidade_id)
-                    
-                    key = {
-                        'id': msg.id_mensagem,
-                        'remoteJid': f"{msg.numero_remetente}@s.whatsapp.net",
-                        'fromMe': msg.de_mim
-                    }
-                    
-                    media_result = service.get_media_base64(key)
-                    
-                    if media_result and media_result.get('base64'):
-                        # Salva base64 do áudio para reprodução futura
-                        mimetype = media_result.get('mimetype', 'audio/ogg; codecs=opus')
-                        audio_b64 = media_result['base64']
-                        if not audio_b64.startswith('data:'):
-                            audio_b64 = f"data:{mimetype};base64,{audio_b64}"
-                        msg.media_base64 = audio_b64
-
-                        transcription = transcribe_from_base64(
-                            media_result['base64'],
-                            media_result.get('mimetype', '')
-                        )
-                        
-                        if transcription and transcription.get('text'):
-                            duration = transcription.get('duration', 0)
-                            msg.texto = f"🎤 [Áudio {int(duration)}s]: {transcription['text']}"
-                            msg.save(update_fields=['texto', 'media_base64'])
-                            processed_audio += 1
-                        else:
-                            msg.save(update_fields=['media_base64'])
-                            
-                except Exception as e:
-                    logger.error(f"[ProcessMedia] Erro ao processar áudio {msg.id}: {e}")
+        for msg in pending_audio[:5]:  # Limita para não demorar muito
+            try:
+                # Com o whisper_worker ativo a transcrição só é enfileirada
+                transcription = transcricao.transcrever(msg, None, '')
+                if transcription and transcription.get('text'):
+                    processed_audio += 1
+            except Exception as e:
+                logger.error(f"[ProcessMedia] Erro ao processar áudio {msg.id}: {e}")
 
-        # Processa imagens
-        if pending_images.exists():
-            from .services.evolution_api import EvolutionService
-            
-            for msg in pending_images[:10]:  # Limita
-                try:
-                    # Obtém a instância Evolution do canal da mensagem
-                    service, canal, instance_name = self._get_evolution_service_for_entity(msg.oportunidade_id)
-                    
-                    key = {
-                        'id': msg.id_mensagem,
-                        'remoteJid': f"{msg.numero_remetente}@s.whatsapp.net",
-                        'fromMe': msg.de_mim
-                    }
-                    
-                    media_result = service.get_media_base64(key)
-                    
-                    if media_result and media_result.get('base64'):
-                        mimetype = media_result.get('mimetype', 'image/jpeg')
-                        base64_data = media_result['base64']
-                        
-                        if not base64_data.startswith('data:'):
-                            base64_data = f"data:{mimetype};base64,{base64_data}"
-                        
-                        msg.media_base64 = base64_data
-                        msg.save(update_fields=['media_base64'])
-                        processed_images += 1
-                        
-                except Exception as e:
-                    logger.error(f"[ProcessMedia] Erro ao processar imagem {msg.id}: {e}")
-        
         return Response({
             'processed_audio': processed_audio,
-            'processed_images': processed_images
+            'downloads_agendados': agendadas
         })
 
     @action(detail=False, methods=['post'])
@@ -3551,64 +3657,68 @@ class WhatsappViewSet(viewsets.ModelViewSet):
         if msg.tipo_mensagem != 'audio':
             return Response({'error': 'message is not audio'}, status=400)
 
-        # Verifica se já tem o áudio salvo no banco (cache)
-        if msg.media_base64:
-            logger.info(f"[GetAudio] msg={msg.id} servido do cache DB")
+        # Verifica se já tem o áudio salvo (store de mídias ou base64 legado)
+        if media_store.tem_midia(msg):
+            logger.info(f"[GetAudio] msg={msg.id} servido do store")
             return Response({
                 'success': True,
-                'audio_url': msg.media_base64,
-                'mimetype': 'audio/ogg; codecs=opus'
+                'audio_url': media_store.url_midia(msg, request),
+                'mimetype': msg.media_mimetype or 'audio/ogg; codecs=opus'
             })
 
-        # Baixa o áudio da Evolution API usando a instância correta
-        from .services.evolution_api import EvolutionService
-
-        # Obtém a instância Evolution do canal associado
-        service, canal, instance_name = self._get_evolution_service_for_entity(msg.oportunidade_id)
+        # Baixa da Evolution API (instância do canal) e grava no store
+        try:
+            media_fetcher.baixar(msg)
+        except Exception as e:
+            logger.error(f"[GetAudio] Falha ao baixar áudio para msg={msg.id}: {e}")
+            return Response({'error': 'could_not_download_audio'}, status=500)
 
-        # Usa o remoteJid correto: para recebidas é o número do remetente, para enviadas é o destinatário
-        remote_number = msg.numero_remetente if not msg.de_mim else msg.numero_destinatario
-        # Remove @s.whatsapp.net se já vier com sufixo
-        remote_number = remote_number.split('@')[0] if remote_number else ''
-        key = {
-            'id': msg.id_mensagem,
-            'remoteJid': f"{remote_number}@s.whatsapp.net",
-            'fromMe': msg.de_mim
-        }
+        return Response({
+            'success': True,
+            'audio_url': media_store.url_midia(msg, request),
+            'mimetype': msg.media_mimetype or 'audio/ogg; codecs=opus'
+        })
 
-        logger.info(f"[GetAudio] msg={msg.id} key={key}")
-        media_result = service.get_media_base64(key)
+    @action(detail=False, methods=['post'])
+    def load_media(self, request):
+        """
+        Baixa sob demanda a mídia de uma mensagem e devolve a URL de streaming.
+        Tipos LAZY do media_fetcher (vídeo, documento) só são baixados aqui.
+        """
+        message_id = request.data.get('message_id')
 
-        if not media_result or not media_result.get('base64'):
-            logger.error(f"[GetAudio] Falha ao baixar áudio para msg={msg.id} key={key}")
-            return Response({'error': 'could_not_download_audio'}, status=500)
+        if not message_id:
+            return Response({'error': 'message_id required'}, status=400)
 
-        base64_data = media_result['base64']
-        mimetype = media_result.get('mimetype') or 'audio/ogg; codecs=opus'
-        if not mimetype.startswith('audio'):
-            mimetype = 'audio/ogg; codecs=opus'
+        msg = WhatsappMessage.objects.select_related('oportunidade__canal').filter(id=message_id).first()
+        if msg is None:
+            return Response({'error': 'message not found'}, status=404)
 
-        audio_url = f"data:{mimetype};base64,{base64_data}"
+        if media_fetcher.politica(msg.tipo_mensagem) is None:
+            return Response({'error': 'message has no media'}, status=400)
 
-        # Salva no banco para próximas requisições
         try:
-            msg.media_base64 = audio_url
-            msg.save(update_fields=['media_base64'])
-            logger.info(f"[GetAudio] msg={msg.id} áudio salvo no DB para cache")
+            media_fetcher.baixar(msg)
+        except media_fetcher.MidiaGrandeDemais:
+            return Response({'error': 'media_too_large'}, status=413)
         except Exception as e:
-            logger.warning(f"[GetAudio] Falha ao salvar cache DB: {e}")
+            logger.error(f"[LoadMedia] Falha ao baixar mídia para msg={msg.id}: {e}")
+            return Response({'error': 'could_not_download_media'}, status=500)
 
         return Response({
             'success': True,
-            'audio_url': audio_url,
-            'mimetype': mimetype
+            'media_src': media_store.url_midia(msg, request),
+            'mimetype': msg.media_mimetype
         })
 
     @action(detail=False, methods=['post'])
     def transcribe_audio(self, request):
         """
         Transcreve um áudio específico por ID.
-        Retorna a transcrição e o base64 do áudio para reprodução.
+        Retorna a transcrição e a URL do áudio para reprodução.
+
+        Com stream=true responde logo (streaming=True) e o texto chega pelo
+        WebSocket do canal em eventos transcricao_parcial.
         """
         message_id = request.data.get('message_id')
 
@@ -3623,56 +3733,34 @@ class WhatsappViewSet(viewsets.ModelViewSet):
         if msg.tipo_mensagem != 'audio':
             return Response({'error': 'message is not audio'}, status=400)
 
-        from .services.audio_transcription import transcribe_from_base64
-
+        stream = str(request.data.get('stream', '')).lower() in ('1', 'true')
         base64_data = None
         mimetype = 'audio/ogg'
         audio_url = None
 
-        # Verifica se já tem o áudio salvo no banco (cache)
-        if msg.media_base64:
-            logger.info(f"[TranscribeAudio] msg={msg.id} usando áudio do cache DB")
-            audio_url = msg.media_base64
-            # Extrai base64 puro e mimetype do data URI para transcrição
-            if msg.media_base64.startswith('data:'):
-                parts = msg.media_base64.split(',', 1)
-                if len(parts) == 2:
-                    mimetype = parts[0].replace('data:', '').replace(';base64', '')
-                    base64_data = parts[1]
-            else:
-                base64_data = msg.media_base64
+        # Verifica se já tem o áudio salvo (store de mídias ou base64 legado)
+        if media_store.tem_midia(msg):
+            base64_data, mimetype_salvo = media_store.ler_base64(msg)
+            if base64_data:
+                logger.info(f"[TranscribeAudio] msg={msg.id} usando áudio do store")
+                mimetype = mimetype_salvo or mimetype
+                audio_url = media_store.url_midia(msg, request)
 
-        # Se não tem no cache, baixa da Evolution API
+        # Se não tem no cache, baixa da Evolution API e grava no store
         if not base64_data:
-            from .services.evolution_api import EvolutionService
-
-            service, canal, instance_name = self._get_evolution_service_for_entity(msg.oportunidade_id)
-            remote_number = msg.numero_remetente if not msg.de_mim else msg.numero_destinatario
-            remote_number = remote_number.split('@')[0] if remote_number else ''
-            key = {
-                'id': msg.id_mensagem,
-                'remoteJid': f"{remote_number}@s.whatsapp.net",
-                'fromMe': msg.de_mim
-            }
-
-            media_result = service.get_media_base64(key)
-
-            if not media_result or not media_result.get('base64'):
-                return Response({'error': 'could_not_download_audio'}, status=500)
-
-            base64_data = media_result['base64']
-            mimetype = media_result.get('mimetype', 'audio/ogg')
-
-            # Formata o base64 para reprodução
-            audio_url = f"data:{mimetype};base64,{base64_data}"
-
-            # Salva no banco para próximas requisições
             try:
-                msg.media_base64 = audio_url
-                msg.save(update_fields=['media_base64'])
-                logger.info(f"[TranscribeAudio] msg={msg.id} áudio salvo no DB para cache")
+                base64_data, mimetype_baixado = media_fetcher.baixar(msg)
+                if not base64_data:
+                    # Outro download da mesma mídia terminou antes
+                    base64_data, mimetype_baixado = media_store.ler_base64(msg)
             except Exception as e:
-                logger.warning(f"[TranscribeAudio] Falha ao salvar cache DB: {e}")
+                logger.error(f"[TranscribeAudio] Falha ao baixar áudio para msg={msg.id}: {e}")
+                return Response({'error': 'could_not_download_audio'}, status=500)
+            if not base64_data:
+                return Response({'error': 'could_not_download_audio'}, status=500)
+
+            mimetype = mimetype_baixado or mimetype
+            audio_url = media_store.url_midia(msg, request)
 
         # Tenta transcrever
         transcription_text = None
@@ -3683,16 +3771,18 @@ class WhatsappViewSet(viewsets.ModelViewSet):
             logger.info(f"[TranscribeAudio] Iniciando transcrição para msg {message_id}")
             logger.info(f"[TranscribeAudio] Mimetype: {mimetype}, Base64 len: {len(base64_data)}")
 
-            result = transcribe_from_base64(base64_data, mimetype)
+            # Com o whisper_worker ativo, espera o pedido interativo (prioridade máxima)
+            result = transcricao.transcrever(msg, base64_data, mimetype, interativa=True, stream=stream)
             logger.info(f"[TranscribeAudio] Resultado: {result}")
 
-            if result and result.get('text'):
+            if result and result.get('pendente') and stream:
+                logger.info(f"[TranscribeAudio] msg {message_id} em transcrição progressiva")
+            elif result and result.get('pendente'):
+                transcription_error = "transcription_pending"
+                logger.info(f"[TranscribeAudio] msg {message_id} continua na fila de transcrição")
+            elif result and result.get('text'):
                 transcription_text = result['text']
                 duration = result.get('duration', 0)
-
-                # Atualiza a mensagem no banco
-                msg.texto = f"🎤 [Áudio {int(duration)}s]: {transcription_text}"
-                msg.save(update_fields=['texto'])
                 logger.info(f"[TranscribeAudio] Sucesso! Texto: {transcription_text[:50]}...")
             else:
                 transcription_error = "transcription_empty"
@@ -3709,6 +3799,7 @@ class WhatsappViewSet(viewsets.ModelViewSet):
             'transcription': transcription_text,
             'duration': duration,
             'updated_text': msg.texto,
+            'streaming': stream and transcription_text is None and transcription_error is None,
             'error': transcription_error
         })
 
@@ -3729,6 +3820,7 @@ class WhatsappWebhookView(APIView):
 
     def post(self, request):
         import json
+        from .services.whatsapp_webhook import extrair_evento, extrair_mensagens, processar_payload
 
         if not self._validate_webhook_token(request):
             logger.warning("[WEBHOOK] Requisição rejeitada: token inválido")
@@ -3736,285 +3828,30 @@ class WhatsappWebhookView(APIView):
 
         data = request.data
 
-        # Log para debug (ajuda muito a identificar mudanças na API Evolution)
-        logger.warning(f"[WEBHOOK] Payload recebido | event={data.get('event')} instance={data.get('instance')} | {json.dumps(data)[:800]}")
-        
-        event = data.get('event', '').lower()
-        instance = data.get('instance', 'unknown')
-
-        # Normaliza o nome do evento
-        event = event.replace('_', '.')
-        
-        # Aceita mensagens recebidas/atribuídas e enviadas
-        if 'messages' in event or 'message' in event:
-            # Tenta encontrar a lista de mensagens em qualquer lugar do payload
-            messages = []
-            
-            # Formatos comuns da Evolution API:
-            # 1. data['data']['messages']
-            # 2. data['messages']
-            # 3. data['data'] (se for uma única mensagem)
-            
-            if 'data' in data and isinstance(data['data'], dict) and 'messages' in data['data']:
-                messages = data['data']['messages']
-            elif 'messages' in data:
-                messages = data['messages']
-            elif 'data' in data:
-                messages = [data['data']] if isinstance(data['data'], dict) else []
-            else:
-                # Se não achou nos lugares comuns, procura por 'key' no root (formado de mensagem única)
-                if 'key' in data:
-                    messages = [data]
-
-            if not messages:
-                # print(f"[WEBHOOK] Nenhum conteúdo de mensagem encontrado para o evento {event}", file=sys.stderr)
-                return Response({'status': 'ignored'}, status=200)
-
-            # print(f"[WEBHOOK] Processando {len(messages)} mensagens do evento '{event}'", file=sys.stderr)
-
-            for msg_data in messages:
-                try:
-                    key = msg_data.get('key', {})
-                    id_msg = key.get('id')
-
-                    if not id_msg:
-                        continue
-                    
-                    remote_jid = key.get('remoteJid', '')
-                    from_me = key.get('fromMe', False)
-                    
-                    # Trata reações (reactionMessage) — atualiza a mensagem original
-                    message_content = msg_data.get('message', {})
-                    if 'reactionMessage' in message_content:
-                        reaction = message_content['reactionMessage']
-                        original_id = reaction.get('key', {}).get('id')
-                        emoji = reaction.get('text', '')
-                        remote_number = remote_jid.split('@')[0] if remote_jid else ''
-                        try:
-                            original_msg = WhatsappMessage.objects.get(id_mensagem=original_id)
-                            reacoes = list(original_msg.reacoes or [])
-                            # Remove reação anterior do mesmo número
-                            reacoes = [r for r in reacoes if r.get('numero') != remote_number]
-                            if emoji:  # string vazia = remoção da reação
-                                reacoes.append({'emoji': emoji, 'de_mim': from_me, 'numero': remote_number})
-                            original_msg.reacoes = reacoes
-                            original_msg.save(update_fields=['reacoes'])
-                        except WhatsappMessage.DoesNotExist:
-                            pass
-                        continue  # Reação não é salva como mensagem nova
-
-                    # Previne duplicatas
-                    if WhatsappMessage.objects.filter(id_mensagem=id_msg).exists():
-                        continue
-
-                    # Extrai texto
-                    message_content = msg_data.get('message', {})
-                    text = ""
-                    media_url = None
-                    
-                    if 'conversation' in message_content:
-                        text = message_content['conversation']
-                    elif 'extendedTextMessage' in message_content:
-                        text = message_content['extendedTextMessage'].get('text', '')
-                    elif 'buttonsResponseMessage' in message_content:
-                        text = message_content['buttonsResponseMessage'].get('selectedDisplayText', '')
-                    
-                    # Mídia
-                    mtype = 'text'
-                    media_base64 = None
-                    needs_async_processing = False
-                    
-                    if not text:
-                        for media_type in ['imageMessage', 'videoMessage', 'documentMessage', 'audioMessage']:
-                            if media_type in message_content:
-                                media_content = message_content[media_type]
-                                text = media_content.get('caption', '')
-                                mtype = media_type.replace('Message', '')
-                                
-                                # Extrai URL da mídia para referência
-                                media_url = media_content.get('url') or media_content.get('directPath')
-
-                                # Captura base64 se a Evolution API enviou via Webhook Base64
-                                inline_b64 = media_content.get('base64') or msg_data.get('base64')
-                                if inline_b64:
-                                    mimetype = media_content.get('mimetype') or media_content.get('mimeType') or ''
-                                    if not inline_b64.startswith('data:'):
-                                        inline_b64 = f"data:{mimetype};base64,{inline_b64}" if mimetype else inline_b64
-                                    media_base64 = inline_b64
-
-                                # Define texto temporário; só marca async se não tiver base64 inline
-                                if media_type == 'audioMessage':
-                                    if not text:
-                                        text = "🎤 [Áudio]"
-                                    if not media_base64:
-                                        needs_async_processing = True
-
-                                elif media_type == 'imageMessage':
-                                    if not text:
-                                        text = "📷 [Imagem]"
-                                    if not media_base64:
-                                        needs_async_processing = True
-                                    
-                                elif media_type == 'videoMessage':
-                                    if not text:
-                                        text = "🎥 [Vídeo]"
-                                        
-                                elif media_type == 'documentMessage':
-                                    filename = media_content.get('fileName', 'documento')
-                                    if not text:
-                                        text = f"📄 [{filename}]"
-                                
-                                if not text:
-                                    text = f'[{media_type}]'
-                                break
-
-                    # Timestamp
-                    ts_int = msg_data.get('messageTimestamp')
-                    dt = timezone.datetime.fromtimestamp(int(ts_int), tz=dt_timezone.utc) if ts_int else timezone.now()
-
-                    # Determina números
-                    remote_number = remote_jid.split('@')[0] if remote_jid else ''
-                    
-                    if from_me:
-                        numero_remetente = instance
-                        numero_destinatario = remote_number
-                    else:
-                        numero_remetente = remote_number
-                        numero_destinatario = instance
-
-                    # Salva
-                    msg_obj = WhatsappMessage.objects.create(
-                        id_mensagem=id_msg,
-                        instancia=instance,
-                        de_mim=from_me,
-                        numero_remetente=numero_remetente,
-                        numero_destinatario=numero_destinatario,
-                        texto=text or '[sem texto]',
-                        tipo_mensagem=mtype,
-                        url_media=media_url,
-                        media_base64=media_base64 if mtype in ['image', 'audio'] else None,
-                        timestamp=dt
-                    )
-                    
-                    # Tenta linkar com Lead/Oportunidade
-                    EvolutionService.identify_and_link_message(msg_obj)
-
-                    # Encaminha para responsável do canal (se habilitado)
-                    if not from_me and msg_obj.oportunidade_id:
-                        try:
-                            msg_obj.refresh_from_db()
-                            opp = msg_obj.oportunidade
-                            if opp and opp.canal and opp.canal.encaminhar_whatsapp_responsavel:
-                                canal_obj = opp.canal
-                                resp = canal_obj.responsavel
-                                if resp and resp.telefone:
-                                    resp_number = ''.join(filter(str.isdigit, resp.telefone))
-                                    # Evita loop: não encaminha se o remetente é o próprio responsável
-                                    if resp_number and resp_number not in (remote_number, f'55{remote_number}'):
-                                        service_fwd = EvolutionService.for_canal(canal_obj)
-                                        conta_nome = opp.conta.nome_empresa if opp.conta else ''
-                                        contato_nome = opp.contato.nome if opp.contato else remote_number
-                                        header = f"📩 *{contato_nome}*"
-                                        if conta_nome:
-                                            header += f" ({conta_nome})"
-                                        fwd_text = f"{header}\n\n{text}"
-                                        import threading as _threading
-                                        def _forward(svc, num, txt):
-                                            try:
-                                                svc.send_text(num, txt)
-                                            except Exception as fe:
-                                                logger.error(f"[WEBHOOK] Erro ao encaminhar msg para responsável: {fe}")
-                                        t = _threading.Thread(target=_forward, args=(service_fwd, resp_number, fwd_text))
-                                        t.daemon = True
-                                        t.start()
-                        except Exception as fwd_err:
-                            logger.error(f"[WEBHOOK] Erro ao verificar encaminhamento: {fwd_err}")
-
-                    # Processamento assíncrono de mídia (imagens e áudios)
-                    if needs_async_processing and mtype in ['image', 'audio']:
-                        import threading
-                        import time
-                        
-                        def process_media_async(msg_id, msg_key, instance_name, media_type):
-                            """Processa mídia em background após delay para API estar pronta"""
-                            try:
-                                time.sleep(3)  # Aguarda API processar
-                                
-                                from django.db import connection
-                                connection.close()  # Força nova conexão
-                                
-                                from .models import WhatsappMessage
-                                from .services.evolution_api import EvolutionService
-                                
-                                msg = WhatsappMessage.objects.get(id=msg_id)
-                                
-                                # Obtém serviço do canal correto
-                                service = EvolutionService(
-                                    instance_name=instance_name,
-                                    instance_token=None
-                                )
-                                
-                                # Tenta pegar de configuração do canal via Oportunidade
-                                if msg.oportunidade and msg.oportunidade.canal:
-                                    service = EvolutionService(
-                                        instance_name=msg.oportunidade.canal.evolution_instance_name or instance_name,
-                                        instance_token=msg.oportunidade.canal.evolution_token
-                                    )
-                                
-                                media_result = service.get_media_base64(msg_key)
-                                
-                                if media_result and media_result.get('base64'):
-                                    if media_type == 'image':
-                                        # Salva imagem
-                                        mimetype = media_result.get('mimetype', 'image/jpeg')
-                                        base64_data = media_result['base64']
-                                        if not base64_data.startswith('data:'):
-                                            base64_data = f"data:{mimetype};base64,{base64_data}"
-                                        msg.media_base64 = base64_data
-                                        msg.save(update_fields=['media_base64'])
-
-                                    elif media_type == 'audio':
-                                        # Salva base64 do áudio para reprodução futura
-                                        mimetype = media_result.get('mimetype', 'audio/ogg; codecs=opus')
-                                        audio_b64 = media_result['base64']
-                                        if not audio_b64.startswith('data:'):
-                                            audio_b64 = f"data:{mimetype};base64,{audio_b64}"
-                                        msg.media_base64 = audio_b64
-
-                                        # Transcreve áudio
-                                        from .services.audio_transcription import transcribe_from_base64
-                                        transcription = transcribe_from_base64(
-                                            media_result['base64'],
-                                            media_result.get('mimetype', '')
-                                        )
-                                        if transcription and transcription.get('text'):
-                                            duration = transcription.get('duration', 0)
-                                            msg.texto = f"🎤 [Áudio {int(duration)}s]: {transcription['text']}"
-                                            msg.save(update_fields=['texto', 'media_base64'])
-                                        else:
-                                            msg.save(update_fields=['media_base64'])
-
-                            except Exception as e:
-                                logger.error(f"[ASYNC] Erro ao processar mídia {msg_id}: {e}")
-
-                        # Dispara thread
-                        msg_key_for_thread = {
-                            'id': id_msg,
-                            'remoteJid': remote_jid,
-                            'fromMe': from_me
-                        }
-                        thread = threading.Thread(
-                            target=process_media_async,
-                            args=(msg_obj.id, msg_key_for_thread, instance, mtype)
-                        )
-                        thread.daemon = True
-                        thread.start()
-
-                except Exception as e:
-                    logger.error(f"[WEBHOOK] Erro ao processar mensagem: {str(e)}")
-                    continue
+        # Só o resumo: mídias trazem base64 de vários MB e o payload inteiro já fica em WebhookEvento
+        mensagens = extrair_mensagens(data)
+        primeira = mensagens[0] if mensagens and isinstance(mensagens[0], dict) else {}
+        logger.info(
+            f"[WEBHOOK] Payload recebido | event={data.get('event')} instance={data.get('instance')} "
+            f"key={(primeira.get('key') or {}).get('id')} mensagens={len(mensagens)}"
+        )
+        if logger.isEnabledFor(logging.DEBUG):
+            # Payload para identificar mudanças na API Evolution
+            logger.debug(f"[WEBHOOK] Payload | {json.dumps(data)[:800]}")
+
+        # Modo assíncrono: apenas persiste o payload bruto na caixa de entrada e
+        # responde imediatamente. O worker `process_webhook_inbox` faz o resto.
+        if getattr(settings, 'WHATSAPP_WEBHOOK_ASYNC', False):
+            event, instance = extrair_evento(data)
+            WebhookEvento.objects.create(
+                instancia=str(instance)[:100],
+                evento=event[:100],
+                payload=data,
+            )
+            return Response({'status': 'queued'}, status=200)
 
-        return Response({'status': 'received'}, status=200)
+        result = processar_payload(data)
+        return Response({'status': result}, status=200)
 
 
 class LogViewSet(viewsets.ReadOnlyModelViewSet):
@@ -4197,8 +4034,9 @@ class OrganogramaViewSet(viewsets.ViewSet):
 class TimelineViewSet(viewsets.ViewSet):
     """
     ViewSet unificado para a Timeline (Feed)
-    Agrega Atividades, Mensagens do WhatsApp e Logs em uma única lista cronológica.
-    Endpoint: /api/timeline/?model=oportunidade&id=1
+    Agrega Atividades, Mensagens do WhatsApp e Logs em uma única lista cronológica,
+    lida da tabela materializada TimelineEvento (services.timeline).
+    Endpoint: /api/timeline/?model=oportunidade&id=1[&cursor=...]
     """
     permission_classes = [permissions.IsAuthenticated]
 
@@ -4212,168 +4050,39 @@ class TimelineViewSet(viewsets.ViewSet):
                 status=status.HTTP_400_BAD_REQUEST
             )
 
-        # 1. Identificar a entidade
-        entity = None
-        if model_name == 'oportunidade':
-            entity = Oportunidade.objects.filter(id=model_id).first()
-        elif model_name == 'contato':
-            entity = Contato.objects.filter(id=model_id).first()
-        elif model_name == 'conta':
-            entity = Conta.objects.filter(id=model_id).first()
-        
-        if not entity:
+        # Entidade: o model é o escopo da tabela TimelineEvento
+        modelo = timeline.ESCOPOS.get(model_name)
+        if modelo is None or not model_id.isdigit() or not modelo.objects.filter(id=model_id).exists():
             return Response({'error': 'Objeto não encontrado'}, status=status.HTTP_404_NOT_FOUND)
 
-        # 2. Buscar Dados
-        timeline_items = []
-        related_oportunidade_ids = []
-        related_conta_id = None
-        phone_lookup_values = set()
-
-        def add_phone_variants(raw_phone):
-            digits = re.sub(r'\D', '', str(raw_phone or ''))
-            if not digits:
-                return
-
-            candidates = {digits}
-            if digits.startswith('55') and len(digits) > 2:
-                candidates.add(digits[2:])
-            elif len(digits) <= 11:
-                candidates.add(f"55{digits}")
-
-            for number in candidates:
-                if not number:
-                    continue
-                phone_lookup_values.add(number)
-                phone_lookup_values.add(f"{number}@s.whatsapp.net")
-
-        if model_name == 'contato':
-            related_conta_id = entity.conta_id
-            related_oportunidade_ids = list(
-                Oportunidade.objects.filter(
-                    Q(contato_principal=entity) | Q(contatos=entity)
-                ).values_list('id', flat=True).distinct()
-            )
+        return self._pagina(request, model_name, int(model_id))
 
-            add_phone_variants(entity.telefone)
-            add_phone_variants(entity.celular)
-            for phone in entity.telefones.values_list('numero', flat=True):
-                add_phone_variants(phone)
-        elif model_name == 'conta':
-            related_oportunidade_ids = list(
-                Oportunidade.objects.filter(
-                    Q(conta=entity) | Q(empresas=entity)
-                ).values_list('id', flat=True).distinct()
-            )
-            add_phone_variants(entity.telefone_principal)
-
-        # A. Atividades (Padrão Django ContentType)
-        # Precisamos descobrir o ContentType do modelo
-        from django.contrib.contenttypes.models import ContentType
-        ct = ContentType.objects.get_for_model(entity)
-        atividades_filter = Q(content_type=ct, object_id=entity.id)
-
-        if model_name == 'contato':
-            if related_conta_id:
-                ct_conta = ContentType.objects.get_for_model(Conta)
-                atividades_filter |= Q(content_type=ct_conta, object_id=related_conta_id)
-            if related_oportunidade_ids:
-                ct_oportunidade = ContentType.objects.get_for_model(Oportunidade)
-                atividades_filter |= Q(content_type=ct_oportunidade, object_id__in=related_oportunidade_ids)
-        elif model_name == 'conta' and related_oportunidade_ids:
-            ct_oportunidade = ContentType.objects.get_for_model(Oportunidade)
-            atividades_filter |= Q(content_type=ct_oportunidade, object_id__in=related_oportunidade_ids)
-
-        atividades = Atividade.objects.filter(atividades_filter).select_related('proprietario')
-        
-        for item in atividades:
-            timeline_items.append({
-                'id': f"atividade_{item.id}",
-                'db_id': item.id,
-                'type': 'atividade',
-                'subtype': item.tipo, # TAREFA, LIGACAO, NOTA, etc
-                'timestamp': item.data_criacao,
-                'author': item.proprietario.get_full_name() if item.proprietario else 'Sistema',
-                'content': item.descricao or item.titulo,
-                'title': item.titulo,
-                'status': item.status,
-                'data': AtividadeSerializer(item).data
-            })
-
-        # B. WhatsApp Messages
-        # Lógica de vínculo varia por modelo
-        msgs = WhatsappMessage.objects.none()
-        if model_name == 'oportunidade':
-            # Mensagens vinculadas diretamente à oportunidade
-            # OU mensagens do contato principal da oportunidade (opcional, pode ser complexo filtrar data)
-            msgs = WhatsappMessage.objects.filter(oportunidade=entity)
-        elif model_name in ['contato', 'conta']:
-            msg_filter = Q()
-            has_msg_filters = False
-
-            if related_oportunidade_ids:
-                msg_filter |= Q(oportunidade_id__in=related_oportunidade_ids)
-                has_msg_filters = True
-
-            if phone_lookup_values:
-                msg_filter |= Q(numero_remetente__in=phone_lookup_values) | Q(numero_destinatario__in=phone_lookup_values)
-                has_msg_filters = True
-
-            if has_msg_filters:
-                msgs = WhatsappMessage.objects.filter(msg_filter).distinct()
-        
-        for item in msgs:
-            timeline_items.append({
-                'id': f"whatsapp_{item.id}",
-                'db_id': item.id,
-                'type': 'whatsapp',
-                'subtype': item.tipo_mensagem, # text, image, audio
-                'timestamp': item.timestamp,
-                'author': 'Eu' if item.de_mim else (item.numero_remetente or 'Cliente'),
-                'direction': 'outbound' if item.de_mim else 'inbound',
-                'content': item.texto or f"[{item.tipo_mensagem or 'midia'}]",
-                'status': 'read' if item.lida else 'delivered',
-                'data': WhatsappMessageSerializer(item).data
-            })
-
-        # C. Logs (Audit)
-        log_filter = Q(modelo=entity.__class__.__name__, objeto_id=entity.id)
-
-        if model_name == 'contato':
-            if related_conta_id:
-                log_filter |= Q(modelo='Conta', objeto_id=related_conta_id)
-            if related_oportunidade_ids:
-                log_filter |= Q(modelo='Oportunidade', objeto_id__in=related_oportunidade_ids)
-        elif model_name == 'conta' and related_oportunidade_ids:
-            log_filter |= Q(modelo='Oportunidade', objeto_id__in=related_oportunidade_ids)
-
-        logs = Log.objects.filter(log_filter)
-        for item in logs:
-             timeline_items.append({
-                'id': f"log_{item.id}",
-                'db_id': item.id,
-                'type': 'log',
-                'subtype': item.acao,
-                'timestamp': item.timestamp,
-                'author': item.usuario.get_full_name() if item.usuario else 'Sistema',
-                'content': f"{item.get_acao_display()}: {item.observacao or ''}",
-                'data': LogSerializer(item).data
-            })
-
-        # 3. Ordenação (Do mais recente para o mais antigo)
-        timeline_items.sort(key=lambda x: x['timestamp'], reverse=True)
-
-        # 4. Paginação Manual
-        page = int(request.query_params.get('page', 1))
-        page_size = 20
-        start = (page - 1) * page_size
-        end = start + page_size
-        
-        paginated_items = timeline_items[start:end]
-        
-        return Response({
-            'count': len(timeline_items),
-            'results': paginated_items,
-            'page': page,
-            'pages': max(1, (len(timeline_items) + page_size - 1) // page_size)
-        })
+    def _pagina(self, request, escopo, entidade_id):
+        """
+        Pagina por ?cursor= (next da resposta anterior). ?page=N sem cursor
+        continua aceito para clientes antigos, por deslocamento.
+        """
+        cursor = request.query_params.get('cursor')
+        deslocamento = 0
+        page = None
+        try:
+            if cursor:
+                cursor = timeline.decodificar_cursor(cursor)
+            elif request.query_params.get('page'):
+                page = max(1, int(request.query_params['page']))
+                deslocamento = (page - 1) * timeline.TAMANHO_PAGINA
+        except (timeline.CursorInvalido, ValueError):
+            return Response({'error': 'Cursor ou página inválidos'}, status=status.HTTP_400_BAD_REQUEST)
+
+        linhas, tem_mais = timeline.pagina(escopo, entidade_id, cursor=cursor or None, deslocamento=deslocamento)
+
+        proximo = None
+        if tem_mais:
+            fonte, item_id, momento = linhas[-1]
+            url = remove_query_param(request.build_absolute_uri(), 'page')
+            proximo = replace_query_param(url, 'cursor', timeline.codificar_cursor(momento, fonte, item_id))
+
+        resposta = {'results': timeline.itens(linhas, request), 'next': proximo}
+        if page is not None:
+            resposta['page'] = page
+        return Response(resposta)
@@ -4,30 +4,44 @@ Endpoints REST para inbox de conversas por canal.
 """
 
 import logging
+import re
 from datetime import timedelta
-from django.db.models import Max, Count, Q, Subquery, OuterRef
-from django.db.models.functions import Coalesce
+from django.db.models import Q
 from django.utils import timezone
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated
+from rest_framework.pagination import CursorPagination
 
-from .models import WhatsappMessage, Canal, Contato, NumeroBloqueado, Funil
+from .models import Canal, Conversa, Funil
+from .services import bloqueados
+from .services.phone import canonical_phone
 
 logger = logging.getLogger(__name__)
 
 
+class ConversasCursorPagination(CursorPagination):
+    """Paginação por cursor do inbox: estável mesmo com conversas subindo para o topo."""
+    page_size = 100
+    page_size_query_param = 'page_size'
+    max_page_size = 500
+    ordering = ('-ultima_recebida_timestamp', '-id')
+
+
 class InboxConversasView(APIView):
     """
     GET /api/atendimento/conversas/
 
-    Retorna lista de conversas agrupadas por número remetente,
+    Retorna lista de conversas (tabela Conversa, mantida por services.conversas),
     filtradas pelo canal do usuário logado (ou por canal_id para Admin).
 
     Query params:
         canal_id   (int, optional)   — Admin pode especificar canal
         funil_tipo (str, optional)   — VENDAS | SUPORTE | POS_VENDA
-        search     (str, optional)   — filtra por número ou nome
+        search     (str, optional)   — filtra por número ou nome do contato
+        dias       (int, optional)   — janela pela última mensagem recebida (padrão 30)
+        page_size  (int, optional)   — padrão 100, máx. 500
+        cursor     (str, optional)   — cursor da próxima página (campo `next`)
     """
     permission_classes = [IsAuthenticated]
 
@@ -48,127 +62,34 @@ class InboxConversasView(APIView):
                 return Response({'conversas': [], 'canal': None})
             canal_id = canal.id
 
-        # Base queryset: mensagens do canal (filtra por instancia)
-        # Limita por período para evitar carregar histórico inteiro do celular
+        # Limita por período da última mensagem recebida
         dias_inbox = int(request.query_params.get('dias', 30))
         data_limite = timezone.now() - timedelta(days=dias_inbox)
 
+        qs = Conversa.objects.filter(ultima_recebida_timestamp__gte=data_limite).select_related('contato')
+
         # Exclui números bloqueados
-        numeros_bloqueados = list(NumeroBloqueado.objects.values_list('numero', flat=True))
-        qs = WhatsappMessage.objects.filter(timestamp__gte=data_limite)
-        if numeros_bloqueados:
-            q_block = Q()
-            for nb in numeros_bloqueados:
-                q_block |= Q(numero_remetente__icontains=nb)
-                q_block |= Q(numero_destinatario__icontains=nb)
-            qs = qs.exclude(q_block)
+        chaves_bloqueadas = bloqueados.chaves()
+        if chaves_bloqueadas:
+            qs = qs.exclude(numero_chave__in=chaves_bloqueadas)
 
         if canal:
             qs = qs.filter(instancia=canal.evolution_instance_name)
-        elif canal_id:
-            canal_obj = Canal.objects.filter(id=canal_id).first()
-            if canal_obj:
-                qs = qs.filter(instancia=canal_obj.evolution_instance_name)
 
         # Filtro por funil_tipo
         funil_tipo = request.query_params.get('funil_tipo')
         if funil_tipo:
-            qs = qs.filter(oportunidade__funil__tipo=funil_tipo)
+            qs = qs.filter(funil_tipo=funil_tipo)
 
-        # Busca por número
+        # Busca por número ou nome
         search = request.query_params.get('search', '').strip()
         if search:
-            qs = qs.filter(
-                Q(numero_remetente__icontains=search) |
-                Q(numero_destinatario__icontains=search)
-            )
-
-        # Agrupa por número remetente (contatos que enviaram para nós)
-        # Exclui mensagens que "nós" enviamos como remetente
-        qs_recebidas = qs.filter(de_mim=False)
-
-        # Pega números únicos com última mensagem e contagem de não lidas
-        numeros = (
-            qs_recebidas
-            .values('numero_remetente')
-            .annotate(
-                ultima_timestamp=Max('timestamp'),
-                nao_lidas=Count('id', filter=Q(lida=False)),
-            )
-            .order_by('-ultima_timestamp')[:100]
-        )
-
-        conversas = []
-        for item in numeros:
-            numero = item['numero_remetente']
-
-            # Última mensagem (pode ser recebida ou enviada)
-            ultima_msg = (
-                qs.filter(
-                    Q(numero_remetente=numero) | Q(numero_destinatario=numero)
-                )
-                .order_by('-timestamp')
-                .values('texto', 'tipo_mensagem', 'de_mim', 'timestamp', 'oportunidade_id')
-                .first()
-            )
-
-            # Tenta resolver nome do contato (inclui conta_id para classificação)
-            contato = (
-                Contato.objects
-                .filter(
-                    Q(celular__icontains=numero[-8:]) |
-                    Q(telefone__icontains=numero[-8:])
-                )
-                .values('id', 'nome', 'conta_id')
-                .first()
-            )
-
-            # Funil tipo (da oportunidade vinculada)
-            oportunidade_id = ultima_msg.get('oportunidade_id') if ultima_msg else None
-            funil_tipo_conv = None
-            if oportunidade_id:
-                from .models import Oportunidade
-                opp = Oportunidade.objects.filter(id=oportunidade_id).select_related('funil').first()
-                if opp and opp.funil:
-                    funil_tipo_conv = opp.funil.tipo
-
-            # Se não tem oportunidade pela mensagem, tenta pelo contato
-            if not oportunidade_id and contato:
-                from .models import Oportunidade
-                opp_contato = Oportunidade.objects.filter(
-                    Q(conta__contatos__id=contato['id']) |
-                    Q(contato_principal_id=contato['id'])
-                ).order_by('-data_criacao').values('id', 'funil__tipo').first()
-                if opp_contato:
-                    oportunidade_id = opp_contato['id']
-                    funil_tipo_conv = opp_contato.get('funil__tipo')
-
-            texto_preview = ''
-            if ultima_msg:
-                texto = ultima_msg.get('texto') or ''
-                tipo = ultima_msg.get('tipo_mensagem', 'text')
-                if tipo == 'audio':
-                    texto_preview = '🎤 Áudio'
-                elif tipo == 'image':
-                    texto_preview = '📷 Imagem'
-                elif tipo == 'document':
-                    texto_preview = '📄 Documento'
-                else:
-                    texto_preview = texto[:80]
-
-            conversas.append({
-                'numero': numero,
-                'nome_contato': contato['nome'] if contato else numero,
-                'contato_id': contato['id'] if contato else None,
-                'conta_id': contato.get('conta_id') if contato else None,
-                'ultima_mensagem': texto_preview,
-                'ultima_mensagem_timestamp': item['ultima_timestamp'].isoformat() if item['ultima_timestamp'] else None,
-                'de_mim': ultima_msg.get('de_mim', False) if ultima_msg else False,
-                'nao_lidas': item['nao_lidas'],
-                'oportunidade_id': oportunidade_id,
-                'funil_tipo': funil_tipo_conv,
-                'canal_id': canal.id if canal else None,
-            })
+            # Número completo: busca exata pela chave; trecho: busca parcial
+            search_chave = canonical_phone(search) if len(re.sub(r'\D', '', search)) >= 10 else ''
+            if search_chave:
+                qs = qs.filter(numero_chave=search_chave)
+            else:
+                qs = qs.filter(Q(numero__icontains=search) | Q(contato__nome__icontains=search))
 
         # Filtra por funis do usuário (não-admin só vê conversas dos seus funis)
         is_admin = user.perfil == 'ADMIN' or user.is_superuser
@@ -182,13 +103,34 @@ class InboxConversasView(APIView):
             )
             if funis_tipos_usuario:
                 # Mostra: conversas do funil do usuário + desconhecidos (sem funil)
-                conversas = [
-                    c for c in conversas
-                    if c['funil_tipo'] in funis_tipos_usuario or c['funil_tipo'] is None
-                ]
+                qs = qs.filter(Q(funil_tipo__in=funis_tipos_usuario) | Q(funil_tipo__isnull=True))
+
+        paginator = ConversasCursorPagination()
+        pagina = paginator.paginate_queryset(qs, request, view=self)
+
+        conversas = [
+            {
+                'numero': c.numero,
+                'nome_contato': c.contato.nome if c.contato else c.numero,
+                'contato_id': c.contato_id,
+                'conta_id': c.contato.conta_id if c.contato else None,
+                'ultima_mensagem': c.ultima_mensagem,
+                'ultima_mensagem_timestamp': (
+                    c.ultima_recebida_timestamp.isoformat() if c.ultima_recebida_timestamp else None
+                ),
+                'de_mim': c.ultima_mensagem_de_mim,
+                'nao_lidas': c.nao_lidas,
+                'oportunidade_id': c.oportunidade_id,
+                'funil_tipo': c.funil_tipo,
+                'canal_id': canal.id if canal else None,
+            }
+            for c in pagina
+        ]
 
         return Response({
             'conversas': conversas,
+            'next': paginator.get_next_link(),
+            'previous': paginator.get_previous_link(),
             'canal': {
                 'id': canal.id,
                 'nome': canal.nome,
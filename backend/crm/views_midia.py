@@ -0,0 +1,140 @@
+"""
+Streaming das mídias do WhatsApp (services.media_store).
+
+GET /api/whatsapp/midia/<assinatura>/
+
+A URL é assinada pelo servidor (media_store.url_midia) e vai direto em
+<img>/<audio>, que não enviam o JWT; por isso a view não usa a autenticação
+do DRF. A assinatura expira (MIDIA_URL_TTL): URL adulterada ou vencida dá
+404. Suporta HTTP Range (seek em áudios) e cache pelo hash do conteúdo.
+"""
+
+import logging
+import os
+import re
+
+from django.conf import settings
+from django.http import Http404, HttpResponse, StreamingHttpResponse
+from django.views.decorators.http import require_GET
+
+from .models import WhatsappMessage
+from .services import media_store
+
+logger = logging.getLogger(__name__)
+
+TAMANHO_BLOCO = 64 * 1024
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def _intervalo(cabecalho, tamanho):
+    """
+    Interpreta um cabeçalho Range de intervalo único.
+
+    Returns:
+        (inicio, fim) inclusivo, None para ignorar o cabeçalho (resposta
+        completa) ou False se o intervalo não for satisfazível (416)
+    """
+    m = RANGE_RE.match(cabecalho.strip())
+    if not m or m.groups() == ('', ''):
+        return None
+    inicio, fim = m.groups()
+    if inicio == '':
+        sufixo = int(fim)
+        if sufixo == 0:
+            return False
+        return max(tamanho - sufixo, 0), tamanho - 1
+    inicio = int(inicio)
+    fim = min(int(fim), tamanho - 1) if fim else tamanho - 1
+    if inicio >= tamanho or inicio > fim:
+        return False
+    return inicio, fim
+
+
+def _ler(caminho, inicio, quantidade):
+    with open(caminho, 'rb') as f:
+        f.seek(inicio)
+        while quantidade > 0:
+            bloco = f.read(min(TAMANHO_BLOCO, quantidade))
+            if not bloco:
+                break
+            quantidade -= len(bloco)
+            yield bloco
+
+
+def _resolver(valor):
+    """(media_hash, mimetype) do valor assinado; migra mensagens legadas."""
+    if valor.startswith('m') and valor[1:].isdigit():
+        msg = WhatsappMessage.objects.filter(id=int(valor[1:])).first()
+        if not msg:
+            raise Http404
+        if not msg.media_hash:
+            try:
+                media_store.migrar_legado(msg)
+            except media_store.MidiaInvalida as e:
+                logger.warning(f'[Midia] msg={msg.id} base64 inválido: {e}')
+                raise Http404
+        if not msg.media_hash:
+            raise Http404
+        return msg.media_hash, msg.media_mimetype
+
+    if not media_store.HASH_RE.match(valor):
+        raise Http404
+    mimetype = (
+        WhatsappMessage.objects
+        .filter(media_hash=valor)
+        .values_list('media_mimetype', flat=True)
+        .first()
+    )
+    if mimetype is None:
+        raise Http404
+    return valor, mimetype
+
+
+@require_GET
+def midia_whatsapp(request, assinatura):
+    valor = media_store.resolver_assinatura(assinatura)
+    if not valor:
+        raise Http404
+
+    media_hash, mimetype = _resolver(valor)
+    caminho = media_store.caminho(media_hash)
+    try:
+        tamanho = os.path.getsize(caminho)
+    except OSError:
+        logger.error(f'[Midia] Arquivo ausente no store: {media_hash}')
+        raise Http404
+
+    etag = f'"{media_hash}"'
+    cabecalhos = {
+        'ETag': etag,
+        'Accept-Ranges': 'bytes',
+        # Conteúdo endereçado por hash nunca muda, mas a URL só vale até a assinatura expirar
+        'Cache-Control': f'private, max-age={settings.MIDIA_URL_TTL}, immutable',
+    }
+
+    if etag in request.headers.get('If-None-Match', ''):
+        resposta = HttpResponse(status=304)
+    else:
+        intervalo = _intervalo(request.headers.get('Range', ''), tamanho)
+        if intervalo is False:
+            resposta = HttpResponse(status=416)
+            resposta['Content-Range'] = f'bytes */{tamanho}'
+        elif intervalo:
+            inicio, fim = intervalo
+            resposta = StreamingHttpResponse(
+                _ler(caminho, inicio, fim - inicio + 1),
+                status=206,
+                content_type=mimetype or 'application/octet-stream',
+            )
+            resposta['Content-Range'] = f'bytes {inicio}-{fim}/{tamanho}'
+            resposta['Content-Length'] = str(fim - inicio + 1)
+        else:
+            resposta = StreamingHttpResponse(
+                _ler(caminho, 0, tamanho),
+                content_type=mimetype or 'application/octet-stream',
+            )
+            resposta['Content-Length'] = str(tamanho)
+
+    for nome, valor_cabecalho in cabecalhos.items():
+        resposta[nome] = valor_cabecalho
+    return resposta
@@ -7,6 +7,15 @@ export const whatsappService = {
         return api.get('/whatsapp/', { params })
     },
 
+    // Só o que mudou desde `since` (novas, reações, transcrições, lidas); 304 se nada mudou
+    getMessageChanges(params, etag) {
+        return api.get('/whatsapp/', {
+            params,
+            headers: etag ? { 'If-None-Match': etag } : {},
+            validateStatus: status => status === 200 || status === 304
+        })
+    },
+
     sendMessage(data) {
         // data: { number, text, oportunidade }
         return api.post('/whatsapp/send/', data)
@@ -39,19 +48,25 @@ export const whatsappService = {
         return api.post('/whatsapp/process_pending_media/', { number })
     },
 
-    // Busca uma mensagem completa (com media_base64) pelo ID
+    // Busca uma mensagem pelo ID (media_src: URL de streaming da mídia)
     getMessage(id) {
         return api.get(`/whatsapp/${id}/`)
     },
 
+    // Baixa sob demanda a mídia da mensagem (vídeos e documentos só são baixados assim)
+    loadMedia(messageId) {
+        return api.post('/whatsapp/load_media/', { message_id: messageId })
+    },
+
     // Baixa apenas o áudio (sem transcrever)
     getAudio(messageId) {
         return api.post('/whatsapp/get_audio/', { message_id: messageId })
     },
 
     // Transcreve um áudio específico por ID
-    transcribeAudio(messageId) {
-        return api.post('/whatsapp/transcribe_audio/', { message_id: messageId })
+    // stream=true: responde logo e o texto chega pelo WebSocket (transcricao_parcial)
+    transcribeAudio(messageId, stream = false) {
+        return api.post('/whatsapp/transcribe_audio/', { message_id: messageId, stream })
     },
 
     // ==================== CONEXÃO ====================
@@ -90,7 +105,7 @@ export const whatsappService = {
 
     // Lista conversas do canal (inbox multiatendimento)
     getConversas(params) {
-        // params: { canal_id?, funil_tipo?, search? }
+        // params: { canal_id?, funil_tipo?, search?, page_size?, cursor? }
         return api.get('/atendimento/conversas/', { params })
     },
 
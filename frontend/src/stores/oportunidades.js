@@ -33,10 +33,14 @@ export const useOportunidadesStore = defineStore('oportunidades', () => {
 
       const response = await api.get(endpoint, { params })
 
-      // Padroniza a resposta
+      // Padroniza a resposta: total/valor_total são da coluna inteira,
+      // items só a primeira página (as demais via carregarMaisColuna)
       const data = response.data.map(col => ({
         ...col,
-        items: col.oportunidades || col.items || []
+        items: col.oportunidades || col.items || [],
+        total: col.total ?? (col.oportunidades || col.items || []).length,
+        next: col.next || null,
+        carregando: false
       }))
 
       kanbanData.value = data
@@ -48,6 +52,26 @@ export const useOportunidadesStore = defineStore('oportunidades', () => {
     }
   }
 
+  async function carregarMaisColuna(estagioId) {
+    const coluna = kanbanData.value.find(col => col.estagio.id === estagioId)
+    if (!coluna || !coluna.next || coluna.carregando) return
+
+    coluna.carregando = true
+    try {
+      // O `next` já traz funil, filtros e cursor da coluna
+      const params = Object.fromEntries(new URL(coluna.next, window.location.origin).searchParams)
+      const response = await api.get('/oportunidades/kanban/coluna/', { params })
+      const vistos = new Set(coluna.items.map(item => item.id))
+      coluna.items.push(...response.data.results.filter(item => !vistos.has(item.id)))
+      coluna.next = response.data.next
+    } catch (err) {
+      error.value = err.message
+      console.error('Error loading kanban column:', err)
+    } finally {
+      coluna.carregando = false
+    }
+  }
+
   async function createOportunidade(data) {
     try {
       const response = await api.post('/oportunidades/', data)
@@ -112,6 +136,7 @@ export const useOportunidadesStore = defineStore('oportunidades', () => {
     fetchFunis,
     fetchOportunidades,
     fetchKanban,
+    carregarMaisColuna,
     createOportunidade,
     updateOportunidade,
     mudarEstagio,
@@ -13,15 +13,36 @@ export const useWhatsappStore = defineStore('whatsapp', {
         // Multiatendimento Inbox
         conversas: [],
         conversasLoading: false,
+        conversasCursor: null,   // cursor da próxima página do inbox
+        conversasCarregandoMais: false,
         conversasCooldownUntil: 0,
         canalAtual: null,
         canaisDisponiveis: [],
         funilFiltro: null,   // null | 'VENDAS' | 'SUPORTE' | 'POS_VENDA'
 
-        // WebSocket
+        // WebSocket: uma conexão multiplexada (ws/atendimento/) para todos os canais.
+        // wsConectado: canal do inbox assinado; wsBadgesConectado: canais do menu global assinados
         ws: null,
-        wsConectado: false,
         wsReconnectTimer: null,
+        wsHeartbeatTimer: null,
+        wsUltimoHeartbeat: 0,
+        wsConectado: false,
+        wsBadgesConectado: false,
+        canalInbox: null,        // canal do inbox (canalAtual)
+        canaisBadges: [],        // canais cujos unread_update atualizam o menu global
+        canaisAssinados: {},     // { [canal_id]: true } confirmados pelo servidor
+        unreadRefreshTimer: null,
+
+        // Transcrições progressivas recebidas pelo WebSocket: { [mensagem_id]: evento }
+        transcricoesParciais: {},
+
+        // Chat ao vivo: conversas assinadas no WebSocket ({ [numero]: canal_id | null }),
+        // as confirmadas pelo servidor e o último lote de mensagens de cada uma
+        conversasAssinadas: {},
+        conversasAoVivo: {},
+        mensagensConversa: {},   // { [numero]: { mensagens, recebidoEm } }
+        // Servidor descartou eventos (client lento): quem está aberto recarrega
+        ressincronizadoEm: 0,
     }),
 
     getters: {
@@ -32,6 +53,8 @@ export const useWhatsappStore = defineStore('whatsapp', {
         totalNaoLidas: (state) => {
             return state.conversas.reduce((acc, c) => acc + (c.nao_lidas || 0), 0)
         },
+        // O chat dispensa o polling enquanto a conversa recebe push pelo WebSocket
+        conversaAoVivo: (state) => (numero) => !!state.conversasAoVivo[numero],
     },
 
     actions: {
@@ -60,6 +83,15 @@ export const useWhatsappStore = defineStore('whatsapp', {
             }
         },
 
+        // Contadores mudaram no servidor (evento unread_update): agrupa rajadas em uma requisição
+        agendarUnreadCounts() {
+            if (this.unreadRefreshTimer) clearTimeout(this.unreadRefreshTimer)
+            this.unreadRefreshTimer = setTimeout(() => {
+                this.unreadRefreshTimer = null
+                this.fetchUnreadCounts()
+            }, 1000)
+        },
+
         // ──────────────────────────────
         // Inbox: Conversas & Canais
         // ──────────────────────────────
@@ -80,12 +112,9 @@ export const useWhatsappStore = defineStore('whatsapp', {
             if (this.conversasLoading) return
             this.conversasLoading = true
             try {
-                const params = {}
-                if (this.canalAtual?.id) params.canal_id = this.canalAtual.id
-                if (this.funilFiltro) params.funil_tipo = this.funilFiltro
-
-                const res = await whatsappService.getConversas(params)
+                const res = await whatsappService.getConversas(this._paramsConversas())
                 this.conversas = res.data.conversas || []
+                this.conversasCursor = this._extrairCursor(res.data.next)
                 this.conversasCooldownUntil = 0
                 if (res.data.canal && !this.canalAtual) {
                     this.canalAtual = res.data.canal
@@ -101,6 +130,35 @@ export const useWhatsappStore = defineStore('whatsapp', {
             }
         },
 
+        async fetchMaisConversas() {
+            if (!this.conversasCursor || this.conversasCarregandoMais) return
+            this.conversasCarregandoMais = true
+            try {
+                const params = { ...this._paramsConversas(), cursor: this.conversasCursor }
+                const res = await whatsappService.getConversas(params)
+                const existentes = new Set(this.conversas.map(c => c.numero))
+                const novas = (res.data.conversas || []).filter(c => !existentes.has(c.numero))
+                this.conversas = [...this.conversas, ...novas]
+                this.conversasCursor = this._extrairCursor(res.data.next)
+            } catch (e) {
+                console.error('[Atendimento] Erro ao carregar mais conversas:', e)
+            } finally {
+                this.conversasCarregandoMais = false
+            }
+        },
+
+        _paramsConversas() {
+            const params = {}
+            if (this.canalAtual?.id) params.canal_id = this.canalAtual.id
+            if (this.funilFiltro) params.funil_tipo = this.funilFiltro
+            return params
+        },
+
+        _extrairCursor(nextUrl) {
+            if (!nextUrl) return null
+            return new URL(nextUrl, window.location.origin).searchParams.get('cursor')
+        },
+
         setFunilFiltro(tipo) {
             this.funilFiltro = tipo
             this.fetchConversas()
@@ -112,6 +170,11 @@ export const useWhatsappStore = defineStore('whatsapp', {
             this.conectarWebSocket()
         },
 
+        // Evento transcricao_parcial: texto acumulado do áudio (concluida=true no final)
+        aplicarTranscricaoParcial(data) {
+            this.transcricoesParciais[data.mensagem_id] = data
+        },
+
         // Insere ou atualiza uma conversa recebida via WebSocket
         upsertConversa(payload) {
             const idx = this.conversas.findIndex(c => c.numero === payload.numero)
@@ -136,6 +199,14 @@ export const useWhatsappStore = defineStore('whatsapp', {
             }
         },
 
+        // Aplica o contador autoritativo enviado pelo servidor
+        aplicarNaoLidas(payload) {
+            const idx = this.conversas.findIndex(c => c.numero === payload.numero)
+            if (idx >= 0) {
+                this.conversas.splice(idx, 1, { ...this.conversas[idx], nao_lidas: payload.nao_lidas })
+            }
+        },
+
         marcarConversaLida(numero) {
             const idx = this.conversas.findIndex(c => c.numero === numero)
             if (idx >= 0) {
@@ -148,47 +219,100 @@ export const useWhatsappStore = defineStore('whatsapp', {
         // ──────────────────────────────
         conectarWebSocket() {
             if (!this.canalAtual?.id) return
+            const anterior = this.canalInbox
+            this.canalInbox = this.canalAtual.id
+            if (anterior && anterior !== this.canalInbox) this._cancelarCanal(anterior)
+            this._assinarCanal(this.canalInbox)
+        },
 
-            this.desconectarWebSocket()
+        desconectarWebSocket() {
+            const anterior = this.canalInbox
+            this.canalInbox = null
+            if (anterior) this._cancelarCanal(anterior)
+            this._atualizarStatus()
+        },
 
-            const token = localStorage.getItem('access_token') || sessionStorage.getItem('access_token')
-            if (!token) return
+        // Menu global: recebe unread_update dos canais (o do usuário; Admin, todos)
+        // no lugar do polling de /whatsapp/unread_counts/
+        conectarBadges(canalIds) {
+            const novos = [].concat(canalIds).filter(Boolean)
+            const anteriores = this.canaisBadges
+            this.canaisBadges = novos
+            anteriores.filter(id => !novos.includes(id)).forEach(id => this._cancelarCanal(id))
+            novos.forEach(id => this._assinarCanal(id))
+        },
 
-            const wsBase = (import.meta.env.VITE_API_URL || 'http://localhost:8000')
-                .replace(/^http/, 'ws')
-                .replace(/\/api\/?$/, '')
+        desconectarBadges() {
+            const anteriores = this.canaisBadges
+            this.canaisBadges = []
+            anteriores.forEach(id => this._cancelarCanal(id))
+            this._atualizarStatus()
+        },
 
-            const url = `${wsBase}/ws/atendimento/${this.canalAtual.id}/?token=${token}`
+        _assinarCanal(canalId) {
+            this._abrirSocket()
+            this._enviar({ acao: 'assinar_canal', canal_id: canalId })
+            this._atualizarStatus()
+        },
+
+        // Só cancela se o canal não for mais usado pelo inbox nem pelo menu global
+        _cancelarCanal(canalId) {
+            if (this.canalInbox === canalId || this.canaisBadges.includes(canalId)) return
+            delete this.canaisAssinados[canalId]
+            this._enviar({ acao: 'cancelar_canal', canal_id: canalId })
+            this._fecharSeOcioso()
+        },
+
+        _atualizarStatus() {
+            this.wsConectado = !!(this.canalInbox && this.canaisAssinados[this.canalInbox])
+            this.wsBadgesConectado = this.canaisBadges.length > 0
+                && this.canaisBadges.every(id => this.canaisAssinados[id])
+        },
+
+        _abrirSocket() {
+            if (this.ws) return
+            if (this.wsReconnectTimer) clearTimeout(this.wsReconnectTimer)
+
+            const url = this._wsUrl()
+            if (!url) return
 
             try {
-                this.ws = new WebSocket(url)
+                const ws = new WebSocket(url)
+                this.ws = ws
 
-                this.ws.onopen = () => {
-                    this.wsConectado = true
+                ws.onopen = () => {
+                    // Refaz as assinaturas (primeira conexão ou reconexão)
+                    const canais = new Set([this.canalInbox, ...this.canaisBadges].filter(Boolean))
+                    canais.forEach(id => this._enviar({ acao: 'assinar_canal', canal_id: id }))
+                    this._reassinarConversas()
+                    this._vigiarHeartbeat()
+                    if (this.canaisBadges.length) this.fetchUnreadCounts()
                 }
 
-                this.ws.onmessage = (event) => {
+                ws.onmessage = (event) => {
                     try {
-                        const data = JSON.parse(event.data)
-                        if (data.tipo === 'nova_mensagem' && data.conversa) {
-                            this.upsertConversa(data.conversa)
-                        }
+                        this._eventoWebSocket(JSON.parse(event.data))
                     } catch (e) {
                         console.error('[WS] Erro ao processar mensagem:', e)
                     }
                 }
 
-                this.ws.onclose = (event) => {
-                    this.wsConectado = false
+                ws.onclose = (event) => {
+                    if (this.ws !== ws) return
+                    this.ws = null
+                    if (this.wsHeartbeatTimer) clearInterval(this.wsHeartbeatTimer)
+                    this.canaisAssinados = {}
+                    this.conversasAoVivo = {}
+                    this._atualizarStatus()
                     // Reconecta automaticamente (exceto se foi desconexão intencional ou erro de autenticação)
-                    if (event.code !== 1000 && event.code !== 4001 && event.code !== 4003) {
-                        this.wsReconnectTimer = setTimeout(() => this.conectarWebSocket(), 5000)
-                    } else if (event.code === 4001 || event.code === 4003) {
+                    if (event.code === 4001 || event.code === 4003) {
                         console.error('[WS] Erro de autenticação/permissão. Não reconectando.')
+                    } else if (event.code !== 1000 && !this._ocioso()) {
+                        this.wsReconnectTimer = setTimeout(() => this._abrirSocket(), 5000)
                     }
                 }
 
-                this.ws.onerror = (e) => {
+                ws.onerror = (e) => {
                     console.error('[WS] Erro na conexão:', e)
                 }
             } catch (e) {
@@ -196,13 +320,127 @@ export const useWhatsappStore = defineStore('whatsapp', {
             }
         },
 
-        desconectarWebSocket() {
+        _ocioso() {
+            return !this.canalInbox && !this.canaisBadges.length && !Object.keys(this.conversasAssinadas).length
+        },
+
+        _fecharSeOcioso() {
+            if (!this._ocioso()) return
             if (this.wsReconnectTimer) clearTimeout(this.wsReconnectTimer)
+            if (this.wsHeartbeatTimer) clearInterval(this.wsHeartbeatTimer)
             if (this.ws) {
                 this.ws.close(1000, 'Desconexão intencional')
                 this.ws = null
             }
-            this.wsConectado = false
+            this.canaisAssinados = {}
+            this._atualizarStatus()
+        },
+
+        _enviar(dados) {
+            if (this.ws?.readyState === WebSocket.OPEN) this.ws.send(JSON.stringify(dados))
+        },
+
+        // O servidor manda heartbeat periodicamente; sem nenhum por 60s a conexão
+        // é dada como morta e reaberta
+        _vigiarHeartbeat() {
+            this.wsUltimoHeartbeat = Date.now()
+            if (this.wsHeartbeatTimer) clearInterval(this.wsHeartbeatTimer)
+            this.wsHeartbeatTimer = setInterval(() => {
+                if (this.ws && Date.now() - this.wsUltimoHeartbeat > 60000) {
+                    this.ws.close(4000, 'Sem heartbeat')
+                }
+            }, 10000)
+        },
+
+        _eventoWebSocket(data) {
+            switch (data.tipo) {
+                case 'heartbeat':
+                    this.wsUltimoHeartbeat = Date.now()
+                    this._enviar({ acao: 'pong' })
+                    break
+                case 'canal_assinado':
+                    this.canaisAssinados[data.canal_id] = true
+                    this._atualizarStatus()
+                    break
+                case 'erro':
+                    console.error('[WS] Erro:', data)
+                    break
+                case 'nova_mensagem':
+                    if (data.conversa && data.conversa.canal_id === this.canalInbox) this.upsertConversa(data.conversa)
+                    break
+                case 'unread_update':
+                    if (data.canal_id === this.canalInbox) this.aplicarNaoLidas(data)
+                    this.agendarUnreadCounts()
+                    break
+                case 'transcricao_parcial':
+                    this.aplicarTranscricaoParcial(data)
+                    break
+                case 'ressincronizar':
+                    if (this.canalInbox) this.fetchConversas()
+                    this.agendarUnreadCounts()
+                    this.ressincronizadoEm = Date.now()
+                    break
+                default:
+                    this._eventoConversa(data)
+            }
+        },
+
+        // ──────────────────────────────
+        // Chat ao vivo (assinatura de conversa no WebSocket)
+        // ──────────────────────────────
+        // Sem canalId a conversa é assinada em todos os canais do usuário
+        assinarConversa(numero, canalId = null) {
+            if (!numero) return
+            this.conversasAssinadas[numero] = canalId
+            this._abrirSocket()
+            this._enviar({ acao: 'assinar', numero, canal_id: canalId })
+        },
+
+        cancelarConversa(numero) {
+            if (!numero || !(numero in this.conversasAssinadas)) return
+            delete this.conversasAssinadas[numero]
+            delete this.conversasAoVivo[numero]
+            delete this.mensagensConversa[numero]
+            this._enviar({ acao: 'cancelar', numero })
+            this._fecharSeOcioso()
+        },
+
+        _reassinarConversas() {
+            Object.entries(this.conversasAssinadas).forEach(([numero, canalId]) => {
+                this._enviar({ acao: 'assinar', numero, canal_id: canalId })
+            })
+        },
+
+        // Eventos conversa_assinada / conversa_mensagens (services.chat_ao_vivo)
+        _eventoConversa(data) {
+            if (!(data.numero in this.conversasAssinadas)) return
+            if (data.tipo === 'conversa_assinada') {
+                this.conversasAoVivo[data.numero] = true
+            } else if (data.tipo === 'conversa_mensagens') {
+                this.mensagensConversa[data.numero] = {
+                    mensagens: (data.mensagens || []).map(m => ({ ...m, media_src: this._urlApi(m.media_src) })),
+                    recebidoEm: Date.now(),
+                }
+            }
+        },
+
+        // media_src chega relativo (sem request no servidor): completa com a origem da API
+        _urlApi(caminho) {
+            if (!caminho || !caminho.startsWith('/')) return caminho
+            return this._apiBase() + caminho
+        },
+
+        _apiBase() {
+            return (import.meta.env.VITE_API_URL || 'http://localhost:8000').replace(/\/api\/?$/, '')
+        },
+
+        _wsUrl() {
+            const token = localStorage.getItem('access_token') || sessionStorage.getItem('access_token')
+            if (!token) return null
+
+            const wsBase = this._apiBase().replace(/^http/, 'ws')
+
+            return `${wsBase}/ws/atendimento/?token=${token}`
         },
     },
 })